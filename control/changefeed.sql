@@ -0,0 +1,80 @@
+--
+-- Change sequence for jobs and machines, used by the /jobs/changes and
+-- /machines/changes APIs and for job ETags.
+--
+-- changeseq is the id of the last transaction to change the row or, for
+-- jobs, its parameters, results, result details or log, and for machines,
+-- its machine data. Rows that haven't changed since this was applied have
+-- changeseq 1, which is visible in every snapshot.
+--
+-- Apply once to the master with psql -f changefeed.sql
+--
+
+ALTER TABLE tbljobs ADD COLUMN changeseq bigint NOT NULL DEFAULT 1;
+ALTER TABLE tblmachines ADD COLUMN changeseq bigint NOT NULL DEFAULT 1;
+
+CREATE INDEX tbljobs_idx_changeseq ON tbljobs USING btree (changeseq, jobid);
+CREATE INDEX tblmachines_idx_changeseq ON tblmachines USING btree (changeseq, machine);
+
+CREATE FUNCTION xenrt_set_changeseq() RETURNS trigger AS $$
+BEGIN
+    NEW.changeseq := txid_current();
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tbljobs_changeseq BEFORE INSERT OR UPDATE ON tbljobs
+    FOR EACH ROW EXECUTE PROCEDURE xenrt_set_changeseq();
+CREATE TRIGGER tblmachines_changeseq BEFORE INSERT OR UPDATE ON tblmachines
+    FOR EACH ROW EXECUTE PROCEDURE xenrt_set_changeseq();
+
+-- Touch the parent row, at most once per transaction
+CREATE FUNCTION xenrt_job_child_changed() RETURNS trigger AS $$
+DECLARE
+    r RECORD;
+    j integer;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        r := OLD;
+    ELSE
+        r := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'tbljoblog' THEN
+        j := r.job;
+    ELSIF TG_TABLE_NAME = 'tbldetails' THEN
+        SELECT jobid INTO j FROM tblresults WHERE detailid = r.detailid;
+    ELSE
+        j := r.jobid;
+    END IF;
+    UPDATE tbljobs SET changeseq = txid_current()
+        WHERE jobid = j AND changeseq != txid_current();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tbljobdetails_changeseq AFTER INSERT OR UPDATE OR DELETE ON tbljobdetails
+    FOR EACH ROW EXECUTE PROCEDURE xenrt_job_child_changed();
+CREATE TRIGGER tblresults_changeseq AFTER INSERT OR UPDATE OR DELETE ON tblresults
+    FOR EACH ROW EXECUTE PROCEDURE xenrt_job_child_changed();
+CREATE TRIGGER tbldetails_changeseq AFTER INSERT OR UPDATE OR DELETE ON tbldetails
+    FOR EACH ROW EXECUTE PROCEDURE xenrt_job_child_changed();
+CREATE TRIGGER tbljoblog_changeseq AFTER INSERT OR UPDATE OR DELETE ON tbljoblog
+    FOR EACH ROW EXECUTE PROCEDURE xenrt_job_child_changed();
+
+CREATE FUNCTION xenrt_machine_child_changed() RETURNS trigger AS $$
+DECLARE
+    m character(24);
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        m := OLD.machine;
+    ELSE
+        m := NEW.machine;
+    END IF;
+    UPDATE tblmachines SET changeseq = txid_current()
+        WHERE machine = m AND changeseq != txid_current();
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER tblmachinedata_changeseq AFTER INSERT OR UPDATE OR DELETE ON tblmachinedata
+    FOR EACH ROW EXECUTE PROCEDURE xenrt_machine_child_changed();
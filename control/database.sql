@@ -50,6 +50,78 @@ CREATE AGGREGATE to_array(anyelement) (
 
 ALTER AGGREGATE public.to_array(anyelement) OWNER TO xenrtd;
 
+--
+-- Name: xenrt_job_child_changed(); Type: FUNCTION; Schema: public; Owner: xenrtd
+--
+
+CREATE FUNCTION xenrt_job_child_changed() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    r RECORD;
+    j integer;
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        r := OLD;
+    ELSE
+        r := NEW;
+    END IF;
+    IF TG_TABLE_NAME = 'tbljoblog' THEN
+        j := r.job;
+    ELSIF TG_TABLE_NAME = 'tbldetails' THEN
+        SELECT jobid INTO j FROM tblresults WHERE detailid = r.detailid;
+    ELSE
+        j := r.jobid;
+    END IF;
+    UPDATE tbljobs SET changeseq = txid_current()
+        WHERE jobid = j AND changeseq != txid_current();
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.xenrt_job_child_changed() OWNER TO xenrtd;
+
+--
+-- Name: xenrt_machine_child_changed(); Type: FUNCTION; Schema: public; Owner: xenrtd
+--
+
+CREATE FUNCTION xenrt_machine_child_changed() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+DECLARE
+    m character(24);
+BEGIN
+    IF TG_OP = 'DELETE' THEN
+        m := OLD.machine;
+    ELSE
+        m := NEW.machine;
+    END IF;
+    UPDATE tblmachines SET changeseq = txid_current()
+        WHERE machine = m AND changeseq != txid_current();
+    RETURN NULL;
+END;
+$$;
+
+
+ALTER FUNCTION public.xenrt_machine_child_changed() OWNER TO xenrtd;
+
+--
+-- Name: xenrt_set_changeseq(); Type: FUNCTION; Schema: public; Owner: xenrtd
+--
+
+CREATE FUNCTION xenrt_set_changeseq() RETURNS trigger
+    LANGUAGE plpgsql
+    AS $$
+BEGIN
+    NEW.changeseq := txid_current();
+    RETURN NEW;
+END;
+$$;
+
+
+ALTER FUNCTION public.xenrt_set_changeseq() OWNER TO xenrtd;
+
 --
 -- Name: jobid_seq; Type: SEQUENCE; Schema: public; Owner: xenrtd
 --
@@ -222,7 +294,8 @@ CREATE TABLE tbljobs (
     userid character(12),
     machine character(24),
     uploaded character(8),
-    removed character(8)
+    removed character(8),
+    changeseq bigint DEFAULT 1 NOT NULL
 );
 
 
@@ -259,7 +332,8 @@ CREATE TABLE tblmachines (
     jobid integer,
     leasereason character(128),
     leasefrom timestamp without time zone,
-    leasepolicy integer
+    leasepolicy integer,
+    changeseq bigint DEFAULT 1 NOT NULL
 );
 
 
@@ -670,6 +744,13 @@ CREATE INDEX tbljobdetails_index_jobid ON tbljobdetails USING btree (jobid);
 CREATE INDEX tbljobdetails_index_param ON tbljobdetails USING btree (param);
 
 
+--
+-- Name: tbljobs_idx_changeseq; Type: INDEX; Schema: public; Owner: xenrtd; Tablespace: 
+--
+
+CREATE INDEX tbljobs_idx_changeseq ON tbljobs USING btree (changeseq, jobid);
+
+
 --
 -- Name: tbljobs_idx_jobstatus; Type: INDEX; Schema: public; Owner: xenrtd; Tablespace: 
 --
@@ -740,6 +821,13 @@ CREATE INDEX tbljobs_index_version ON tbljobs USING btree (version);
 CREATE INDEX tblmachine_site ON tblmachines USING btree (site);
 
 
+--
+-- Name: tblmachines_idx_changeseq; Type: INDEX; Schema: public; Owner: xenrtd; Tablespace: 
+--
+
+CREATE INDEX tblmachines_idx_changeseq ON tblmachines USING btree (changeseq, machine);
+
+
 --
 -- Name: tblmachines_leaseto; Type: INDEX; Schema: public; Owner: xenrtd; Tablespace: 
 --
@@ -768,6 +856,48 @@ CREATE INDEX tblresults_index_jobid ON tblresults USING btree (jobid);
 CREATE INDEX tblresults_index_test ON tblresults USING btree (test);
 
 
+--
+-- Name: tbldetails_changeseq; Type: TRIGGER; Schema: public; Owner: xenrtd
+--
+
+CREATE TRIGGER tbldetails_changeseq AFTER INSERT OR DELETE OR UPDATE ON tbldetails FOR EACH ROW EXECUTE PROCEDURE xenrt_job_child_changed();
+
+
+--
+-- Name: tbljobdetails_changeseq; Type: TRIGGER; Schema: public; Owner: xenrtd
+--
+
+CREATE TRIGGER tbljobdetails_changeseq AFTER INSERT OR DELETE OR UPDATE ON tbljobdetails FOR EACH ROW EXECUTE PROCEDURE xenrt_job_child_changed();
+
+
+--
+-- Name: tbljobs_changeseq; Type: TRIGGER; Schema: public; Owner: xenrtd
+--
+
+CREATE TRIGGER tbljobs_changeseq BEFORE INSERT OR UPDATE ON tbljobs FOR EACH ROW EXECUTE PROCEDURE xenrt_set_changeseq();
+
+
+--
+-- Name: tblmachinedata_changeseq; Type: TRIGGER; Schema: public; Owner: xenrtd
+--
+
+CREATE TRIGGER tblmachinedata_changeseq AFTER INSERT OR DELETE OR UPDATE ON tblmachinedata FOR EACH ROW EXECUTE PROCEDURE xenrt_machine_child_changed();
+
+
+--
+-- Name: tblmachines_changeseq; Type: TRIGGER; Schema: public; Owner: xenrtd
+--
+
+CREATE TRIGGER tblmachines_changeseq BEFORE INSERT OR UPDATE ON tblmachines FOR EACH ROW EXECUTE PROCEDURE xenrt_set_changeseq();
+
+
+--
+-- Name: tblresults_changeseq; Type: TRIGGER; Schema: public; Owner: xenrtd
+--
+
+CREATE TRIGGER tblresults_changeseq AFTER INSERT OR DELETE OR UPDATE ON tblresults FOR EACH ROW EXECUTE PROCEDURE xenrt_job_child_changed();
+
+
 --
 -- Name: public; Type: ACL; Schema: -; Owner: postgres
 --
@@ -0,0 +1,93 @@
+#!/usr/bin/python
+#
+# Start-up time of the harness: runs "import xenrt" and some short-lived
+# main.py modes a number of times each, and reports the wall time and the
+# number of modules each one loaded, so that a change which makes them
+# import (or do) much more at start-up is noticed.
+#
+# Usage: importbench.py [options] [main.py arguments]
+#
+# Without arguments the modes below are measured, otherwise just main.py
+# with the given arguments. Run it on a controller, as main.py reads the
+# site config and, for some modes, talks to the database. With --budget the
+# exit status is 1 if the median time of any mode is over budget.
+
+import sys, os, os.path, optparse, subprocess, tempfile, time
+
+MAIN = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+
+MODES = [("import", None),
+         ("lookup", ["--lookup", "XENRT_BASE"]),
+         ("dump-config", ["--dump-config"]),
+         ("list-locks", ["--list-locks"]),
+         ("replay-db", ["--replay-db"])]
+
+# Runs main.py (or just imports xenrt) and writes the number of modules
+# loaded to the file given as the first argument when the process exits
+BOOTSTRAP = """
+import sys, os, atexit
+out = sys.argv.pop(1)
+def report():
+    f = open(out, "w")
+    f.write("%d\\n" % len([m for m in sys.modules.values() if m]))
+    f.close()
+atexit.register(report)
+sys.argv = sys.argv[1:]
+if sys.argv[0] == "import":
+    sys.path.insert(0, EXECDIR)
+    sys.path.append("%s/lib" % (os.path.dirname(EXECDIR)))
+    import xenrt
+else:
+    execfile(sys.argv[0], {"__name__": "__main__", "__file__": sys.argv[0]})
+"""
+
+def runOnce(args):
+    (fd, out) = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        code = BOOTSTRAP.replace("EXECDIR", repr(os.path.dirname(MAIN)))
+        if args is None:
+            argv = ["import"]
+        else:
+            argv = [MAIN] + args
+        start = time.time()
+        devnull = open(os.devnull, "w")
+        try:
+            rc = subprocess.call([sys.executable, "-c", code, out] + argv,
+                                 stdout=devnull, stderr=devnull)
+        finally:
+            devnull.close()
+        elapsed = time.time() - start
+        modules = open(out).read().strip()
+        return (elapsed, modules and int(modules) or None, rc)
+    finally:
+        os.unlink(out)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] [main.py arguments]")
+    parser.add_option("--repeat", dest="repeat", type="int", default=5)
+    parser.add_option("--sequence", dest="sequence",
+                      help="also time validating this sequence file with --dump-sequence")
+    parser.add_option("--budget", dest="budget", type="float",
+                      help="seconds any mode may take")
+    parser.disable_interspersed_args()
+    (options, args) = parser.parse_args()
+
+    if args:
+        modes = [(" ".join(args), args)]
+    else:
+        modes = list(MODES)
+        if options.sequence:
+            modes.append(("dump-sequence", ["-s", options.sequence, "--dump-sequence"]))
+
+    over = False
+    print "%-16s %8s %8s %8s %4s" % ("mode", "min", "median", "modules", "rc")
+    for (name, args) in modes:
+        runs = [runOnce(args) for i in range(options.repeat)]
+        times = sorted([r[0] for r in runs])
+        median = times[len(times) / 2]
+        print "%-16s %7.2fs %7.2fs %8s %4d" % (name, times[0], median, runs[-1][1], runs[-1][2])
+        if options.budget and median > options.budget:
+            over = True
+    if over:
+        sys.exit(1)
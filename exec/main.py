@@ -29,13 +29,8 @@ for p in possible_paths:
     if os.path.exists(p):
         sys.path.append(p)
 
-import xenrt, xenrt.lib.cloud, xenrt.lib.xenserver, xenrt.lib.oss, xenrt.lib.xl, xenrt.lib.generic, xenrt.lib.opsys, xenrt.lib.hyperv, xenrt.lib.oraclevm, xenrt.lib.nativewindows
-try:
-    import xenrt.lib.libvirt
-    import xenrt.lib.kvm
-    import xenrt.lib.esx
-except Exception, e:
-    sys.stderr.write("WARNING: Could not import libvirt classes: %s\n" % (e))
+# The product libraries (xenrt.lib.xenserver etc.) are imported on first use
+import xenrt
 import localxenrt
 
 #############################################################################
@@ -153,6 +148,9 @@ def usage(fd):
     --replay-db                           Replays failed database uploads
     --cleanup-filecache                   Cleanup the shared file cache
     --remove-filecache <file>             Remove a file from the cache
+    --filecache-stats                     Show the size and hit, miss and
+                                          eviction counts of the shared
+                                          file cache
     --list-locks                          List all known shared resources and
                                           locking statuses
     --cleanup-locks                       Remove any left over locks from
@@ -227,6 +225,7 @@ noplace = False
 replaydb = False
 cleanupfilecache = False
 removefilecache = None
+filecachestats = False
 docgen = False
 lookupvar = None
 listlocks = False
@@ -347,6 +346,7 @@ try:
                                       'devrun',
                                       'cleanup-filecache',
                                       'remove-filecache=',
+                                      'filecache-stats',
                                       'generate-docs',
                                       'lookup=',
                                       'inputs=',
@@ -671,6 +671,9 @@ try:
             removefilecache = value
             verbose=True
             aux = True
+        elif flag == "--filecache-stats":
+            filecachestats = True
+            aux = True
         elif flag == "--generate-docs":
             docgen = True
             aux = True
@@ -931,6 +934,7 @@ for sv in setvars:
     var, value = sv
     config.setVariable(var, value)
 config.setSecondaryVariables()
+config.freeze()
 
 gec = xenrt.GlobalExecutionContext(config=config)
 
@@ -1253,6 +1257,11 @@ def exitcb():
         gec.dbconnect.jobUpdate("FINISHED",
                                 time.asctime(time.gmtime()) + " UTC")
         gec.dbconnect.jobComplete()
+    gec.dbconnect.close()
+    try:
+        gec.filemanager.releaseViews()
+    except Exception, e:
+        print str(e)
 
 
 atexit.register(exitcb)
@@ -1677,6 +1686,13 @@ if removefilecache:
     fm = xenrt.filemanager.getFileManager()
     fm.removeFromCache(removefilecache)
 
+if filecachestats:
+    fm = xenrt.filemanager.getFileManager()
+    for (cachedir, summary) in fm.getCacheSummary().items():
+        print "%s:" % (cachedir)
+        for k in sorted(summary.keys()):
+            print "    %-16s %s" % (k, summary[k])
+
 
 if docgen:
     done = False
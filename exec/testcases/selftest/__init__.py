@@ -8,8 +8,8 @@
 # conditions as licensed by Citrix Systems, Inc. All other rights reserved.
 #
 
-import sys, re, string, os.path, urllib, traceback, time, xml.dom.minidom, uuid
-import xenrt, xenrt.lib.xenserver
+import sys, re, string, os.path, urllib, traceback, time, xml.dom.minidom, uuid, random, threading, glob
+import xenrt, xenrt.lib.xenserver, xenrt.triage
 
 class TCNICCheck(xenrt.TestCase):
     """Check each physical NIC received the expected DHCP address."""
@@ -397,3 +397,384 @@ class TCMachineCheck(xenrt.TestCase):
             lock.release()
 
 
+
+class TCSSHTransportPool(xenrt.TestCase):
+    """Benchmark SSH command latency with and without the transport pool"""
+
+    def run(self, arglist):
+        args = self.parseArgsKeyValue(arglist)
+        iterations = int(args.get("iterations", "200"))
+        host = self.getDefaultHost()
+
+        for pooled in (False, True):
+            xenrt.ssh.closePooledTransports(host.getIP())
+            start = time.time()
+            for i in range(iterations):
+                xenrt.ssh.SSH(host.getIP(),
+                              "true",
+                              password=host.password,
+                              level=xenrt.RC_FAIL,
+                              nolog=True,
+                              pooled=pooled)
+            elapsed = time.time() - start
+            name = pooled and "Pooled" or "Unpooled"
+            self.tec.value("%sTotal" % (name), elapsed, "s")
+            self.tec.value("%sPerCommand" % (name),
+                           elapsed * 1000.0 / iterations,
+                           "ms")
+
+        for (target, stats) in xenrt.ssh.getTransportPoolStats().items():
+            xenrt.TEC().logverbose("SSH transport pool %s: %s" %
+                                   (target, str(stats)))
+
+class TCSFTPTreeCopy(xenrt.TestCase):
+    """Benchmark SFTP tree copies against an SSH server, by default the
+    local one. Times copying a generated tree of small log files to the
+    server and back with different numbers of SFTP channels, and the
+    previous file at a time implementation."""
+
+    def _legacyCopy(self, sftp, source, dest):
+        # One listdir per entry to find directories, then stat and get each
+        # file
+        if not os.path.exists(dest):
+            os.makedirs(dest)
+        for i in sftp.client.listdir(source):
+            try:
+                sftp.client.listdir("%s/%s" % (source, i))
+                isdir = True
+            except:
+                isdir = False
+            if isdir:
+                self._legacyCopy(sftp, "%s/%s" % (source, i), "%s/%s" % (dest, i))
+            else:
+                sftp.client.stat("%s/%s" % (source, i))
+                sftp.client.get("%s/%s" % (source, i), "%s/%s" % (dest, i))
+
+    def run(self, arglist):
+        args = self.parseArgsKeyValue(arglist)
+        target = args.get("target", "127.0.0.1")
+        password = args.get("password")
+        dirs = int(args.get("dirs", "20"))
+        files = int(args.get("files", "50"))
+        size = int(args.get("size", "4096"))
+
+        source = xenrt.TEC().tempDir()
+        for d in range(dirs):
+            os.makedirs("%s/d%d" % (source, d))
+            for f in range(files):
+                fh = open("%s/d%d/f%d.log" % (source, d, f), "w")
+                fh.write(os.urandom(size))
+                fh.close()
+
+        remote = string.strip(xenrt.ssh.SSH(target, "mktemp -d", password=password,
+                                            retval="string", level=xenrt.RC_FAIL))
+        sftp = xenrt.ssh.SFTPSession(target, password=password, level=xenrt.RC_FAIL)
+        try:
+            for workers in [int(w) for w in args.get("workers", "1,4,8").split(",")]:
+                xenrt.TEC().config.setVariable("SFTP_TREE_WORKERS", str(workers))
+                start = time.time()
+                sftp.copyTreeTo(source, "%s/w%d" % (remote, workers))
+                self.tec.value("CopyTreeTo%d" % (workers), time.time() - start, "s")
+                dest = xenrt.TEC().tempDir()
+                start = time.time()
+                sftp.copyTreeFrom("%s/w%d" % (remote, workers), dest)
+                self.tec.value("CopyTreeFrom%d" % (workers), time.time() - start, "s")
+                if xenrt.command("diff -r %s %s" % (source, dest), retval="code", level=xenrt.RC_OK) != 0:
+                    raise xenrt.XRTFailure("Tree copied with %d workers differs" % (workers))
+
+            dest = xenrt.TEC().tempDir()
+            start = time.time()
+            self._legacyCopy(sftp, "%s/w%d" % (remote, workers), dest)
+            self.tec.value("CopyTreeFromLegacy", time.time() - start, "s")
+        finally:
+            sftp.close()
+            xenrt.ssh.SSH(target, "rm -rf %s" % (remote), password=password,
+                          level=xenrt.RC_OK)
+
+class TCXenAPICLIEngine(xenrt.TestCase):
+    """Benchmark the XenAPI CLI engine against the xe binary.
+
+    With fake=yes the engine runs against a local fake XenAPI server and the
+    baseline is one login per command (which is what each xe invocation
+    does, less the cost of the fork). Otherwise both engines are run
+    against the default host and their outputs are checked to be identical.
+    """
+
+    def _workload(self, vms):
+        commands = [("vm-list", "", True),
+                    ("vm-list", "power-state=running", True),
+                    ("host-list", "params=address", True)]
+        for vm in vms:
+            commands.append(("vm-param-get",
+                             "uuid=%s param-name=power-state" % (vm), False))
+            commands.append(("vm-param-get",
+                             "uuid=%s param-name=resident-on" % (vm), False))
+            commands.append(("vm-list", "uuid=%s params=name-label" % (vm),
+                             True))
+        return commands
+
+    def _timeEngine(self, newEngine, commands, iterations, perCommand=False):
+        engine = newEngine()
+        start = time.time()
+        for i in range(iterations):
+            for (command, args, minimal) in commands:
+                if engine.execute(command, args, minimal=minimal) == None:
+                    raise xenrt.XRTError("Command %s %s was not translated" %
+                                         (command, args))
+                if perCommand:
+                    engine.close()
+        return (time.time() - start) / (iterations * len(commands))
+
+    def runFake(self, vms, iterations):
+        from testcases.selftest.fakexapi import FakeXenAPIServer, FakeXenAPIHost
+        server = FakeXenAPIServer(vms=vms)
+        server.start()
+        try:
+            host = FakeXenAPIHost(server)
+            engine = xenrt.lib.xenserver.xapicli.XenAPICLIEngine(host)
+            uuids = engine.execute("vm-list", "", minimal=True).split(",")[:10]
+            commands = self._workload(uuids)
+            persistent = self._timeEngine(lambda: engine, commands, iterations)
+            perCall = self._timeEngine(\
+                lambda: xenrt.lib.xenserver.xapicli.XenAPICLIEngine(host),
+                commands, iterations, perCommand=True)
+        finally:
+            server.stop()
+        self.tec.value("PersistentSessionPerCommand", persistent * 1000.0, "ms")
+        self.tec.value("LoginPerCommand", perCall * 1000.0, "ms")
+
+    def runHost(self, iterations):
+        host = self.getDefaultHost()
+        cli = host.getCLIInstance()
+        engine = xenrt.lib.xenserver.xapicli.XenAPICLIEngine(host)
+        commands = self._workload(host.minimalList("vm-list")[:10])
+
+        xeTime = 0.0
+        apiTime = 0.0
+        for i in range(iterations):
+            for (command, args, minimal) in commands:
+                c = xenrt.lib.xenserver.cli.buildCommandLine(host,
+                                                             command,
+                                                             args=args,
+                                                             minimal=minimal)
+                start = time.time()
+                xeReply = xenrt.command("%s %s" % (cli.xePath(), c),
+                                        strip=True, nolog=True)
+                xeTime += time.time() - start
+                start = time.time()
+                apiReply = engine.execute(command, args, minimal=minimal)
+                apiTime += time.time() - start
+                if apiReply == None:
+                    raise xenrt.XRTError("Command %s %s was not translated" %
+                                         (command, args))
+                if apiReply.strip() != xeReply:
+                    raise xenrt.XRTFailure("XenAPI engine output differs from "
+                                           "xe for %s %s" % (command, args),
+                                           "xe: '%s' XenAPI: '%s'" %
+                                           (xeReply, apiReply))
+        engine.close()
+        count = iterations * len(commands)
+        self.tec.value("XePerCommand", xeTime * 1000.0 / count, "ms")
+        self.tec.value("XenAPIPerCommand", apiTime * 1000.0 / count, "ms")
+
+    def run(self, arglist):
+        args = self.parseArgsKeyValue(arglist)
+        iterations = int(args.get("iterations", "20"))
+        if args.get("fake") == "yes":
+            self.runFake(int(args.get("vms", "200")), iterations)
+        else:
+            self.runHost(iterations)
+
+class TCLogTriage(xenrt.TestCase):
+    """Benchmark failure triage over a generated log directory.
+
+    Compares the single pass triage engine with running pcregrep once for
+    each pattern and file (the previous implementation), if pcregrep is
+    installed, and checks the two find the same snippets.
+    """
+
+    def _writeLog(self, fn, size, rand, blocks):
+        filler = ["[%10.6f] usb 1-1: new high-speed USB device number %d" %
+                  (i * 0.37, i) for i in range(200)] + \
+                 ["[INFO] Step complete", "", "xapi: [debug|host|D:abc] ok"]
+        f = open(fn, "w")
+        written = 0
+        while written < size:
+            if rand.random() < 0.0005:
+                stamp = "[%10.6f] " % (written / 1000.0)
+                text = "".join([stamp + l + "\n" for l in rand.choice(blocks)])
+            else:
+                text = rand.choice(filler) + "\n"
+            f.write(text)
+            written += len(text)
+        f.close()
+
+    def run(self, arglist):
+        args = self.parseArgsKeyValue(arglist)
+        hosts = int(args.get("hosts", "8"))
+        size = int(args.get("size", "20")) * 1024 * 1024
+        rand = random.Random(1)
+        blocks = [["------------[ cut here ]------------",
+                   "WARNING: at drivers/foo.c:12",
+                   "Call Trace:",
+                   " [<ffffffff>] bar+0x10",
+                   "---[ end trace 1234 ]---"],
+                  ["kernel BUG at mm/slab.c:100!",
+                   "invalid opcode: 0000"],
+                  ["INFO: task xapi:123 blocked for more than 120 seconds."],
+                  ["Out of memory: Kill process 123 (qemu) score 900"]]
+        logdir = xenrt.TEC().tempDir()
+        for i in range(hosts):
+            self._writeLog("%s/host-serial-log-h%d" % (logdir, i), size, rand,
+                           blocks)
+            self._writeLog("%s/console.h%d.log" % (logdir, i), size / 10,
+                           rand, blocks)
+        self._writeLog("%s/xenrt.log" % (logdir), size, rand, blocks)
+
+        triage = xenrt.triage.LogTriage()
+        start = time.time()
+        desc = triage.run(logdir)
+        elapsed = time.time() - start
+        xenrt.TEC().logverbose("Triage stats: %s" % (str(triage.stats)))
+        self.tec.value("SinglePass", elapsed, "s")
+        self.tec.value("BytesRead", triage.stats["bytes"])
+
+        if xenrt.command("which pcregrep", level=xenrt.RC_OK) != 0:
+            xenrt.TEC().comment("pcregrep not installed, not comparing")
+            return
+        start = time.time()
+        old = "\n"
+        for fp in xenrt.triage.FAILURE_PATTERNS:
+            for fn in glob.glob("%s/%s" % (logdir, fp['file'])):
+                text = str(xenrt.command("pcregrep -M '%s' %s" %
+                                         (fp['pattern'], fn),
+                                         level=xenrt.RC_OK)).strip()
+                if text != "1":
+                    kw = {}
+                    if fp.has_key('startPoint'):
+                        kw = {"startPoint": fp['startPoint'],
+                              "endPoint": fp['endPoint']}
+                    old += xenrt.triage.formatSnippet(text, fn, fp['desc'], **kw)
+                old += "\n"
+        self.tec.value("PcregrepPerPattern", time.time() - start, "s")
+        if old != desc:
+            raise xenrt.XRTFailure("Triage output differs from pcregrep")
+
+class TCVMEventWatcher(xenrt.TestCase):
+    """Compare the latency of detecting VM power state changes with the
+    shared event watcher against polling, using a local fake XenAPI server.
+    A number of guests each change state after a random delay while one
+    waiter thread per guest waits for the change."""
+
+    def _transitions(self, server, refs, maxdelay):
+        starts = {}
+        def change(ref, delay):
+            time.sleep(delay)
+            starts[ref] = time.time()
+            server.setVMPowerState(ref, "Running", 100)
+        threads = []
+        for ref in refs:
+            t = threading.Thread(target=change,
+                                 args=(ref, random.uniform(0, maxdelay)))
+            t.setDaemon(True)
+            threads.append(t)
+        return (starts, threads)
+
+    def _measure(self, server, refs, maxdelay, waiter):
+        (starts, threads) = self._transitions(server, refs, maxdelay)
+        detected = {}
+        def wait(ref):
+            waiter(ref)
+            detected[ref] = time.time()
+        waiters = [threading.Thread(target=wait, args=(ref,)) for ref in refs]
+        for t in waiters + threads:
+            t.start()
+        for t in waiters + threads:
+            t.join()
+        latencies = [detected[r] - starts[r] for r in refs]
+        return sum(latencies) / len(latencies)
+
+    def run(self, arglist):
+        from testcases.selftest.fakexapi import FakeXenAPIServer, FakeXenAPIHost
+        args = self.parseArgsKeyValue(arglist)
+        guests = int(args.get("guests", "20"))
+        pollperiod = float(args.get("pollperiod", "2"))
+        maxdelay = float(args.get("maxdelay", "5"))
+
+        server = FakeXenAPIServer(vms=guests * 2)
+        server.start()
+        try:
+            host = FakeXenAPIHost(server)
+            session = host.getAPISession()
+            records = session.xenapi.VM.get_all_records()
+            halted = [r for r in records.keys()
+                      if records[r]["power_state"] == "Halted"]
+            uuids = dict([(r, records[r]["uuid"]) for r in halted])
+
+            watcher = xenrt.lib.xenserver.events.VMEventWatcher(host)
+            watcher.start()
+            def eventWait(ref):
+                if not watcher.waitFor(uuids[ref],
+                                       lambda r: r["power_state"] == "Running",
+                                       maxdelay + 60):
+                    raise xenrt.XRTFailure("Timed out waiting for event")
+            eventLatency = self._measure(server, halted[:guests], maxdelay,
+                                         eventWait)
+            stats = watcher.getStats()
+            watcher.stop()
+
+            polls = [0]
+            def pollWait(ref):
+                s = host.getAPISession()
+                while s.xenapi.VM.get_power_state(ref) != "Running":
+                    polls[0] += 1
+                    time.sleep(pollperiod)
+            pollLatency = self._measure(server, halted[guests:], maxdelay,
+                                        pollWait)
+        finally:
+            server.stop()
+        xenrt.TEC().logverbose("Watcher stats: %s" % (str(stats)))
+        self.tec.value("EventLatency", eventLatency * 1000.0, "ms")
+        self.tec.value("PollLatency", pollLatency * 1000.0, "ms")
+        self.tec.value("EventAPICalls", stats["batches"] + stats["queries"])
+        self.tec.value("PollAPICalls", polls[0] + guests)
+
+class TCConfigLookup(xenrt.TestCase):
+    """Benchmark Config.lookup of every string variable in the global config,
+    with and without the compiled snapshot, and check the results match."""
+
+    def _paths(self, d, prefix=[]):
+        for k in d.keys():
+            if type(d[k]) == type("") and type(k) == type(""):
+                yield prefix + [k]
+            elif type(d[k]) == type({}):
+                for p in self._paths(d[k], prefix + [k]):
+                    yield p
+
+    def _time(self, config, vars, rounds):
+        start = time.time()
+        for i in range(rounds):
+            for v in vars:
+                config.lookup(v, None)
+        return time.time() - start
+
+    def run(self, arglist):
+        args = self.parseArgsKeyValue(arglist)
+        rounds = int(args.get("rounds", "20"))
+        plain = xenrt.Config()
+        plain.config = xenrt.GEC().config.config
+        frozen = xenrt.Config()
+        frozen.config = plain.config
+        frozen.freeze()
+        vars = [":".join(p) for p in self._paths(plain.config)]
+        xenrt.TEC().logverbose("Looking up %d variables %d times" %
+                               (len(vars), rounds))
+
+        for v in vars:
+            if plain.lookup(v, None) != frozen.lookup(v, None):
+                raise xenrt.XRTFailure("Compiled lookup of %s differs" % (v))
+        lookups = len(vars) * rounds
+        plainTime = self._time(plain, vars, rounds)
+        frozenTime = self._time(frozen, vars, rounds)
+        self.tec.value("PlainLookupsPerSecond", lookups / plainTime)
+        self.tec.value("CompiledLookupsPerSecond", lookups / frozenTime)
@@ -0,0 +1,231 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# Local fake XenAPI server for harness benchmarks
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import threading, time, uuid, SocketServer, SimpleXMLRPCServer
+import XenAPI
+
+class _QuietHandler(SimpleXMLRPCServer.SimpleXMLRPCRequestHandler):
+    def log_message(self, *args):
+        pass
+
+class _ThreadingServer(SocketServer.ThreadingMixIn,
+                       SimpleXMLRPCServer.SimpleXMLRPCServer):
+    daemon_threads = True
+
+class FakeXenAPIServer(object):
+    """An in-process XML-RPC server answering the subset of the XenAPI used
+    by the harness read paths (get_all_records, get_by_uuid, get_<field>,
+    get_uuid, event.from, event.inject) over a synthetic database of hosts,
+    SRs and VMs."""
+
+    def __init__(self, vms=100, hosts=1):
+        self.db = {"host": {}, "SR": {}, "VM": {}, "VBD": {}, "VDI": {},
+                   "VIF": {}, "network": {}, "PIF": {}, "PBD": {}, "pool": {}}
+        self.lock = threading.Condition()
+        # Event log of (generation, class, operation, ref)
+        self.generation = 0
+        self.events = []
+        hostRefs = [self.add("host", {"name_label": "host%d" % (i),
+                                      "name_description": "",
+                                      "address": "10.0.0.%d" % (i + 1),
+                                      "hostname": "host%d" % (i),
+                                      "enabled": True,
+                                      "edition": "free",
+                                      "API_version_major": "2",
+                                      "API_version_minor": "4",
+                                      "other_config": {},
+                                      "software_version": {},
+                                      "tags": []})
+                    for i in range(hosts)]
+        sr = self.add("SR", {"name_label": "Local storage",
+                             "name_description": "",
+                             "type": "lvm",
+                             "content_type": "user",
+                             "shared": False,
+                             "physical_size": "107374182400",
+                             "physical_utilisation": "0",
+                             "virtual_allocation": "0",
+                             "other_config": {},
+                             "sm_config": {},
+                             "tags": []})
+        self.add("pool", {"name_label": "",
+                          "name_description": "",
+                          "master": hostRefs[0],
+                          "default_SR": sr,
+                          "ha_enabled": False,
+                          "other_config": {},
+                          "tags": []})
+        for i in range(vms):
+            self.add("VM", {"name_label": "vm%d" % (i),
+                            "name_description": "",
+                            "power_state": i % 2 and "Running" or "Halted",
+                            "is_a_template": False,
+                            "is_a_snapshot": False,
+                            "is_control_domain": False,
+                            "resident_on": i % 2 and hostRefs[i % hosts]
+                                           or "OpaqueRef:NULL",
+                            "affinity": "OpaqueRef:NULL",
+                            "snapshot_of": "OpaqueRef:NULL",
+                            "parent": "OpaqueRef:NULL",
+                            "domid": i % 2 and str(i) or "-1",
+                            "user_version": "1",
+                            "memory_static_max": "1073741824",
+                            "memory_static_min": "1073741824",
+                            "memory_dynamic_max": "1073741824",
+                            "memory_dynamic_min": "1073741824",
+                            "VCPUs_max": "1",
+                            "VCPUs_at_startup": "1",
+                            "HVM_boot_policy": "",
+                            "PV_bootloader": "pygrub",
+                            "PV_args": "",
+                            "ha_restart_priority": "",
+                            "other_config": {"xenrt": "vm%d" % (i)},
+                            "platform": {},
+                            "xenstore_data": {},
+                            "blocked_operations": {},
+                            "allowed_operations": [],
+                            "current_operations": {},
+                            "tags": []})
+        self.server = _ThreadingServer(\
+            ("127.0.0.1", 0), requestHandler=_QuietHandler, allow_none=True,
+            logRequests=False)
+        self.server.register_instance(self)
+        self.thread = None
+
+    def add(self, cls, record):
+        ref = "OpaqueRef:%s" % (uuid.uuid4())
+        record = dict(record)
+        record["uuid"] = str(uuid.uuid4())
+        self.db[cls][ref] = record
+        return ref
+
+    def _event(self, cls, op, ref):
+        """Record an event. Must be called with self.lock held."""
+        self.generation += 1
+        self.events.append((self.generation, cls, op, ref))
+        self.lock.notifyAll()
+
+    def setVMPowerState(self, ref, state, domid):
+        """Change a VM's power state and domid as a lifecycle operation
+        would, generating an event"""
+        self.lock.acquire()
+        try:
+            self.db["VM"][ref]["power_state"] = state
+            self.db["VM"][ref]["domid"] = str(domid)
+            self._event("VM", "mod", ref)
+        finally:
+            self.lock.release()
+
+    def _token(self):
+        return "%020d" % (self.generation)
+
+    def _eventFrom(self, classes, token, timeout):
+        classes = [c.lower() for c in classes]
+        if not token:
+            events = []
+            for cls in self.db.keys():
+                if cls.lower() in classes:
+                    for (ref, r) in self.db[cls].items():
+                        events.append({"class": cls.lower(), "operation": "add",
+                                       "ref": ref, "snapshot": r})
+            return self._success({"events": events, "token": self._token(),
+                                  "valid_ref_counts": {}})
+        since = int(token)
+        deadline = time.time() + timeout
+        while True:
+            events = [{"class": cls.lower(), "operation": op, "ref": ref,
+                       "snapshot": self.db[cls].get(ref, {})}
+                      for (gen, cls, op, ref) in self.events
+                      if gen > since and cls.lower() in classes]
+            remaining = deadline - time.time()
+            if events or remaining <= 0:
+                return self._success({"events": events, "token": self._token(),
+                                      "valid_ref_counts": {}})
+            self.lock.wait(remaining)
+
+    def url(self):
+        return "http://127.0.0.1:%d" % (self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _success(self, value):
+        return {"Status": "Success", "Value": value}
+
+    def _failure(self, details):
+        return {"Status": "Failure", "ErrorDescription": details}
+
+    def _dispatch(self, method, params):
+        self.lock.acquire()
+        try:
+            if method == "session.login_with_password":
+                return self._success("OpaqueRef:%s" % (uuid.uuid4()))
+            if method == "session.logout":
+                return self._success("")
+            if not "." in method:
+                return self._failure(["MESSAGE_METHOD_UNKNOWN", method])
+            (cls, op) = method.split(".", 1)
+            if method == "event.from":
+                return self._eventFrom(params[1], params[2], params[3])
+            if method == "event.inject":
+                self._event(params[1], "mod", params[2])
+                return self._success(self._token())
+            if not self.db.has_key(cls):
+                return self._failure(["MESSAGE_METHOD_UNKNOWN", method])
+            table = self.db[cls]
+            if op == "get_all_records":
+                return self._success(table)
+            if op == "get_all":
+                return self._success(table.keys())
+            if op == "get_by_uuid":
+                for (ref, r) in table.items():
+                    if r["uuid"] == params[1]:
+                        return self._success(ref)
+                return self._failure(["UUID_INVALID", cls, params[1]])
+            if op == "get_by_name_label":
+                return self._success([ref for (ref, r) in table.items()
+                                      if r.get("name_label") == params[1]])
+            if op.startswith("get_"):
+                field = op[4:]
+                if not table.has_key(params[1]):
+                    return self._failure(["HANDLE_INVALID", cls, params[1]])
+                r = table[params[1]]
+                if field == "record":
+                    return self._success(r)
+                if not r.has_key(field):
+                    return self._failure(["MESSAGE_METHOD_UNKNOWN", method])
+                return self._success(r[field])
+            return self._failure(["MESSAGE_METHOD_UNKNOWN", method])
+        finally:
+            self.lock.release()
+
+class FakeXenAPIHost(object):
+    """Minimal stand-in for a Host object whose API sessions go to a
+    FakeXenAPIServer"""
+
+    def __init__(self, server):
+        self.server = server
+
+    def getAPISession(self, secure=True):
+        session = XenAPI.Session(self.server.url())
+        session.login_with_password("root", "xenroot")
+        return session
+
+    def getName(self):
+        return "fakexapi"
+
+    def getIP(self):
+        return "127.0.0.1"
@@ -1197,7 +1197,8 @@ class TC11221(_CCSetup):
         self.startAsync(target, "while [ 1 ]; do echo %s; done | telnet %s %s &> /dev/null" %
                                 (self.ascii(pattern), 
                                  xenrt.TEC().lookup("XENRT_SERVER_ADDRESS"),
-                                 port))
+                                 port),
+                        detached=True)
 
     def stopNetcatTraffic(self, port):
         pid = xenrt.command("pgrep -f '[n]c.*%s' || true" % (port)).strip()
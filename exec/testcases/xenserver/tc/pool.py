@@ -81,7 +81,7 @@ class TC7302(xenrt.TestCase):
             commands.append("done")
 
             for h in hosts:
-                self.startAsync(h, commands)
+                self.startAsync(h, commands, detached=True)
 
             # Wait for load average to drop below 1.
             deadline = xenrt.timenow() + 7200
@@ -82,7 +82,8 @@ class TC8357(xenrt.TestCase):
 
         self.startAsync(self.host,
                        "while /bin/true; do echo `date` >> %s; sleep %s; done" %
-                       (livefile, livesleep))
+                       (livefile, livesleep),
+                       detached=True)
         self.guest.start()
         time.sleep(120)
         self.guest.shutdown()
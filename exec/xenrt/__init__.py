@@ -313,6 +313,15 @@ class XRTThread(threading.Thread):
         _tecs[self.getName()] = tec
         threading.Thread.start(self)
 
+    def inherit(self, tec, parent):
+        """Associate this running thread with tec and the parent thread, as
+        start() does with the starting thread. Used by pooled worker threads
+        which run tasks on behalf of several threads."""
+        global _tecs
+        _tecs[self.getName()] = tec
+        self._parent_thread = parent
+        self._config = {}
+
     def lookup(self, variable):
         """Look up a variable in the configuration space. If it does not
         exists here the lookup continues to the parent thread until no
@@ -326,6 +335,7 @@ class XRTThread(threading.Thread):
     def setVariable(self, variable, value):
         """Set a variable in the thread local configuration space."""
         self._config[variable] = value
+        xenrt.config.threadVariableSet()
         xenrt.TEC().logverbose(\
             "Setting thread local variable for thread '%s': %s=%s" %
             (self.getName(), variable, value))
@@ -383,6 +393,7 @@ class TestCase(object):
         self.tcsku = None
         self.marvinTestConfig = None
         self.logsfrom = {}
+        self.logCaptureStats = {}
         self._anon = anon
         if anon:
             self.runningtag = "Anonymous"
@@ -1204,14 +1215,31 @@ Abort this testcase with: xenrt interact %s -n '%s'
         cmds = filter(lambda x: x[0] == "!", paths)
         actualpaths = filter(lambda x: x not in cmds, paths)
         if not xenrt.TEC().lookup("QUICKLOGS", False, boolean=True):
-            try:
-                sftp = place.sftpClient()
-                xenrt.TEC().logverbose("Trying to fetch %s." % (actualpaths))
-                sftp.copyLogsFrom(actualpaths, d)
-            except Exception, e:
-                traceback.print_exc(file=sys.stderr)
-                xenrt.TEC().logverbose("Exception fetching logs from %s: %s" %
-                                       (place.getName(), str(e)))
+            fetched = False
+            if xenrt.TEC().lookup("LOG_CAPTURE_MODE", "tar") == "tar":
+                try:
+                    received = xenrt.ssh.tarLogsFrom(place.getIP(),
+                                                     actualpaths,
+                                                     d,
+                                                     password=place.password)
+                    self._recordLogCapture(place, "tar", received)
+                    fetched = True
+                except Exception, e:
+                    xenrt.TEC().logverbose("Could not stream logs from %s "
+                                           "with tar, using SFTP: %s" %
+                                           (place.getName(), str(e)))
+            if not fetched:
+                try:
+                    before = xenrt.util.dirSize(d)
+                    sftp = place.sftpClient()
+                    xenrt.TEC().logverbose("Trying to fetch %s." % (actualpaths))
+                    sftp.copyLogsFrom(actualpaths, d)
+                    self._recordLogCapture(place, "sftp",
+                                           xenrt.util.dirSize(d) - before)
+                except Exception, e:
+                    traceback.print_exc(file=sys.stderr)
+                    xenrt.TEC().logverbose("Exception fetching logs from %s: %s" %
+                                           (place.getName(), str(e)))
             for c in cmds:
                 try:
                     outfile = re.sub("\s", "_", c.lstrip("!").split("/")[-1])
@@ -1577,23 +1605,49 @@ Abort this testcase with: xenrt interact %s -n '%s'
             return
         xenrt.TEC().logverbose("Getting logs from %s." % 
                               ([self.getLogObjName(x) for x in self.logsfrom.keys()]))
-        for h in self.logsfrom.keys():
-            paths = self.logsfrom[h]
-            try:
-                self._getRemoteLogsFrom(h, paths)
-            except Exception, e:
-                traceback.print_exc(file=sys.stderr)
+        objs = self.logsfrom.items()
         if self.runon and not self.logsfrom.has_key(self.runon):
-            try:
-                self._getRemoteLogsFrom(self.runon)
-            except:
-                pass
+            objs.append((self.runon, None))
+        self.logCaptureStats = {}
+        # Collect from several hosts and guests at once, but not so many
+        # that the controller is swamped
+        executor = xenrt.Executor(int(xenrt.TEC().lookup("LOG_CAPTURE_WORKERS", "8")))
+        try:
+            futures = [(h, executor.submit(self._timeRemoteLogsFrom, h, paths))
+                       for (h, paths) in objs]
+            for (h, f) in futures:
+                e = f.exception()
+                if e:
+                    xenrt.TEC().logverbose("Exception getting logs from %s: %s" %
+                                           (self.getLogObjName(h), str(e)))
+        finally:
+            executor.shutdown(wait=False)
+        for (name, stats) in sorted(self.logCaptureStats.items()):
+            xenrt.TEC().logverbose("Logs from %s: %.1fs, %d bytes (%s)" %
+                                   (name, stats.get("seconds", 0),
+                                    stats.get("bytes", 0),
+                                    stats.get("mode", "other")))
         xenrt.TEC().logverbose("Collecting controller information")
         try:
             self.getControllerInfo()
         except:
             pass
 
+    def _timeRemoteLogsFrom(self, obj, paths):
+        start = time.time()
+        try:
+            self._getRemoteLogsFrom(obj, paths)
+        finally:
+            stats = self.logCaptureStats.setdefault(self.getLogObjName(obj), {})
+            stats["seconds"] = time.time() - start
+
+    def _recordLogCapture(self, place, mode, received):
+        """Record how logs were fetched from place and how many bytes were
+        transferred, for the summary logged by _getRemoteLogs"""
+        stats = self.logCaptureStats.setdefault(place.getName(), {})
+        stats["mode"] = mode
+        stats["bytes"] = stats.get("bytes", 0) + received
+
     def getControllerInfo(self):
         """Retrieve local information on XenRT controller"""
         d = xenrt.TEC().getLogdir()
@@ -1782,12 +1836,15 @@ Abort this testcase with: xenrt interact %s -n '%s'
     def runAsync(self, runon, commands, timeout=3600, ignoreSSHErrors=False):
         """Run a command(s) on the specified location asynchronously.
 
-        Creates a shell script on the specified location to run the
-        commands supplied. Polls for completion of the script.
+        Runs a shell script of the commands supplied on one SSH channel,
+        copying its output to the log as it runs, and waits for it to
+        finish. If ignoreSSHErrors is set the script is instead left
+        running detached on the target and polled for completion, so that
+        it survives the target becoming unreachable (e.g. rebooting).
 
-        This method does nothing to check for error returns. It will
-        raise an error exception if the commands are still running after
-        the timeout period.
+        This method raises a failure exception if the script exits with a
+        non-zero value. It will raise an error exception if the commands
+        are still running after the timeout period.
 
         This method uses SSH.
 
@@ -1797,75 +1854,67 @@ Abort this testcase with: xenrt interact %s -n '%s'
         @param ignoreSSHErrors: if true treat SSH errors as the script still running
         """
 
-        runon.execcmd("mkdir -p %s" % xenrt.TEC().lookup("LOCAL_BASE"))
-        flagfile = string.strip(runon.execcmd("mktemp %s/flagXXXXXX" % xenrt.TEC().lookup("LOCAL_BASE")))
-        scriptfile = string.strip(runon.execcmd("mktemp %s/scriptXXXXXX" % xenrt.TEC().lookup("LOCAL_BASE")))
-        logfile = string.strip(runon.execcmd("mktemp %s/logXXXXXX" % xenrt.TEC().lookup("LOCAL_BASE")))
-        ecfile = string.strip(runon.execcmd("mktemp %s/ecXXXXXX" % xenrt.TEC().lookup("LOCAL_BASE")))
-        if type(commands) == type(""):
-            c = commands
-        else:
-            c = string.join(commands, "\n")
-        script = """#!/bin/bash
-%s
-echo $? > %s
-rm -f %s
-""" % (c, ecfile, flagfile)
-        scrf = xenrt.TEC().tempFile()
-        f = file(scrf, "w")
-        f.write(script)
-        f.close()
-        xenrt.TEC().logverbose("Remote script %s contents: %s" %
-                               (scriptfile, script))
-        sftp = runon.sftpClient()
-        sftp.copyTo(scrf, scriptfile)
-        runon.execcmd("%s > %s 2>&1 < /dev/null &" % (scriptfile, logfile))
-        now = xenrt.util.timenow()
-        deadline = now + timeout
+        if not ignoreSSHErrors:
+            handle = self.startAsync(runon, commands)
+            xenrt.TEC().logverbose("Waiting for remote script to complete")
+            if handle.wait(timeout) is None:
+                handle.close()
+                raise xenrt.XRTError("Remote script timed out")
+            self.completeAsync(handle)
+            return
+
+        handle = self.startAsync(runon, commands, detached=True)
+        deadline = xenrt.util.timenow() + timeout
         xenrt.TEC().logverbose("Waiting for remote script to complete")
         try:
             while True:
                 try:
-                    if runon.execcmd("test -e %s" % (flagfile),
-                                     retval="code") != 0:
+                    if self.pollAsync(handle):
                         break
                 except Exception, e:
-                    if ignoreSSHErrors:
-                        # Treat this exception as if the script is still
-                        # running. This is probably because the target
-                        # is expected to become temporarily unreachable
-                        # during execution.
-                        xenrt.TEC().logverbose("Ignoring runAsync SSH "
-                                               "exception: %s" % (str(e)))
-                    else:
-                        raise e.__class__, e, sys.exc_info()[2]
-                now = xenrt.util.timenow()
-                if now > deadline:
+                    # Treat this exception as if the script is still
+                    # running. This is probably because the target
+                    # is expected to become temporarily unreachable
+                    # during execution.
+                    xenrt.TEC().logverbose("Ignoring runAsync SSH "
+                                           "exception: %s" % (str(e)))
+                if xenrt.util.timenow() > deadline:
                     raise xenrt.XRTError("Remote script timed out")
                 xenrt.sleep(60)
         finally:
-            ec = 0
-            try:
-                ec = int(runon.execcmd("cat %s" % (ecfile)).strip())
-                xenrt.TEC().logverbose("Remote command returned: %d" % (ec))
-                locallogfile = xenrt.TEC().logFile()
-                sftp.copyFrom(logfile, locallogfile)
-                sftp.close()
-            except:
-                pass
-            if not ec == 0:
-                raise xenrt.XRTFailure("Remote command exited with non-zero "
-                                       "value.")
-
-    def startAsync(self, runon, commands):
-        flagfile = string.strip(runon.execcmd("mktemp /tmp/flagXXXXXX"))
-        scriptfile = string.strip(runon.execcmd("mktemp /tmp/scriptXXXXXX"))
-        logfile = string.strip(runon.execcmd("mktemp /tmp/logXXXXXX"))
-        ecfile = string.strip(runon.execcmd("mktemp /tmp/ecXXXXXX"))
+            self.completeAsync(handle)
+
+    def startAsync(self, runon, commands, detached=False):
+        """Start a command(s) on the specified location, returning a handle
+        for pollAsync and completeAsync.
+
+        The commands run on an SSH channel kept open until they finish,
+        unless detached is set, in which case they are run in the
+        background on the target in a script that writes its exit status
+        to a file. Commands which are never waited for should be run
+        detached, so they don't keep a channel and a thread open.
+
+        @param runon: an instance of L{GenericPlace} to execute on
+        @param commands: string, or list of strings, to execute
+        @param detached: if true the commands survive the SSH connection
+            being lost
+        """
         if type(commands) == type(""):
             c = commands
         else:
             c = string.join(commands, "\n")
+        if not detached:
+            xenrt.TEC().logverbose("Remote script on %s: %s" % (runon.getIP(), c))
+            try:
+                locallogfile = xenrt.TEC().logFile()
+            except:
+                locallogfile = xenrt.TEC().tempFile()
+            return runon.startcmd(commands, logfile=locallogfile)
+
+        base = xenrt.TEC().lookup("LOCAL_BASE")
+        (flagfile, scriptfile, logfile, ecfile) = runon.execcmd(
+            "mkdir -p %s && for f in flag script log ec; do mktemp %s/${f}XXXXXX; done" %
+            (base, base)).split()
         script = """#!/bin/bash
 %s
 echo $? > %s
@@ -1875,6 +1924,8 @@ rm -f %s
         f = file(scrf, "w")
         f.write(script)
         f.close()
+        xenrt.TEC().logverbose("Remote script %s contents: %s" %
+                               (scriptfile, script))
         sftp = runon.sftpClient()
         try:
             sftp.copyTo(scrf, scriptfile)
@@ -1884,14 +1935,30 @@ rm -f %s
         return (runon, flagfile, ecfile, logfile)
 
     def pollAsync(self, handle):
+        """Returns True if the commands started by startAsync have finished"""
+        if isinstance(handle, xenrt.ssh.SSHAsyncCommand):
+            return handle.poll()
         runon, flagfile, ecfile, logfile = handle
         if runon.execcmd("test -e %s" % (flagfile), retval="code") == 0:
             return False
         return True
 
     def completeAsync(self, handle):
+        """Wait for the commands started by startAsync to finish, returning
+        their output. Raises a failure exception if they exit with a
+        non-zero value."""
+        if isinstance(handle, xenrt.ssh.SSHAsyncCommand):
+            ec = handle.wait()
+            xenrt.TEC().logverbose("Remote command returned: %d" % (ec))
+            if ec == -1:
+                raise xenrt.XRTError("SSH channel closed unexpectedly")
+            if not ec == 0:
+                raise xenrt.XRTFailure("Remote command exited with non-zero value.")
+            return handle.getOutput()
+
         runon, flagfile, ecfile, logfile = handle
         ec = 0
+        data = ""
         try:
             ec = int(runon.execcmd("cat %s" % (ecfile)).strip())
             xenrt.TEC().logverbose("Remote command returned: %d" % (ec))
@@ -1904,13 +1971,13 @@ rm -f %s
                 sftp.copyFrom(logfile, locallogfile)
             finally:
                 sftp.close()
+            f = file(locallogfile, 'r')
+            data = f.read()
+            f.close()
         except:
             pass
         if not ec == 0:
             raise xenrt.XRTFailure("Remote command exited with non-zero value.")
-        f = file(locallogfile, 'r')
-        data = f.read()
-        f.close()
         return data
 
     def uninstallOnCleanup(self, guest):
@@ -3721,6 +3788,7 @@ from xenrt.pxeboot import *
 from xenrt.rootops import *
 from xenrt.ssh import *
 from xenrt.util import *
+from xenrt.executor import *
 from xenrt.registry import *
 from xenrt.objects import *
 from xenrt.config import *
@@ -3729,15 +3797,31 @@ from xenrt.results import *
 from xenrt.formatter import *
 from xenrt.filemanager import *
 from xenrt.dbconnect import *
-from xenrt.jiralink import *
+from xenrt.triage import *
 from xenrt.filecache import *
 from xenrt.tools import *
 from xenrt.suite import *
 from xenrt.lazylog import *
 from xenrt.sslutils import *
-from xenrt.storageadmin import *
-from xenrt.racktableslink import *
-from xenrt.archive import *
-from xenrt.txt import *
 from xenrt.stringutils import *
-from xenrt.virtualmedia import *
+
+# These are only imported the first time one of their names is used, as they
+# (or what they import) are slow to load and most invocations don't need them
+_lazyModules = {
+    "lib": [],
+    "jiralink": ["JiraLink", "getJiraLink"],
+    "storageadmin": ["StorageArrayFactory", "StorageArrayType",
+                     "StorageArrayVendor", "StorageArrayContainer",
+                     "StorageArrayInitiatorGroup", "StorageArrayLun",
+                     "StorageArray", "NetAppFCStorageArray",
+                     "NetAppFCInitiatorGroup", "NetAppISCSIStorageArray",
+                     "NetAppISCSIInitiatorGroup", "NetAppLunContainer",
+                     "NetAppLun", "NetAppFCLun", "NetAppISCSILun"],
+    "racktableslink": ["getRackTablesInstance", "readMachineFromRackTables",
+                       "closeRackTablesInstance"],
+    "archive": ["TarGzArchiver"],
+    "txt": ["TXTCommand", "AttestationIdParser", "TpmQuoteParser",
+            "TXTSuppPackInstaller", "TXTErrorParser"],
+    "virtualmedia": ["VirtualMediaFactory"]}
+import xenrt.lazyimport
+xenrt.lazyimport.lazyPackage("xenrt", _lazyModules)
@@ -8,11 +8,27 @@
 # conditions as licensed by XenSource, Inc. All other rights reserved.
 #
 
-import sys, string, xml.dom.minidom, re, os.path, os, copy, yaml
+import sys, string, xml.dom.minidom, re, os.path, os, copy, yaml, threading
 import xenrt
 
 __all__ = ["Config"]
 
+# Number of thread local variables ever set. Until one has been, lookups
+# needn't look for them.
+_threadVariables = 0
+
+def threadVariableSet():
+    global _threadVariables
+    _threadVariables += 1
+
+VARIABLE_RE = re.compile(r"\$\{([\w:]+)\}")
+
+# Defaults found from the controller's network interfaces, see discoverNetwork()
+DISCOVERED_VARIABLES = [("XENRT_SERVER_ADDRESS",),
+                        ("NETWORK_CONFIG", "DEFAULT", "SUBNETMASK"),
+                        ("NETWORK_CONFIG", "DEFAULT", "SUBNET"),
+                        ("NETWORK_CONFIG", "DEFAULT", "GATEWAY")]
+
 class Config(object):
     """Configuration"""
     def __init__(self):
@@ -20,17 +36,17 @@ class Config(object):
         self.nologging = False
         self.config = {}
 
-        # By default we'll use our eth0 IP address as the server address
-        netdata = os.popen("/sbin/ip addr show dev eth0").read()
-        r = re.search(r"inet ([0-9\.]+)", netdata)
-        if r:
-            self.config["XENRT_SERVER_ADDRESS"] = r.group(1)
-        else:
-            # Try xenbr0 (if we're running on a Xen host)
-            netdata = os.popen("/sbin/ip addr show dev xenbr0").read()
-            r = re.search(r"inet ([0-9\.]+)", netdata)
-            if r:
-                self.config["XENRT_SERVER_ADDRESS"] = r.group(1)
+        # Compiled snapshot, see freeze()
+        self._compiled = None
+        self._dependents = {}
+        self._generation = 0
+        self._compileLock = threading.Lock()
+        self._compiling = threading.local()
+
+        # The server address and default network are found from our own
+        # interfaces when first needed
+        self._discovered = False
+        self._discoverLock = threading.Lock()
 
         # Defaults
         self.config["OSS_VOLUME_GROUP"] = "VGXenRT"
@@ -53,9 +69,18 @@ class Config(object):
         self.config["ISCSI_BASE_PATH"] = "/local/scratch/iscsi"
         self.config["FILE_MANAGER_CACHE"] = "/local/scratch/cache2"
         self.config["FILE_MANAGER_CACHE_NFS"] = "/local/scratch/cache_nfs"
+        self.config["FILE_MANAGER_CACHE_SIZE"] = "80%"
+        self.config["FILE_MANAGER_CACHE_NFS_SIZE"] = "80%"
+        self.config["FILE_MANAGER_MAX_FETCHES"] = "4"
+        self.config["FILE_MANAGER_SEGMENTS"] = "4"
+        self.config["FILE_MANAGER_SEGMENT_THRESHOLD"] = "67108864"
         self.config["CLEANUP_FLAGS_PATH"] = "/local/scratch/cleanup"
         self.config["RESOURCE_LOCK_DIR"] = "${NFS_BASE_PATH}/locks"
         self.config["DB_BUFFER_DIR"] = "${NFS_BASE_PATH}/dbconnect"
+        self.config["DB_ASYNC_REPORTING"] = "yes"
+        self.config["DB_REPORT_BATCH"] = "100"
+        self.config["DB_REPORT_INTERVAL"] = "0.5"
+        self.config["DB_REPORT_FLUSH_TIMEOUT"] = "600"
         self.config["JIRA_BUFFER_DIR"] = "${NFS_BASE_PATH}/jiralink"
 
         self.config["LOCALURL"] = "http://${XENRT_SERVER_ADDRESS}"
@@ -79,17 +104,6 @@ class Config(object):
         # Networking configuration
         self.config["NETWORK_CONFIG"] = {}
         self.config["NETWORK_CONFIG"]["DEFAULT"] = {}
-        r = re.search(r"inet [^/]+/(\d+)", netdata)
-        if r and self.config.has_key("XENRT_SERVER_ADDRESS"):
-            mask = xenrt.util.prefLenToMask(int(r.group(1)))
-            subnet = xenrt.util.formSubnet(self.config["XENRT_SERVER_ADDRESS"],
-                                           int(r.group(1)))
-            self.config["NETWORK_CONFIG"]["DEFAULT"]["SUBNETMASK"] = mask
-            self.config["NETWORK_CONFIG"]["DEFAULT"]["SUBNET"] = subnet
-        routedata = os.popen("/sbin/ip route show").read()
-        r = re.search(r"default via ([0-9\.]+) dev eth0", routedata)
-        if r:
-            self.config["NETWORK_CONFIG"]["DEFAULT"]["GATEWAY"] = r.group(1)
         self.config["NETWORK_CONFIG"]["DEFAULT"]["POOLSTART"] = "TODO"
         self.config["NETWORK_CONFIG"]["DEFAULT"]["POOLEND"] = "TODO"
 
@@ -103,6 +117,20 @@ class Config(object):
 
         self.config["SSH_PRIVATE_KEY_FILE"] = "${XENRT_CONF}/keys/ssh/id_dsa_xenrt"
         self.config["SSH_PUBLIC_KEY_FILE"] = "${SSH_PRIVATE_KEY_FILE}.pub"
+        self.config["SSH_TRANSPORT_POOL"] = "yes"
+        self.config["SSH_POOL_IDLE_TIMEOUT"] = "120"
+        self.config["SSH_POOL_MAX_CHANNELS"] = "8"
+        self.config["SSH_POOL_OPEN_TIMEOUT"] = "30"
+        self.config["SFTP_TREE_WORKERS"] = "4"
+        self.config["LOG_CAPTURE_MODE"] = "tar"
+        self.config["LOG_CAPTURE_WORKERS"] = "8"
+        self.config["XMLRPC_CHUNK_SIZE"] = "1048576"
+        self.config["XMLRPC_COMPRESS"] = "yes"
+        self.config["XE_ENGINE"] = "xe"
+        self.config["VM_EVENT_WATCHER"] = "no"
+        self.config["RECORD_SNAPSHOT_TTL"] = "0"
+        self.config["EXECUTOR_MAX_WORKERS"] = "32"
+        self.config["EXECUTOR_MAX_PER_TARGET"] = "0"
         self.config["RPMCHROOT"] = "${XENRT_BASE}/imagesrc/rpmchroot"
         self.config["REMOTE_SCRIPTDIR"] = "/opt/xenrt/scripts"
         self.config["LOCAL_SCRIPTDIR"] = "${XENRT_BASE}/scripts"
@@ -3319,6 +3347,7 @@ class Config(object):
             self.config["CARBON_PATCHES_CREEDENCE"]["HF12"] = self.config["HOTFIXES"]["Creedence"]["SP1"]["XS65ESP1012"]
             self.config["CARBON_PATCHES_CREEDENCE"]["HF13"] = self.config["HOTFIXES"]["Creedence"]["SP1"]["XS65ESP1013"]
             self.config["CARBON_PATCHES_CREEDENCE"]["HF16"] = self.config["HOTFIXES"]["Creedence"]["SP1"]["XS65ESP1016"]
+        self.invalidate()
 
             
     def readFromFile(self, filename, path=None):
@@ -3337,6 +3366,7 @@ class Config(object):
         """Read config from a JSON file."""
         with open(filename, 'r') as jf:
             self.__dictMerge(self.config, yaml.load(jf.read()))
+        self.invalidate()
 
     def doPostLoadProcessing(self):
         # Process GUEST_TESTS data
@@ -3372,11 +3402,13 @@ class Config(object):
                             self.config["GUEST_TESTS"][r]["%s_LinuxHTTPInstall" % g].append(d)
                         if [x for x in nfsInstallSupport if re.match(x, d)]:
                             self.config["GUEST_TESTS"][r]["%s_LinuxNFSInstall" % g].append(d)
+        self.invalidate()
 
 
     def writeOut(self, fd, conf=None, pref=[]):
         """Write the config out to a file descriptor"""
         if conf == None:
+            self.discoverNetwork()
             conf = self.config
         keys = conf.keys()
         keys.sort()
@@ -3399,21 +3431,27 @@ class Config(object):
     def setVariable(self, key, value):
         """Write a variable to the config"""
         if type(key) == type(""):
-            self.config[str(key)] = str(value)
+            path = (str(key),)
         elif type(key) == type(u""):
-            self.config[str(key)] = str(value)
+            path = (str(key),)
         else:
-            dict = self.config
-            for e in key[:-1]:
-                e = str(e)
-                if not dict.has_key(e):
-                    dict[e] = {}
-                dict = dict[e]
-            dict[str(key[-1])] = str(value)
+            path = tuple([str(e) for e in key])
+        dict = self.config
+        for e in path[:-1]:
+            if not dict.has_key(e):
+                dict[e] = {}
+            dict = dict[e]
+        replaced = dict.get(path[-1])
+        dict[path[-1]] = str(value)
+        if type(replaced) == type({}):
+            self.invalidate()
+        else:
+            self.invalidate(path)
 
     def getAll(self, deep=False, dict=None, prefix=[]):
         reply = ""
         if dict == None:
+            self.discoverNetwork()
             dict = self.config
         for key in dict.keys():
             if type(dict[key]) == type(""):
@@ -3431,6 +3469,7 @@ class Config(object):
         return reply
 
     def getWithPrefix(self, prefix):
+        self.discoverNetwork()
         reply = []
         dict = self.config
         for key in dict.keys():
@@ -3440,9 +3479,175 @@ class Config(object):
 
     def defined(self, var):
         """Check for the specified variable being defined."""
+        if not self._discovered:
+            self._discoverFor(var)
         return self.config.has_key(var)
 
+    def discoverNetwork(self):
+        """Default the server address to that of eth0 (or xenbr0), and the
+        default network to the one it is on, unless they are already set.
+        This is only done once, when one of them is first looked up, as it
+        runs /sbin/ip."""
+        if self._discovered:
+            return
+        self._discoverLock.acquire()
+        try:
+            if self._discovered:
+                return
+            found = {}
+            # By default we'll use our eth0 IP address as the server address
+            netdata = os.popen("/sbin/ip addr show dev eth0").read()
+            r = re.search(r"inet ([0-9\.]+)", netdata)
+            if not r:
+                # Try xenbr0 (if we're running on a Xen host)
+                netdata = os.popen("/sbin/ip addr show dev xenbr0").read()
+                r = re.search(r"inet ([0-9\.]+)", netdata)
+            if r:
+                address = r.group(1)
+                found[DISCOVERED_VARIABLES[0]] = address
+                r = re.search(r"inet [^/]+/(\d+)", netdata)
+                if r:
+                    found[DISCOVERED_VARIABLES[1]] = \
+                        xenrt.util.prefLenToMask(int(r.group(1)))
+                    found[DISCOVERED_VARIABLES[2]] = \
+                        xenrt.util.formSubnet(address, int(r.group(1)))
+            routedata = os.popen("/sbin/ip route show").read()
+            r = re.search(r"default via ([0-9\.]+) dev eth0", routedata)
+            if r:
+                found[DISCOVERED_VARIABLES[3]] = r.group(1)
+
+            for (path, value) in found.items():
+                dict = self.config
+                for e in path[:-1]:
+                    dict = dict.setdefault(e, {})
+                    if type(dict) != type({}):
+                        break
+                else:
+                    dict.setdefault(path[-1], value)
+            self._discovered = True
+        finally:
+            self._discoverLock.release()
+        self.invalidate()
+
+    def _discoverFor(self, var):
+        """Run discoverNetwork if var is, or contains, a discovered variable"""
+        if type(var) in (list, tuple):
+            path = tuple(var)
+        else:
+            path = (var,)
+        for d in DISCOVERED_VARIABLES:
+            if d[:len(path)] == path:
+                self.discoverNetwork()
+                return
+
+    def freeze(self):
+        """Start keeping a compiled snapshot of the config: string values
+        are looked up and have their ${} references expanded once, then
+        served from a flat dictionary keyed by path tuple until they, or
+        anything they reference, are changed with setVariable or setDefault.
+        Anything that changes self.config directly must call invalidate().
+        Threads with thread local variables bypass the snapshot."""
+        self._compileLock.acquire()
+        try:
+            if self._compiled is None:
+                self._compiled = {}
+                self._dependents = {}
+        finally:
+            self._compileLock.release()
+
+    def invalidate(self, path=None):
+        """Drop path, and everything that references it, from the compiled
+        snapshot, or the whole snapshot if path is None"""
+        if self._compiled is None:
+            return
+        self._compileLock.acquire()
+        try:
+            self._generation += 1
+            if path is None:
+                self._compiled = {}
+                self._dependents = {}
+                return
+            todo = [path]
+            while todo:
+                p = todo.pop()
+                self._compiled.pop(p, None)
+                todo.extend(self._dependents.pop(p, []))
+        finally:
+            self._compileLock.release()
+
+    def _threadOverrides(self):
+        """Whether the current thread or one of its parents has thread local
+        variables"""
+        if not _threadVariables:
+            return False
+        t = xenrt.myThread()
+        while t:
+            if getattr(t, "_config", None):
+                return True
+            t = getattr(t, "_parent_thread", None)
+        return False
+
+    def _lookupCompiled(self, var):
+        """Look up the expanded string value of var from the compiled
+        snapshot, compiling it if needed. Returns None if var isn't a
+        string value, or the snapshot can't be used."""
+        if type(var) == type(""):
+            path = tuple(var.split(":"))
+        elif type(var) in (list, tuple):
+            path = tuple(var)
+        else:
+            return None
+        if self._threadOverrides():
+            return None
+        # Anything being expanded depends on what it references
+        stack = getattr(self._compiling, "stack", None)
+        if stack:
+            stack[-1].add(path)
+        v = self._compiled.get(path)
+        if v is not None:
+            return v
+
+        generation = self._generation
+        s = self.lookupNoRecurse(list(path), default=None)
+        if type(s) != type(""):
+            return None
+        if not stack:
+            stack = self._compiling.stack = []
+        deps = set()
+        stack.append(deps)
+        try:
+            v = VARIABLE_RE.sub(self.lookupHelper, s)
+        finally:
+            stack.pop()
+        self._compileLock.acquire()
+        try:
+            # Don't keep it if anything changed while it was expanded
+            if self._compiled is not None and generation == self._generation:
+                self._compiled[path] = v
+                for d in deps:
+                    self._dependents.setdefault(d, set()).add(path)
+        finally:
+            self._compileLock.release()
+        return v
+
+    def _stringValue(self, v, boolean):
+        if boolean:
+            if string.lower(v[0]) in ("1", "y", "t", "e"):
+                return True
+            if string.lower(v[0]) in ("0", "n", "f", "d"):
+                return False
+            if string.lower(v) == "on":
+                return True
+            if string.lower(v) == "off":
+                return False
+            return bool(v)
+        return v
+
     def lookup(self, var, default=xenrt.XRTError, boolean=False):
+        if self._compiled is not None:
+            v = self._lookupCompiled(var)
+            if v is not None:
+                return self._stringValue(v, boolean)
         s = None
         if type(var) == type("") and ":" in var:
             # Treat a string with colons as a list of the entities
@@ -3456,18 +3661,8 @@ class Config(object):
         if not s:
             s = self.lookupNoRecurse(var, default=default)
         if type(s) == type(""):
-            v = re.sub(r"\$\{([\w:]+)\}", self.lookupHelper, s)
-            if boolean:
-                if string.lower(v[0]) in ("1", "y", "t", "e"):
-                    return True
-                if string.lower(v[0]) in ("0", "n", "f", "d"):
-                    return False
-                if string.lower(v) == "on":
-                    return True
-                if string.lower(v) == "off":
-                    return False
-                return bool(v)
-            return v
+            v = VARIABLE_RE.sub(self.lookupHelper, s)
+            return self._stringValue(v, boolean)
         v = s
         if v == None:
             return None
@@ -3546,6 +3741,8 @@ class Config(object):
 
     def lookupNoRecurse(self, var, default=xenrt.XRTError):
         """Look up the specified variable."""
+        if not self._discovered:
+            self._discoverFor(var)
         if type(var) == type(""):
             if self.config.has_key(var):
                 return self.config[var]
@@ -3583,6 +3780,7 @@ class Config(object):
         """
         if not self.config.has_key(var):
             self.config[var] = value
+            self.invalidate((var,))
 
     def isVerbose(self):
         """Return true if verbose is enabled"""
@@ -0,0 +1,99 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# Waiting for commands run by the Windows execution daemon
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import re, socket, xmlrpclib
+import xenrt
+
+__all__ = ["daemonVersion", "supportsWait", "waitForResult", "multiCall"]
+
+# The first daemon version with wait, result and system.multicall
+WAIT_VERSION = (0, 9, 5)
+
+# Longest a single wait call blocks for, this must be well inside the
+# socket timeout of the XML-RPC transport
+WAIT_SLICE = 30
+
+def daemonVersion(server):
+    """Returns the version of the daemon at server as a tuple"""
+    m = re.search(r"v(\d+)\.(\d+)\.(\d+)", server.version())
+    if not m:
+        return (0, 0, 0)
+    return tuple(map(int, m.groups()))
+
+def supportsWait(version):
+    return version >= WAIT_VERSION
+
+def waitForResult(server, ref, started, timeout, longPoll, ignoredata=False,
+                  cleanup=True, maxerrors=2, backoff=True):
+    """Wait for the command ref to complete, returning its return code and
+    (unless ignoredata is set) its log, or None if it doesn't complete
+    within timeout seconds of started. With longPoll the daemon blocks
+    until the command completes and then returns everything in one call,
+    otherwise it is polled, either backing off exponentially from one
+    second up to 16 or every 15 seconds."""
+    period = 1
+    errors = 0
+    if not longPoll and backoff:
+        xenrt.sleep(period, log=False)
+    while True:
+        if timeout:
+            remaining = started + timeout - xenrt.util.timenow()
+        else:
+            remaining = WAIT_SLICE
+        try:
+            if longPoll:
+                st = server.wait(ref, max(0, min(WAIT_SLICE, remaining)))
+            else:
+                st = server.poll(ref)
+            errors = 0
+        except socket.error, e:
+            errors = errors + 1
+            if errors > maxerrors:
+                raise
+            st = "ERROR"
+        if st == "DONE":
+            break
+        if timeout and xenrt.util.timenow() >= started + timeout:
+            return None
+        if longPoll:
+            if st == "ERROR":
+                xenrt.sleep(period, log=False)
+            continue
+        if backoff:
+            period = min(period * 2, 16)
+        else:
+            period = 15
+        xenrt.sleep(period, log=False)
+
+    if longPoll:
+        r = server.result(ref, not ignoredata, cleanup)
+        return (r["returncode"], r.get("log"))
+    if ignoredata:
+        data = None
+    else:
+        data = server.log(ref)
+    rc = server.returncode(ref)
+    if cleanup:
+        try:
+            server.cleanup(ref)
+        except Exception, e:
+            xenrt.TEC().warning("Got exception while cleaning up after %s: %s" %
+                                (ref, str(e)))
+    return (rc, data)
+
+def multiCall(server, calls, batched):
+    """Make the calls, a list of (method, args) tuples, returning a list of
+    their results. If batched is set they are sent in one request."""
+    if not batched:
+        return [getattr(server, m)(*args) for (m, args) in calls]
+    mc = xmlrpclib.MultiCall(server)
+    for (m, args) in calls:
+        getattr(mc, m)(*args)
+    return list(mc())
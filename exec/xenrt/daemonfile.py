@@ -0,0 +1,105 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# Chunked file transfer to and from the Windows execution daemon
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import hashlib, zlib, xmlrpclib
+import xenrt
+
+__all__ = ["sendFile", "readFile"]
+
+# Attempts at each chunk before giving up on a transfer
+ATTEMPTS = 3
+
+def _unsupported(e):
+    """Returns True if e is the fault raised by a daemon too old to have
+    the chunked transfer calls"""
+    return isinstance(e, xmlrpclib.Fault) and "is not supported" in e.faultString
+
+def _settings():
+    return (int(xenrt.TEC().lookup("XMLRPC_CHUNK_SIZE", str(xenrt.MEGA))),
+            xenrt.TEC().lookup("XMLRPC_COMPRESS", False, boolean=True))
+
+def _call(func, *args):
+    for i in range(ATTEMPTS):
+        try:
+            return func(*args)
+        except xmlrpclib.Fault:
+            raise
+        except Exception, e:
+            if i == ATTEMPTS - 1:
+                raise
+            xenrt.TEC().logverbose("Retrying chunk after %s" % (str(e)))
+
+def sendFile(server, localfilename, remotefilename):
+    """Push a file to the daemon at server a chunk at a time, checking its
+    checksum once it has all been sent. Returns False, having sent
+    nothing, if the daemon doesn't support chunked transfers."""
+    (chunk, compress) = _settings()
+    h = hashlib.sha1()
+    offset = 0
+    f = file(localfilename, "rb")
+    try:
+        while True:
+            data = f.read(chunk)
+            h.update(data)
+            payload = data
+            compressed = False
+            if compress:
+                z = zlib.compress(data, 1)
+                if len(z) < len(data):
+                    payload = z
+                    compressed = True
+            try:
+                offset = long(_call(server.appendFile, remotefilename,
+                                    str(offset), xmlrpclib.Binary(payload),
+                                    compressed))
+            except xmlrpclib.Fault, e:
+                if offset == 0 and _unsupported(e):
+                    return False
+                raise
+            if len(data) < chunk:
+                break
+    finally:
+        f.close()
+    _checkDigest(server.fileChecksum(remotefilename), remotefilename,
+                 h.hexdigest())
+    return True
+
+def readFile(server, remotefilename, fh):
+    """Read a file from the daemon at server a chunk at a time, writing it
+    to the file object fh, and check its checksum. Returns False, having
+    written nothing, if the daemon doesn't support chunked transfers."""
+    (chunk, compress) = _settings()
+    h = hashlib.sha1()
+    offset = 0
+    while True:
+        try:
+            (compressed, payload) = _call(server.readFileAt, remotefilename,
+                                          str(offset), chunk, compress)
+        except xmlrpclib.Fault, e:
+            if offset == 0 and _unsupported(e):
+                return False
+            raise
+        data = payload.data
+        if compressed:
+            data = zlib.decompress(data)
+        fh.write(data)
+        h.update(data)
+        offset += len(data)
+        if len(data) < chunk:
+            break
+    # Only check what we read, logs in particular may have grown since
+    _checkDigest(server.fileChecksum(remotefilename, str(offset)),
+                 remotefilename, h.hexdigest())
+    return True
+
+def _checkDigest(remote, remotefilename, digest):
+    if remote != digest:
+        raise xenrt.XRTError("Checksum of %s is %s, expected %s" %
+                             (remotefilename, remote, digest))
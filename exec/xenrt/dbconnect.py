@@ -9,11 +9,174 @@
 #
 
 import sys, string, xml.dom.minidom, os.path, os, shutil, tempfile, fcntl, stat
-import time, ConfigParser, xenrtapi, requests, pipes
+import time, ConfigParser, xenrtapi, requests, pipes, threading, traceback
 import xenrt
 
 __all__ = ["DBConnect", "APIFactory"]
 
+class _ReportQueue(object):
+    """Runs jobctrl commands for a DBConnect from a background thread so
+    the caller doesn't wait for them. Runs of setresult, logdata and update
+    commands are sent together with DBConnect.sendBatch, anything else is
+    run through the CLI in the order it was queued. Commands that can't be
+    sent are buffered for replay."""
+
+    BATCHED = ("setresult", "logdata", "update")
+
+    def __init__(self, dbconnect, maxBatch, interval):
+        self.dbconnect = dbconnect
+        self.maxBatch = maxBatch
+        self.interval = interval
+        self.cond = threading.Condition()
+        self.pending = []
+        self.busy = False
+        self.flushing = 0
+        self.closed = False
+        self.thread = None
+        self.stats = {"queued": 0, "batches": 0, "batched": 0, "commands": 0,
+                      "buffered": 0, "failed": 0}
+
+    def put(self, command, args, bufferfile):
+        """Queue a command, returns False if the queue has been closed"""
+        self.cond.acquire()
+        try:
+            if self.closed:
+                return False
+            self.pending.append((command, args, bufferfile))
+            self.stats["queued"] += 1
+            if not self.thread:
+                self.thread = threading.Thread(target=self._run,
+                                               name="DBConnectReporter")
+                self.thread.setDaemon(True)
+                self.thread.start()
+            self.cond.notifyAll()
+            return True
+        finally:
+            self.cond.release()
+
+    def _take(self):
+        self.cond.acquire()
+        try:
+            while not self.pending:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            # Give a burst of commands a moment to arrive so they can go
+            # in one batch, unless someone is waiting for them
+            deadline = time.time() + self.interval
+            while len(self.pending) < self.maxBatch and \
+                    not self.closed and not self.flushing:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self.cond.wait(remaining)
+            batch = self.pending[:self.maxBatch]
+            del self.pending[:self.maxBatch]
+            self.busy = True
+            return batch
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            if batch is None:
+                return
+            try:
+                self._send(batch)
+            except Exception:
+                traceback.print_exc(file=sys.stderr)
+            self.cond.acquire()
+            try:
+                self.busy = False
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+
+    def _send(self, batch):
+        i = 0
+        while i < len(batch):
+            j = i
+            while j < len(batch) and batch[j][0] in self.BATCHED:
+                j += 1
+            if j > i:
+                self._sendBatch(batch[i:j])
+                i = j
+                continue
+            (command, args, bufferfile) = batch[i]
+            try:
+                self.dbconnect.jobctrl(command, args, bufferfile=bufferfile)
+                self.stats["commands"] += 1
+            except Exception, e:
+                xenrt.TEC().logverbose("XenRT CLI %s failed: %s" %
+                                       (command, str(e)))
+                self.stats["failed"] += 1
+            i += 1
+
+    def _sendBatch(self, items):
+        sent = []
+        try:
+            self.dbconnect.sendBatch(items, sent)
+            self.stats["batches"] += 1
+            self.stats["batched"] += len(items)
+        except Exception, e:
+            xenrt.TEC().logverbose("Sending %u results failed: %s" %
+                                   (len(items), str(e)))
+            for i in range(len(items)):
+                if i in sent:
+                    continue
+                (command, args, bufferfile) = items[i]
+                try:
+                    self.dbconnect.bufferCommand(command, args, bufferfile)
+                    self.stats["buffered"] += 1
+                except Exception, e:
+                    xenrt.TEC().logverbose("Could not buffer %s: %s" %
+                                           (command, str(e)))
+                    self.stats["failed"] += 1
+
+    def flush(self, timeout=None):
+        """Wait for everything queued so far to be sent. Returns False if
+        that took longer than timeout seconds."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.cond.acquire()
+        self.flushing += 1
+        try:
+            self.cond.notifyAll()
+            while self.pending or self.busy:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+            return True
+        finally:
+            self.flushing -= 1
+            self.cond.release()
+
+    def close(self, timeout=None):
+        """Send everything queued and stop the thread. Anything that could
+        not be sent within timeout seconds is buffered for replay."""
+        self.flush(timeout)
+        self.cond.acquire()
+        try:
+            self.closed = True
+            left = self.pending
+            self.pending = []
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        for (command, args, bufferfile) in left:
+            try:
+                self.dbconnect.bufferCommand(command, args, bufferfile)
+                self.stats["buffered"] += 1
+            except Exception, e:
+                xenrt.TEC().logverbose("Could not buffer %s: %s" %
+                                       (command, str(e)))
+                self.stats["failed"] += 1
+
 class DBConnect(object):
 
     def __init__(self, jobid):
@@ -26,6 +189,12 @@ class DBConnect(object):
             os.makedirs(self._bufferdir)
 
         self._api = None
+        self._queue = None
+        if xenrt.GEC().config.lookup("DB_ASYNC_REPORTING", True, boolean=True):
+            self._queue = _ReportQueue(\
+                self,
+                int(xenrt.GEC().config.lookup("DB_REPORT_BATCH", "100")),
+                float(xenrt.GEC().config.lookup("DB_REPORT_INTERVAL", "0.5")))
 
     def jobid(self):
         return self._jobid
@@ -38,6 +207,8 @@ class DBConnect(object):
         
 
     def detailid(self, phase, test):
+        # The result may still be queued to be sent in the background
+        self.flush()
         jobid = self.jobid()
         job = self.api.get_job(jobid)
         detailids = [x['detailid'] for x in job['results'].values() if x['phase'] == phase and x['test'] == test]
@@ -61,30 +232,113 @@ class DBConnect(object):
                 raise
             if not self._bufferdir:
                 raise
-            xenrt.TEC().logverbose("BUFFERING: %s" % (commandline))
-            # If we've got a file then copy it and replace references to it
-            # in the command
+            self.bufferCommand(command, args, bufferfile)
+
+    def bufferCommand(self, command, args, bufferfile=None):
+        """Save a command to be run by replay"""
+        if not self._bufferdir:
+            raise xenrt.XRTError("No buffer directory")
+        xenrt.TEC().logverbose("BUFFERING: %s %s" % (command, string.join(args)))
+        args = list(args)
+        # If we've got a file then copy it and replace references to it
+        # in the command
+        if bufferfile:
+            f, fn = tempfile.mkstemp("", "buffile", self._bufferdir)
+            os.close(f)
+            os.chmod(fn,
+                     stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | \
+                     stat.S_IXOTH)
+            shutil.copy(bufferfile, fn)
+            for i in range(len(args)):
+                args[i] = string.replace(args[i], bufferfile, fn)
+        for i in range(len(args)):
+            args[i] = string.replace(args[i], "\t", " ")
+        f = file("%s/bufferedcommands" % (self._bufferdir), "a")
+        try:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            x = ["COMMAND", command]
+            x.extend(args)
+            f.write("%s\n" % (string.join(x, "\t")))
+            if bufferfile:
+                f.write("FILE\t%s\n" % (fn))
+        finally:
+            f.close()
+
+    def report(self, command, args, bufferfile=None):
+        """Run a jobctrl command in the background if asynchronous reporting
+        is enabled, otherwise run it now"""
+        if self._queue:
             if bufferfile:
-                f, fn = tempfile.mkstemp("", "buffile", self._bufferdir)
-                os.close(f)
-                os.chmod(fn,
-                         stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | \
-                         stat.S_IXOTH)
+                # The caller may change or remove the file once we return
+                fn = xenrt.GEC().anontec.tempFile()
                 shutil.copy(bufferfile, fn)
-                for i in range(len(args)):
-                    args[i] = string.replace(args[i], bufferfile, fn)
-            for i in range(len(args)):
-                args[i] = string.replace(args[i], "\t", " ")
-            f = file("%s/bufferedcommands" % (self._bufferdir), "a")
-            try:
-                fcntl.flock(f, fcntl.LOCK_EX)
-                x = ["COMMAND", command]
-                x.extend(args)
-                f.write("%s\n" % (string.join(x, "\t")))
-                if bufferfile:
-                    f.write("FILE\t%s\n" % (fn))
-            finally:
-                f.close()
+                args = [string.replace(x, bufferfile, fn) for x in args]
+                bufferfile = fn
+            if self._queue.put(command, args, bufferfile):
+                return
+        self.jobctrl(command, args, bufferfile=bufferfile)
+
+    def sendBatch(self, items, sent):
+        """Send a list of (command, args, bufferfile) setresult, logdata and
+        update commands using as few API calls as possible. The indexes of
+        the items that have been sent are added to sent as they are, so a
+        caller can tell what is left if this raises an exception."""
+        jobs = []
+        byJob = {}
+        for i in range(len(items)):
+            (command, args, bufferfile) = items[i]
+            jobid = int(args[0])
+            if not byJob.has_key(jobid):
+                jobs.append(jobid)
+                byJob[jobid] = ({}, [], [], [])
+            (params, paramItems, updates, updateItems) = byJob[jobid]
+            if command == "update":
+                # Only the last value of a field matters
+                params[args[1]] = args[2]
+                paramItems.append(i)
+            elif command == "setresult":
+                updates.append({"phase": args[1], "test": args[2],
+                                "result": args[3]})
+                updateItems.append(i)
+            elif command == "logdata":
+                updates.append({"phase": args[1], "test": args[2],
+                                "key": args[3], "value": args[4]})
+                updateItems.append(i)
+            else:
+                raise xenrt.XRTError("Cannot batch %s" % (command))
+        for jobid in jobs:
+            (params, paramItems, updates, updateItems) = byJob[jobid]
+            if params:
+                self.api.update_job(jobid, params=params)
+                sent.extend(paramItems)
+            if updates and hasattr(self.api, "bulk_results"):
+                self.api.bulk_results(jobid, updates)
+                sent.extend(updateItems)
+            else:
+                # The server bindings predate the bulk call
+                for (u, i) in zip(updates, updateItems):
+                    if u.has_key("result"):
+                        self.api.set_result(jobid, u["phase"], u["test"],
+                                            u["result"])
+                    else:
+                        self.api.new_logdata(jobid, u["phase"], u["test"],
+                                             u["key"], u["value"])
+                    sent.append(i)
+
+    def flush(self, timeout=None):
+        """Wait for any commands being run in the background to finish"""
+        if self._queue:
+            return self._queue.flush(timeout)
+        return True
+
+    def close(self):
+        """Finish running background commands, buffering any that don't
+        finish in time"""
+        if self._queue:
+            self._queue.close(float(xenrt.GEC().config.lookup(\
+                "DB_REPORT_FLUSH_TIMEOUT", "600")))
+            xenrt.TEC().logverbose("Result reporting: %s" %
+                                   (str(self._queue.stats)))
 
     def replay(self):
         if not self._bufferdir:
@@ -148,34 +402,36 @@ class DBConnect(object):
     def jobUpdate(self, field, value):
         j = self.jobid()
         if j:
-            self.jobctrl("update", ["%u" % (j), field, value])
+            self.report("update", ["%u" % (j), field, value])
 
     def jobComplete(self):
         j = self.jobid()
         if j:
+            self.flush()
             self.jobctrl("complete", ["%u" % (j)])
 
     def jobStart(self):
         j = self.jobid()
         if j:
+            self.flush()
             self.jobctrl("start", ["%u" % (j)])
 
     def jobSetResult(self, phase, test, result):
         j = self.jobid()
         if j:
-            self.jobctrl("setresult", ["%u" % (j), phase, test, result])
+            self.report("setresult", ["%u" % (j), phase, test, result])
 
     def jobSubResults(self, phase, test, filename):
         j = self.jobid()
         if j:
-            self.jobctrl("subresults",
-                         ["%u" % (j), phase, test, "-f", filename],
-                         bufferfile = filename)
+            self.report("subresults",
+                        ["%u" % (j), phase, test, "-f", filename],
+                        bufferfile = filename)
 
     def jobLogData(self, phase, test, key, value):
         j = self.jobid()
         if j:
-            self.jobctrl("logdata", ["%u" % (j), phase, test, key, value])
+            self.report("logdata", ["%u" % (j), phase, test, key, value])
 
     def jobUpload(self, source, phase=None, test=None, prefix=None):
         j = self.jobid()
@@ -194,7 +450,7 @@ class DBConnect(object):
             if prefix:
                 args.extend(["-P", prefix])
             args.extend(["-f", f])
-            self.jobctrl("upload", args, bufferfile=f)
+            self.report("upload", args, bufferfile=f)
 
     def jobDownload(self, filename, jobid=None):
         if jobid:
@@ -231,6 +487,7 @@ class DBConnect(object):
     def jobEmail(self):
         j = self.jobid()
         if j:
+            self.flush()
             self.jobctrl("email", ["%u" % (j)])
 
     def perfUpload(self, filename):
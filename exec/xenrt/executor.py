@@ -0,0 +1,262 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# Bounded thread pool executor
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import sys, threading, time, traceback
+import xenrt
+
+# Symbols we want to export from the package.
+__all__ = ["Executor", "Future"]
+
+class Future(object):
+    """The pending result of a call submitted to an Executor."""
+
+    PENDING = "pending"
+    RUNNING = "running"
+    FINISHED = "finished"
+    CANCELLED = "cancelled"
+
+    def __init__(self, func, args, kwargs, target=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.target = target
+        self.state = self.PENDING
+        self.value = None
+        self.error = None
+        self.cond = threading.Condition()
+        # The context of the submitting thread, which the worker adopts
+        # while running the call
+        self.tec = xenrt.TEC()
+        self.parent = xenrt.myThread()
+
+    def __repr__(self):
+        return "<Future %s %s>" % (getattr(self.func, "__name__", self.func),
+                                   self.state)
+
+    def _setRunning(self):
+        """Move from pending to running, returns False if cancelled."""
+        self.cond.acquire()
+        try:
+            if self.state != self.PENDING:
+                return False
+            self.state = self.RUNNING
+            return True
+        finally:
+            self.cond.release()
+
+    def _run(self):
+        value = None
+        error = None
+        try:
+            value = self.func(*self.args, **self.kwargs)
+        except Exception, e:
+            traceback.print_exc(file=sys.stderr)
+            error = e
+        self._finish(value, error)
+
+    def _finish(self, value=None, error=None):
+        """Record the outcome of the call. Also used to complete Futures
+        for work that something other than an Executor is tracking."""
+        self.cond.acquire()
+        try:
+            self.value = value
+            self.error = error
+            self.state = self.FINISHED
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def cancel(self):
+        """Cancel the call if it has not started. Returns True if the call
+        was cancelled. Calls that are already running cannot be stopped."""
+        self.cond.acquire()
+        try:
+            if self.state == self.PENDING:
+                self.state = self.CANCELLED
+                self.cond.notifyAll()
+            return self.state == self.CANCELLED
+        finally:
+            self.cond.release()
+
+    def cancelled(self):
+        return self.state == self.CANCELLED
+
+    def running(self):
+        return self.state == self.RUNNING
+
+    def done(self):
+        return self.state in (self.FINISHED, self.CANCELLED)
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds (forever if None) for the call to
+        finish or be cancelled. Returns True if it did."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.cond.acquire()
+        try:
+            while not self.done():
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                    self.cond.wait(remaining)
+            return True
+        finally:
+            self.cond.release()
+
+    def exception(self, timeout=None):
+        """Return the exception raised by the call, or None."""
+        if not self.wait(timeout):
+            raise xenrt.XRTError("Timed out after %ss waiting for %s" %
+                                 (timeout, self))
+        if self.cancelled():
+            raise xenrt.XRTError("%s was cancelled" % (self))
+        return self.error
+
+    def result(self, timeout=None):
+        """Return the value returned by the call, raising any exception
+        it raised. Raises XRTError if timeout expires first or the call
+        was cancelled."""
+        e = self.exception(timeout)
+        if e:
+            raise e
+        return self.value
+
+class _Worker(xenrt.XRTThread):
+    def __init__(self, executor):
+        xenrt.XRTThread.__init__(self)
+        self.executor = executor
+        self.setDaemon(True)
+
+    def run(self):
+        self.executor._work(self)
+
+class Executor(object):
+    """Runs calls on a bounded pool of worker threads.
+
+    At most maxWorkers calls run at once (0 for no limit), and at most
+    maxPerTarget calls submitted with the same target (0 for no limit), for
+    example a host, so that a large batch of operations does not open an
+    unbounded number of connections to one machine. Calls that cannot run
+    yet are queued in submission order. Each call runs with the TEC and
+    thread local variables of the thread that submitted it, as if it had
+    been started in its own XRTThread."""
+
+    def __init__(self, maxWorkers=None, maxPerTarget=None):
+        if maxWorkers is None:
+            maxWorkers = int(xenrt.TEC().lookup("EXECUTOR_MAX_WORKERS", "32"))
+        if maxPerTarget is None:
+            maxPerTarget = int(xenrt.TEC().lookup("EXECUTOR_MAX_PER_TARGET", "0"))
+        self.maxWorkers = maxWorkers
+        self.maxPerTarget = maxPerTarget
+        self.cond = threading.Condition()
+        self.queue = []
+        self.active = {}
+        self.workers = []
+        self.idle = 0
+        self.closing = False
+
+    def submit(self, func, *args, **kwargs):
+        """Queue func(*args, **kwargs) and return its Future."""
+        return self.submitTo(None, func, *args, **kwargs)
+
+    def submitTo(self, target, func, *args, **kwargs):
+        """Queue func(*args, **kwargs), counting it against the concurrency
+        limit for target, and return its Future."""
+        future = Future(func, args, kwargs, target)
+        self.cond.acquire()
+        try:
+            if self.closing:
+                raise xenrt.XRTError("Cannot submit to an executor that has "
+                                     "been shut down")
+            self.queue.append(future)
+            if len(self.queue) > self.idle and \
+                    (self.maxWorkers <= 0 or
+                     len(self.workers) < self.maxWorkers):
+                w = _Worker(self)
+                self.workers.append(w)
+                w.start()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        return future
+
+    def map(self, func, *seqs, **kwargs):
+        """Submit func for each set of arguments taken from seqs as map()
+        does, returning the list of Futures in the same order. If target
+        is given it is called with the arguments of each call to get the
+        call's target."""
+        target = kwargs.get("target")
+        return [self.submitTo(target and target(*a), func, *a)
+                for a in zip(*seqs)]
+
+    def _next(self):
+        """Take the first queued call that is allowed to run. Must be called
+        with self.cond held."""
+        for f in self.queue[:]:
+            if f.cancelled():
+                self.queue.remove(f)
+            elif f.target is None or self.maxPerTarget <= 0 or \
+                    self.active.get(f.target, 0) < self.maxPerTarget:
+                self.queue.remove(f)
+                return f
+        return None
+
+    def _work(self, worker):
+        while True:
+            self.cond.acquire()
+            try:
+                while True:
+                    f = self._next()
+                    if f:
+                        break
+                    if self.closing and not self.queue:
+                        self.workers.remove(worker)
+                        return
+                    self.idle += 1
+                    self.cond.wait()
+                    self.idle -= 1
+                if f.target is not None:
+                    self.active[f.target] = self.active.get(f.target, 0) + 1
+            finally:
+                self.cond.release()
+            try:
+                if f._setRunning():
+                    worker.inherit(f.tec, f.parent)
+                    f._run()
+            finally:
+                self.cond.acquire()
+                try:
+                    if f.target is not None:
+                        self.active[f.target] -= 1
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+
+    def shutdown(self, wait=True, cancel=False):
+        """Stop accepting calls. Workers exit once the queue is empty. If
+        cancel is True queued calls are cancelled, if wait is True block
+        until the workers have exited."""
+        self.cond.acquire()
+        try:
+            self.closing = True
+            if cancel:
+                for f in self.queue:
+                    f.cancel()
+                self.queue = []
+            workers = self.workers[:]
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        if wait:
+            for w in workers:
+                w.join()
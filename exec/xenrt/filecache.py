@@ -8,11 +8,534 @@
 # conditions as licensed by XenSource, Inc. All other rights reserved.
 #
 
-import stat, os, os.path, urllib, time
+import stat, os, os.path, urllib, time, errno, fcntl, hashlib, json, shutil, atexit
+import socket, tempfile, select, ctypes, ctypes.util
 import xenrt
-from random import choice
 
-__all__ = ["FileCache"]
+__all__ = ["FileCache", "CacheStore"]
+
+class _DirWatch(object):
+    """Wakes a waiter when a file in a directory is closed after writing,
+    or one is added or removed, using inotify. Where inotify isn't
+    available, or the change is made on another NFS client, wait just
+    sleeps for the timeout."""
+
+    IN_CLOSE_WRITE = 0x008
+    IN_MOVED_TO = 0x080
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+
+    def __init__(self, path):
+        self.fd = None
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+            fd = libc.inotify_init()
+        except (OSError, AttributeError):
+            return
+        if fd < 0:
+            return
+        mask = self.IN_CLOSE_WRITE | self.IN_MOVED_TO | self.IN_CREATE | self.IN_DELETE
+        if libc.inotify_add_watch(fd, path, mask) < 0:
+            os.close(fd)
+            return
+        self.fd = fd
+
+    def wait(self, timeout):
+        if self.fd is None:
+            time.sleep(timeout)
+            return
+        try:
+            if select.select([self.fd], [], [], timeout)[0]:
+                os.read(self.fd, 65536)
+        except (select.error, OSError), e:
+            if e.args[0] != errno.EINTR:
+                raise
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+class _FetchLock(object):
+    """A held fetch lock. The lock file is also kept open for writing, so
+    closing it, or the holder dying, wakes any waiters watching the
+    directory."""
+
+    def __init__(self, path, lockfile, owner):
+        self.lockfile = lockfile
+        self.notifier = open(path, "r+")
+        self.notifier.truncate()
+        self.notifier.write(owner)
+        self.notifier.flush()
+
+    def close(self):
+        self.lockfile.close()
+        self.notifier.close()
+
+class CacheStore(object):
+    """A shared store of downloaded files, kept under the SHA-256 digest of
+    their content so a file published under several names is only stored
+    once.
+
+    Layout under the root directory:
+        blobs/<digest>          the files
+        keys/<hash of key>      JSON index entry mapping a key (normally a
+                                URL) to a digest, with the validators
+                                (ETag, Last-Modified, size) of the source
+                                when it was fetched
+        partial/<hash of key>/  files being fetched
+        partial/<hash of key>.fetching
+                                locked by the process fetching the key
+        pins/<host>-<pid>/      hard links to blobs a process is using
+                                through a symlink
+        stats                   cumulative hit, miss and eviction counts
+
+    Once the blobs exceed the budget the least recently used are evicted.
+    A blob with more than one link is in use, by a per-job hard link or a
+    pin, and is never evicted.
+    """
+
+    LAYOUT = ["blobs", "keys", "partial", "pins", "stats", ".lock"]
+    COUNTERS = ["hits", "misses", "stale", "added", "deduplicated",
+                "evicted", "evictedBytes"]
+    # Pins left by processes on other hosts are assumed to be stale after
+    # this long
+    PIN_TTL = 2 * 86400
+    # How often to retry a fetch lock if no change is seen in the
+    # directory, which happens when it is held from another NFS client
+    FETCH_POLL = 10
+    # How often to add the counts to the stats file
+    STATS_INTERVAL = 60
+
+    def __init__(self, root, budget=None):
+        """budget is a number of bytes, or a percentage of the filesystem
+        size (e.g. "80%"). If it is not set the store is not bounded."""
+        self.root = root
+        self.budget = budget
+        for d in ["blobs", "keys", "partial", "pins"]:
+            if not os.path.exists("%s/%s" % (root, d)):
+                try:
+                    os.makedirs("%s/%s" % (root, d))
+                except OSError, e:
+                    if e.errno != errno.EEXIST:
+                        raise
+        self.owner = "%s-%d" % (socket.gethostname(), os.getpid())
+        self.stats = dict([(c, 0) for c in self.COUNTERS])
+        self.pendingStats = {}
+        self.statsWritten = time.time()
+        atexit.register(self._flushStatsAtExit)
+
+    def _keyHash(self, key):
+        return hashlib.sha256(key).hexdigest()
+
+    def _keyPath(self, key):
+        return "%s/keys/%s" % (self.root, self._keyHash(key))
+
+    def blobPath(self, digest):
+        return "%s/blobs/%s" % (self.root, digest)
+
+    def partialPath(self, key, filename):
+        """Returns where to fetch the file for key to before adding it.
+        The path is the same each time for a key, so a fetch can resume
+        from where an earlier one stopped."""
+        dirname = "%s/partial/%s" % (self.root, self._keyHash(key))
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        return "%s/%s" % (dirname, filename)
+
+    def fetchingPath(self, key):
+        return "%s/partial/%s.fetching" % (self.root, self._keyHash(key))
+
+    def _openFetching(self, path, create=True):
+        # Waiters open the lock file read only, so that only its holder
+        # closing it wakes them
+        try:
+            return open(path, "r")
+        except IOError, e:
+            if e.errno != errno.ENOENT or not create:
+                raise
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            os.fchmod(fd, 0666)
+        except OSError:
+            # Created by another user
+            pass
+        os.close(fd)
+        return open(path, "r")
+
+    def lockFetch(self, key, timeout, owner=None):
+        """Block until this process is the only one fetching key, returning
+        a lock to close once the fetch has been added to the store. The
+        caller should check whether the key was added while it waited.
+
+        The lock is released by the kernel if its holder dies, so a fetch
+        abandoned by a dead job is taken over straight away. Raises
+        XRTError if the lock isn't acquired within timeout seconds."""
+        path = self.fetchingPath(key)
+        f = self._lockFetching(path, key, timeout, True)
+        return _FetchLock(path, f, "%s (%s)" % (owner or "nojob", self.owner))
+
+    def waitForFetch(self, key, timeout):
+        """Block until no other process is fetching key"""
+        f = self._lockFetching(self.fetchingPath(key), key, timeout, False)
+        if f:
+            f.close()
+
+    def _lockFetching(self, path, key, timeout, create):
+        deadline = time.time() + timeout
+        watch = None
+        try:
+            while True:
+                try:
+                    f = self._openFetching(path, create)
+                except IOError, e:
+                    if not create and e.errno == errno.ENOENT:
+                        return None
+                    raise
+                try:
+                    fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except IOError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        f.close()
+                        raise
+                    holder = f.read().strip() or "another job"
+                    f.close()
+                    if not watch:
+                        xenrt.TEC().logverbose("Waiting for %s to fetch %s" % (holder, key))
+                        watch = _DirWatch(os.path.dirname(path))
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        raise xenrt.XRTError("Timed out after %ds waiting for %s to fetch %s" % (timeout, holder, key))
+                    # The holder closing the lock file wakes us up
+                    watch.wait(min(remaining, self.FETCH_POLL))
+                    continue
+                # cleanup may have removed the file before we locked it
+                try:
+                    if os.fstat(f.fileno()).st_ino != os.stat(path).st_ino:
+                        f.close()
+                        continue
+                except OSError:
+                    f.close()
+                    continue
+                return f
+        finally:
+            if watch:
+                watch.close()
+
+    def _lock(self):
+        f = open("%s/.lock" % (self.root), "a")
+        fcntl.flock(f, fcntl.LOCK_EX)
+        return f
+
+    def _writeJSON(self, path, data):
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp")
+        f = os.fdopen(fd, "w")
+        try:
+            json.dump(data, f)
+        finally:
+            f.close()
+        os.chmod(tmp, stat.S_IRUSR | stat.S_IWUSR | stat.S_IRGRP | stat.S_IWGRP | stat.S_IROTH)
+        os.rename(tmp, path)
+
+    def _count(self, **deltas):
+        for (c, n) in deltas.items():
+            self.stats[c] += n
+            self.pendingStats[c] = self.pendingStats.get(c, 0) + n
+        if time.time() - self.statsWritten >= self.STATS_INTERVAL:
+            self.flushStats()
+
+    def flushStats(self):
+        """Add the counts since the last flush to the stats file"""
+        self.statsWritten = time.time()
+        if not self.pendingStats:
+            return
+        (deltas, self.pendingStats) = (self.pendingStats, {})
+        f = self._lock()
+        try:
+            try:
+                totals = json.load(open("%s/stats" % (self.root)))
+            except (IOError, ValueError):
+                totals = {}
+            for (c, n) in deltas.items():
+                totals[c] = totals.get(c, 0) + n
+            self._writeJSON("%s/stats" % (self.root), totals)
+        finally:
+            f.close()
+
+    def _flushStatsAtExit(self):
+        try:
+            self.flushStats()
+        except (IOError, OSError):
+            pass
+
+    def getEntry(self, key):
+        """Returns the index entry for key, or None"""
+        try:
+            return json.load(open(self._keyPath(key)))
+        except (IOError, ValueError):
+            return None
+
+    def isStale(self, entry, validators):
+        """Returns True if validators (a dictionary of etag, lastModified
+        and size, any of which may be missing) show the source of entry has
+        changed since it was fetched"""
+        stale = False
+        for v in ["etag", "lastModified"]:
+            if entry.get(v) and validators.get(v):
+                stale = entry[v] != validators[v]
+                break
+        else:
+            if validators.get("size") is not None:
+                stale = entry.get("size") != validators["size"]
+        if stale:
+            self._count(stale=1)
+        return stale
+
+    def lookup(self, key):
+        """Returns the path of the blob stored for key, or None"""
+        entry = self.getEntry(key)
+        if entry:
+            blob = self.blobPath(entry["digest"])
+            if os.path.exists(blob):
+                try:
+                    # The modification time records when the blob was last
+                    # used
+                    os.utime(blob, None)
+                except OSError:
+                    pass
+                self._count(hits=1)
+                return blob
+            # The blob has been evicted
+            self._removeKey(key)
+        self._count(misses=1)
+        return None
+
+    def add(self, key, path, validators=None, evict=True):
+        """Move the file at path into the store under key, returning the
+        path of its blob. If evict is False the caller must call evict once
+        it has linked to the blob."""
+        h = hashlib.sha256()
+        f = open(path, "rb")
+        try:
+            while True:
+                data = f.read(xenrt.MEGA)
+                if not data:
+                    break
+                h.update(data)
+        finally:
+            f.close()
+        digest = h.hexdigest()
+        blob = self.blobPath(digest)
+        os.chmod(path, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
+        try:
+            os.link(path, blob)
+            self._count(added=1)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+            xenrt.TEC().logverbose("%s is already cached as %s" % (key, digest))
+            self._count(deduplicated=1)
+        os.unlink(path)
+        entry = {"key": key, "digest": digest, "size": os.stat(blob).st_size, "added": time.time()}
+        if validators:
+            for v in ["etag", "lastModified"]:
+                if validators.get(v):
+                    entry[v] = validators[v]
+        self._writeJSON(self._keyPath(key), entry)
+        try:
+            os.utime(blob, None)
+        except OSError:
+            pass
+        if evict:
+            self.evict()
+        return blob
+
+    def pin(self, blob):
+        """Keep the blob from being evicted until releasePins is called or
+        this process exits. Returns False if it has already been evicted."""
+        pindir = "%s/pins/%s" % (self.root, self.owner)
+        if not os.path.exists(pindir):
+            os.makedirs(pindir)
+        try:
+            os.link(blob, "%s/%s" % (pindir, os.path.basename(blob)))
+        except OSError, e:
+            if e.errno == errno.ENOENT:
+                return False
+            if e.errno != errno.EEXIST:
+                raise
+        return True
+
+    def view(self, blob, dest, symlink=False):
+        """Make the blob available at dest with a hard link, or a symlink
+        if dest is on a different filesystem. Symlinked blobs are pinned
+        until releasePins is called."""
+        if symlink:
+            if not self.pin(blob):
+                raise OSError(errno.ENOENT, "%s has been evicted" % (blob))
+            os.symlink(blob, dest)
+        else:
+            os.link(blob, dest)
+
+    def releasePins(self):
+        shutil.rmtree("%s/pins/%s" % (self.root, self.owner), ignore_errors=True)
+
+    def _expirePins(self):
+        host = socket.gethostname()
+        for owner in os.listdir("%s/pins" % (self.root)):
+            path = "%s/pins/%s" % (self.root, owner)
+            try:
+                (ownerhost, pid) = owner.rsplit("-", 1)
+                pid = int(pid)
+            except ValueError:
+                continue
+            if ownerhost == host:
+                try:
+                    os.kill(pid, 0)
+                    continue
+                except OSError, e:
+                    if e.errno != errno.ESRCH:
+                        continue
+            elif time.time() - os.stat(path).st_mtime < self.PIN_TTL:
+                continue
+            xenrt.TEC().logverbose("Removing stale cache pins %s" % (path))
+            shutil.rmtree(path, ignore_errors=True)
+
+    def budgetBytes(self):
+        """Returns the budget in bytes, or None if the store is unbounded"""
+        if not self.budget:
+            return None
+        budget = str(self.budget).strip()
+        if budget.endswith("%"):
+            st = os.statvfs(self.root)
+            return int(st.f_blocks * st.f_frsize * float(budget[:-1]) / 100)
+        return int(budget) or None
+
+    def _blobs(self):
+        blobs = []
+        for name in os.listdir("%s/blobs" % (self.root)):
+            try:
+                blobs.append((name, os.stat(self.blobPath(name))))
+            except OSError:
+                pass
+        return blobs
+
+    def evict(self):
+        """Evict least recently used blobs that are not in use until the
+        store is within its budget"""
+        limit = self.budgetBytes()
+        if not limit:
+            return
+        evicted = 0
+        evictedBytes = 0
+        f = self._lock()
+        try:
+            self._expirePins()
+            blobs = self._blobs()
+            total = sum([st.st_size for (name, st) in blobs])
+            if total <= limit:
+                return
+            candidates = [(st.st_mtime, name, st.st_size) for (name, st) in blobs if st.st_nlink == 1]
+            candidates.sort()
+            for (mtime, name, size) in candidates:
+                if total <= limit:
+                    break
+                try:
+                    os.unlink(self.blobPath(name))
+                except OSError:
+                    continue
+                total -= size
+                evicted += 1
+                evictedBytes += size
+            if total > limit:
+                xenrt.TEC().warning("File cache %s is over its budget with files in use" % (self.root))
+        finally:
+            f.close()
+        if evicted:
+            xenrt.TEC().logverbose("Evicted %d files (%d bytes) from %s" % (evicted, evictedBytes, self.root))
+            self._count(evicted=evicted, evictedBytes=evictedBytes)
+
+    def _removeKey(self, key):
+        try:
+            os.unlink(self._keyPath(key))
+        except OSError:
+            pass
+
+    def remove(self, key):
+        """Remove key from the store, and its blob unless it is in use or
+        stored under another key. Returns False if key was not stored."""
+        entry = self.getEntry(key)
+        if not entry:
+            return False
+        self._removeKey(key)
+        f = self._lock()
+        try:
+            for k in os.listdir("%s/keys" % (self.root)):
+                try:
+                    if json.load(open("%s/keys/%s" % (self.root, k)))["digest"] == entry["digest"]:
+                        return True
+                except (IOError, ValueError, KeyError):
+                    pass
+            blob = self.blobPath(entry["digest"])
+            if os.path.exists(blob) and os.stat(blob).st_nlink == 1:
+                os.unlink(blob)
+        finally:
+            f.close()
+        return True
+
+    def cleanup(self, days):
+        """Remove blobs not used and partial fetches not touched for days,
+        and index entries for blobs that have gone"""
+        cutoff = time.time() - days * 86400
+        f = self._lock()
+        try:
+            self._expirePins()
+            for (name, st) in self._blobs():
+                if st.st_nlink == 1 and st.st_mtime < cutoff:
+                    xenrt.TEC().logverbose("Removing %s" % (self.blobPath(name)))
+                    os.unlink(self.blobPath(name))
+            for k in os.listdir("%s/keys" % (self.root)):
+                try:
+                    digest = json.load(open("%s/keys/%s" % (self.root, k)))["digest"]
+                except (IOError, ValueError, KeyError):
+                    digest = None
+                if not digest or not os.path.exists(self.blobPath(digest)):
+                    os.unlink("%s/keys/%s" % (self.root, k))
+            for p in os.listdir("%s/partial" % (self.root)):
+                path = "%s/partial/%s" % (self.root, p)
+                if os.path.getmtime(path) < cutoff:
+                    if os.path.isdir(path):
+                        xenrt.TEC().logverbose("Removing %s" % (path))
+                        shutil.rmtree(path, ignore_errors=True)
+                        continue
+                    lf = self._openFetching(path)
+                    try:
+                        try:
+                            fcntl.flock(lf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                        except IOError:
+                            # Still being fetched
+                            continue
+                        xenrt.TEC().logverbose("Removing %s" % (path))
+                        os.unlink(path)
+                    finally:
+                        lf.close()
+        finally:
+            f.close()
+
+    def getSummary(self):
+        """Returns the size and usage of the store and its cumulative hit,
+        miss and eviction counts"""
+        self.flushStats()
+        blobs = self._blobs()
+        try:
+            totals = json.load(open("%s/stats" % (self.root)))
+        except (IOError, ValueError):
+            totals = {}
+        summary = dict([(c, totals.get(c, 0)) for c in self.COUNTERS])
+        summary["files"] = len(blobs)
+        summary["bytes"] = sum([st.st_size for (name, st) in blobs])
+        summary["inUse"] = len([name for (name, st) in blobs if st.st_nlink > 1])
+        summary["budget"] = self.budgetBytes()
+        return summary
 
 class FileCache(object):
     """XenRT File Cache"""
@@ -26,67 +549,47 @@ class FileCache(object):
             raise xenrt.XRTError("CACHE_PATH not specified!")
 
         self.path = "%s/%s" % (basedir,type)
-
-        # Check it exists, if not create it
-        if not os.path.exists(self.path):
-            os.makedirs(self.path)
+        self.store = CacheStore(self.path, xenrt.TEC().lookup("CACHE_SIZE", None))
 
     def getURL(self,URL):
-        """Get the file specified by the URL, returns a local path"""
+        """Get the file specified by the URL, returns a local path. The
+        file is pinned, so it isn't evicted while this process runs."""
 
         fn = os.path.basename(URL)
-        filepath = "%s/%s" % (self.path,fn)
 
         # First see if it already exists
-        if os.path.exists(filepath):
+        filepath = self.store.lookup(URL)
+        if filepath and self.store.pin(filepath):
             return filepath
 
-        flagpath = "%s/%s.fetching" % (self.path,fn)
-
-        # See if there's a .fetching file
-        if os.path.exists(flagpath):
-            # Poll waiting for it to appear or for the downloading file to
-            # disappear (with a timeout)
-            xenrt.TEC().logverbose("Waiting for another process to fetch %s" % 
-                                   (fn))
-            deadline = xenrt.util.timenow() + 1800
-            while not os.path.exists(filepath):
-                if not os.path.exists(flagpath):
-                    # Apparently it's downloaded or aborted
-                    break
-                if xenrt.util.timenow() > deadline:
-                    xenrt.TEC().logverbose("Timed out waiting for %s, will "
-                                           "fetch here..." % (fn))
-                    break
-                xenrt.sleep(60)
-
-            if os.path.exists(filepath):
-                return filepath
-
-        # Download it ourselves...
-        xenrt.TEC().logverbose("Fetching %s" % (fn))
-        f = file(flagpath, "w")
-        f.write("%u" % (xenrt.util.timenow()))
-        f.close()
-        os.chmod(flagpath,
-                 stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
+        # Only one process fetches the file, any others wait for it
+        try:
+            fetchLock = self.store.lockFetch(URL, 1800, owner=str(xenrt.GEC().jobid()))
+        except xenrt.XRTError, e:
+            xenrt.TEC().logverbose("%s, will fetch here..." % (e))
+            return self.__fetch(URL, fn)
+        try:
+            if self.store.getEntry(URL):
+                filepath = self.store.lookup(URL)
+                if filepath and self.store.pin(filepath):
+                    return filepath
 
-        rand = ""
-        chars = "ABCDEFGHIJKLMNOPQRSTUVWXYZ"
-        for i in range(8):
-            rand += choice(chars)
+            xenrt.TEC().logverbose("Fetching %s" % (fn))
+            return self.__fetch(URL, fn)
+        finally:
+            fetchLock.close()
 
-        tf = "%s.%s" % (filepath,rand)
+    def __fetch(self, URL, fn):
+        (fd, tf) = tempfile.mkstemp(prefix=fn,
+                                    dir=os.path.dirname(self.store.partialPath(URL, fn)))
+        os.close(fd)
         try:
-            try:
-                urllib.urlretrieve(URL, tf)
-                os.link(tf,filepath)
+            urllib.urlretrieve(URL, tf)
+            blob = self.store.add(URL, tf, evict=False)
+        except Exception, e:
+            if os.path.exists(tf):
                 os.unlink(tf)
-            except Exception, e:
-                raise xenrt.XRTError("Exception fetching %s: %s" % (URL,e))
-        finally:
-            # Make it clear we aren't downloading it any more
-            os.unlink(flagpath)
-
-        return filepath
-
+            raise xenrt.XRTError("Exception fetching %s: %s" % (URL,e))
+        self.store.pin(blob)
+        self.store.evict()
+        return blob
@@ -1,7 +1,7 @@
 
-import sys, string, os.path, threading, os, shutil, tempfile, stat, hashlib
-import time, urlparse, glob, re, requests
-import xenrt, xenrt.util, xenrt.ssh
+import sys, string, os.path, threading, os, shutil, tempfile, hashlib
+import time, urlparse, glob, re, requests, json
+import xenrt, xenrt.util, xenrt.ssh, xenrt.filecache
 
 __all__ = ["getFileManager"]
 
@@ -129,73 +129,153 @@ class FileNameResolver(object):
 class FileManager(object):
     def __init__(self):
         self.cachedir = xenrt.TempDirectory().path()
+        # Protects fileLocks and stats. Only ever held briefly, fetches hold
+        # the lock for the file being fetched
         self.lock = threading.Lock()
+        self.fileLocks = {}
+        self.fetches = threading.BoundedSemaphore(\
+            int(xenrt.TEC().lookup("FILE_MANAGER_MAX_FETCHES", "4")))
+        self.stats = {"hits": 0, "fetches": 0, "bytes": 0, "seconds": 0.0}
+        self.stores = {}
         self.defaultFetchTimeout = 3600
         self.externalFetchTimeout = 6 * 3600
 
+    def _fileLock(self, localName):
+        self.lock.acquire()
+        try:
+            if not self.fileLocks.has_key(localName):
+                self.fileLocks[localName] = threading.Lock()
+            return self.fileLocks[localName]
+        finally:
+            self.lock.release()
+
+    def _head(self, url):
+        """Returns the size of url, whether the server accepts range
+        requests for it, and the validators to store it in the cache with.
+        The size is None if we can't tell."""
+        r = requests.head(url, allow_redirects=True, proxies=self.__proxies)
+        if r.status_code == 200 and 'content-length' in r.headers:
+            return (int(r.headers['content-length']),
+                    r.headers.get('accept-ranges') == "bytes",
+                    {"etag": r.headers.get('etag'),
+                     "lastModified": r.headers.get('last-modified')})
+        return (None, False, None)
+
     def getFile(self, filename, multiple=False, replaceExistingIfDiffers=False):
+        fileLock = None
+        fetchLock = None
         try:
             xenrt.TEC().logverbose("getFile %s" % filename)
-            self.lock.acquire()
             sharedLocation = None
             isUsingExternalCache = False
             fnr = FileNameResolver(filename, multiple)
             url = fnr.url
             localName = fnr.localName
+            # Only fetches of the same file need to wait for each other
+            fileLock = self._fileLock(localName)
+            fileLock.acquire()
             cache = self.__availableInCache(fnr, replaceExistingIfDiffers=replaceExistingIfDiffers)
             if cache:
+                self.lock.acquire()
+                self.stats["hits"] += 1
+                self.lock.release()
                 return cache
 
             else:
-                sharedLocation = self._sharedCacheLocation(localName)
+                store = self._sharedStore()
                 # Check file size and decide which global cache to use. If file size is greater than
                 # FILE_SIZE_CACHE_LIMIT, we cache file on external storage.
+                size = None
+                ranges = False
+                validators = None
                 try:
                     fileSizeThreshold = float(xenrt.TEC().lookup("FILE_SIZE_CACHE_LIMIT", str(1 * xenrt.GIGA)))
-                    if fnr.isSimpleFile:
-                        r = requests.head(fnr.url, allow_redirects=True)
-                        if r.status_code == 200 and 'content-length' in r.headers and \
-                            float(r.headers['content-length']) > fileSizeThreshold:
+                    if fnr.isSimpleFile and not filename.startswith("sftp://"):
+                        (size, ranges, validators) = self._head(fnr.url)
+                        if size and size > fileSizeThreshold:
                             xenrt.TEC().logverbose("Using external cache")
-                            sharedLocation = self._externalCacheLocation(localName)
+                            store = self._externalStore()
                             isUsingExternalCache = True
                 except Exception, e:
                     xenrt.TEC().warning('Reverting:Using internal shared cache. File Manager failed: %s' % e)
 
+                sharedLocation = store.partialPath(localName, self._filename(localName))
                 perJobLocation = self._perJobCacheLocation(localName)
-                f = open("%s.fetching" % sharedLocation, "w")
-                f.write(str(xenrt.GEC().jobid()) or "nojob")
-                f.close()
-
-                if multiple:
-                    self.getMultipleFiles(url, sharedLocation)
-                elif fnr.directory:
-                    self.getDirectory(url, sharedLocation)
-                elif fnr.singleFileWithWildcard:
-                    self.getSingleFileWithWildcard(url, sharedLocation)
-                elif filename.startswith("sftp://"):
-                    self.getSingleFileViaSftp(filename, sharedLocation)
-                else:
-                    self.getSingleFile(url, sharedLocation, isUsingExternalCache)
-                os.chmod(sharedLocation, stat.S_IRWXU | stat.S_IRWXG | stat.S_IROTH | stat.S_IXOTH)
-
-                if isUsingExternalCache:
-                    os.symlink(sharedLocation, perJobLocation)
-                else:
-                    os.link(sharedLocation, perJobLocation)
+                timeout = isUsingExternalCache and self.externalFetchTimeout or self.defaultFetchTimeout
+                fetchLock = store.lockFetch(localName, timeout, owner=self._fetchOwner())
+                # Another job may have fetched it since we looked
+                if store.getEntry(localName):
+                    blob = store.lookup(localName)
+                    if blob:
+                        store.view(blob, perJobLocation, symlink=isUsingExternalCache)
+                        return perJobLocation
+
+                self.fetches.acquire()
+                try:
+                    started = time.time()
+                    if multiple:
+                        self.getMultipleFiles(url, sharedLocation)
+                    elif fnr.directory:
+                        self.getDirectory(url, sharedLocation)
+                    elif fnr.singleFileWithWildcard:
+                        self.getSingleFileWithWildcard(url, sharedLocation)
+                    elif filename.startswith("sftp://"):
+                        self.getSingleFileViaSftp(filename, sharedLocation)
+                    else:
+                        self.getSingleFile(url, sharedLocation, isUsingExternalCache, size=size, ranges=ranges)
+                    self._logFetch(filename, sharedLocation, time.time() - started)
+                finally:
+                    self.fetches.release()
+
+                blob = store.add(localName, sharedLocation, validators, evict=False)
+                store.view(blob, perJobLocation, symlink=isUsingExternalCache)
+                store.evict()
                 return perJobLocation
         except Exception, e:
             xenrt.TEC().logverbose("Warning - could not fetch %s - %s" % (filename, e))
             return None
         finally:
-            if sharedLocation:
-                os.unlink("%s.fetching" % sharedLocation)
+            if fetchLock:
+                fetchLock.close()
+            if fileLock:
+                fileLock.release()
+
+    def _fetchOwner(self):
+        return "job %s" % (xenrt.GEC().jobid() or "nojob")
+
+    def _logFetch(self, filename, location, elapsed):
+        size = os.path.exists(location) and os.stat(location).st_size or 0
+        xenrt.TEC().logverbose("Fetched %s: %d bytes in %.1fs (%.2f MB/s)" %
+                               (filename, size, elapsed,
+                                size / float(xenrt.MEGA) / max(elapsed, 0.001)))
+        self.lock.acquire()
+        try:
+            self.stats["fetches"] += 1
+            self.stats["bytes"] += size
+            self.stats["seconds"] += elapsed
+        finally:
             self.lock.release()
 
-    def getSingleFile(self, url, sharedLocation, isUsingExternalCache=False):
+    def getStats(self):
+        """Returns the number of cache hits and the number, total size and
+        total duration of fetches so far"""
+        self.lock.acquire()
+        try:
+            stats = dict(self.stats)
+            stats["caches"] = dict([(root, dict(store.stats)) for (root, store) in self.stores.items()])
+            return stats
+        finally:
+            self.lock.release()
+
+    def getSingleFile(self, url, sharedLocation, isUsingExternalCache=False, size=None, ranges=False):
+        # Increase timeout if using external nfs.
+        timeout = self.externalFetchTimeout if isUsingExternalCache else self.defaultFetchTimeout
+        segments = int(xenrt.TEC().lookup("FILE_MANAGER_SEGMENTS", "4"))
+        threshold = int(xenrt.TEC().lookup("FILE_MANAGER_SEGMENT_THRESHOLD", str(64 * xenrt.MEGA)))
+        if ranges and size >= threshold and segments > 1:
+            self.getSingleFileInSegments(url, sharedLocation, size, segments, timeout)
+            return
         try:
-            # Increase timeout if using external nfs.
-            timeout = self.externalFetchTimeout if isUsingExternalCache else self.defaultFetchTimeout
             xenrt.util.command("wget%s -nv '%s' -O '%s.part'" % (self.__proxyflag, url, sharedLocation), timeout=timeout)
         except:
             os.unlink('%s.part' % sharedLocation)
@@ -203,6 +283,93 @@ class FileManager(object):
         else:
             os.rename('%s.part' % sharedLocation, sharedLocation)
 
+    def getSingleFileInSegments(self, url, sharedLocation, size, segments, timeout):
+        """
+        Fetch a file with several range requests in parallel. Progress is
+        saved alongside the partial file, so a fetch that fails can be
+        resumed by a later one.
+        """
+        part = "%s.part" % sharedLocation
+        statefile = "%s.segments" % sharedLocation
+        state = None
+        try:
+            if os.path.exists(part):
+                state = json.load(open(statefile))
+                if state['url'] != url or state['size'] != size or os.stat(part).st_size != size:
+                    state = None
+        except Exception:
+            state = None
+        if state:
+            done = sum([s[2] for s in state['segments']])
+            xenrt.TEC().logverbose("Resuming fetch of %s with %d of %d bytes already fetched" % (url, done, size))
+        else:
+            segsize = (size + segments - 1) / segments
+            state = {'url': url, 'size': size,
+                     'segments': [[i, min(i + segsize, size), 0] for i in range(0, size, segsize)]}
+            f = open(part, "wb")
+            f.truncate(size)
+            f.close()
+            self._saveSegments(statefile, state)
+
+        stateLock = threading.Lock()
+        deadline = time.time() + timeout
+        executor = xenrt.Executor(maxWorkers=len(state['segments']))
+        try:
+            futures = [executor.submit(self._fetchSegment, url, part, seg, statefile, state, stateLock, deadline)
+                       for seg in state['segments'] if seg[0] + seg[2] < seg[1]]
+        finally:
+            executor.shutdown(wait=False)
+        errors = [x for x in [fut.exception(max(0, deadline - time.time()) + 60) for fut in futures] if x]
+        if errors:
+            raise errors[0]
+        os.rename(part, sharedLocation)
+        os.unlink(statefile)
+
+    def _saveSegments(self, statefile, state):
+        f = open("%s.tmp" % statefile, "w")
+        json.dump(state, f)
+        f.close()
+        os.rename("%s.tmp" % statefile, statefile)
+
+    def _fetchSegment(self, url, part, seg, statefile, state, stateLock, deadline):
+        # seg is [start, end, bytes fetched so far]
+        offset = seg[0] + seg[2]
+        r = requests.get(url, headers={"Range": "bytes=%d-%d" % (offset, seg[1] - 1)},
+                         stream=True, proxies=self.__proxies, timeout=60)
+        try:
+            if r.status_code != 206:
+                raise xenrt.XRTError("Range request for %s returned %d" % (url, r.status_code))
+            f = open(part, "r+b")
+            try:
+                f.seek(offset)
+                saved = time.time()
+                for data in r.iter_content(xenrt.MEGA):
+                    data = data[:seg[1] - seg[0] - seg[2]]
+                    f.write(data)
+                    seg[2] += len(data)
+                    if time.time() > deadline:
+                        raise xenrt.XRTError("Timed out fetching %s" % url)
+                    if time.time() - saved > 10:
+                        # Only record what has reached the file
+                        f.flush()
+                        stateLock.acquire()
+                        try:
+                            self._saveSegments(statefile, state)
+                        finally:
+                            stateLock.release()
+                        saved = time.time()
+            finally:
+                f.close()
+                stateLock.acquire()
+                try:
+                    self._saveSegments(statefile, state)
+                finally:
+                    stateLock.release()
+        finally:
+            r.close()
+        if seg[0] + seg[2] != seg[1]:
+            raise xenrt.XRTError("Fetched %d of %d bytes of %s" % (seg[2], seg[1] - seg[0], url))
+
     def getSingleFileWithWildcard(self, url, sharedLocation):
         try:
             t = xenrt.resources.TempDirectory()
@@ -263,6 +430,14 @@ class FileManager(object):
         else:
             os.rename('%s.part' % sharedLocation, sharedLocation)
 
+    @property
+    def __proxies(self):
+        proxy = xenrt.TEC().lookup("HTTP_PROXY", None)
+        if proxy:
+            return {"http": proxy}
+        else:
+            return None
+
     @property
     def __proxyflag(self):
         proxy = xenrt.TEC().lookup("HTTP_PROXY", None)
@@ -274,11 +449,21 @@ class FileManager(object):
     def _filename(self, filename):
         return filename.rstrip("/").split("/")[-1]
 
-    def _sharedCacheLocation(self, filename):
-        dirname = "%s/%s" % (xenrt.TEC().lookup("FILE_MANAGER_CACHE"), hashlib.sha256(filename).hexdigest())
-        if not os.path.exists(dirname):
-            os.makedirs(dirname)
-        return "%s/%s" % (dirname, self._filename(filename))
+    def _store(self, root, budget):
+        self.lock.acquire()
+        try:
+            if not self.stores.has_key(root):
+                self.stores[root] = xenrt.filecache.CacheStore(root, budget)
+            return self.stores[root]
+        finally:
+            self.lock.release()
+
+    def _cacheDirs(self):
+        return [(xenrt.TEC().lookup("FILE_MANAGER_CACHE"), xenrt.TEC().lookup("FILE_MANAGER_CACHE_SIZE", None)),
+                (xenrt.TEC().lookup("FILE_MANAGER_CACHE_NFS"), xenrt.TEC().lookup("FILE_MANAGER_CACHE_NFS_SIZE", None))]
+
+    def _sharedStore(self):
+        return self._store(*self._cacheDirs()[0])
 
     def _perJobCacheLocation(self, filename):
         dirname = "%s/%s" % (self.cachedir, hashlib.sha256(filename).hexdigest())
@@ -286,46 +471,46 @@ class FileManager(object):
             os.makedirs(dirname)
         return "%s/%s" % (dirname, self._filename(filename))
 
-    def _externalCacheLocation(self, filename, ignoreError=False):
+    def _externalStore(self, ignoreError=False):
         try:
             cachedir=xenrt.TEC().lookup("FILE_MANAGER_CACHE_NFS")
             if os.path.exists(cachedir) and xenrt.command("stat -f -c %%T %s" % cachedir, nolog=True).strip() == "nfs":
-                dirname = "%s/%s" % (cachedir, hashlib.sha256(filename).hexdigest())
-                if not os.path.exists(dirname):
-                    os.makedirs(dirname)
-                return "%s/%s" % (dirname, self._filename(filename))
+                return self._store(*self._cacheDirs()[1])
             elif os.path.exists(cachedir):
                 raise xenrt.XRTError("External cache directory exists but is not external storage.")
         except Exception, e:
             if not ignoreError:
-                raise xenrt.XRTError("_externalCacheLocation: %s" % str(e))
+                raise xenrt.XRTError("_externalStore: %s" % str(e))
         return None
 
+    def _globalStores(self):
+        stores = [self._sharedStore()]
+        external = self._externalStore(ignoreError=True)
+        if external:
+            stores.append(external)
+        return stores
+
     def removeFromCache(self, filename):
         fnr = FileNameResolver(filename, False)
         url = fnr.url
-        globalCaches = []
         # try for both, filename and resolved filename
         for f in [filename, url]:
-            globalCaches.append(self._sharedCacheLocation(f))
-            externalLocation = self._externalCacheLocation(f, ignoreError=True)
-            if externalLocation: 
-                globalCaches.append(externalLocation)
+            for store in self._globalStores():
+                if store.remove(f):
+                    xenrt.TEC().logverbose("Found %s in cache %s" % (f, store.root))
+                    return
 
-        for cache in globalCaches:
-            if os.path.exists(cache):
-                xenrt.TEC().logverbose("Found %s in cache" % cache)
-                os.unlink(cache)
-                return
+    def releaseViews(self):
+        """Release the files this process is using from the external cache
+        through symlinks, so they can be evicted"""
+        for store in self.stores.values():
+            store.releasePins()
 
     def __availableInCache(self, fnr, replaceExistingIfDiffers=False):
 
         filename = fnr.localName
         perJobLocation = self._perJobCacheLocation(filename)
-        globalCaches = [self._sharedCacheLocation(filename)]
-        externalLocation = self._externalCacheLocation(filename, ignoreError=True)
-        if externalLocation: 
-            globalCaches.append(externalLocation)
+        externalStore = self._externalStore(ignoreError=True)
 
         # First try the per-job cache
         if os.path.exists(perJobLocation):
@@ -333,68 +518,50 @@ class FileManager(object):
             return perJobLocation
 
         # If it's not in the per-job cache, try the global cache(s)
-        ## First, if someone else is fetching, wait until fetching is complete
-        for cache in globalCaches:
-            if os.path.exists("%s.fetching" % cache):
-                xenrt.TEC().logverbose("File is fetching - waiting")
-                if cache == externalLocation:
-                    deadline = xenrt.util.timenow() + self.externalFetchTimeout
-                else:
-                    deadline = xenrt.util.timenow() + self.defaultFetchTimeout
-                while xenrt.util.timenow() < deadline:
-                    try:
-                        with open("%s.fetching" % cache) as f:
-                            job = f.read().strip()
-                            if job != "nojob":
-                                # Check if the job is still running
-                                j = xenrt.GEC().dbconnect.api.get_job(int(job))
-                                if j['rawstatus'] == "done" or j['params'].get('DEAD_JOB') == "yes":
-                                    os.unlink("%s.fetching" % cache)
-                                    break
-                    except Exception, e:
-                        xenrt.TEC().logverbose("Warning: exception %s raised when checking fetching file" % str(e))
-                        if not os.path.exists("%s.fetching" % cache):
-                            break
-                        raise 
-                    xenrt.sleep(15)
-
-                # we need to raise an alarm if any fetching file is not deleted.
-                if xenrt.util.timenow() > deadline:
-                    raise xenrt.XRTError("found %s.fetching, file exceeds its max possible download duration." % cache)
+        for store in self._globalStores():
+            # If someone else is fetching, wait until they have finished or died
+            if store == externalStore:
+                timeout = self.externalFetchTimeout
+            else:
+                timeout = self.defaultFetchTimeout
+            store.waitForFetch(filename, timeout)
 
             # Now check whether the file is available
-            if os.path.exists(cache):
-                # If it is, hardlink it to the per-job cache
-                xenrt.TEC().logverbose("Found file in cache : %s" % cache)
+            entry = store.getEntry(filename)
+            if entry:
+                xenrt.TEC().logverbose("Found file in cache %s: %s" % (store.root, entry['digest']))
 
                 if fnr.isSimpleFile:
-                    # Check the content length matches (i.e. the file hasn't been updated underneath us)
-                    expectedLength = None
+                    # Check the file hasn't been updated underneath us
+                    validators = None
                     try:
-                        r = requests.head(fnr.url, allow_redirects=True)
-                        # We only trust the content-length if we got a 200 code, and the length is
+                        (size, ranges, validators) = self._head(fnr.url)
+                        # We only trust the content-length if the length is
                         # >10M, this is to avoid situations where we have a script providing the
                         # file where a HEAD request will give the size of the script not the file
                         # it provides
-                        if r.status_code == 200 and 'content-length' in r.headers and \
-                           r.headers['content-length'] > (10 * xenrt.MEGA):
-                            expectedLength = int(r.headers['content-length'])
+                        if validators and size > (10 * xenrt.MEGA):
+                            validators['size'] = size
                     except:
                         # File is currently not available for some reason, still valid to use it from the cache
                         pass
 
-                    if expectedLength:
-                        s = os.stat(cache)
-                        if s.st_size != expectedLength:
-                            if replaceExistingIfDiffers:
-                                self.removeFromCache(filename)
-                                return None
-                            raise xenrt.XRTError("found in global cache, but content-length (%d) differs from original (%d)" % (s.st_size, expectedLength))
-
-                if cache == externalLocation:
-                    os.symlink(cache, perJobLocation)
-                else:
-                    os.link(cache, perJobLocation)
+                    if validators and store.isStale(entry, validators):
+                        # A new ETag or Last-Modified means the file has been
+                        # replaced at the source, so fetch it again. Without
+                        # them only the size can be compared, and a size
+                        # mismatch is an error unless the caller asked for
+                        # the file to be replaced.
+                        if not replaceExistingIfDiffers and \
+                           not [v for v in ["etag", "lastModified"] if entry.get(v) and validators.get(v)]:
+                            raise xenrt.XRTError("found in global cache, but content-length (%d) differs from original (%d)" % (entry["size"], validators["size"]))
+                        xenrt.TEC().logverbose("%s has changed since it was cached, fetching it again" % (filename))
+                        store.remove(filename)
+                        continue
+
+            cache = store.lookup(filename)
+            if cache:
+                store.view(cache, perJobLocation, symlink=(store == externalStore))
                 # Return the cache location in the per-job cache
                 return perJobLocation
 
@@ -405,11 +572,15 @@ class FileManager(object):
         if not days:
             days=7
 
-        for sharedDir in [xenrt.TEC().lookup("FILE_MANAGER_CACHE"), xenrt.TEC().lookup("FILE_MANAGER_CACHE_NFS")]:
+        for (sharedDir, budget) in self._cacheDirs():
             if os.path.exists(sharedDir):
+                store = self._store(sharedDir, budget)
+                store.cleanup(days)
+                store.evict()
+                # Remove anything left from before the cache was content addressed
                 entries = os.listdir(sharedDir)
                 for entry in entries:
-                    if entry == ".snapshot":
+                    if entry == ".snapshot" or entry in xenrt.filecache.CacheStore.LAYOUT:
                         continue
                     cachepath = "%s/%s" % (sharedDir, entry)
                     mtime = os.path.getmtime(cachepath)
@@ -417,16 +588,26 @@ class FileManager(object):
                         xenrt.TEC().logverbose("Removing %s" % cachepath)
                         shutil.rmtree(cachepath)
 
+    def getCacheSummary(self):
+        """Returns the size, usage and cumulative statistics of each shared
+        cache"""
+        summary = {}
+        for (sharedDir, budget) in self._cacheDirs():
+            if os.path.exists(sharedDir):
+                summary[sharedDir] = self._store(sharedDir, budget).getSummary()
+        return summary
+
     def fileExists(self, filename):
+        xenrt.TEC().logverbose("fileExists %s" % filename)
+        fnr = FileNameResolver(filename)
+        fileLock = self._fileLock(fnr.localName)
+        fileLock.acquire()
         try:
-            xenrt.TEC().logverbose("fileExists %s" % filename)
-            self.lock.acquire()
-            fnr = FileNameResolver(filename)
             if self.__availableInCache(fnr):
                 return True
-            return xenrt.isUrlFetchable(fnr.url)
         finally:
-            self.lock.release()
+            fileLock.release()
+        return xenrt.isUrlFetchable(fnr.url)
 
 def getFileManager():
     global fm
@@ -12,6 +12,7 @@ import xenrt
 import os, os.path, re, urllib, urllib2, string, inspect, traceback, sys, fcntl, xml.dom.minidom
 import glob
 import jirarest.client
+import xenrt.triage
 
 __all__ = ["JiraLink", "getJiraLink"]
 
@@ -22,6 +23,9 @@ class JiraLink(object):
     TRIAGEDEV = "11891"
     DEFAULT_ASSIGNEE = "svcacct_xs_xenrt"
 
+    # Log patterns searched by getFailedLogSnippetsFromPattern
+    FAILURE_PATTERNS = xenrt.triage.FAILURE_PATTERNS
+
     def __init__(self):
         # JIRA settings
         self.JIRA_URL = xenrt.TEC().lookup("JIRA_URL", None) 
@@ -85,99 +89,12 @@ class JiraLink(object):
         noformattext = str(xenrt.command("pcregrep -M '%s' %s" % (pattern, logfilename) , level=xenrt.RC_OK))
         noformattext = noformattext.strip()
         if noformattext!="1":
-            if(len(noformattext)) > (endPoint - startPoint) and abs(endPoint) <= (len(noformattext)) and abs(startPoint) <=(len(noformattext)):
-                noformattext = noformattext[startPoint:endPoint] + "\n\n..."
-            snippet = ("Found '%s' in '%s':- \n{noformat}\n%s\n{noformat}" % (patterndesc,logfilename.replace(xenrt.TEC().getLogdir()+"/", ""),noformattext.strip()))
-            return snippet
+            return xenrt.triage.formatSnippet(noformattext, logfilename, patterndesc, startPoint=startPoint, endPoint=endPoint)
         return ""
 
     def getFailedLogSnippetsFromPattern(self):
         """Returns a string containing possible reason of failure from logs"""
-
-        failurepatterns =   [
-            ## Log files to be pathed with reference to TEC.logdir
-            # xenrt.log
-            {'file':"xenrt.log", 'desc':"Generic Failure Log",
-                'pattern':r'(?:.*\n){0,4}(?:\[VERBOSE\].*Traceback.*\n)(?:.*\n){0,24}(?:\[REASON.*\n)(?:.*\n){0,2}'},
-
-            # console*
-            {'file':"console*", 'desc':"Host Out of memory",
-                'pattern':r'(?:.*\n){0,4}.*\] Out of memory\: Kill process.*(?:.*\n){0,4}'},
-            {'file':"console*", 'desc':"INFO",
-                'pattern':r'(?:.*\n){0,5}.*\] INFO\: .*(?:.*\n){0,10}'},
-            {'file':"console*", 'desc':"Call Trace",
-                'pattern':r'(?:.*\n){0,6}.* [cC]all [tT]race(?:.*\n){0,24}'},
-
-            # host-serial-log-*
-            {'file':"host-serial-log-*", 'desc':"Blocked Tasks",
-                'pattern':r'(?:.*\n){0,4}.*INFO\: task .*? blocked for more than \d*? seconds\.(?:.*\n){0,4}'},
-            {'file':"host-serial-log-*", 'desc':"Kernel BUG",
-                'pattern':r'(?:.*\n){0,4}.*\] kernel BUG at .*(?:.*\n){0,6}'},
-            {'file':"host-serial-log-*", 'desc':"Stacked Call Trace",
-                'pattern':r'(?:.*\n){0,6}.*\] Call Trace\:(?:.*\n){0,14}'},
-            {'file':"host-serial-log-*", 'desc':"CPU stuck",
-                'pattern':r'(?:.*\n){0,6}.*\] Watchdog timer detects that .* is stuck!(?:.*\n){0,14}'},
-            {'file':"host-serial-log-*", 'desc':"cut here",
-                'pattern':r'\n.*\] ------------\[ cut here \]------------(?:.*\n)*?.*\] ---\[ end trace .*---.*'},
-
-            # [HOST_NAME]/kern.log
-            {'file':"*/kern.log", 'desc':"cut here",
-                'pattern':r'\n.*\] ------------\[ cut here \]------------(?:.*\n)*?.*\] ---\[ end trace .*---.*'},
-
-            # [HOST_NAME]/daemon.log
-            {'file':"*/daemon.log", 'desc':"BUGCHECK",
-                'pattern':r'\n.*BUGCHECK: ====>(?:.*\n)*?.*BUGCHECK: <====.*'},
-
-            # [GUEST_NAME]/messages
-            {'file':"*/messages", 'desc':"cut here",
-                'pattern':r'\n.*: ------------\[ cut here \]------------(?:.*\n)*?.*: ---\[ end trace .*---.*'},
-
-            # [GUEST_NAME]/guest-console-logs/console*
-            {'file':"*/guest-console-logs/console*", 'desc':"cut here",
-                'pattern':r'\n.*\] ------------\[ cut here \]------------(?:.*\n)*?.*\] ---\[ end trace .*---.*'},
-            {'file':"*/guest-console-logs/console*", 'desc':"Network autoconfig using DHCP failed",
-                'pattern':r'(?:.*\n){0,1}(?:.*Network autoconfiguration failed.*)(?:.*\n){0,4}'},
-#            {'file':"*/guest-console-logs/console*", 'desc':"Guest Stacked Call Trace", 'ignoreAfter': "SysRq :",
-#                'pattern':r'(?:.*\n){0,2}(?:.*Call Trace\:.*)(?:.*\n){0,10}'},
-            {'file':"*/guest-console-logs/console*", 'desc':"Guest GRUB Installation failure",
-                'pattern':r'(?:.*\n){0,20}(?:.*GRUB installation failed.*)(?:.*\n){0,4}'},
-            {'file':"*/guest-console-logs/console*", 'desc':"Guest BUG",
-                'pattern':r'(?:.*\n){0,2}(?:.*BUG\:.*)(?:.*\n){0,3}'},
-            {'file':"*/guest-console-logs/console*", 'desc':"Kernel Panic",
-                'pattern':r'(?:.*\n){0,4}(?:.*Kernel panic.*)(?:.*\n){0,4}'},
-
-#            {'file':"*/cloudstack/management/management-server.log*", 'desc':"Management server Exception logs",
-#                'pattern':r'(?:.*\n){0,1}(?:.*Exception\:.+)(?:.*\n){0,4}','type':"CLOUD",'startPoint':-8192,'endPoint':-1},
-
-#            {'file':"*/cloudstack/management/management-server.log*", 'desc':"Management server Error logs",
-#                'pattern':r'(?:.*\n){0,1}(?:.*ERROR.+)(?:.*\n){0,4}','type':"CLOUD",'startPoint':-8192,'endPoint':-1},
-
-#            {'file':"*/cloudstack/management/apilog.log*", 'desc':"API logs",
-#                'pattern':r'(?:.*\n){0,5}(?:.*exception.+)(?:.*\n){0,5}','type':"CLOUD"},
-
-            {'file':"*/cloudstack/management/localhost*", 'desc':"Local Host log",
-                'pattern':r'(?:.*\n){0,1}(?:.*SEVERE\:.+)(?:.*\n){0,10}','type':"CLOUD",'startPoint':-8192,'endPoint':-1},
-
-#            {'file':"*/cloudstack/agent.log*", 'desc':"Agent logs",
-#                'pattern':r'(?:.*\n){0,1}(?:.*Exception\:.+)(?:.*\n){0,4}','type':"CLOUD",'startPoint':-8192,'endPoint':-1}
-        ]
-        desc = "\n"
-        for fp in failurepatterns:
-            try:
-                clogfiles = glob.glob("%s/%s" % (xenrt.TEC().getLogdir(),fp['file']))
-            except Exception, e:
-                if not fp.has_key('type'):
-                    xenrt.TEC().warning("Failed to get logfile list matching '%s': %s" %(fp['file'],str(e)))
-            for file in clogfiles:
-                try:
-                    if fp.has_key('startPoint'):
-                        desc += self.getSnippet(file, fp['pattern'], fp['desc'],startPoint=fp['startPoint'], endPoint=fp['endPoint'])
-                    else:
-                        desc += self.getSnippet(file, fp['pattern'], fp['desc'])
-                    desc += "\n"
-                except Exception, e:
-                    xenrt.TEC().warning("Failed to get snippet from file %s: %s" %(file,str(e)))
-        return desc
+        return xenrt.triage.LogTriage(self.FAILURE_PATTERNS).run()
 
     def processPrepare(self,tec,reason):
         """Handle an error during a prepare action"""
@@ -0,0 +1,107 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# Lazy loading of package submodules
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import sys, types, threading
+
+__all__ = ["LazyModule", "lazyPackage"]
+
+# Held while a submodule is loaded and its names are set on the package
+_loadLock = threading.RLock()
+
+def _private(name):
+    return name.startswith("_") and not name.startswith("__")
+
+class LazyModule(types.ModuleType):
+    """Stands in for a package in sys.modules so that some of its submodules,
+    and the names they export into the package, are only imported the first
+    time they are used.
+
+    Public names are copied here, so looking them up costs the same as it
+    does on the package. Assignments, including mock patches, are made on
+    both. Private names are always read from the package, as its functions
+    may rebind them with global."""
+
+    def __init__(self, package, lazy):
+        types.ModuleType.__init__(self, package.__name__)
+        d = self.__dict__
+        d["_LazyModule__package"] = package
+        d["_LazyModule__lazy"] = {}
+        for (k, v) in package.__dict__.items():
+            if not _private(k):
+                d[k] = v
+        self.__addLazy(lazy)
+
+    def __addLazy(self, lazy):
+        for (module, names) in lazy.items():
+            self.__lazy[module] = module
+            for n in names:
+                self.__lazy[n] = module
+
+    def __load(self, module):
+        _loadLock.acquire()
+        try:
+            fullname = "%s.%s" % (self.__name__, module)
+            __import__(fullname)
+            m = sys.modules[fullname]
+            # Nothing is left to do if another thread has loaded it already.
+            # Names are set before they stop being lazy, so they can be
+            # read at any point without the lock.
+            for (n, lazyModule) in self.__lazy.items():
+                if lazyModule == module:
+                    setattr(self, n, n == module and m or getattr(m, n))
+                    del self.__lazy[n]
+        finally:
+            _loadLock.release()
+
+    def __getattr__(self, name):
+        module = self.__lazy.get(name)
+        if module:
+            self.__load(module)
+        try:
+            value = getattr(self.__package, name)
+        except AttributeError:
+            raise AttributeError("'module' object has no attribute '%s'" %
+                                 (name))
+        if not _private(name):
+            self.__dict__[name] = value
+        return value
+
+    def __setattr__(self, name, value):
+        setattr(self.__package, name, value)
+        if not _private(name):
+            self.__dict__[name] = value
+
+    def __delattr__(self, name):
+        delattr(self.__package, name)
+        self.__dict__.pop(name, None)
+
+def lazyPackage(name, lazy):
+    """Replace the (already imported) package name with a LazyModule that
+    imports the submodules in lazy, a dictionary of submodule name to the
+    names it exports into the package, on first use. Modules in the package
+    which imported it while it was loading are pointed at the LazyModule."""
+    package = sys.modules[name]
+    if isinstance(package, LazyModule):
+        # The package has been reloaded, which runs it in the LazyModule
+        package._LazyModule__addLazy(lazy)
+        return package
+    proxy = LazyModule(package, lazy)
+    sys.modules[name] = proxy
+    if "." in name:
+        (parent, child) = name.rsplit(".", 1)
+        setattr(sys.modules[parent], child, proxy)
+    else:
+        modules = [package, proxy] + [m for (n, m) in sys.modules.items()
+                                      if m and n.startswith(name + ".")]
+        for m in modules:
+            for (k, v) in m.__dict__.items():
+                if v is package and k != "_LazyModule__package":
+                    m.__dict__[k] = proxy
+    return proxy
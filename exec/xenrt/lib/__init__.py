@@ -14,3 +14,11 @@ from xenrt.lib.native import *
 from xenrt.lib.kirkwood import *
 from xenrt.lib.switch import createSwitch
 from xenrt.lib.generic import *
+
+# Product and toolstack libraries are imported when first used, e.g. by
+# xenrt.productLib() for the product type of a host
+import xenrt.lazyimport
+xenrt.lazyimport.lazyPackage("xenrt.lib", dict([(m, []) for m in [
+    "assertions", "cloud", "esx", "filesystem", "hyperv", "kvm", "libvirt",
+    "nativewindows", "netscaler", "opsys", "oraclevm", "oss", "scalextreme",
+    "xenserver", "xl"]]))
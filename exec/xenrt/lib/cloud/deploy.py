@@ -491,9 +491,17 @@ def doDeploy(cloudSpec, manSvr=None):
             if cloudSpec.has_key('globalConfig'):
                 manSvr.restart()
 
-            marvin.waitForSystemVmsReady()
-            if xenrt.TEC().lookup("CLOUD_WAIT_FOR_TPLTS", False, boolean=True):
-                marvin.waitForBuiltInTemplatesReady()
+            # System VMs and built in templates come up independently, so
+            # wait for both at once
+            executor = xenrt.Executor(2)
+            try:
+                waits = [executor.submit(marvin.waitForSystemVmsReady)]
+                if xenrt.TEC().lookup("CLOUD_WAIT_FOR_TPLTS", False, boolean=True):
+                    waits.append(executor.submit(marvin.waitForBuiltInTemplatesReady))
+                for w in waits:
+                    w.result()
+            finally:
+                executor.shutdown(wait=False)
 
             toolstack.postDeploy()
         finally:
@@ -1,10 +1,11 @@
 import xenrt
 import logging
-import os, urllib, glob
+import os, urllib, glob, time
 from datetime import datetime
 import shutil
 import tarfile
 import inspect
+import threading
 
 import xenrt.lib.cloud
 try:
@@ -17,9 +18,127 @@ except ImportError:
 
 __all__ = ["MarvinApi"]
 
+class AsyncJobTracker(object):
+    """Waits for CloudStack async jobs. All the outstanding jobs are checked
+    with one listAsyncJobs call per tick. Ticks start MIN_INTERVAL seconds
+    apart, the interval doubling up to MAX_INTERVAL while nothing completes
+    and dropping back when something does or a new job is tracked."""
+
+    MIN_INTERVAL = 1
+    MAX_INTERVAL = 15
+    PAGESIZE = 500
+
+    def __init__(self, cloudApi):
+        self.cloudApi = cloudApi
+        self.cond = threading.Condition()
+        self.jobs = {}
+        self.polling = False
+        self.interval = self.MIN_INTERVAL
+        self.lastTick = 0
+        self.executor = None
+
+    def track(self, jobid, timeout=1800):
+        """Returns a Future for the result of the job jobid, which raises
+        XRTFailure if the job fails or XRTError if it hasn't completed
+        within timeout seconds."""
+        future = xenrt.Future(self.track, (jobid,), {})
+        future._setRunning()
+        self.cond.acquire()
+        try:
+            self.jobs[jobid] = (future, xenrt.timenow() + timeout)
+            self.interval = self.MIN_INTERVAL
+            if not self.polling:
+                self.polling = True
+                if not self.executor:
+                    self.executor = xenrt.Executor(1)
+                self.executor.submit(self._poll)
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        return future
+
+    def _poll(self):
+        while True:
+            self.cond.acquire()
+            try:
+                # Wait for the next tick, which moves earlier if a job is
+                # tracked in the meantime
+                while self.jobs:
+                    remaining = self.lastTick + self.interval - time.time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+                if not self.jobs:
+                    self.polling = False
+                    return
+                jobs = self.jobs.copy()
+                self.lastTick = time.time()
+            finally:
+                self.cond.release()
+
+            try:
+                completed = self._check(jobs)
+            except Exception, e:
+                xenrt.TEC().logverbose("Error checking CloudStack jobs: %s" % str(e))
+                completed = 0
+            for (jobid, (future, deadline)) in jobs.items():
+                if not future.done() and xenrt.timenow() > deadline:
+                    self._complete(jobid, error=xenrt.XRTError("Timed out waiting for response"))
+
+            self.cond.acquire()
+            try:
+                if completed:
+                    self.interval = self.MIN_INTERVAL
+                else:
+                    self.interval = min(self.interval * 2, self.MAX_INTERVAL)
+            finally:
+                self.cond.release()
+
+    def _check(self, jobs):
+        """Check on the jobs, completing the Futures of any that have
+        finished. Returns the number that have."""
+        # The list is paged, so read pages until all the jobs have been seen
+        listed = {}
+        page = 1
+        while True:
+            listing = self.cloudApi.listAsyncJobs(listall=True, page=page, pagesize=self.PAGESIZE) or []
+            for j in listing:
+                if jobs.has_key(j.jobid):
+                    listed[j.jobid] = j
+            if len(listed) == len(jobs) or len(listing) < self.PAGESIZE:
+                break
+            page += 1
+        completed = 0
+        for jobid in jobs.keys():
+            job = listed.get(jobid)
+            if not job:
+                # Jobs of other accounts, or ones that have dropped out of
+                # the list, have to be asked about individually
+                job = self.cloudApi.queryAsyncJobResult(jobid=jobid)
+            if job.jobstatus == 0:
+                continue
+            elif job.jobstatus == 2:
+                self._complete(jobid, error=xenrt.XRTFailure("Cloudstack job failed with %s" % str(job.jobresult)))
+            else:
+                result = getattr(job, "jobresult", None)
+                if result is None:
+                    result = self.cloudApi.queryAsyncJobResult(jobid=jobid).jobresult
+                self._complete(jobid, value=result)
+            completed += 1
+        return completed
+
+    def _complete(self, jobid, value=None, error=None):
+        self.cond.acquire()
+        try:
+            (future, deadline) = self.jobs.pop(jobid)
+        finally:
+            self.cond.release()
+        future._finish(value, error)
+
 class CloudApi(object):
     def __init__(self, apiClient):
         self.__apiClient = apiClient
+        self.jobTracker = AsyncJobTracker(self)
 
     def __command(self, command, **kwargs):
         """Wraps a generic command. Paramters are command - name of the command (e.g. "listHosts"), then optional arguments of the command parameters. Returns the response class"""
@@ -59,14 +178,13 @@ class CloudApi(object):
         else:
             return status.jobresult
 
+    def trackAsyncJob(self, jobid, timeout=1800):
+        """Returns a Future for the jobresult of an async job, so that many
+        jobs can be waited for together"""
+        return self.jobTracker.track(jobid, timeout)
+
     def pollAsyncJob(self, jobid, timeout=1800):
-        deadline = xenrt.timenow() + timeout
-        while xenrt.timenow() <= deadline:
-            result = self.checkAsyncJob(jobid)
-            if result:
-                return result
-            xenrt.sleep(15)
-        raise xenrt.XRTError("Timed out waiting for response")
+        return self.trackAsyncJob(jobid, timeout).result()
 
     def __getattr__(self, attr):
         def wrapper(**kwargs):
@@ -78,6 +196,8 @@ class MarvinApi(object):
     
     MS_USERNAME = 'admin'
     MS_PASSWORD = 'password'
+    # Page size for list calls that read every page
+    PAGESIZE = 500
 
     def __init__(self, mgtSvr):
         self.__testClientObj = None
@@ -168,6 +288,7 @@ class MarvinApi(object):
 
     def waitForSystemVmsReady(self):
         deadline = xenrt.timenow() + 1200
+        interval = 2
 
         while True:
             systemvms = self.cloudApi.listSystemVms() or []
@@ -189,37 +310,63 @@ class MarvinApi(object):
             
             if xenrt.timenow() > deadline:
                 raise xenrt.XRTError("Waiting for system VMs timed out")
-            xenrt.sleep(15)
+            xenrt.sleep(interval, log=False)
+            interval = min(interval * 2, 15)
+
+    def _listTemplates(self, **kwargs):
+        """Returns every template listTemplates lists for kwargs, reading
+        all the pages"""
+        templates = []
+        page = 1
+        while True:
+            listing = self.cloudApi.listTemplates(page=page, pagesize=self.PAGESIZE, **kwargs) or []
+            templates.extend(listing)
+            if len(listing) < self.PAGESIZE:
+                return templates
+            page += 1
 
     def waitForBuiltInTemplatesReady(self):
-        templateList = [x for x in self.cloudApi.listTemplates(templatefilter='all') if x.templatetype == "BUILTIN"]
-        map(lambda x:self.waitForTemplateReady(name=x.name, zoneId=x.zoneid), templateList)
+        templateList = [x for x in self._listTemplates(templatefilter='all') if x.templatetype == "BUILTIN"]
+        self.waitForTemplatesReady([(x.name, x.zoneid) for x in templateList])
 
     def waitForTemplateReady(self, name, zoneId=None):
-        templateReady = False
+        self.waitForTemplatesReady([(name, zoneId)])
+
+    def waitForTemplatesReady(self, templates):
+        """Wait for the templates, a list of (name, zoneId) tuples, to be
+        ready, checking on all of them with one listing of the templates"""
         startTime = datetime.now()
-        timeout = 1800
-        while((datetime.now() - startTime).seconds < timeout):
-            templateList = self.cloudApi.listTemplates(templatefilter='all', name=name, zoneid=zoneId)
-            if not templateList:
-                xenrt.TEC().logverbose('Template %s not found' % (name))
-            elif len(templateList) == 1:
-                xenrt.TEC().logverbose('Template %s, is ready: %s, status: %s' % (name, templateList[0].isready, templateList[0].status))
-                templateReady = templateList[0].isready
-                if templateReady:
-                    break
-                if templateList[0].hypervisor.lower() == "hyperv":
-                    # CS-20595 - Hyper-V downloads are very slow
-                    timeout = 10800
+        timeouts = dict([(t, 1800) for t in templates])
+        pending = list(templates)
+        interval = 5
+        while True:
+            if len(pending) == 1:
+                # Let the management server find a single template
+                (name, zoneId) = pending[0]
+                allTemplates = self._listTemplates(templatefilter='all', name=name, zoneid=zoneId)
             else:
-                raise xenrt.XRTFailure('>1 template found with name %s' % (name))
-
-            xenrt.sleep(60)
-
-        if not templateReady:
-            raise xenrt.XRTFailure('Timeout expired waiting for template %s' % (name))
-
-        xenrt.TEC().logverbose('Template %s ready after %d seconds' % (name, (datetime.now() - startTime).seconds))
+                allTemplates = self._listTemplates(templatefilter='all')
+            for (name, zoneId) in pending[:]:
+                templateList = [x for x in allTemplates if x.name == name and (not zoneId or x.zoneid == zoneId)]
+                if not templateList:
+                    xenrt.TEC().logverbose('Template %s not found' % (name))
+                elif len(templateList) == 1:
+                    xenrt.TEC().logverbose('Template %s, is ready: %s, status: %s' % (name, templateList[0].isready, templateList[0].status))
+                    if templateList[0].isready:
+                        xenrt.TEC().logverbose('Template %s ready after %d seconds' % (name, (datetime.now() - startTime).seconds))
+                        pending.remove((name, zoneId))
+                        continue
+                    if templateList[0].hypervisor.lower() == "hyperv":
+                        # CS-20595 - Hyper-V downloads are very slow
+                        timeouts[(name, zoneId)] = 10800
+                else:
+                    raise xenrt.XRTFailure('>1 template found with name %s' % (name))
+                if (datetime.now() - startTime).seconds >= timeouts[(name, zoneId)]:
+                    raise xenrt.XRTFailure('Timeout expired waiting for template %s' % (name))
+            if not pending:
+                return
+            xenrt.sleep(interval, log=False)
+            interval = min(interval * 2, 60)
 
     def copySystemTemplatesToSecondaryStorage(self, storagePath, provider):
         # Load templates for this version
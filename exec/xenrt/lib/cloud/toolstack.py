@@ -109,6 +109,13 @@ class CloudStack(object):
             return xenrt.util.mostCommonInList(hypervisors)
         return "XenServer"
 
+    def deployVirtualMachine(self, **kwargs):
+        """Deploy a VM, waiting through the shared job tracker so that
+        instances being created in parallel are polled for together.
+        Returns the id of the VM."""
+        jobid = self.cloudApi.deployVirtualMachineAsync(**kwargs)
+        return self.cloudApi.pollAsyncJob(jobid).virtualmachine.id
+
     def createInstance(self,
                        distro=None,
                        name=None,
@@ -260,21 +267,19 @@ class CloudStack(object):
 
             domainid = self.cloudApi.listDomains(name='ROOT')[0].id
 
-            rsp = self.cloudApi.deployVirtualMachine(serviceofferingid=svcOffering,
-                                                     zoneid=zoneid,
-                                                     displayname=name,
-                                                     name=name,
-                                                     templateid=templateid,
-                                                     diskofferingid=diskOffering,
-                                                     hostid = startOnId,
-                                                     hypervisor=hypervisor,
-                                                     startvm=False,
-                                                     securitygroupids=secGroupIds,
-                                                     networkids = networks,
-                                                     account="admin",
-                                                     domainid=domainid)
-
-            instance.toolstackId = rsp.id
+            instance.toolstackId = self.deployVirtualMachine(serviceofferingid=svcOffering,
+                                                             zoneid=zoneid,
+                                                             displayname=name,
+                                                             name=name,
+                                                             templateid=templateid,
+                                                             diskofferingid=diskOffering,
+                                                             hostid = startOnId,
+                                                             hypervisor=hypervisor,
+                                                             startvm=False,
+                                                             securitygroupids=secGroupIds,
+                                                             networkids = networks,
+                                                             account="admin",
+                                                             domainid=domainid)
 
             self.cloudApi.createTags(resourceids=[instance.toolstackId],
                                      resourcetype="userVm",
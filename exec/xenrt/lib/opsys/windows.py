@@ -1,5 +1,6 @@
-import xenrt
+import xenrt, xenrt.daemonfile, xenrt.daemonexec
 import string, xmlrpclib, IPy, httplib, socket, sys, traceback, os, re, bz2, time
+import StringIO
 try:
     import winrm
 except:
@@ -107,6 +108,7 @@ class WindowsOS(OS):
         self.vifStem = "eth"
         self.viridian = True
         self.__randomStringGenerator = None
+        self._daemonVersion = None
         self.username = "Administrator"
         self.password = "xensource"
 
@@ -255,6 +257,22 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
                                      transport=trans, 
                                      allow_none=True)
 
+    def _daemonSupportsWait(self, s):
+        """Returns True if the daemon can wait for commands and batch calls"""
+        if not self._daemonVersion:
+            self._daemonVersion = xenrt.daemonexec.daemonVersion(s)
+        return xenrt.daemonexec.supportsWait(self._daemonVersion)
+
+    def multiCall(self, calls):
+        """Make several daemon calls, a list of (method, args) tuples, in
+        one request if the daemon supports it. Returns a list of results."""
+        try:
+            s = self._xmlrpc()
+            return xenrt.daemonexec.multiCall(s, calls, self._daemonSupportsWait(s))
+        except Exception, e:
+            self.checkHealth()
+            raise
+
     def cmdExec(self,
                 command,
                 level=xenrt.RC_FAIL,
@@ -268,9 +286,6 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
                 winrm=False,
                 ignoreHealthCheck=False):
         """Execute a command and wait for completion."""
-        currentPollPeriod = 1
-        maxPollPeriod = 16
-
         try:
             log("Running on %s via %s: %s" % (self.getIP(),
                 "WinRM[PS]" if (winrm and powershell) else "WinRM" if winrm else "Powershell" if powershell else "Daemon",
@@ -292,46 +307,25 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
                 data= None if ignoredata else ref.std_out if rc==0 else ref.std_err
             else:
                 s = self._xmlrpc()
+                longPoll = self._daemonSupportsWait(s)
                 if powershell:
                     ref = s.runpshell(command.encode("utf-16").encode("uu"))
                 else:
                     ref = s.runbatch(command.encode("utf-16").encode("uu"))
 
-                xenrt.sleep(currentPollPeriod, log=False)
-                errors = 0
                 if xenrt.TEC().lookup("EXTRA_TIME", False, boolean=True):
                     maxerrors = 6
                 else:
                     maxerrors = 2
-                while True:
-                    try:
-                        st = s.poll(ref)
-                        errors = 0
-                    except socket.error, e:
-                        errors = errors + 1
-                        if errors > maxerrors:
-                            raise
-                        st = "ERROR"
-                    if st == "DONE":
-                        break
-                    if timeout:
-                        now = xenrt.util.timenow()
-                        deadline = started + timeout
-                        if now > deadline:
-                            xenrt.TEC().logverbose("Timed out polling for %s on %s"
-                                                   % (ref, self.getIP()))
-                            return xenrt.XRT("%s timed out" % (desc), level)
-                    if currentPollPeriod < maxPollPeriod:
-                        currentPollPeriod *= 2
-                        currentPollPeriod = min(currentPollPeriod, maxPollPeriod)
-                    xenrt.sleep(currentPollPeriod, log=False)
-                data = None if ignoredata else s.log(ref)
-                rc = s.returncode(ref)
-                try:
-                    s.cleanup(ref)
-                except Exception, e:
-                    xenrt.TEC().warning("Got exception while cleaning up after "
-                                        "cmdExec: %s" % (str(e)))
+                res = xenrt.daemonexec.waitForResult(s, ref, started, timeout,
+                                                     longPoll,
+                                                     ignoredata=ignoredata,
+                                                     maxerrors=maxerrors)
+                if not res:
+                    xenrt.TEC().logverbose("Timed out polling for %s on %s"
+                                           % (ref, self.getIP()))
+                    return xenrt.XRT("%s timed out" % (desc), level)
+                (rc, data) = res
 
             if data:
                 xenrt.TEC().log(data.encode("utf-8"))
@@ -379,6 +373,7 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
     def updateDaemon(self):
         """Update the test execution daemon to the latest version"""
         xenrt.TEC().logverbose("Updating XML-RPC daemon on %s" % (self.getIP()))
+        self._daemonVersion = None
         f = file("%s/utils/execdaemon.py" %
                  (xenrt.TEC().lookup("LOCAL_SCRIPTDIR")), "r")
         data = f.read()
@@ -495,21 +490,16 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
         try:
             started = xenrt.util.timenow()
             s = self._xmlrpc()
-            while True:
-                st = s.poll(ref)
-                if st == "DONE":
-                    break
-                if timeout:
-                    now = xenrt.util.timenow()
-                    deadline = started + timeout
-                    if now > deadline:
-                        return xenrt.XRT("%s timed out" % (desc), level)
-                xenrt.sleep(15)
-            data = s.log(ref).encode("utf-8")
+            res = xenrt.daemonexec.waitForResult(s, ref, started, timeout,
+                                                 self._daemonSupportsWait(s),
+                                                 cleanup=cleanup,
+                                                 maxerrors=0,
+                                                 backoff=False)
+            if not res:
+                return xenrt.XRT("%s timed out" % (desc), level)
+            rc = res[0]
+            data = res[1].encode("utf-8")
             xenrt.TEC().log(data)
-            rc = s.returncode(ref)
-            if cleanup:
-                s.cleanup(ref)
             if rc != 0:
                 return xenrt.XRT("%s returned error (%d)" % (desc, rc),
                                  level,
@@ -658,6 +648,9 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
             xenrt.TEC().logverbose("Fetching file %s from %s via daemon" %
                                    (filename, self.getIP()))
             s = self._xmlrpc(patient=patient)
+            f = StringIO.StringIO()
+            if xenrt.daemonfile.readFile(s, filename, f):
+                return f.getvalue()
             return s.readFile(filename).data
         except Exception, e:
             if not ignoreHealthCheck:
@@ -668,10 +661,17 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
         xenrt.TEC().logverbose("GetFile %s to %s on %s" %
                                (remotefn, localfn, self.getIP()))
         try:
-            data = self.readFile(remotefn, patient=patient, ignoreHealthCheck=ignoreHealthCheck)
-            f = file(localfn, "w")
-            f.write(data)
-            f.close()
+            s = self._xmlrpc(patient=patient)
+            f = file(localfn, "wb")
+            try:
+                done = xenrt.daemonfile.readFile(s, remotefn, f)
+            finally:
+                f.close()
+            if not done:
+                data = self.readFile(remotefn, patient=patient, ignoreHealthCheck=ignoreHealthCheck)
+                f = file(localfn, "wb")
+                f.write(data)
+                f.close()
         except Exception, e:
             if not ignoreHealthCheck:
                 self.checkHealth()
@@ -890,7 +890,7 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
                 # Pull the file into the guest
                 wdir = xenrt.resources.WebDirectory()
                 try:
-                    wdir.copyIn(localfilename)
+                    wdir.linkIn(localfilename)
                     xenrt.TEC().logverbose("Pulling %s into %s:%s" %
                                            (localfilename,
                                             self.getIP(),
@@ -901,14 +901,15 @@ $connections | % {$_.GetNetwork().SetCategory(1)}""", powershell=True)
                     wdir.remove()
             else:
                 # Push the file to the guest
-                f = file(localfilename, 'r')
-                data = f.read()
-                f.close()
                 xenrt.TEC().logverbose("Pushing %s to %s:%s" %
                                        (localfilename,
                                         self.getIP(),
                                         remotefilename))
-                s.createFile(remotefilename, xmlrpclib.Binary(data))
+                if not xenrt.daemonfile.sendFile(s, localfilename, remotefilename):
+                    f = file(localfilename, 'r')
+                    data = f.read()
+                    f.close()
+                    s.createFile(remotefilename, xmlrpclib.Binary(data))
         except Exception, e:
             if not ignoreHealthCheck:
                 self.checkHealth()
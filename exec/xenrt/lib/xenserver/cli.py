@@ -10,6 +10,7 @@
 
 import sys, os, glob, os.path, string, re, time
 import xenrt
+from xenrt.lib.xenserver.xapicli import XenAPICLIEngine
 
 # Symbols we want to export from the package.
 __all__ = ["getSession",
@@ -26,6 +27,7 @@ def getSession(machine):
 def clearCacheFor(machine):
     global sessions
     if sessions.has_key(machine):
+        sessions[machine].closeAPIEngine()
         del sessions[machine]
 
 class Session(object):
@@ -45,6 +47,7 @@ class Session(object):
         self.tempDir = None
         self.winguest = None
         self.debug_on_fail = False
+        self.apiEngine = None
 
         if not self.password:
             self.password = xenrt.TEC().lookup("ROOT_PASSWORD")
@@ -179,6 +182,7 @@ class Session(object):
                 xenrt.TEC().logverbose("xe doesn't support --debug-on-fail")
                 
     def close(self):
+        self.closeAPIEngine()
         if self.tempDir and not self.cached:
             # Remove the CLI binary.
             self.tempDir.remove()
@@ -189,6 +193,39 @@ class Session(object):
         """Return the full path to the xe binary."""
         return "%s/xe" % (self.dir)
 
+    def getAPIEngine(self):
+        """Return the XenAPI engine for read-only commands if XE_ENGINE
+        selects it, otherwise None."""
+        if xenrt.TEC().lookup("XE_ENGINE", "xe") != "xenapi":
+            return None
+        if xenrt.TEC().registry.read("/xenrt/cli/windows"):
+            return None
+        host = self.machine.getHost()
+        if not isinstance(host, xenrt.lib.xenserver.Host) or \
+                host.compatCLI() == xenrt.lib.xenserver.host.CLI_LEGACY_COMPAT:
+            return None
+        if not self.apiEngine:
+            secure = not xenrt.TEC().lookup("NO_XE_SSL", False, boolean=True)
+            self.apiEngine = XenAPICLIEngine(host, secure=secure)
+        return self.apiEngine
+
+    def getRecordSnapshot(self):
+        """Return the host's active record snapshot, if any."""
+        host = self.machine.getHost()
+        if not isinstance(host, xenrt.lib.xenserver.Host):
+            return None
+        return host.getRecordSnapshot()
+
+    def invalidateRecordSnapshot(self):
+        host = self.machine.getHost()
+        if isinstance(host, xenrt.lib.xenserver.Host):
+            host.invalidateRecordSnapshot()
+
+    def closeAPIEngine(self):
+        if self.apiEngine:
+            self.apiEngine.close()
+            self.apiEngine = None
+
     def execute(self,
                 command,
                 args="",
@@ -230,6 +267,32 @@ class Session(object):
         if xenrt.TEC().lookup("EXTRA_TIME", False, boolean=True):
             timeout = timeout * 2
 
+        # Anything other than a read may change the records held in a
+        # snapshot
+        readonly = command.endswith("-list") or command.endswith("-param-get")
+        if not readonly:
+            self.invalidateRecordSnapshot()
+
+        # Read-only commands can be served from a record snapshot or by a
+        # long-lived XenAPI session rather than by forking xe, anything
+        # else falls through to xe
+        if readonly and retval == "string" and compat == None and \
+                useCredentials and not username and not password and \
+                not debugOnFail:
+            for (engine, desc) in [(self.getRecordSnapshot(), "Snapshot"),
+                                   (self.getAPIEngine(), "XenAPI")]:
+                if not engine:
+                    continue
+                reply = engine.execute(command, args=args, minimal=minimal)
+                if reply != None:
+                    if not nolog:
+                        xenrt.TEC().logverbose("%s CLI: %s %s" %
+                                               (desc, command, args))
+                    xenrt.TEC().log(reply + "\n")
+                    if strip:
+                        return string.strip(reply)
+                    return reply + "\n"
+
         ex = None
         for i in range(3):
             try:
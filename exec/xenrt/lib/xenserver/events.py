@@ -0,0 +1,284 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# Shared XenAPI event watcher for VM power state and domid
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import threading, time
+import XenAPI
+import xenrt
+
+# Symbols we want to export from the package.
+__all__ = ["VMEventWatcher", "getVMEventWatcher", "closeVMEventWatchers"]
+
+# How long a single event.from call blocks on the server
+EVENT_TIMEOUT = 30.0
+
+# How long to wait before starting a new watcher for a pool whose previous
+# watcher failed
+RESTART_BACKOFF = 60
+
+# The subset of the VM record we cache
+FIELDS = ["power_state", "domid", "allowed_operations", "resident_on"]
+
+_watchers = {}
+_watchersLock = threading.Lock()
+
+def _subset(record):
+    r = {}
+    for f in FIELDS:
+        r[f] = record.get(f)
+    if r["domid"] is not None:
+        r["domid"] = int(r["domid"])
+    return r
+
+class VMEventWatcher(threading.Thread):
+    """Maintains a cache of VM power state, domid and allowed operations
+    for a pool, fed by a single XenAPI event.from loop. Callers block on
+    a condition variable which is notified whenever a batch of events
+    has been applied."""
+
+    def __init__(self, host, secure=True):
+        threading.Thread.__init__(self, name="VMEventWatcher-%s" % (host.getName()))
+        self.setDaemon(True)
+        self.host = host
+        self.secure = secure
+        self.cond = threading.Condition()
+        self.records = {}
+        self.refs = {}
+        self.uuids = {}
+        self.hostRefs = {}
+        # Number of events seen for each VM, used as a barrier by waitFor
+        self.seen = {}
+        self.token = ""
+        self.ready = False
+        self.failed = None
+        self.failedAt = None
+        self.unsupported = False
+        self.stopping = False
+        self.querySession = None
+        self.queryLock = threading.Lock()
+        self.stats = {"batches": 0, "events": 0, "waits": 0, "queries": 0}
+
+    def _update(self, ref, record):
+        """Apply an event snapshot. Must be called with self.cond held."""
+        uuid = record["uuid"]
+        self.refs[uuid] = ref
+        self.uuids[ref] = uuid
+        self.records[uuid] = _subset(record)
+        self.seen[uuid] = self.seen.get(uuid, 0) + 1
+
+    def _delete(self, ref):
+        """Forget a destroyed VM. Must be called with self.cond held."""
+        if self.uuids.has_key(ref):
+            uuid = self.uuids[ref]
+            del self.uuids[ref]
+            for d in (self.refs, self.records):
+                if d.has_key(uuid):
+                    del d[uuid]
+            self.seen[uuid] = self.seen.get(uuid, 0) + 1
+
+    def _fail(self, reason):
+        self.cond.acquire()
+        try:
+            self.failed = reason
+            self.failedAt = time.time()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def run(self):
+        session = None
+        try:
+            session = self.host.getAPISession(secure=self.secure)
+            while not self.stopping:
+                # "from" is a reserved word so we can't use normal syntax
+                result = getattr(session.xenapi.event, "from")(["vm"], self.token, EVENT_TIMEOUT)
+                self.cond.acquire()
+                try:
+                    for ev in result["events"]:
+                        if ev["operation"] == "del":
+                            self._delete(ev["ref"])
+                        elif ev.has_key("snapshot"):
+                            self._update(ev["ref"], ev["snapshot"])
+                    self.token = result["token"]
+                    self.ready = True
+                    self.stats["batches"] += 1
+                    self.stats["events"] += len(result["events"])
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+        except XenAPI.Failure, e:
+            if e.details and e.details[0] == "MESSAGE_METHOD_UNKNOWN":
+                self.unsupported = True
+            if not self.stopping:
+                xenrt.TEC().logverbose("VM event watcher for %s failed: %s" %
+                                       (self.host.getName(), str(e)))
+            self._fail(str(e))
+        except Exception, e:
+            if not self.stopping:
+                xenrt.TEC().logverbose("VM event watcher for %s failed: %s" %
+                                       (self.host.getName(), str(e)))
+            self._fail(str(e))
+        if session is not None:
+            try:
+                session.xenapi.session.logout()
+            except:
+                pass
+
+    def stop(self):
+        """Stop the watcher. The thread exits once its current event.from
+        call returns."""
+        self.stopping = True
+        self._fail("stopped")
+        self.queryLock.acquire()
+        try:
+            if self.querySession is not None:
+                try:
+                    self.querySession.xenapi.session.logout()
+                except:
+                    pass
+                self.querySession = None
+        finally:
+            self.queryLock.release()
+
+    def _call(self, method, *args):
+        """Make a synchronous XenAPI call on the query session, which is
+        separate from the session blocked in event.from."""
+        self.queryLock.acquire()
+        try:
+            if self.querySession is None:
+                self.querySession = self.host.getAPISession(secure=self.secure)
+            f = self.querySession.xenapi
+            for n in method.split("."):
+                f = getattr(f, n)
+            self.stats["queries"] += 1
+            try:
+                return f(*args)
+            except Exception, e:
+                if isinstance(e, XenAPI.Failure) and \
+                        e.details and e.details[0] != "SESSION_INVALID":
+                    raise
+                # The session has expired or its connection is broken, so
+                # log in again for the next call
+                try:
+                    self.querySession.xenapi.session.logout()
+                except:
+                    pass
+                self.querySession = None
+                raise
+        finally:
+            self.queryLock.release()
+
+    def _ref(self, uuid):
+        self.cond.acquire()
+        try:
+            ref = self.refs.get(uuid)
+        finally:
+            self.cond.release()
+        if not ref:
+            ref = self._call("VM.get_by_uuid", uuid)
+        return ref
+
+    def hostRef(self, uuid):
+        """Return the reference of the host with the given UUID"""
+        ref = self.hostRefs.get(uuid)
+        if not ref:
+            ref = self._call("host.get_by_uuid", uuid)
+            self.hostRefs[uuid] = ref
+        return ref
+
+    def current(self, uuid):
+        """Return the cached fields for the VM read directly from xapi.
+        Point reads don't use the cache as it may not yet have received
+        an event that xapi has already committed."""
+        return _subset(self._call("VM.get_record", self._ref(uuid)))
+
+    def waitFor(self, uuid, predicate, timeout):
+        """Block until predicate(record) is true for the VM, where record is
+        a dictionary of the cached fields. Returns the record, or None if
+        timeout expires first. Raises XRTError if the watcher fails."""
+        deadline = time.time() + timeout
+        # Inject an event for the VM so we don't test the predicate against
+        # a cache that is behind changes xapi has already made.
+        self.cond.acquire()
+        try:
+            barrier = self.seen.get(uuid, 0)
+        finally:
+            self.cond.release()
+        try:
+            self._call("event.inject", "VM", self._ref(uuid))
+            barrier += 1
+        except XenAPI.Failure, e:
+            xenrt.TEC().logverbose("event.inject failed, waiting without "
+                                   "a barrier: %s" % (str(e)))
+        self.cond.acquire()
+        try:
+            self.stats["waits"] += 1
+            while True:
+                if self.failed:
+                    raise xenrt.XRTError("VM event watcher failed: %s" %
+                                         (self.failed))
+                if self.ready and self.seen.get(uuid, 0) >= barrier:
+                    r = self.records.get(uuid)
+                    if r and predicate(r):
+                        return dict(r)
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(remaining)
+        finally:
+            self.cond.release()
+
+    def getStats(self):
+        self.cond.acquire()
+        try:
+            return dict(self.stats)
+        finally:
+            self.cond.release()
+
+def getVMEventWatcher(host):
+    """Return the VM event watcher for the pool host belongs to, starting
+    one if necessary. Returns None if VM_EVENT_WATCHER is disabled, host
+    is not a XenServer host, or the last watcher for the pool failed
+    recently."""
+    if not xenrt.TEC().lookup("VM_EVENT_WATCHER", False, boolean=True):
+        return None
+    if not isinstance(host, xenrt.lib.xenserver.Host):
+        return None
+    master = host
+    if host.pool and host.pool.master:
+        master = host.pool.master
+    key = master.getIP()
+    _watchersLock.acquire()
+    try:
+        w = _watchers.get(key)
+        if w and w.failed:
+            if w.unsupported or time.time() - w.failedAt < RESTART_BACKOFF:
+                return None
+            w = None
+        if not w:
+            secure = not xenrt.TEC().lookup("NO_XE_SSL", False, boolean=True)
+            w = VMEventWatcher(master, secure=secure)
+            w.start()
+            _watchers[key] = w
+        return w
+    finally:
+        _watchersLock.release()
+
+def closeVMEventWatchers(host=None):
+    """Stop the watchers for the pool containing host, or all watchers."""
+    _watchersLock.acquire()
+    try:
+        for key in _watchers.keys():
+            w = _watchers[key]
+            if host and w.host != host and key != host.getIP():
+                continue
+            w.stop()
+            del _watchers[key]
+    finally:
+        _watchersLock.release()
@@ -10,6 +10,7 @@
 import sys, string, time, random, re, crypt, urllib, os, os.path, socket, copy, IPy
 import shutil, traceback, fnmatch, xml.dom.minidom, pipes, uuid
 import xenrt
+import xenrt.lib.xenserver.events
 from PIL import Image
 from IPy import IP
 from xenrt.lazylog import *
@@ -878,14 +879,50 @@ users:
     def poll(self, state, timeout=600, level=xenrt.RC_FAIL, pollperiod=15):
         """Poll our VM for reaching the specified state"""
         deadline = xenrt.timenow() + timeout
+        watcher = xenrt.lib.xenserver.events.getVMEventWatcher(self.getHost())
+        if watcher:
+            try:
+                if watcher.waitFor(self.getUUID(),
+                                   lambda r: self.statustext.get(r["power_state"].lower(),
+                                                                r["power_state"].lower()) == state,
+                                   timeout):
+                    return
+            except Exception, e:
+                xenrt.TEC().logverbose("Falling back to polling the CLI: %s" %
+                                       (str(e)))
         while 1:
             status = self.getState()
             if state == status:
                 return
             if xenrt.timenow() > deadline:
-                xenrt.XRT("Timed out waiting for VM %s to be %s" %
-                          (self.name, state), level)
-            xenrt.sleep(15, log=False)
+                return xenrt.XRT("Timed out waiting for VM %s to be %s" %
+                                 (self.name, state), level)
+            xenrt.sleep(pollperiod, log=False)
+
+    def waitForDomidChange(self, domid, timeout, pollperiod=10):
+        """Wait for the domid of our VM to change from domid, as it does when
+        the VM reboots. Returns True if it changed within timeout."""
+        deadline = xenrt.util.timenow() + timeout
+        watcher = xenrt.lib.xenserver.events.getVMEventWatcher(self.getHost())
+        if watcher:
+            try:
+                if watcher.waitFor(self.getUUID(),
+                                   lambda r: r["domid"] not in (domid, -1),
+                                   timeout):
+                    return True
+            except Exception, e:
+                xenrt.TEC().logverbose("Falling back to polling the domid: %s" %
+                                       (str(e)))
+        while True:
+            try:
+                if self.getDomid() != domid:
+                    return True
+            except:
+                # There is a tiny window where the domid may not exist while the reboot occurs
+                pass
+            if xenrt.util.timenow() > deadline:
+                return False
+            xenrt.sleep(pollperiod)
 
     def start(self, reboot=False, skipsniff=False, specifyOn=True,\
               extratime=False, managenetwork=None, managebridge=None, 
@@ -899,17 +936,8 @@ users:
                 domid = self.getDomid()
                 self.unenlightenedReboot()
                 # Wait for the domid to change
-                startTime = xenrt.util.timenow()
-                while True:
-                    try:
-                        if self.getDomid() != domid:
-                            break
-                    except:
-                        # There is a tiny window where the domid may not exist while the reboot occurs
-                        pass
-                    if (xenrt.util.timenow() - startTime) > 600:
-                        raise xenrt.XRTError("domid failed to change 10 minutes after an unenlightenedReboot")
-                    xenrt.sleep(10)
+                if not self.waitForDomidChange(domid, 600, 10):
+                    raise xenrt.XRTError("domid failed to change 10 minutes after an unenlightenedReboot")
             xenrt.sleep(20)
         else:
             xenrt.TEC().progress("Starting guest VM %s" % (self.name))
@@ -1467,18 +1495,9 @@ at > c:\\xenrtatlog.txt
         self.xmlrpcStart("c:\\xensetup.exe /S")
 
         # Monitor the guest for a domid change, this is the reboot
-        deadline = xenrt.util.timenow() + 7200
-        while True:
-            try:
-                if self.host.getDomid(self) != domid:
-                    break
-            except:
-                pass
-            now = xenrt.util.timenow()
-            if now > deadline:
-                self.checkHealth()
-                raise xenrt.XRTFailure("Timed out waiting for installer initiated reboot")
-            xenrt.sleep(30)
+        if not self.waitForDomidChange(domid, 7200, 30):
+            self.checkHealth()
+            raise xenrt.XRTFailure("Timed out waiting for installer initiated reboot")
         try:
             bootTimeout=1200
             if xenrt.TEC().lookup("STRESS_TEST", False, boolean=True):
@@ -1540,21 +1559,11 @@ exit /B 1
         domid = self.host.getDomid(self)
         self.xmlrpcStart("c:\\uninstallpvdrivers.bat")
 
-        # Wait for a domid change        
-        deadline = xenrt.util.timenow() + 300
-        while True:
-            try:
-                d = self.host.getDomid(self)
-                if d != domid:
-                    break
-            except:
-                pass
-            now = xenrt.util.timenow()
-            if now > deadline:
-                self.checkHealth()
-                raise xenrt.XRTFailure("Timed out waiting for uninstaller "
-                                       "initiated reboot")
-            xenrt.sleep(30)
+        # Wait for a domid change
+        if not self.waitForDomidChange(domid, 300, 30):
+            self.checkHealth()
+            raise xenrt.XRTFailure("Timed out waiting for uninstaller "
+                                   "initiated reboot")
 
         if waitForDaemon:
             # Wait until we can connect
@@ -2434,9 +2443,18 @@ exit /B 1
                                 "Syssetup.dll,UpdatePnpDeviceDrivers", timeout=1800)
 
     def getState(self):
-        status = self.getHost().parseListForParam("vm-list",
-                                                  self.getUUID(),
-                                                  "power-state")
+        status = None
+        watcher = xenrt.lib.xenserver.events.getVMEventWatcher(self.getHost())
+        if watcher:
+            try:
+                status = watcher.current(self.getUUID())["power_state"].lower()
+            except Exception, e:
+                xenrt.TEC().logverbose("Could not get power state from the "
+                                       "VM event watcher: %s" % (str(e)))
+        if not status:
+            status = self.getHost().parseListForParam("vm-list",
+                                                      self.getUUID(),
+                                                      "power-state")
         if self.statustext.has_key(status):
             status = self.statustext[status]
         return status
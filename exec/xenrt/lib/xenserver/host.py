@@ -19,6 +19,8 @@ import xenrt
 import xenrt.lib.xenserver
 import xenrt.lib.xenserver.guest
 import xenrt.lib.xenserver.install
+import xenrt.lib.xenserver.events
+import xenrt.lib.xenserver.xapicli
 import xenrt.lib.xenserver.jobtests
 from  xenrt.lib.xenserver import licensedfeatures
 import XenAPI
@@ -617,6 +619,9 @@ class Host(xenrt.GenericHost):
         self.tileTemplates = {}
         self.tileLock = threading.Lock()
         self.netNameLock = threading.Lock()
+        self.recordSnapshot = None
+        self.recordSnapshotHolds = 0
+        self.recordSnapshotLock = threading.Lock()
         self.isOnline = True
         self.haLocalConfig = {}
         self.haStatefileBlocked = False
@@ -758,18 +763,23 @@ class Host(xenrt.GenericHost):
     
         self.guestconsolelogs = xenrt.TEC().lookup("GUEST_CONSOLE_LOGDIR")
 
-        # Initialise guests
+        # Initialise guests, reading their parameters from one snapshot
+        # of the host's records rather than with a CLI call each
         if doguests:
-            guests = self.listGuests()
-            for guestname in guests:
-                try:
-                    guest = self.guestFactory()(guestname, None)
-                    guest.existing(self)
-                    xenrt.TEC().logverbose("Found existing guest: %s" % (guestname))
-                    if guestsInRegistry:
-                        xenrt.TEC().registry.guestPut(guestname, guest)
-                except:
-                    xenrt.TEC().logverbose("Could not load guest - perhaps it was deleted")
+            self.openRecordSnapshot()
+            try:
+                guests = self.listGuests()
+                for guestname in guests:
+                    try:
+                        guest = self.guestFactory()(guestname, None)
+                        guest.existing(self)
+                        xenrt.TEC().logverbose("Found existing guest: %s" % (guestname))
+                        if guestsInRegistry:
+                            xenrt.TEC().registry.guestPut(guestname, guest)
+                    except:
+                        xenrt.TEC().logverbose("Could not load guest - perhaps it was deleted")
+            finally:
+                self.closeRecordSnapshot()
         self.distro = "XSDom0"
 
     def reinstall(self):
@@ -2810,6 +2820,23 @@ fi
         """Return the domid of the specified guest."""
         # Look up the UUID of the guest
         uuid = guest.getUUID()
+        watcher = xenrt.lib.xenserver.events.getVMEventWatcher(self)
+        if watcher:
+            record = None
+            try:
+                record = watcher.current(uuid)
+                hostRef = watcher.hostRef(self.getMyHostUUID())
+            except Exception, e:
+                xenrt.TEC().logverbose("Could not get domid from the VM "
+                                       "event watcher: %s" % (str(e)))
+                record = None
+            if record:
+                # The watcher covers the whole pool, so check the guest is
+                # running on this host
+                if record["resident_on"] != hostRef:
+                    raise xenrt.XRTError("Domain '%s' not found" % (uuid))
+                if record["domid"] >= 0:
+                    return record["domid"]
         domains = self.listDomains(includeS=True)
         if domains.has_key(uuid):
             return domains[uuid][0]
@@ -3518,6 +3545,66 @@ fi
                 return xenrt.XRT("%s timed out" % (desc), level)
             xenrt.sleep(15)
             
+    def openRecordSnapshot(self):
+        """Serve read-only CLI commands for this host from a snapshot of
+        its VM, VBD, VDI, VIF, SR, host and network records until the
+        matching closeRecordSnapshot(). Calls may be nested."""
+        self.recordSnapshotLock.acquire()
+        try:
+            self.recordSnapshotHolds += 1
+        finally:
+            self.recordSnapshotLock.release()
+
+    def closeRecordSnapshot(self):
+        self.recordSnapshotLock.acquire()
+        try:
+            self.recordSnapshotHolds -= 1
+        finally:
+            self.recordSnapshotLock.release()
+
+    def invalidateRecordSnapshot(self):
+        """Discard the record snapshot of this host, and of the other
+        members of its pool as they hold the same records."""
+        hosts = [self]
+        if self.pool:
+            hosts = self.pool.getHosts()
+            if not self in hosts:
+                hosts.append(self)
+        for h in hosts:
+            h.recordSnapshotLock.acquire()
+            try:
+                h.recordSnapshot = None
+            finally:
+                h.recordSnapshotLock.release()
+
+    def getRecordSnapshot(self):
+        """Return the record snapshot read-only CLI commands should be
+        served from, or None. A snapshot is used while one is held open by
+        openRecordSnapshot() or, if RECORD_SNAPSHOT_TTL is non-zero, for
+        that many seconds after it was taken. A new snapshot is taken if
+        the previous one has been invalidated or has expired."""
+        ttl = float(xenrt.TEC().lookup("RECORD_SNAPSHOT_TTL", "0"))
+        self.recordSnapshotLock.acquire()
+        try:
+            if self.recordSnapshotHolds <= 0 and ttl <= 0:
+                return None
+            snapshot = self.recordSnapshot
+            if snapshot and (self.recordSnapshotHolds > 0 or
+                             snapshot.age() < ttl):
+                return snapshot
+            secure = not xenrt.TEC().lookup("NO_XE_SSL", False, boolean=True)
+            snapshot = xenrt.lib.xenserver.xapicli.RecordSnapshot(self, secure=secure)
+            try:
+                snapshot.refresh()
+            except Exception, e:
+                xenrt.TEC().logverbose("Could not take record snapshot of %s: %s" %
+                                       (self.getName(), str(e)))
+                return None
+            self.recordSnapshot = snapshot
+            return snapshot
+        finally:
+            self.recordSnapshotLock.release()
+
     def parameterList(self, command, params, argsString=''):
         """Parse the output of an xe list command for 1 or more parameters.
            This returns a list of dictionaries where the keys match the params passed into the function.
@@ -3526,7 +3613,13 @@ fi
         """
         if not isinstance(params, list) or len(params) == 0:
             raise xenrt.XRTError('Invalid call to method: parameterList, 0 or invalid params specified')
-        
+
+        snapshot = self.getRecordSnapshot()
+        if snapshot:
+            paramList = snapshot.parameterList(command, params, argsString)
+            if paramList != None:
+                return paramList
+
         c = self.getCLIInstance()
         lines = c.execute(command, 'params=%s %s' % (','.join(params), argsString), strip=True).splitlines()
         # Add an extra blank line at the end to act as a end-of-record marker
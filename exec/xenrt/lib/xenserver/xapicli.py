@@ -0,0 +1,535 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# XenAPI implementation of read-only CLI commands
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import string, shlex, socket, threading, time, xmlrpclib, httplib
+import XenAPI
+import xenrt
+
+# Symbols we want to export from the package.
+__all__ = ["XenAPICLIEngine", "RecordSnapshot"]
+
+NULL_REF = "OpaqueRef:NULL"
+
+class _Untranslatable(Exception):
+    pass
+
+def _str(v):
+    return str(v)
+
+def _lower(v):
+    return str(v).lower()
+
+def _bool(v):
+    if v:
+        return "true"
+    return "false"
+
+def _map(v):
+    # xe lists the keys in the order xapi holds them, which XenAPI
+    # doesn't give us, so only single keys of maps are translated
+    raise _Untranslatable()
+
+def _set(v):
+    return string.join(map(str, v), "; ")
+
+# For each CLI class, xe parameter name -> (XenAPI field, formatter,
+# referenced class). Only parameters whose xe rendering we can reproduce
+# exactly are listed, anything else goes to the xe binary.
+_NAME = {"uuid": ("uuid", _str, None),
+         "name-label": ("name_label", _str, None),
+         "name-description": ("name_description", _str, None)}
+
+FIELDS = {
+    "vm": dict(_NAME, **{
+        "power-state": ("power_state", _lower, None),
+        "is-a-template": ("is_a_template", _bool, None),
+        "is-a-snapshot": ("is_a_snapshot", _bool, None),
+        "is-control-domain": ("is_control_domain", _bool, None),
+        "resident-on": ("resident_on", None, "host"),
+        "affinity": ("affinity", None, "host"),
+        "snapshot-of": ("snapshot_of", None, "VM"),
+        "parent": ("parent", None, "VM"),
+        "dom-id": ("domid", _str, None),
+        "user-version": ("user_version", _str, None),
+        "memory-static-max": ("memory_static_max", _str, None),
+        "memory-static-min": ("memory_static_min", _str, None),
+        "memory-dynamic-max": ("memory_dynamic_max", _str, None),
+        "memory-dynamic-min": ("memory_dynamic_min", _str, None),
+        "VCPUs-max": ("VCPUs_max", _str, None),
+        "VCPUs-at-startup": ("VCPUs_at_startup", _str, None),
+        "HVM-boot-policy": ("HVM_boot_policy", _str, None),
+        "PV-bootloader": ("PV_bootloader", _str, None),
+        "PV-args": ("PV_args", _str, None),
+        "ha-restart-priority": ("ha_restart_priority", _str, None),
+        "other-config": ("other_config", _map, None),
+        "platform": ("platform", _map, None),
+        "xenstore-data": ("xenstore_data", _map, None),
+        "blocked-operations": ("blocked_operations", _map, None),
+        "tags": ("tags", _set, None)}),
+    "host": dict(_NAME, **{
+        "address": ("address", _str, None),
+        "hostname": ("hostname", _str, None),
+        "enabled": ("enabled", _bool, None),
+        "edition": ("edition", _str, None),
+        "other-config": ("other_config", _map, None),
+        "software-version": ("software_version", _map, None),
+        "tags": ("tags", _set, None)}),
+    "sr": dict(_NAME, **{
+        "type": ("type", _str, None),
+        "content-type": ("content_type", _str, None),
+        "shared": ("shared", _bool, None),
+        "physical-size": ("physical_size", _str, None),
+        "physical-utilisation": ("physical_utilisation", _str, None),
+        "virtual-allocation": ("virtual_allocation", _str, None),
+        "other-config": ("other_config", _map, None),
+        "sm-config": ("sm_config", _map, None),
+        "tags": ("tags", _set, None)}),
+    "vdi": dict(_NAME, **{
+        "sr-uuid": ("SR", None, "SR"),
+        "virtual-size": ("virtual_size", _str, None),
+        "physical-utilisation": ("physical_utilisation", _str, None),
+        "location": ("location", _str, None),
+        "read-only": ("read_only", _bool, None),
+        "sharable": ("sharable", _bool, None),
+        "managed": ("managed", _bool, None),
+        "is-a-snapshot": ("is_a_snapshot", _bool, None),
+        "snapshot-of": ("snapshot_of", None, "VDI"),
+        "other-config": ("other_config", _map, None),
+        "sm-config": ("sm_config", _map, None),
+        "tags": ("tags", _set, None)}),
+    "vbd": {
+        "uuid": ("uuid", _str, None),
+        "vm-uuid": ("VM", None, "VM"),
+        "vdi-uuid": ("VDI", None, "VDI"),
+        "device": ("device", _str, None),
+        "userdevice": ("userdevice", _str, None),
+        "bootable": ("bootable", _bool, None),
+        "mode": ("mode", _str, None),
+        "type": ("type", _str, None),
+        "unpluggable": ("unpluggable", _bool, None),
+        "currently-attached": ("currently_attached", _bool, None),
+        "empty": ("empty", _bool, None),
+        "other-config": ("other_config", _map, None)},
+    "vif": {
+        "uuid": ("uuid", _str, None),
+        "vm-uuid": ("VM", None, "VM"),
+        "network-uuid": ("network", None, "network"),
+        "device": ("device", _str, None),
+        "MAC": ("MAC", _str, None),
+        "MTU": ("MTU", _str, None),
+        "currently-attached": ("currently_attached", _bool, None),
+        "other-config": ("other_config", _map, None)},
+    "network": dict(_NAME, **{
+        "bridge": ("bridge", _str, None),
+        "MTU": ("MTU", _str, None),
+        "other-config": ("other_config", _map, None),
+        "tags": ("tags", _set, None)}),
+    "pif": {
+        "uuid": ("uuid", _str, None),
+        "device": ("device", _str, None),
+        "MAC": ("MAC", _str, None),
+        "MTU": ("MTU", _str, None),
+        "VLAN": ("VLAN", _str, None),
+        "host-uuid": ("host", None, "host"),
+        "network-uuid": ("network", None, "network"),
+        "management": ("management", _bool, None),
+        "physical": ("physical", _bool, None),
+        "currently-attached": ("currently_attached", _bool, None),
+        "IP-configuration-mode": ("ip_configuration_mode", _str, None),
+        "IP": ("IP", _str, None),
+        "netmask": ("netmask", _str, None),
+        "gateway": ("gateway", _str, None),
+        "DNS": ("DNS", _str, None),
+        "other-config": ("other_config", _map, None)},
+    "pbd": {
+        "uuid": ("uuid", _str, None),
+        "host-uuid": ("host", None, "host"),
+        "sr-uuid": ("SR", None, "SR"),
+        "currently-attached": ("currently_attached", _bool, None),
+        "device-config": ("device_config", _map, None),
+        "other-config": ("other_config", _map, None)},
+    "pool": dict(_NAME, **{
+        "master": ("master", None, "host"),
+        "default-SR": ("default_SR", None, "SR"),
+        "ha-enabled": ("ha_enabled", _bool, None),
+        "other-config": ("other_config", _map, None),
+        "tags": ("tags", _set, None)}),
+    }
+
+# XenAPI class names for CLI classes
+CLASSES = {"vm": "VM",
+           "template": "VM",
+           "snapshot": "VM",
+           "host": "host",
+           "sr": "SR",
+           "vdi": "VDI",
+           "vbd": "VBD",
+           "vif": "VIF",
+           "network": "network",
+           "pif": "PIF",
+           "pbd": "PBD",
+           "pool": "pool"}
+
+class XenAPICLIEngine(object):
+    """Executes common read-only xe commands (*-list --minimal and
+    *-param-get) as calls on one long-lived XenAPI session to a host.
+    execute() returns None for anything it cannot translate, the caller
+    should then run the command with the xe binary."""
+
+    def __init__(self, host, secure=True):
+        self.host = host
+        self.secure = secure
+        self.session = None
+        self.lock = threading.Lock()
+        self.stats = {"calls": 0, "fallbacks": 0, "logins": 0, "time": 0.0}
+
+    def _parse(self, command, args, minimal):
+        if command.endswith("-param-get"):
+            cls = command[:-len("-param-get")]
+            op = "param-get"
+        elif command.endswith("-list"):
+            cls = command[:-len("-list")]
+            op = "list"
+        else:
+            raise _Untranslatable()
+        if not FIELDS.has_key(cls) and cls not in ("template", "snapshot"):
+            raise _Untranslatable()
+        params = {}
+        try:
+            tokens = shlex.split(args)
+        except ValueError:
+            raise _Untranslatable()
+        for t in tokens:
+            if t == "--minimal":
+                minimal = True
+            elif t.startswith("-") or not "=" in t:
+                raise _Untranslatable()
+            else:
+                (k, v) = t.split("=", 1)
+                if params.has_key(k):
+                    raise _Untranslatable()
+                params[k] = v
+        return (cls, op, params, minimal)
+
+    def _field(self, cls, name):
+        if cls in ("template", "snapshot"):
+            cls = "vm"
+        if ":" in name:
+            (name, key) = name.split(":", 1)
+        else:
+            key = None
+        if not FIELDS[cls].has_key(name):
+            raise _Untranslatable()
+        (field, fmt, refcls) = FIELDS[cls][name]
+        if key and fmt != _map:
+            raise _Untranslatable()
+        return (field, fmt, refcls, key)
+
+    def _render(self, session, refs, value, fmt, refcls, key=None):
+        if refcls:
+            if value == NULL_REF:
+                return "<not in database>"
+            if not refs.has_key(value):
+                refs[value] = getattr(session.xenapi, refcls).get_uuid(value)
+            return refs[value]
+        if key != None:
+            if not value.has_key(key):
+                # xe reports an error for this, so leave it to xe
+                raise _Untranslatable()
+            return str(value[key])
+        return fmt(value)
+
+    def _list(self, session, cls, params, minimal):
+        if not minimal:
+            raise _Untranslatable()
+        params = params.copy()
+        show = params.pop("params", "uuid")
+        if "," in show or show == "all":
+            raise _Untranslatable()
+        (field, fmt, refcls, key) = self._field(cls, show)
+        refs = {}
+        reply = map(lambda r: self._render(session, refs, r[field], fmt,
+                                           refcls, key),
+                    self._select(session, refs, cls, params))
+        return string.join(reply, ",")
+
+    def _select(self, session, refs, cls, params):
+        """Return the records of class cls matching the filters in params"""
+        filters = map(lambda f: (self._field(cls, f), params[f]),
+                      params.keys())
+        apicls = getattr(session.xenapi, CLASSES[cls])
+        if params.has_key("uuid"):
+            # Avoid fetching every record for the common lookup by uuid
+            try:
+                ref = apicls.get_by_uuid(params["uuid"])
+                records = {ref: apicls.get_record(ref)}
+            except XenAPI.Failure, e:
+                if not e.details or e.details[0] != "UUID_INVALID":
+                    raise
+                records = {}
+        elif params.has_key("name-label") and cls != "pool":
+            records = {}
+            for ref in apicls.get_by_name_label(params["name-label"]):
+                records[ref] = apicls.get_record(ref)
+        else:
+            records = apicls.get_all_records()
+        reply = []
+        for r in self._ordered(apicls, records):
+            if cls == "vm" and not params.has_key("is-a-template") and \
+                    r["is_a_template"]:
+                continue
+            if cls == "template" and \
+                    (not r["is_a_template"] or r["is_a_snapshot"]):
+                continue
+            if cls == "snapshot" and not r["is_a_snapshot"]:
+                continue
+            match = True
+            for ((field, fmt, refcls, key), value) in filters:
+                if key != None and not r[field].has_key(key):
+                    match = False
+                elif self._render(session, refs, r[field], fmt, refcls, key) \
+                        != value:
+                    match = False
+                if not match:
+                    break
+            if match:
+                reply.append(r)
+        return reply
+
+    def _ordered(self, apicls, records):
+        """Return the records in the order xe lists them, which is
+        the order get_all returns their references in"""
+        if len(records) < 2:
+            return records.values()
+        refs = apicls.get_all()
+        reply = [records[ref] for ref in refs if records.has_key(ref)]
+        if len(reply) < len(records):
+            # Created since get_all_records was called
+            refs = set(refs)
+            reply.extend([r for (ref, r) in records.items()
+                          if not ref in refs])
+        return reply
+
+    def _paramGet(self, session, cls, params):
+        params = params.copy()
+        uuid = params.pop("uuid", None)
+        name = params.pop("param-name", None)
+        key = params.pop("param-key", None)
+        if not uuid or not name or params:
+            raise _Untranslatable()
+        (field, fmt, refcls, _) = self._field(cls, name)
+        if key != None and fmt != _map:
+            raise _Untranslatable()
+        apicls = getattr(session.xenapi, CLASSES[cls])
+        ref = apicls.get_by_uuid(uuid)
+        value = getattr(apicls, "get_%s" % (field))(ref)
+        return self._render(session, {}, value, fmt, refcls, key)
+
+    def _getSession(self):
+        # XenAPI.Session would forward a truth test to the server
+        if self.session is None:
+            self.session = self.host.getAPISession(secure=self.secure)
+            self.stats["logins"] += 1
+        return self.session
+
+    def _dropSession(self):
+        session = self.session
+        self.session = None
+        if session is not None:
+            try:
+                session.xenapi.session.logout()
+            except:
+                pass
+
+    def execute(self, command, args="", minimal=False):
+        """Run the xe command, returning its output without the trailing
+        newline, or None if it needs to be run by the xe binary."""
+        try:
+            (cls, op, params, minimal) = self._parse(command, args, minimal)
+        except _Untranslatable:
+            return None
+        if op == "list":
+            return self._run(command, lambda s: self._list(s, cls, params,
+                                                           minimal))
+        return self._run(command, lambda s: self._paramGet(s, cls, params))
+
+    def parameterList(self, command, params, args=""):
+        """Return the list of dictionaries Host.parameterList() would parse
+        from the output of the xe list command, or None if it needs to be
+        run by the xe binary."""
+        try:
+            (cls, op, filters, _) = self._parse(command, args, False)
+            if op != "list" or filters.has_key("params"):
+                return None
+            fields = map(lambda p: (p, self._field(cls, p)), params)
+        except _Untranslatable:
+            return None
+        def run(session):
+            refs = {}
+            reply = []
+            for r in self._select(session, refs, cls, filters):
+                entry = {}
+                for (p, (field, fmt, refcls, key)) in fields:
+                    entry[p] = self._render(session, refs, r[field], fmt,
+                                            refcls, key)
+                reply.append(entry)
+            return reply
+        return self._run(command, run)
+
+    def _run(self, command, method):
+        self.lock.acquire()
+        try:
+            start = time.time()
+            for attempt in range(2):
+                try:
+                    session = self._getSession()
+                    reply = method(session)
+                    self.stats["calls"] += 1
+                    self.stats["time"] += time.time() - start
+                    return reply
+                except _Untranslatable:
+                    break
+                except XenAPI.Failure, e:
+                    if e.details and e.details[0] == "SESSION_INVALID" and \
+                            attempt == 0:
+                        self.session = None
+                        continue
+                    # Let xe report the error in its usual form
+                    xenrt.TEC().logverbose("XenAPI CLI engine failure for %s:"
+                                           " %s" % (command, str(e)))
+                    break
+                except (socket.error, IOError, xmlrpclib.ProtocolError,
+                        httplib.HTTPException), e:
+                    xenrt.TEC().logverbose("XenAPI CLI engine connection "
+                                           "error for %s: %s" %
+                                           (command, str(e)))
+                    self._dropSession()
+                    break
+            self.stats["fallbacks"] += 1
+            return None
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self._dropSession()
+        finally:
+            self.lock.release()
+
+# Classes held by a RecordSnapshot. host and network are included so that
+# references from the others can be rendered without further calls.
+SNAPSHOT_CLASSES = ["VM", "VBD", "VDI", "VIF", "SR", "host", "network"]
+
+class _SnapshotClass(object):
+    """Answers the read calls XenAPICLIEngine makes on a XenAPI class from
+    the records of a RecordSnapshot"""
+
+    def __init__(self, cls, records, refs):
+        self.cls = cls
+        self.records = records
+        self.refs = refs
+        self.byUUID = {}
+        for (ref, r) in records.items():
+            self.byUUID[r["uuid"]] = ref
+
+    def get_all_records(self):
+        return self.records
+
+    def get_all(self):
+        return self.refs
+
+    def get_by_uuid(self, uuid):
+        if not self.byUUID.has_key(uuid):
+            # The object may have been created since the snapshot was taken
+            raise _Untranslatable()
+        return self.byUUID[uuid]
+
+    def get_by_name_label(self, name):
+        return [ref for (ref, r) in self.records.items()
+                if r.get("name_label") == name]
+
+    def get_record(self, ref):
+        if not self.records.has_key(ref):
+            raise _Untranslatable()
+        return self.records[ref]
+
+    def __getattr__(self, name):
+        if not name.startswith("get_"):
+            raise AttributeError(name)
+        field = name[4:]
+        def get(ref):
+            r = self.get_record(ref)
+            if not r.has_key(field):
+                raise _Untranslatable()
+            return r[field]
+        return get
+
+class _SnapshotAPI(object):
+    def __init__(self, classes):
+        self.classes = classes
+
+    def __getattr__(self, name):
+        if not self.classes.has_key(name):
+            raise _Untranslatable()
+        return self.classes[name]
+
+class RecordSnapshot(XenAPICLIEngine):
+    """A read-only copy of the VM, VBD, VDI, VIF, SR, host and network
+    records of a host or pool, fetched with one get_all_records and one
+    get_all call per class. execute() and parameterList() answer
+    read-only CLI commands from it exactly as XenAPICLIEngine would from
+    a live session, returning None for anything the snapshot does not
+    hold."""
+
+    def __init__(self, host, secure=True):
+        XenAPICLIEngine.__init__(self, host, secure=secure)
+        self.xenapi = None
+        self.taken = None
+
+    def refresh(self):
+        """Fetch a new copy of the records"""
+        start = time.time()
+        session = self.host.getAPISession(secure=self.secure)
+        try:
+            classes = {}
+            for cls in SNAPSHOT_CLASSES:
+                apicls = getattr(session.xenapi, cls)
+                classes[cls] = _SnapshotClass(cls, apicls.get_all_records(),
+                                              apicls.get_all())
+        finally:
+            try:
+                session.xenapi.session.logout()
+            except:
+                pass
+        self.lock.acquire()
+        try:
+            self.xenapi = _SnapshotAPI(classes)
+            self.taken = time.time()
+        finally:
+            self.lock.release()
+        xenrt.TEC().logverbose("Took record snapshot of %s in %.2fs (%s)" %
+                               (self.host.getName(), time.time() - start,
+                                string.join(["%d %s" % (len(classes[c].records), c)
+                                             for c in SNAPSHOT_CLASSES], ", ")))
+
+    def age(self):
+        """Return the number of seconds since the snapshot was taken"""
+        if self.taken is None:
+            return None
+        return time.time() - self.taken
+
+    def _getSession(self):
+        if self.xenapi is None:
+            raise _Untranslatable()
+        return self
+
+    def _dropSession(self):
+        pass
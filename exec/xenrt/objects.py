@@ -13,6 +13,7 @@ import sys, string, time, socket, re, os.path, os, shutil, random, sets, math
 import traceback, xmlrpclib, crypt, glob, copy, httplib, urllib, mimetools
 import xml.dom.minidom, threading, fnmatch, urlparse, libxml2
 import xenrt, xenrt.ssh, xenrt.util, xenrt.rootops, xenrt.resources
+import xenrt.daemonfile, xenrt.daemonexec, StringIO
 import testcases.benchmarks.workloads
 import bz2, simplejson, json
 import IPy
@@ -164,6 +165,7 @@ class GenericPlace(object):
         self.memory = None
         self.vcpus = None
         self._os = None
+        self._xmlrpcVersion = None
 
     def populateSubclass(self, x):
         x.password = self.password
@@ -414,6 +416,29 @@ class GenericPlace(object):
         else:
             raise xenrt.XRTError("Unknown GenericPlace subclass")
 
+    def startcmd(self,
+                 commands,
+                 username=None,
+                 password=None,
+                 level=xenrt.RC_FAIL,
+                 logfile=None):
+        """Start a command, or list of commands run as one script, on the
+        guest or host using SSH, logging in and transforming each command
+        as execcmd does. Returns an L{xenrt.ssh.SSHAsyncCommand}."""
+        if type(commands) == type(""):
+            commands = [commands]
+        if isinstance(self, GenericHost):
+            commands = map(self.transformCommand, commands)
+        elif not isinstance(self, GenericGuest):
+            raise xenrt.XRTError("Unknown GenericPlace subclass")
+        (ip, username, password) = self._sshLogin(username, password)
+        return xenrt.ssh.SSHAsyncCommand(ip,
+                                         string.join(commands, "\n") + "\n",
+                                         username=username,
+                                         password=password,
+                                         level=level,
+                                         logfile=logfile)
+
     def sftpClient(self, username="root", level=xenrt.RC_FAIL):
         """Get a SFTP client object to the guest"""
         return xenrt.ssh.SFTPSession(self.getIP(),
@@ -597,9 +622,26 @@ class GenericPlace(object):
                                      transport=trans,
                                      allow_none=True)
 
+    def _xmlrpcSupportsWait(self, s):
+        """Returns True if the daemon can wait for commands and batch calls"""
+        if not self._xmlrpcVersion:
+            self._xmlrpcVersion = xenrt.daemonexec.daemonVersion(s)
+        return xenrt.daemonexec.supportsWait(self._xmlrpcVersion)
+
+    def xmlrpcMultiCall(self, calls):
+        """Make several daemon calls, a list of (method, args) tuples, in
+        one request if the daemon supports it. Returns a list of results."""
+        try:
+            s = self._xmlrpc()
+            return xenrt.daemonexec.multiCall(s, calls, self._xmlrpcSupportsWait(s))
+        except Exception, e:
+            self.checkHealth()
+            raise
+
     def xmlrpcUpdate(self):
         """Update the test execution daemon to the latest version"""
         xenrt.TEC().logverbose("Updating XML-RPC daemon on %s" % (self.getIP()))
+        self._xmlrpcVersion = None
         self.xmlrpcExec("attrib -r c:\\execdaemon.py")
         f = file("%s/utils/execdaemon.py" %
                  (xenrt.TEC().lookup("LOCAL_SCRIPTDIR")), "r")
@@ -742,59 +784,31 @@ class GenericPlace(object):
                    returndata=False, returnerror=True, returnrc=False,
                    timeout=300, ignoredata=False, powershell=False,ignoreHealthCheck=False):
         """Execute a command and wait for completion."""
-        currentPollPeriod = 1
-        maxPollPeriod = 16
-
         try:
             xenrt.TEC().logverbose("Running on %s via daemon: %s" %
                                    (self.getName(), command.encode("utf-8")))
             started = xenrt.util.timenow()
             s = self._xmlrpc()
+            longPoll = self._xmlrpcSupportsWait(s)
             if powershell:
                 ref = s.runpshell(command.encode("utf-16").encode("uu"))
             else:
                 ref = s.runbatch(command.encode("utf-16").encode("uu"))
-            xenrt.sleep(currentPollPeriod, log=False)
-            errors = 0
             if xenrt.TEC().lookup("EXTRA_TIME", False, boolean=True):
                 maxerrors = 6
             else:
                 maxerrors = 2
-            while True:
-                try:
-                    st = s.poll(ref)
-                    errors = 0
-                except socket.error, e:
-                    errors = errors + 1
-                    if errors > maxerrors:
-                        raise
-                    st = "ERROR"
-                if st == "DONE":
-                    break
-                if timeout:
-                    now = xenrt.util.timenow()
-                    deadline = started + timeout
-                    if now > deadline:
-                        xenrt.TEC().logverbose("Timed out polling for %s on %s"
-                                               % (ref, self.getIP()))
-                        return xenrt.XRT("%s timed out" % (desc), level)
-
-                if currentPollPeriod < maxPollPeriod:
-                    currentPollPeriod *= 2
-                    currentPollPeriod = min(currentPollPeriod, maxPollPeriod)
-
-                xenrt.sleep(currentPollPeriod, log=False)
-            if not ignoredata:
-                data = s.log(ref)
+            res = xenrt.daemonexec.waitForResult(s, ref, started, timeout,
+                                                 longPoll,
+                                                 ignoredata=ignoredata,
+                                                 maxerrors=maxerrors)
+            if not res:
+                xenrt.TEC().logverbose("Timed out polling for %s on %s"
+                                       % (ref, self.getIP()))
+                return xenrt.XRT("%s timed out" % (desc), level)
+            (rc, data) = res
+            if data is not None:
                 xenrt.TEC().log(data.encode("utf-8"))
-            else:
-                data = None
-            rc = s.returncode(ref)
-            try:
-                s.cleanup(ref)
-            except Exception, e:
-                xenrt.TEC().warning("Got exception while cleaning up after "
-                                    "xmlrpcExec: %s" % (str(e)))
             if rc != 0 and returnerror:
                 return xenrt.XRT("%s returned error (%d)" % (desc, rc),
                                  level,
@@ -821,21 +835,16 @@ class GenericPlace(object):
         try:
             started = xenrt.util.timenow()
             s = self._xmlrpc()
-            while True:
-                st = s.poll(ref)
-                if st == "DONE":
-                    break
-                if timeout:
-                    now = xenrt.util.timenow()
-                    deadline = started + timeout
-                    if now > deadline:
-                        return xenrt.XRT("%s timed out" % (desc), level)
-                xenrt.sleep(15)
-            data = s.log(ref).encode("utf-8")
+            res = xenrt.daemonexec.waitForResult(s, ref, started, timeout,
+                                                 self._xmlrpcSupportsWait(s),
+                                                 cleanup=cleanup,
+                                                 maxerrors=0,
+                                                 backoff=False)
+            if not res:
+                return xenrt.XRT("%s timed out" % (desc), level)
+            rc = res[0]
+            data = res[1].encode("utf-8")
             xenrt.TEC().log(data)
-            rc = s.returncode(ref)
-            if cleanup:
-                s.cleanup(ref)
             if rc != 0:
                 return xenrt.XRT("%s returned error (%d)" % (desc, rc),
                                  level,
@@ -984,6 +993,9 @@ class GenericPlace(object):
             xenrt.TEC().logverbose("Fetching file %s from %s via daemon" %
                                    (filename, self.getIP()))
             s = self._xmlrpc(patient=patient)
+            f = StringIO.StringIO()
+            if xenrt.daemonfile.readFile(s, filename, f):
+                return f.getvalue()
             return s.readFile(filename).data
         except Exception, e:
             if not ignoreHealthCheck:
@@ -994,10 +1006,17 @@ class GenericPlace(object):
         xenrt.TEC().logverbose("GetFile %s to %s on %s" %
                                (remotefn, localfn, self.getIP()))
         try:
-            data = self.xmlrpcReadFile(remotefn, patient=patient, ignoreHealthCheck=ignoreHealthCheck)
-            f = file(localfn, "w")
-            f.write(data)
-            f.close()
+            s = self._xmlrpc(patient=patient)
+            f = file(localfn, "wb")
+            try:
+                done = xenrt.daemonfile.readFile(s, remotefn, f)
+            finally:
+                f.close()
+            if not done:
+                data = self.xmlrpcReadFile(remotefn, patient=patient, ignoreHealthCheck=ignoreHealthCheck)
+                f = file(localfn, "wb")
+                f.write(data)
+                f.close()
         except Exception, e:
             if not ignoreHealthCheck:
                 self.checkHealth()
@@ -1210,7 +1229,7 @@ class GenericPlace(object):
                 # Pull the file into the guest
                 wdir = xenrt.resources.WebDirectory()
                 try:
-                    wdir.copyIn(localfilename)
+                    wdir.linkIn(localfilename)
                     xenrt.TEC().logverbose("Pulling %s into %s:%s" %
                                            (localfilename,
                                             self.getIP(),
@@ -1221,14 +1240,15 @@ class GenericPlace(object):
                     wdir.remove()
             else:
                 # Push the file to the guest
-                f = file(localfilename, 'r')
-                data = f.read()
-                f.close()
                 xenrt.TEC().logverbose("Pushing %s to %s:%s" %
                                        (localfilename,
                                         self.getIP(),
                                         remotefilename))
-                s.createFile(remotefilename, xmlrpclib.Binary(data))
+                if not xenrt.daemonfile.sendFile(s, localfilename, remotefilename):
+                    f = file(localfilename, 'r')
+                    data = f.read()
+                    f.close()
+                    s.createFile(remotefilename, xmlrpclib.Binary(data))
         except Exception, e:
             if not ignoreHealthCheck:
                 self.checkHealth()
@@ -3078,8 +3098,10 @@ Add-WindowsFeature as-net-framework"""
         exenames = string.split(xenrt.TEC().lookup("XENCENTER_EXE_NAME"), ";")
         for path in string.split(xenrt.TEC().lookup("XENCENTER_DIRECTORY"),
                                  ";"):
-            for exe in exenames:
-                if self.xmlrpcFileExists("%s\\%s" % (path, exe)):
+            exists = self.xmlrpcMultiCall([("fileExists", ("%s\\%s" % (path, exe),))
+                                           for exe in exenames])
+            for (exe, found) in zip(exenames, exists):
+                if found:
                     return path, exe
         return None
 
@@ -4749,14 +4771,8 @@ class GenericHost(GenericPlace):
         except Exception, e:
             xenrt.TEC().warning("Error creating OS: %s" % str(e))
             [xenrt.TEC().logverbose(x) for x in traceback.format_stack()]
-        if not username:
-            if self.windows:
-                username = "Administrator"
-            else:
-                username = "root"
-        if not password:
-            password = self.password
-        return xenrt.ssh.SSH(self.getIP(),
+        (ip, username, password) = self._sshLogin(username, password)
+        return xenrt.ssh.SSH(ip,
                              self.transformCommand(command),
                              level=level,
                              retval=retval,
@@ -4770,6 +4786,17 @@ class GenericHost(GenericPlace):
                              getreply=getreply,
                              useThread=useThread)
 
+    def _sshLogin(self, username, password):
+        """Returns the address, username and password to SSH to dom0 with"""
+        if not username:
+            if self.windows:
+                username = "Administrator"
+            else:
+                username = "root"
+        if not password:
+            password = self.password
+        return (self.getIP(), username, password)
+
     def postInstall(self):
         """Perform any product-specific post install actions."""
         pass
@@ -7679,6 +7706,23 @@ class GenericGuest(GenericPlace):
         except Exception, e:
             xenrt.TEC().warning("Error creating OS: %s" % str(e))
             [xenrt.TEC().logverbose(x) for x in traceback.format_stack()]
+        (ip, username, password) = self._sshLogin(username, password)
+        return xenrt.ssh.SSH(ip,
+                             command,
+                             username=username,
+                             password=password,
+                             level=level,
+                             retval=retval,
+                             timeout=timeout,
+                             idempotent=idempotent,
+                             newlineok=newlineok,
+                             getreply=getreply,
+                             nolog=nolog,
+                             useThread=useThread,
+                             outfile=outfile)
+
+    def _sshLogin(self, username, password):
+        """Returns the address, username and password to SSH to the guest with"""
         if not self.mainip:
             raise xenrt.XRTError("Unknown IP address to SSH to %s" %
                                  (self.name))
@@ -7694,19 +7738,7 @@ class GenericGuest(GenericPlace):
         else:
             if password is None:
                 password = self.password
-        return xenrt.ssh.SSH(self.mainip,
-                             command,
-                             username=username,
-                             password=password,
-                             level=level,
-                             retval=retval,
-                             timeout=timeout,
-                             idempotent=idempotent,
-                             newlineok=newlineok,
-                             getreply=getreply,
-                             nolog=nolog,
-                             useThread=useThread,
-                             outfile=outfile)
+        return (self.mainip, username, password)
 
     def reboot(self, force=False, skipsniff=False):
         # Per-product guest subclasses will override this. Define a fallback
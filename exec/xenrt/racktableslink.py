@@ -294,6 +294,7 @@ def readMachineFromRackTables(machine,kvm=False,xrtMachine=None):
         else:
             for k in cfg.keys():
                 xenrt.GEC().config.config["HOST_CONFIGS"][machine][k] = cfg[k]
+            xenrt.GEC().config.invalidate()
 
     # KVM (useful for DNS)
     try:
@@ -236,6 +236,18 @@ class DirectoryResourceImplementer(object):
                 self._copytree(f, "%s/%s" % (self.dir, os.path.basename(f)))
                 xenrt.TEC().logverbose("Copied %s to %s" % (f, self.dir))
 
+    def linkIn(self, filespec):
+        """Make one or more files available in this subdirectory without
+        copying them where possible. The files must not be removed until
+        this directory has been."""
+        files = self._glob(filespec)
+        for f in files:
+            if self._isfile(f):
+                self._link(f, self.dir)
+                xenrt.TEC().logverbose("Linked %s into %s" % (f, self.dir))
+            else:
+                self.copyIn(f)
+
     def remove(self):
         if self.dir and self.keep == 0:
             try:
@@ -273,6 +285,9 @@ class DirectoryResourceImplementer(object):
     def _copy(self, path, destination):
         raise xenrt.XRTError("Unimplemented.")
         
+    def _link(self, path, destination):
+        self._copy(path, destination)
+
     def _copytree(self, path, destination):
         raise xenrt.XRTError("Unimplemented.")
  
@@ -344,6 +359,14 @@ class LocalDirectoryResourceImplementer(DirectoryResourceImplementer):
 
     def _copy(self, path, destination):
         shutil.copy(path, destination)
+
+    def _link(self, path, destination):
+        dest = os.path.join(destination, os.path.basename(path))
+        try:
+            os.link(path, dest)
+        except OSError:
+            # Different filesystem, the web server follows symlinks
+            os.symlink(os.path.abspath(path), dest)
         
     def _copytree(self, path, destination):
         shutil.copytree(path, destination)
@@ -832,6 +832,9 @@ class TestSequence(Serial):
                 xenrt.TEC().tc.pause("Preprepare completed")
                 xenrt.GEC().dbconnect.jobUpdate("PREPARE_PAUSED", "no")
             self.doPrepare()
+            if xenrt.GEC().filemanager is not None:
+                xenrt.TEC().logverbose("File manager after prepare: %s" %
+                                       (str(xenrt.GEC().filemanager.getStats())))
             if xenrt.TEC().lookup("PAUSE_AFTER_PREPARE", False, boolean=True):
                 xenrt.GEC().dbconnect.jobUpdate("PREPARE_PAUSED", "yes")
                 xenrt.TEC().tc.pause("Prepare completed")
@@ -8,7 +8,8 @@
 # conditions as licensed by XenSource, Inc. All other rights reserved.
 #
 
-import socket, string, sys, os, os.path, traceback, time
+import socket, string, sys, os, os.path, traceback, time, threading, stat, Queue
+import subprocess, pipes
 import paramiko
 import xenrt
 
@@ -16,8 +17,10 @@ import xenrt
 __all__ = ["SSHSession",
            "SFTPSession",
            "SSHCommand",
+           "SSHAsyncCommand",
            "SSH",
            "SSHread",
+           "tarLogsFrom",
            "getPublicKey"]
 
 def getPublicKey():
@@ -27,7 +30,245 @@ def getPublicKey():
     f.close()
     return string.strip(data)
 
+class PooledTransport(object):
+    """An authenticated SSH transport held by a TransportPool."""
+    def __init__(self, key, trans):
+        self.key = key
+        self.trans = trans
+        self.users = 0
+        self.lastUsed = time.time()
+        self.retired = False
+
+class TransportPool(object):
+    """Authenticated SSH transports kept alive between commands.
+
+    Transports are keyed by (ip, port, username, password). Each command
+    opens a new channel on a pooled transport rather than doing its own TCP
+    connect, key exchange and authentication. A transport carries at most
+    SSH_POOL_MAX_CHANNELS concurrent channels, further users get another
+    transport. Transports idle for longer than SSH_POOL_IDLE_TIMEOUT seconds
+    or found dead are dropped.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.transports = {}
+        self.stats = {}
+
+    def enabled(self):
+        return xenrt.TEC().lookup("SSH_TRANSPORT_POOL", False, boolean=True)
+
+    def _stats(self, key):
+        name = "%s@%s:%s" % (key[2], key[0], key[1])
+        if not self.stats.has_key(name):
+            self.stats[name] = {"hits": 0,
+                                "misses": 0,
+                                "reconnects": 0,
+                                "evictions": 0,
+                                "handshakes": 0,
+                                "handshakeTime": 0.0}
+        return self.stats[name]
+
+    def _retire(self, pt, stat):
+        """Remove a transport from the pool so no new channels are opened on
+        it. Returns True if it has no users and can be closed now. Must be
+        called with the lock held."""
+        if pt.retired:
+            return False
+        pt.retired = True
+        self._stats(pt.key)[stat] += 1
+        if pt in self.transports.get(pt.key, []):
+            self.transports[pt.key].remove(pt)
+            if not self.transports[pt.key]:
+                del self.transports[pt.key]
+        return pt.users == 0
+
+    def _sweep(self):
+        """Retire dead and idle transports, returning the ones to close.
+        Must be called with the lock held."""
+        idle = int(xenrt.TEC().lookup("SSH_POOL_IDLE_TIMEOUT", 120))
+        now = time.time()
+        toclose = []
+        for pts in self.transports.values():
+            for pt in list(pts):
+                if not pt.trans.is_active():
+                    if self._retire(pt, "reconnects"):
+                        toclose.append(pt)
+                elif pt.users == 0 and now - pt.lastUsed > idle:
+                    if self._retire(pt, "evictions"):
+                        toclose.append(pt)
+        return toclose
+
+    def _close(self, pts):
+        for pt in pts:
+            try:
+                pt.trans.close()
+            except Exception, e:
+                xenrt.TEC().logverbose("SSH pooled transport close exception %s"
+                                       % (str(e)))
+
+    def acquire(self, key, connect, fresh=False):
+        """Return a (PooledTransport, reused) tuple for key. If no pooled
+        transport has a free channel slot (or fresh is set) then connect()
+        is called to create and authenticate a new paramiko Transport."""
+        maxChannels = int(xenrt.TEC().lookup("SSH_POOL_MAX_CHANNELS", 8))
+        self.lock.acquire()
+        try:
+            toclose = self._sweep()
+            found = None
+            if not fresh:
+                for pt in self.transports.get(key, []):
+                    if pt.users < maxChannels:
+                        found = pt
+                        break
+            if found:
+                found.users += 1
+                self._stats(key)["hits"] += 1
+            else:
+                self._stats(key)["misses"] += 1
+        finally:
+            self.lock.release()
+        self._close(toclose)
+        if found:
+            return (found, True)
+
+        start = time.time()
+        trans = connect()
+        elapsed = time.time() - start
+        pt = PooledTransport(key, trans)
+        pt.users = 1
+        self.lock.acquire()
+        try:
+            stats = self._stats(key)
+            stats["handshakes"] += 1
+            stats["handshakeTime"] += elapsed
+            self.transports.setdefault(key, []).append(pt)
+        finally:
+            self.lock.release()
+        return (pt, False)
+
+    def release(self, pt, discard=False):
+        """Hand back a transport. If discard is set (or the transport has
+        died) it is taken out of the pool and closed once unused."""
+        close = False
+        self.lock.acquire()
+        try:
+            pt.users -= 1
+            pt.lastUsed = time.time()
+            if discard or not pt.trans.is_active():
+                self._retire(pt, "reconnects")
+            close = pt.retired and pt.users == 0
+        finally:
+            self.lock.release()
+        if close:
+            self._close([pt])
+
+    def _callWithin(self, timeout, func, args=(), abandon=None):
+        """Call func(*args) in another thread and return its result, or
+        raise XRTError if it hasn't returned within timeout seconds. If a
+        call we gave up on later returns, abandon is called with its
+        result."""
+        lock = threading.Lock()
+        finished = threading.Event()
+        reply = {}
+        def run():
+            result = None
+            error = None
+            try:
+                result = func(*args)
+            except Exception, e:
+                error = e
+            lock.acquire()
+            try:
+                reply["result"] = result
+                reply["error"] = error
+                late = reply.has_key("abandoned")
+            finally:
+                lock.release()
+            finished.set()
+            if late and result is not None and abandon:
+                try:
+                    abandon(result)
+                except Exception, e:
+                    xenrt.TEC().logverbose("SSH abandoned call cleanup "
+                                           "exception %s" % (str(e)))
+        t = threading.Thread(target=run)
+        t.setDaemon(True)
+        t.start()
+        finished.wait(timeout)
+        lock.acquire()
+        try:
+            if not reply.has_key("result"):
+                reply["abandoned"] = True
+                raise xenrt.XRTError("No reply after %ds" % (timeout))
+        finally:
+            lock.release()
+        if reply["error"]:
+            raise reply["error"]
+        return reply["result"]
+
+    def openChannel(self, pt, timeout):
+        """Open a session channel on a pooled transport. paramiko waits
+        forever for the channel open reply, which it will never get if the
+        peer has gone away underneath a pooled transport, so we give up on
+        the open if there is no answer in time, closing the channel if it
+        opens later. The transport is shared with other channels, so it is
+        only closed if it doesn't answer a keepalive either."""
+        try:
+            return self._callWithin(timeout, pt.trans.open_session,
+                                    abandon=lambda chan: chan.close())
+        except xenrt.XRTError, e:
+            try:
+                self._callWithin(timeout, pt.trans.global_request,
+                                 ("keepalive@openssh.com", ))
+                alive = pt.trans.is_active()
+            except Exception:
+                alive = False
+            if not alive:
+                self._close([pt])
+            raise xenrt.XRTError("Opening an SSH channel failed: %s" %
+                                 (str(e)))
+
+    def closeTransports(self, ip=None):
+        """Retire all pooled transports (only those to ip if specified)."""
+        toclose = []
+        self.lock.acquire()
+        try:
+            for key in self.transports.keys():
+                if ip and key[0] != ip:
+                    continue
+                for pt in list(self.transports[key]):
+                    if self._retire(pt, "evictions"):
+                        toclose.append(pt)
+        finally:
+            self.lock.release()
+        self._close(toclose)
+
+    def getStats(self):
+        """Return a dictionary of per user@ip:port statistics."""
+        self.lock.acquire()
+        try:
+            reply = {}
+            for name in self.stats.keys():
+                reply[name] = dict(self.stats[name])
+            return reply
+        finally:
+            self.lock.release()
+
+_transportPool = TransportPool()
+
+def getTransportPoolStats():
+    """Return the SSH transport pool statistics (hits, misses, reconnects,
+    evictions, handshakes and total handshakeTime) keyed by user@ip:port"""
+    return _transportPool.getStats()
+
+def closePooledTransports(ip=None):
+    """Close pooled SSH transports, e.g. after a target has rebooted"""
+    _transportPool.closeTransports(ip)
+
 class SSHSession(object):
+    trans = None
+    pooledTrans = None
+
     def __init__(self,
                  ip,
                  username="root",
@@ -36,29 +277,28 @@ class SSHSession(object):
                  password=None,
                  nowarn=False,
                  useThread=False,
-                 port=22):
+                 port=22,
+                 pooled=False):
         self.level = level
         self.toreply = 0
         self.debug = False
         self.trans = None
+        self.pooledTrans = None
+        self.poolDiscard = False
+        self.reusedTrans = False
+        self.openTimeout = timeout
+        if pooled:
+            self.connectArgs = (ip, port, username, password, timeout, useThread)
+        else:
+            self.connectArgs = None
         for tries in range(3):
             self.trans = None
             try:
-                if useThread:
-                    t = xenrt.util.ThreadWithException(target=self.connect,
-                                                       args=(ip, port, username,
-                                                             password, timeout))
-                    # Make the thread daemonic (so python will exit if it ends
-                    # up hung and still running)
-                    t.setDaemon(True)
-                    t.start()
-                    t.join(timeout)
-                    if t.isAlive():
-                        raise xenrt.XRTFailure("Connection appears to have hung")
-                    if t.exception:
-                        raise t.exception
+                if self.connectArgs:
+                    self.acquireTransport()
                 else:
-                    self.connect(ip, port, username, password, timeout)
+                    self.connectGuarded(ip, port, username, password, timeout,
+                                        useThread)
             except Exception, e:
                 traceback.print_exc(file=sys.stderr)
                 desc = str(e)
@@ -98,6 +338,42 @@ class SSHSession(object):
         self.toreply = 1
         self.close()
 
+    def connectGuarded(self, ip, port, username, password, timeout, useThread):
+        if useThread:
+            t = xenrt.util.ThreadWithException(target=self.connect,
+                                               args=(ip, port, username,
+                                                     password, timeout))
+            # Make the thread daemonic (so python will exit if it ends
+            # up hung and still running)
+            t.setDaemon(True)
+            t.start()
+            t.join(timeout)
+            if t.isAlive():
+                raise xenrt.XRTFailure("Connection appears to have hung")
+            if t.exception:
+                raise t.exception
+        else:
+            self.connect(ip, port, username, password, timeout)
+
+    def acquireTransport(self, fresh=False):
+        """Take an authenticated transport from the pool"""
+        (ip, port, username, password, timeout, useThread) = self.connectArgs
+        def connect():
+            self.trans = None
+            try:
+                self.connectGuarded(ip, port, username, password, timeout,
+                                    useThread)
+            except:
+                if self.trans:
+                    self.trans.close()
+                    self.trans = None
+                raise
+            return self.trans
+        (self.pooledTrans, self.reusedTrans) = _transportPool.acquire(\
+            (ip, port, username, password), connect, fresh=fresh)
+        self.trans = self.pooledTrans.trans
+        self.poolDiscard = False
+
     def connect(self, ip, port, username, password, timeout):
         if self.debug:
             xenrt.TEC().logverbose("connect")
@@ -158,13 +434,39 @@ class SSHSession(object):
     def open_session(self):
         if self.debug:
             xenrt.TEC().logverbose("open_session")
-        return self.trans.open_session()
+        if not self.pooledTrans:
+            return self.trans.open_session()
+        openTimeout = min(self.openTimeout,
+                          int(xenrt.TEC().lookup("SSH_POOL_OPEN_TIMEOUT", 30)))
+        try:
+            return _transportPool.openChannel(self.pooledTrans, openTimeout)
+        except Exception, e:
+            if not self.reusedTrans:
+                raise
+            # The pooled transport may have gone stale (e.g. the target
+            # rebooted), so try a newly connected one. The old transport is
+            # only dropped from the pool if it has died.
+            xenrt.TEC().logverbose("Pooled SSH transport failed (%s), "
+                                   "reconnecting" % (str(e)))
+            self.poolDiscard = not self.pooledTrans.trans.is_active()
+            self.closeTransport()
+            self.acquireTransport(fresh=True)
+            return _transportPool.openChannel(self.pooledTrans, openTimeout)
 
-    def close(self):
-        if self.trans:
+    def closeTransport(self):
+        """Close our transport, or return it to the pool if it's pooled"""
+        if self.pooledTrans:
+            pt = self.pooledTrans
+            self.pooledTrans = None
+            self.trans = None
+            _transportPool.release(pt, discard=self.poolDiscard)
+        elif self.trans:
             self.trans.close()
             self.trans = None
 
+    def close(self):
+        self.closeTransport()
+
     def __del__(self):
         self.close()
 
@@ -177,7 +479,8 @@ class SFTPSession(SSHSession):
                  level=xenrt.RC_ERROR,
                  password=None,
                  nowarn=False,
-                 port=22):
+                 port=22,
+                 pooled=None):
         xenrt.TEC().logverbose("SFTP session to %s@%s" % (username, ip))
         self.ip = ip
         self.port = port
@@ -186,6 +489,10 @@ class SFTPSession(SSHSession):
         self.level = level
         self.password = password
         self.nowarn = nowarn
+        self.client = None
+        if pooled == None:
+            pooled = _transportPool.enabled()
+        self.pooled = pooled
         SSHSession.__init__(self,
                             ip,
                             username=username,
@@ -193,19 +500,23 @@ class SFTPSession(SSHSession):
                             level=level,
                             password=password,
                             nowarn=nowarn,
-                            port=port)
+                            port=port,
+                            pooled=pooled)
         try:
-            # We do this rather than the simple trans.open_sftp_client() because
-            # if we don't then we don't get a timeout set so we can hang forever
-            c = self.trans.open_channel("session")
-            c.settimeout(timeout)
-            c.invoke_subsystem("sftp")
-            self.client = paramiko.SFTPClient(c)
+            self.client = self._openClient()
         except:
             self.reply = xenrt.XRT("SFTP connection failed", self.level)
             self.toreply = 1
             self.close()
 
+    def _openClient(self):
+        # We do this rather than the simple trans.open_sftp_client() because
+        # if we don't then we don't get a timeout set so we can hang forever
+        c = self.open_session()
+        c.settimeout(self.timeout)
+        c.invoke_subsystem("sftp")
+        return paramiko.SFTPClient(c)
+
     def getClient(self):
         # This is UNSAFE - the client object may change if we auto reconnect!
         return self.client
@@ -229,12 +540,16 @@ class SFTPSession(SSHSession):
         if not alive:
             xenrt.TEC().logverbose("SFTP session appears to have gone away, "
                                    "attempting to reconnect...")
+            self.poolDiscard = True
+            self.close()
             self.__init__(self.ip,
                           username=self.username,
                           timeout=self.timeout,
                           level=self.level,
                           password=self.password,
-                          nowarn=self.nowarn)
+                          nowarn=self.nowarn,
+                          port=self.port,
+                          pooled=self.pooled)
 
     def close(self):
         if self.client:
@@ -242,12 +557,12 @@ class SFTPSession(SSHSession):
                 self.client.close()
             except Exception, e:
                 xenrt.TEC().logverbose("SFTP close exception %s" % (str(e)))
-        if self.trans:
-            try:
-                self.trans.close()
-            except Exception, e:
-                xenrt.TEC().logverbose("SFTP trans close exception %s" %
-                                       (str(e)))
+            self.client = None
+        try:
+            self.closeTransport()
+        except Exception, e:
+            xenrt.TEC().logverbose("SFTP trans close exception %s" %
+                                   (str(e)))
 
     def copyTo(self, source, dest, preserve=True):
         xenrt.TEC().logverbose("SFTP local:%s to remote:%s" % (source, dest))
@@ -270,12 +585,102 @@ class SFTPSession(SSHSession):
             xenrt.TEC().logverbose("Skipping %s, too big (%u)" %
                                    (source, st.st_size))
             return
-        self.client.get(source, dest)
+        self._getFile(self.client, source, dest, st, preserve)
+
+    def _getFile(self, client, source, dest, st, preserve):
+        """Fetch a file we already have the attributes of. This saves the
+        stat calls paramiko's get makes, and the reads are pipelined."""
+        fr = client.open(source, "rb")
+        try:
+            fl = file(dest, "wb")
+            try:
+                if st.st_size:
+                    chunks = [(offset, min(xenrt.MEGA, st.st_size - offset))
+                              for offset in range(0, st.st_size, xenrt.MEGA)]
+                    for data in fr.readv(chunks):
+                        fl.write(data)
+                else:
+                    # Files like those in /proc have no size until read
+                    while True:
+                        data = fr.read(32768)
+                        if not data:
+                            break
+                        fl.write(data)
+            finally:
+                fl.close()
+        finally:
+            fr.close()
         if preserve:
             if preserve == True:
                 os.chmod(dest, st.st_mode)
             os.utime(dest, (st.st_atime, st.st_mtime))
 
+    def _putFile(self, client, source, dest, preserve):
+        st = os.lstat(source)
+        fr = client.open(dest, "wb")
+        try:
+            fr.set_pipelined(True)
+            fl = file(source, "rb")
+            try:
+                while True:
+                    data = fl.read(32768)
+                    if not data:
+                        break
+                    fr.write(data)
+            finally:
+                fl.close()
+            if preserve:
+                if preserve == True:
+                    fr.chmod(st.st_mode)
+                fr.utime((st.st_atime, st.st_mtime))
+        finally:
+            fr.close()
+
+    def _parallel(self, func, jobs):
+        """Call func(client, *job) for each job, spread over up to
+        SFTP_TREE_WORKERS SFTP channels on our transport so that the
+        round trips of several files overlap"""
+        workers = min(int(xenrt.TEC().lookup("SFTP_TREE_WORKERS", "4")),
+                      len(jobs))
+        if workers <= 1:
+            for job in jobs:
+                func(self.client, *job)
+            return
+        clients = Queue.Queue()
+        clients.put(self.client)
+        extra = []
+        for i in range(workers - 1):
+            try:
+                c = self._openClient()
+            except Exception, e:
+                xenrt.TEC().logverbose("Could not open another SFTP channel "
+                                       "to %s: %s" % (self.ip, str(e)))
+                break
+            extra.append(c)
+            clients.put(c)
+        def run(job):
+            c = clients.get()
+            try:
+                func(c, *job)
+            finally:
+                clients.put(c)
+        executor = xenrt.Executor(len(extra) + 1)
+        futures = []
+        try:
+            futures = executor.map(run, jobs)
+            for f in futures:
+                f.wait()
+        finally:
+            executor.shutdown(wait=False)
+            for c in extra:
+                try:
+                    c.close()
+                except Exception, e:
+                    xenrt.TEC().logverbose("SFTP close exception %s" % (str(e)))
+        for f in futures:
+            if f.exception():
+                f.result()
+
     def copyTreeTo(self, source, dest, preserve=True):
         """Recursive copy to the remote host
 
@@ -286,70 +691,77 @@ class SFTPSession(SSHSession):
                                (source, dest))
         self.check()
         source = os.path.normpath(source)
-        dirs = os.walk(source)
-        for dir in dirs:
-            (dirname, dirnames, filenames) = dir
+        files = []
+        for (dirname, dirnames, filenames) in os.walk(source):
             # Create the remote directory
             dirname = os.path.normpath(dirname)
             relpath = dirname[len(source):]
             if len(relpath) > 0 and relpath[0] == "/":
                 relpath = relpath[1:]
             targetpath = os.path.normpath(os.path.join(dest, relpath))
+            mode = os.lstat(dirname).st_mode
             try:
-                self.client.lstat(targetpath)
+                self.client.mkdir(targetpath, mode)
+            except IOError, e:
                 # Already exists
                 if preserve == True:
-                    self.client.chmod(targetpath, os.lstat(dirname).st_mode)
-            except IOError, e:
-                self.client.mkdir(targetpath, os.lstat(dirname).st_mode)
-            # Copy all the files in
-            for file in filenames:
-                srcfile = os.path.join(dirname, file)
-                dstfile = os.path.join(targetpath, file)
-                st = os.lstat(srcfile)
-                self.client.put(srcfile, dstfile)
-                if preserve:
-                    if preserve == True:
-                        self.client.chmod(dstfile, st.st_mode)
-                    self.client.utime(dstfile, (st.st_atime, st.st_mtime))
+                    self.client.chmod(targetpath, mode)
+            for f in filenames:
+                files.append((os.path.join(dirname, f),
+                              os.path.join(targetpath, f),
+                              preserve))
+        started = time.time()
+        self._parallel(self._putFile, files)
+        xenrt.TEC().logverbose("SFTP copied %d files in %.1fs" %
+                               (len(files), time.time() - started))
+
+    def _listTree(self, source, dest, threshold=None, sizethresh=None):
+        """Returns the (remote, local, attributes) of the directories and of
+        the files to fetch in the remote tree at source, reading each
+        directory with a single listdir_attr"""
+        dirs = []
+        files = []
+        pending = [(source, dest, self.client.stat(source))]
+        while pending:
+            (rdir, ldir, st) = pending.pop(0)
+            dirs.append((rdir, ldir, st))
+            for a in self.client.listdir_attr(rdir):
+                rpath = "%s/%s" % (rdir, a.filename)
+                lpath = "%s/%s" % (ldir, a.filename)
+                if stat.S_ISLNK(a.st_mode):
+                    # Symlinks are followed
+                    try:
+                        a = self.client.stat(rpath)
+                    except IOError, e:
+                        xenrt.TEC().logverbose("Skipping %s, %s" % (rpath, str(e)))
+                        continue
+                if stat.S_ISDIR(a.st_mode):
+                    pending.append((rpath, lpath, a))
+                elif threshold and a.st_mtime < threshold:
+                    xenrt.TEC().logverbose("Skipping %s, too old" % (rpath))
+                elif sizethresh and a.st_size > long(sizethresh):
+                    xenrt.TEC().logverbose("Skipping %s, too big (%u)" %
+                                           (rpath, a.st_size))
+                else:
+                    files.append((rpath, lpath, a))
+        return (dirs, files)
 
     def copyTreeFromRecurse(self, source, dest, preserve=True, threshold=None,
                             sizethresh=None):
-        # make sure local destination exists
-        if not os.path.exists(dest):
-            os.makedirs(dest)
-        if preserve:
-            os.chmod(dest, self.client.lstat(source).st_mode)
-        d = self.client.listdir(source)
-        for i in d:
-            try:
-                dummy = self.client.listdir("%s/%s" % (source, i))
-                isdir = True
-            except:
-                isdir = False                
-            if isdir:
-                self.copyTreeFromRecurse("%s/%s" % (source, i),
-                                         "%s/%s" % (dest, i),
-                                         preserve=preserve,
-                                         threshold=threshold,
-                                         sizethresh=sizethresh)
-            else:
-                xenrt.TEC().logverbose("About to copy %s/%s" % (source, i))
-                st = self.client.stat("%s/%s" % (source, i))
-                if threshold and st.st_mtime < threshold:
-                    xenrt.TEC().logverbose("Skipping %s/%s, too old" %
-                                           (source, i))
-                elif sizethresh and st.st_size > long(sizethresh):
-                    xenrt.TEC().logverbose("Skipping %s/%s, too big (%u)" %
-                                           (source, i, st.st_size))
-                else:
-                    self.client.get("%s/%s" % (source, i),
-                                    "%s/%s" % (dest, i))
-                    if preserve:
-                        if preserve == True:
-                            os.chmod("%s/%s" % (dest, i), st.st_mode)
-                        os.utime("%s/%s" % (dest, i),
-                                 (st.st_atime, st.st_mtime))
+        started = time.time()
+        (dirs, files) = self._listTree(source, dest, threshold, sizethresh)
+        for (rdir, ldir, st) in dirs:
+            # make sure local destination exists
+            if not os.path.exists(ldir):
+                os.makedirs(ldir)
+            if preserve:
+                os.chmod(ldir, st.st_mode)
+        self._parallel(self._getFile,
+                       [(rpath, lpath, st, preserve) for (rpath, lpath, st) in files])
+        xenrt.TEC().logverbose("SFTP copied %d files (%d bytes) in %.1fs" %
+                               (len(files),
+                                sum([st.st_size for (rpath, lpath, st) in files]),
+                                time.time() - started))
 
     def copyTreeFrom(self, source, dest, preserve=True, threshold=None,
                      sizethresh=None):
@@ -373,22 +785,19 @@ class SFTPSession(SSHSession):
         xenrt.TEC().logverbose("SFTP log fetch of %s to local:%s" %
                                (`pathlist`, dest))
         for p in pathlist:
-            # Directory?
             xenrt.TEC().logverbose("Trying to fetch %s." % (p))
             try:
-                d = self.client.listdir(p)
-                self.copyTreeFrom(p, "%s/%s" % (dest, os.path.basename(p)),
-                                  preserve="utime", threshold=threshold,
-                                  sizethresh=sizethresh)
-            except:
-                # File?
-                try:
-                    s = self.client.lstat(p)
+                st = self.client.stat(p)
+                if stat.S_ISDIR(st.st_mode):
+                    self.copyTreeFrom(p, "%s/%s" % (dest, os.path.basename(p)),
+                                      preserve="utime", threshold=threshold,
+                                      sizethresh=sizethresh)
+                else:
                     self.copyFrom(p, "%s/%s" % (dest, os.path.basename(p)),
                                   preserve="utime", threshold=threshold,
                                   sizethresh=sizethresh)
-                except:
-                    pass
+            except:
+                pass
     
     def __del__(self):
         SSHSession.__del__(self)                
@@ -407,7 +816,11 @@ class SSHCommand(SSHSession):
                  nolog=False,
                  useThread=False,
                  usePty=False,
-                 port=22):
+                 port=22,
+                 pooled=None):
+        self.client = None
+        if pooled == None:
+            pooled = _transportPool.enabled()
         SSHSession.__init__(self,
                             ip,
                             username=username,
@@ -416,7 +829,8 @@ class SSHCommand(SSHSession):
                             password=password,
                             nowarn=nowarn,
                             useThread=useThread,
-                            port=port)
+                            port=port,
+                            pooled=pooled)
         self.command = command
         self.nolog = nolog
         if string.find(command, "\n") > -1 and not newlineok:
@@ -481,6 +895,7 @@ class SSHCommand(SSHSession):
             except socket.timeout:
                 if self.debug:
                     xenrt.TEC().logverbose("close")
+                self.poolDiscard = True
                 self.close()
                 return xenrt.XRT("SSH timed out", self.level)
             if len(output) == 0:
@@ -513,10 +928,140 @@ class SSHCommand(SSHSession):
         if self.debug:
             xenrt.TEC().logverbose("done (3)")
         return reply
+
+    def close(self):
+        if self.pooledTrans and self.client:
+            # Closing a pooled transport doesn't take the channel with it
+            try:
+                self.client.close()
+            except Exception, e:
+                xenrt.TEC().logverbose("SSH channel close exception %s" %
+                                       (str(e)))
+            self.client = None
+        SSHSession.close(self)
     
     def __del__(self):
         SSHSession.__del__(self)   
  
+class SSHAsyncCommand(SSHCommand):
+    """A shell script run on one SSH channel without waiting for it.
+
+    The script is passed to bash as an argument, so nothing needs to be
+    copied to the target first, and stdin is /dev/null as for any other
+    command so nothing in the script can read the rest of it. A thread
+    copies the combined stdout and stderr to the log, and to logfile if
+    given, as it arrives. The exit status comes back on the channel when
+    the script finishes.
+    """
+    def __init__(self,
+                 ip,
+                 script,
+                 username="root",
+                 timeout=300,
+                 level=xenrt.RC_ERROR,
+                 password=None,
+                 nowarn=False,
+                 nolog=False,
+                 logfile=None,
+                 port=22,
+                 pooled=None):
+        self.client = None
+        self.exit_status = None
+        if pooled == None:
+            pooled = _transportPool.enabled()
+        SSHSession.__init__(self,
+                            ip,
+                            username=username,
+                            timeout=timeout,
+                            level=level,
+                            password=password,
+                            nowarn=nowarn,
+                            port=port,
+                            pooled=pooled)
+        if self.toreply:
+            raise self.reply
+        self.command = script
+        self.nolog = nolog
+        self.tec = xenrt.TEC()
+        self.output = []
+        self.logfile = logfile
+        try:
+            self.client = self.open_session()
+            self.client.settimeout(timeout)
+            self.client.set_combine_stderr(True)
+            self.client.exec_command("bash -c %s < /dev/null" %
+                                     (pipes.quote(script)))
+        except Exception, e:
+            self.poolDiscard = True
+            self.close()
+            raise xenrt.XRT("SSH connection failed: %s" % (str(e)), self.level)
+        self.thread = threading.Thread(target=self._stream,
+                                       name="SSHAsync-%s" % (ip))
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def _stream(self):
+        # Only block for a short time on the channel so that the thread
+        # notices if it is closed underneath it
+        self.client.settimeout(30)
+        f = self.logfile and file(self.logfile, "a")
+        partial = ""
+        try:
+            while True:
+                try:
+                    data = self.client.recv(4096)
+                except socket.timeout:
+                    continue
+                except Exception, e:
+                    self.tec.logverbose("SSH async channel exception %s" % (str(e)))
+                    break
+                if not data:
+                    break
+                self.output.append(data)
+                if f:
+                    f.write(data)
+                    f.flush()
+                if not self.nolog:
+                    lines = (partial + data).split("\n")
+                    partial = lines.pop()
+                    if lines:
+                        self.tec.log("\n".join(lines) + "\n")
+        finally:
+            if partial and not self.nolog:
+                self.tec.log(partial + "\n")
+            if f:
+                f.close()
+
+    def poll(self):
+        """Returns True if the script has finished"""
+        return not self.thread.isAlive()
+
+    def wait(self, timeout=None):
+        """Wait up to timeout seconds for the script to finish. Returns the
+        exit status, -1 if the channel was lost, or None if the script is
+        still running."""
+        if timeout is not None:
+            deadline = time.time() + timeout
+        self.thread.join(timeout)
+        if self.thread.isAlive():
+            return None
+        if self.exit_status is None:
+            # The exit status is usually sent after the end of the output
+            if timeout is None:
+                self.client.status_event.wait()
+            else:
+                self.client.status_event.wait(max(0, deadline - time.time()))
+            if not self.client.status_event.isSet():
+                return None
+            # This is -1 if the channel closed without sending a status
+            self.exit_status = self.client.recv_exit_status()
+            self.close()
+        return self.exit_status
+
+    def getOutput(self):
+        """Returns the output of the script so far"""
+        return string.join(self.output, "")
+
 def SSH(ip,
         command,
         username="root",
@@ -532,7 +1077,8 @@ def SSH(ip,
         outfile=None,
         useThread=False,
         usePty=False,
-        port=22):
+        port=22,
+        pooled=None):
     tries = 0
     while True:
         tries = tries + 1
@@ -554,7 +1100,8 @@ def SSH(ip,
                            nolog=nolog,
                            useThread=useThread,
                            usePty=usePty,
-                           port=port)
+                           port=port,
+                           pooled=pooled)
             if outfile:
                 try:
                     f = file(outfile, 'w')
@@ -587,7 +1134,8 @@ def SSHread(ip,
             idempotent=False,
             nowarn=False,
             newlineok=False,
-            port=22):
+            port=22,
+            pooled=None):
     tries = 0
     while True:
         tries = tries + 1
@@ -606,7 +1154,8 @@ def SSHread(ip,
                            password=password,
                            nowarn=nowarn,
                            newlineok=newlineok,
-                           port=port)
+                           port=port,
+                           pooled=pooled)
             reply = s.read(retval="string")
             return reply
         except Exception, e:
@@ -619,6 +1168,85 @@ def SSHread(ip,
                                     % (username, ip, command, str(e)))
             xenrt.sleep(5)
 
+class _CountingWriter(object):
+    def __init__(self, fh):
+        self.fh = fh
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+        self.fh.write(data)
+
+def tarLogsFrom(ip,
+                pathlist,
+                dest,
+                threshold=None,
+                sizethresh=None,
+                username="root",
+                password=None,
+                timeout=3600,
+                port=22,
+                pooled=None):
+    """Copy the files and directory trees in pathlist remotely to dest
+    locally, with the same layout as SFTPSession.copyLogsFrom, as one
+    compressed tar stream over a single SSH channel. Files modified before
+    threshold or bigger than sizethresh bytes are left out. Returns the
+    number of compressed bytes received. Raises an exception if the target
+    does not have GNU tar, so the caller can fall back to SFTP."""
+    filters = ""
+    if threshold:
+        filters += " -mmin -%d" % (int((time.time() - threshold) / 60) + 1)
+    if sizethresh:
+        filters += " -size -%dc" % (long(sizethresh) + 1)
+    parts = []
+    for p in pathlist:
+        p = os.path.normpath(p)
+        # Each path is archived relative to its parent directory, so it
+        # is extracted at dest/basename as copyLogsFrom would
+        parts.append("(cd %s && find -L %s -type f%s -print0 | "
+                     "tar --null --no-recursion -chf - -T -)" %
+                     (pipes.quote(os.path.dirname(p)),
+                      pipes.quote(os.path.basename(p)),
+                      filters))
+    # SSHCommand combines stderr with stdout, so nothing in the pipeline
+    # may write to it
+    command = "{ if tar --version | grep -q GNU; then " \
+              "( %s ) | gzip -c; else exit 3; fi; } 2>/dev/null" % \
+              (string.join(parts, "; "))
+    if not os.path.exists(dest):
+        os.makedirs(dest)
+    xenrt.TEC().logverbose("Streaming %s from %s to %s with tar" %
+                           (`pathlist`, ip, dest))
+    # The archives from each path are concatenated, which tar needs -i to
+    # read past
+    untar = subprocess.Popen(["tar", "-xzif", "-", "--no-same-owner",
+                              "-C", dest],
+                             stdin=subprocess.PIPE,
+                             stderr=subprocess.PIPE)
+    writer = _CountingWriter(untar.stdin)
+    try:
+        s = SSHCommand(ip,
+                       command,
+                       username=username,
+                       timeout=timeout,
+                       level=xenrt.RC_FAIL,
+                       password=password,
+                       nolog=True,
+                       port=port,
+                       pooled=pooled)
+        ret = s.read(retval="code", fh=writer)
+    finally:
+        untar.stdin.close()
+        err = untar.stderr.read()
+        untar.wait()
+    if ret == 3:
+        raise xenrt.XRTError("GNU tar not available on %s" % (ip))
+    if ret != 0:
+        raise xenrt.XRTError("Remote log tar on %s exited with %d" % (ip, ret))
+    if untar.returncode != 0:
+        raise xenrt.XRTError("Extracting logs from %s failed: %s" % (ip, err.strip()))
+    return writer.bytes
+
 def createFile(guest, 
         data="",
         path="/tmp/temp.txt"):
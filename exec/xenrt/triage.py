@@ -0,0 +1,287 @@
+#
+# XenRT: Test harness for Xen and the XenServer product family
+#
+# Failure triage - find known failure signatures in job logs
+#
+# Copyright (c) Citrix Systems, Inc. All use and distribution of this
+# copyrighted material is governed by and subject to terms and
+# conditions as licensed by Citrix Systems, Inc. All other rights reserved.
+#
+
+import glob, re
+import xenrt
+
+# Symbols we want to export from the package.
+__all__ = ["FAILURE_PATTERNS", "LogTriage", "formatSnippet"]
+
+# Known failure signatures. Each entry has
+#   file        glob of the log files to search, relative to the log directory
+#   desc        description used in the snippet header
+#   pattern     multi-line regular expression, matched as pcregrep -M would
+#   anchor      (optional) regular expression found on the same line as the
+#               core of every match, used to skip text that cannot match
+#   before      (required with anchor) the most lines a match can start
+#               before the line the anchor is on
+#   type        (optional) patterns with a type are not warned about
+#   startPoint, endPoint  (optional) the slice of a long snippet to keep
+FAILURE_PATTERNS = [
+    ## Log files to be pathed with reference to TEC.logdir
+    # xenrt.log
+    {'file':"xenrt.log", 'desc':"Generic Failure Log",
+        'pattern':r'(?:.*\n){0,4}(?:\[VERBOSE\].*Traceback.*\n)(?:.*\n){0,24}(?:\[REASON.*\n)(?:.*\n){0,2}',
+        'anchor':r'\[VERBOSE\].*Traceback', 'before':4},
+
+    # console*
+    {'file':"console*", 'desc':"Host Out of memory",
+        'pattern':r'(?:.*\n){0,4}.*\] Out of memory\: Kill process.*(?:.*\n){0,4}',
+        'anchor':r'\] Out of memory\: Kill process', 'before':4},
+    {'file':"console*", 'desc':"INFO",
+        'pattern':r'(?:.*\n){0,5}.*\] INFO\: .*(?:.*\n){0,10}',
+        'anchor':r'\] INFO\: ', 'before':5},
+    {'file':"console*", 'desc':"Call Trace",
+        'pattern':r'(?:.*\n){0,6}.* [cC]all [tT]race(?:.*\n){0,24}',
+        'anchor':r' [cC]all [tT]race', 'before':6},
+
+    # host-serial-log-*
+    {'file':"host-serial-log-*", 'desc':"Blocked Tasks",
+        'pattern':r'(?:.*\n){0,4}.*INFO\: task .*? blocked for more than \d*? seconds\.(?:.*\n){0,4}',
+        'anchor':r'INFO\: task ', 'before':4},
+    {'file':"host-serial-log-*", 'desc':"Kernel BUG",
+        'pattern':r'(?:.*\n){0,4}.*\] kernel BUG at .*(?:.*\n){0,6}',
+        'anchor':r'\] kernel BUG at ', 'before':4},
+    {'file':"host-serial-log-*", 'desc':"Stacked Call Trace",
+        'pattern':r'(?:.*\n){0,6}.*\] Call Trace\:(?:.*\n){0,14}',
+        'anchor':r'\] Call Trace\:', 'before':6},
+    {'file':"host-serial-log-*", 'desc':"CPU stuck",
+        'pattern':r'(?:.*\n){0,6}.*\] Watchdog timer detects that .* is stuck!(?:.*\n){0,14}',
+        'anchor':r'\] Watchdog timer detects that ', 'before':6},
+    {'file':"host-serial-log-*", 'desc':"cut here",
+        'pattern':r'\n.*\] ------------\[ cut here \]------------(?:.*\n)*?.*\] ---\[ end trace .*---.*',
+        'anchor':r'\] ------------\[ cut here \]------------', 'before':1},
+
+    # [HOST_NAME]/kern.log
+    {'file':"*/kern.log", 'desc':"cut here",
+        'pattern':r'\n.*\] ------------\[ cut here \]------------(?:.*\n)*?.*\] ---\[ end trace .*---.*',
+        'anchor':r'\] ------------\[ cut here \]------------', 'before':1},
+
+    # [HOST_NAME]/daemon.log
+    {'file':"*/daemon.log", 'desc':"BUGCHECK",
+        'pattern':r'\n.*BUGCHECK: ====>(?:.*\n)*?.*BUGCHECK: <====.*',
+        'anchor':r'BUGCHECK: ====>', 'before':1},
+
+    # [GUEST_NAME]/messages
+    {'file':"*/messages", 'desc':"cut here",
+        'pattern':r'\n.*: ------------\[ cut here \]------------(?:.*\n)*?.*: ---\[ end trace .*---.*',
+        'anchor':r': ------------\[ cut here \]------------', 'before':1},
+
+    # [GUEST_NAME]/guest-console-logs/console*
+    {'file':"*/guest-console-logs/console*", 'desc':"cut here",
+        'pattern':r'\n.*\] ------------\[ cut here \]------------(?:.*\n)*?.*\] ---\[ end trace .*---.*',
+        'anchor':r'\] ------------\[ cut here \]------------', 'before':1},
+    {'file':"*/guest-console-logs/console*", 'desc':"Network autoconfig using DHCP failed",
+        'pattern':r'(?:.*\n){0,1}(?:.*Network autoconfiguration failed.*)(?:.*\n){0,4}',
+        'anchor':r'Network autoconfiguration failed', 'before':1},
+#    {'file':"*/guest-console-logs/console*", 'desc':"Guest Stacked Call Trace", 'ignoreAfter': "SysRq :",
+#        'pattern':r'(?:.*\n){0,2}(?:.*Call Trace\:.*)(?:.*\n){0,10}'},
+    {'file':"*/guest-console-logs/console*", 'desc':"Guest GRUB Installation failure",
+        'pattern':r'(?:.*\n){0,20}(?:.*GRUB installation failed.*)(?:.*\n){0,4}',
+        'anchor':r'GRUB installation failed', 'before':20},
+    {'file':"*/guest-console-logs/console*", 'desc':"Guest BUG",
+        'pattern':r'(?:.*\n){0,2}(?:.*BUG\:.*)(?:.*\n){0,3}',
+        'anchor':r'BUG\:', 'before':2},
+    {'file':"*/guest-console-logs/console*", 'desc':"Kernel Panic",
+        'pattern':r'(?:.*\n){0,4}(?:.*Kernel panic.*)(?:.*\n){0,4}',
+        'anchor':r'Kernel panic', 'before':4},
+
+#    {'file':"*/cloudstack/management/management-server.log*", 'desc':"Management server Exception logs",
+#        'pattern':r'(?:.*\n){0,1}(?:.*Exception\:.+)(?:.*\n){0,4}','type':"CLOUD",'startPoint':-8192,'endPoint':-1},
+
+#    {'file':"*/cloudstack/management/management-server.log*", 'desc':"Management server Error logs",
+#        'pattern':r'(?:.*\n){0,1}(?:.*ERROR.+)(?:.*\n){0,4}','type':"CLOUD",'startPoint':-8192,'endPoint':-1},
+
+#    {'file':"*/cloudstack/management/apilog.log*", 'desc':"API logs",
+#        'pattern':r'(?:.*\n){0,5}(?:.*exception.+)(?:.*\n){0,5}','type':"CLOUD"},
+
+    {'file':"*/cloudstack/management/localhost*", 'desc':"Local Host log",
+        'pattern':r'(?:.*\n){0,1}(?:.*SEVERE\:.+)(?:.*\n){0,10}','type':"CLOUD",'startPoint':-8192,'endPoint':-1,
+        'anchor':r'SEVERE\:.', 'before':1},
+
+#    {'file':"*/cloudstack/agent.log*", 'desc':"Agent logs",
+#        'pattern':r'(?:.*\n){0,1}(?:.*Exception\:.+)(?:.*\n){0,4}','type':"CLOUD",'startPoint':-8192,'endPoint':-1}
+]
+
+def formatSnippet(text, logfilename, patterndesc, startPoint=0, endPoint=4096):
+    """Format the text matched in logfilename as a JIRA snippet"""
+    text = text.strip()
+    if(len(text)) > (endPoint - startPoint) and abs(endPoint) <= (len(text)) and abs(startPoint) <=(len(text)):
+        text = text[startPoint:endPoint] + "\n\n..."
+    return ("Found '%s' in '%s':- \n{noformat}\n%s\n{noformat}" %
+            (patterndesc, logfilename.replace(xenrt.TEC().getLogdir()+"/", ""), text.strip()))
+
+class _Search(object):
+    """The state of one pattern's search through one file"""
+
+    def __init__(self, fp):
+        self.fp = fp
+        self.regex = re.compile(fp['pattern'])
+        self.anchor = fp.get('anchor') and re.compile(fp['anchor'])
+        self.before = fp.get('before', 0)
+        # Offset (in the file) of the line the next search starts from
+        self.pos = 0
+        self.found = []
+
+class LogTriage(object):
+    """Finds failure patterns in the logs of a job.
+
+    Each log file is read once, a block at a time, and every pattern that
+    applies to it is searched for in the same pass. A pattern only sees a
+    bounded window of the file (at least 2 * BLOCK bytes beyond the line it
+    is searching from), as with pcregrep, and patterns with an anchor are
+    only tried in the few lines before the next occurrence of the anchor.
+    The output is what running pcregrep -M for each pattern and file would
+    give."""
+
+    BLOCK = 1024 * 1024
+
+    def __init__(self, patterns=None):
+        if patterns is None:
+            patterns = FAILURE_PATTERNS
+        self.patterns = list(patterns)
+        self.stats = {"files": 0, "bytes": 0, "searches": 0}
+
+    def addPattern(self, fp):
+        self.patterns.append(fp)
+
+    def _lineStart(self, buf, i):
+        return buf.rfind("\n", 0, i) + 1
+
+    def _linesBack(self, buf, i, n, floor):
+        """Return the start of the line n lines before the line containing
+        buf[i], but not before floor"""
+        start = self._lineStart(buf, i)
+        while n > 0 and start > floor:
+            start = self._lineStart(buf, start - 1)
+            n -= 1
+        return max(start, floor)
+
+    def _searchWindow(self, s, buf, base, eof):
+        """Search for s's pattern in buf, which holds the file from offset
+        base. Returns when the search needs more of the file than buf
+        holds, or at the end of the file."""
+        while True:
+            pos = s.pos - base
+            if pos >= len(buf) or (not eof and len(buf) - pos < 2 * self.BLOCK):
+                return
+            start = pos
+            if s.anchor:
+                a = s.anchor.search(buf, pos)
+                if not a:
+                    if eof:
+                        s.pos = base + len(buf)
+                    else:
+                        # The next anchor may be on the last (partial) line
+                        s.pos = base + self._linesBack(buf, len(buf), s.before, pos)
+                    return
+                start = self._linesBack(buf, a.start(), s.before, pos)
+                if not eof and len(buf) - start < 2 * self.BLOCK:
+                    # No match can start before start
+                    s.pos = base + start
+                    return
+            self.stats["searches"] += 1
+            m = s.regex.search(buf, start)
+            if not m:
+                if eof:
+                    s.pos = base + len(buf)
+                else:
+                    # A match starting in the last 2 * BLOCK bytes may have
+                    # been cut short by the end of the buffer
+                    s.pos = base + max(pos, self._lineStart(buf, len(buf) - 2 * self.BLOCK))
+                return
+            # Output the whole lines that the match spans, and carry on from
+            # the line after
+            first = self._lineStart(buf, m.start())
+            last = max(m.end() - 1, m.start())
+            end = buf.find("\n", last)
+            if end < 0:
+                end = len(buf)
+                text = buf[first:end] + "\n"
+            else:
+                end += 1
+                text = buf[first:end]
+            s.found.append(text)
+            s.pos = base + end
+
+    def searchFile(self, filename, patterns):
+        """Search filename for each of patterns, returning a list of the
+        matched text for each"""
+        searches = [_Search(fp) for fp in patterns]
+        f = open(filename, "rb")
+        try:
+            buf = ""
+            base = 0
+            eof = False
+            while not eof:
+                data = f.read(self.BLOCK)
+                if not data:
+                    eof = True
+                buf += data
+                self.stats["bytes"] += len(data)
+                for s in searches:
+                    self._searchWindow(s, buf, base, eof)
+                if not eof:
+                    # Drop what every pattern has finished with
+                    keep = min([s.pos for s in searches]) - base
+                    if keep > 0:
+                        buf = buf[keep:]
+                        base += keep
+        finally:
+            f.close()
+        self.stats["files"] += 1
+        return ["".join(s.found) for s in searches]
+
+    def run(self, logdir=None):
+        """Return the failure snippets found in the logs in logdir (by
+        default the current log directory), in the same form as
+        JiraLink.getFailedLogSnippetsFromPattern"""
+        if not logdir:
+            logdir = xenrt.TEC().getLogdir()
+        # Work out which patterns apply to each file, so each file is only
+        # read once
+        files = []
+        byFile = {}
+        for i in range(len(self.patterns)):
+            fp = self.patterns[i]
+            try:
+                matches = glob.glob("%s/%s" % (logdir, fp['file']))
+            except Exception, e:
+                if not fp.has_key('type'):
+                    xenrt.TEC().warning("Failed to get logfile list matching '%s': %s" %(fp['file'],str(e)))
+                matches = []
+            files.append(matches)
+            for fn in matches:
+                byFile.setdefault(fn, []).append(i)
+
+        results = {}
+        for fn in sorted(byFile.keys()):
+            try:
+                found = self.searchFile(fn, [self.patterns[i] for i in byFile[fn]])
+            except Exception, e:
+                xenrt.TEC().warning("Failed to get snippet from file %s: %s" %(fn,str(e)))
+                continue
+            for (i, text) in zip(byFile[fn], found):
+                results[(i, fn)] = text
+
+        desc = "\n"
+        for i in range(len(self.patterns)):
+            fp = self.patterns[i]
+            for fn in files[i]:
+                if not results.has_key((i, fn)):
+                    continue
+                if results[(i, fn)]:
+                    if fp.has_key('startPoint'):
+                        desc += formatSnippet(results[(i, fn)], fn, fp['desc'],
+                                              startPoint=fp['startPoint'], endPoint=fp['endPoint'])
+                    else:
+                        desc += formatSnippet(results[(i, fn)], fn, fp['desc'])
+                desc += "\n"
+        return desc
@@ -75,6 +75,7 @@ __all__ = ["timenow",
            "roundDownMiB",
            "getInterfaceIdentifier",
            "recursiveFileSearch",
+           "dirSize",
            "getRandomULAPrefix",
            "sleep",
            "jobOnMachine",
@@ -283,6 +284,17 @@ def recursiveFileSearch(rootdir='.', pattern='*'):
             for filename in filenames
                 if fnmatch.fnmatch(filename, pattern)]
 
+def dirSize(rootdir):
+    """Returns the total size in bytes of the files under rootdir"""
+    size = 0
+    for dirname, dirnames, filenames in os.walk(rootdir):
+        for filename in filenames:
+            try:
+                size += os.lstat(os.path.join(dirname, filename)).st_size
+            except OSError:
+                pass
+    return size
+
 def strlistToDict(strlist, sep="=", keyonly=True):
     """
     Convert a list of strings into a dict. 
@@ -1183,8 +1195,23 @@ class PTask(xenrt.XRTThread):
         self.kwargs = kwargs
         self.result = None
         self.exception = None
+        # Set if the task is run by an Executor rather than as a thread
+        self.future = None
         xenrt.XRTThread.__init__(self)
 
+    def join(self, timeout=None):
+        if self.future:
+            self.future.wait(timeout)
+        else:
+            xenrt.XRTThread.join(self, timeout)
+
+    def isAlive(self):
+        if self.future:
+            return not self.future.done()
+        return xenrt.XRTThread.isAlive(self)
+
+    is_alive = isAlive
+
     def run(self):
         try:
             self.result = self.func(*self.args, **self.kwargs)
@@ -1195,7 +1222,8 @@ class PTask(xenrt.XRTThread):
             self.exception = e
 
 
-def pfarm(tasks, start=True, interval=0, wait=True, value=True, exception=True):
+def pfarm(tasks, start=True, interval=0, wait=True, value=True, exception=True,
+          workers=0, target=None, perTarget=None, timeout=None):
     """
     Run a set of tasks in parallel
 
@@ -1216,6 +1244,16 @@ def pfarm(tasks, start=True, interval=0, wait=True, value=True, exception=True):
     @param exception: if True, the first exception (in list order) of the tasks
                       will be raised; if False, no exceptions will be raised,
                       they'll be exception values returned in the list.
+    @param workers:   the maximum number of tasks to run at once, defaults to
+                      0 for no limit, None for EXECUTOR_MAX_WORKERS
+    @param target:    a function returning the target (e.g. the host) of a
+                      PTask, for use with perTarget
+    @param perTarget: the maximum number of tasks with the same target to run
+                      at once, defaults to EXECUTOR_MAX_PER_TARGET, 0 for no
+                      limit
+    @param timeout:   the maximum time (in seconds) to wait for the tasks,
+                      tasks not started by then are cancelled and tasks not
+                      finished get an XRTError as their exception value
     """
     
     jobs = [ isinstance(t, PTask) and t
@@ -1225,25 +1263,45 @@ def pfarm(tasks, start=True, interval=0, wait=True, value=True, exception=True):
 
     if not start:
         return jobs
-    else:
+
+    # Run the tasks on a bounded pool of threads rather than starting a
+    # thread for each one. Tasks that are still running keep the pool
+    # alive after we return.
+    executor = xenrt.Executor(maxWorkers=workers, maxPerTarget=perTarget)
+    try:
         for j in jobs:
-            j.start()
+            j.future = executor.submitTo(target and target(j), j.run)
             time.sleep(interval)
-        if not wait:
-            return jobs
+    finally:
+        executor.shutdown(wait=False)
+    if not wait:
+        return jobs
+
+    deadline = timeout and time.time() + timeout
+    timedout = []
+    for j in jobs:
+        if deadline:
+            if not j.future.wait(max(0, deadline - time.time())):
+                j.future.cancel()
+                timedout.append(j)
         else:
-            for j in jobs:
-                j.join()
-            if not value:
-                return jobs
-            else:
-                result = []
-                for j in jobs:
-                    if j.exception and exception:
-                        raise j.exception
-                    else:
-                        result.append(j.exception or j.result)
-                return result
+            j.future.wait()
+    if timedout:
+        xenrt.TEC().logverbose("%d of %d parallel tasks did not finish within "
+                               "%ds" % (len(timedout), len(jobs), timeout))
+    if not value:
+        return jobs
+    result = []
+    for j in jobs:
+        e = j.exception
+        if j in timedout:
+            e = xenrt.XRTError("Timed out after %ds waiting for %s" %
+                               (timeout, j.func.__name__))
+        if e and exception:
+            raise e
+        else:
+            result.append(e or j.result)
+    return result
 
 def pmap(func, *args, **kwargs):
 
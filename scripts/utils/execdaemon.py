@@ -43,6 +43,7 @@ from SocketServer import TCPServer
 
 import _winreg
 import bz2
+import zlib
 import platform
 
 def is_ipv6_supported():
@@ -212,6 +213,7 @@ except socket.error, e:
     sys.exit(0)
     
 server.register_introspection_functions()
+server.register_multicall_functions()
 print "Starting XML-RPC server on port 8936..."
 
 PASSWORD = "xensource"
@@ -366,6 +368,38 @@ def cleanup(reference):
     delCommand(c.reference)
     return True
 
+def wait(reference, timeout):
+    """Wait up to timeout seconds for a command to finish, returning its
+    status as poll does"""
+    c = getCommand(reference)
+    if not c:
+        raise Exception("Could not find command object %s" % (reference))
+    deadline = time.time() + float(timeout)
+    delay = 0.05
+    while True:
+        st = c.poll()
+        if st == "DONE" or time.time() >= deadline:
+            return st
+        time.sleep(delay)
+        delay = min(delay * 2, 0.25)
+
+def result(reference, withlog=True, clean=False):
+    """Returns the status, return code and (optionally) the log of a
+    command, cleaning it up afterwards if it has finished and clean is
+    set"""
+    c = getCommand(reference)
+    if not c:
+        raise Exception("Could not find command object %s" % (reference))
+    r = {"status": c.poll(), "returncode": c.returncode}
+    if withlog:
+        r["log"] = log(reference)
+    if clean and c.finished:
+        try:
+            cleanup(reference)
+        except Exception, e:
+            loglocal("Error cleaning up %s: %s" % (reference, str(e)))
+    return r
+
 server.register_function(runbatch)
 server.register_function(runpshell)
 server.register_function(run)
@@ -375,6 +409,8 @@ server.register_function(getPID)
 server.register_function(returncode)
 server.register_function(log)
 server.register_function(cleanup)
+server.register_function(wait)
+server.register_function(result)
 
 ############################################################################
 # Process library functions                                                #
@@ -531,6 +567,65 @@ def readFileBZ2(filename):
              (filename, count, len(data.data)))
     return data
 
+def appendFile(filename, offset, data, compressed=False):
+    """Write the next chunk of a file being pushed in pieces, returning the
+    new size of the file. offset (a string, as XML-RPC integers are only
+    32 bits) must be the size of the file so far, 0 starts it afresh. A
+    chunk sent again because its reply was lost is not written twice."""
+    offset = long(offset)
+    data = data.data
+    if compressed:
+        data = zlib.decompress(data)
+    if offset == 0:
+        f = file(filename, "wb")
+    else:
+        size = os.stat(filename).st_size
+        if size == offset + len(data):
+            return str(size)
+        if size != offset:
+            raise Exception("%s is %u bytes, expected %u" %
+                            (filename, size, offset))
+        f = file(filename, "ab")
+    f.write(data)
+    f.close()
+    return str(offset + len(data))
+
+def readFileAt(filename, offset, length, compress=False):
+    """Read up to length bytes of a file from offset. Returns whether the
+    data has been compressed, which is only done if it makes it smaller,
+    and the data."""
+    f = file(filename, "rb")
+    f.seek(long(offset))
+    data = f.read(length)
+    f.close()
+    if compress:
+        z = zlib.compress(data, 1)
+        if len(z) < len(data):
+            return [True, xmlrpclib.Binary(z)]
+    return [False, xmlrpclib.Binary(data)]
+
+def fileChecksum(filename, length=None):
+    """Returns the SHA-1 of a file, or of its first length bytes (a
+    string) if the file may have grown since it was read"""
+    h = sha.new()
+    f = file(filename, "rb")
+    if length is None:
+        remaining = -1
+    else:
+        remaining = long(length)
+    while remaining != 0:
+        n = 1048576
+        if remaining > 0:
+            n = min(n, remaining)
+        d = f.read(n)
+        if len(d) == 0:
+            break
+        h.update(d)
+        if remaining > 0:
+            remaining -= len(d)
+    f.close()
+    return h.hexdigest()
+
 def globPattern(pattern):
     return glob.glob(pattern)
 
@@ -562,6 +657,9 @@ server.register_function(removeFile)
 server.register_function(createFile)
 server.register_function(readFile)
 server.register_function(readFileBZ2)
+server.register_function(appendFile)
+server.register_function(readFileAt)
+server.register_function(fileChecksum)
 server.register_function(globPattern)
 server.register_function(fileExists)
 server.register_function(dirExists)
@@ -1162,7 +1260,7 @@ def stopDaemon(data):
     return death
 
 def version():
-    return "Execution daemon v0.9.3.\n"
+    return "Execution daemon v0.9.5.\n"
 
 server.register_function(stopDaemon)
 server.register_function(version)
@@ -0,0 +1,67 @@
+#!/usr/bin/python
+#
+# Benchmark of the generated API bindings against a running server (e.g. a
+# local waitressstart.py instance): compares a fresh connection per call (as
+# the bindings used to make) with the keep-alive session, and fetching jobs
+# one at a time with get_jobs_batch.
+#
+# Usage: apibench.py [options] server
+#
+# server is host[:port] as passed to xenrtapi.XenRT. The bindings are
+# fetched from --bindings (e.g. http://localhost:8080/bindings/__init__.py)
+# if given, otherwise the installed xenrtapi module is used.
+
+import sys, imp, optparse, time, requests
+
+def loadBindings(url):
+    if not url:
+        import xenrtapi
+        return xenrtapi
+    r = requests.get(url)
+    r.raise_for_status()
+    module = imp.new_module("xenrtapi")
+    exec r.content in module.__dict__
+    return module
+
+def freshConnection(client, jobid):
+    # One connection per call, as requests.get does
+    r = requests.get("%s/job/%d" % (client.base, jobid), headers=client.customHeaders)
+    r.raise_for_status()
+    return r.json()
+
+def timeCalls(func, ids):
+    start = time.time()
+    for i in ids:
+        func(i)
+    return (time.time() - start) / len(ids)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] server")
+    parser.add_option("--bindings", dest="bindings", help="URL to fetch the bindings from")
+    parser.add_option("--apikey", dest="apikey")
+    parser.add_option("--calls", dest="calls", type="int", default=200)
+    (options, args) = parser.parse_args()
+    if len(args) != 1:
+        parser.error("server is required")
+
+    xenrtapi = loadBindings(options.bindings)
+    client = xenrtapi.XenRT(apikey=options.apikey, server=args[0])
+    ids = sorted(int(j) for j in client.get_jobs(status=["done"], limit=options.calls).keys())
+    if not ids:
+        print "No completed jobs on the server to fetch"
+        sys.exit(1)
+    ids = (ids * (options.calls // len(ids) + 1))[:options.calls]
+
+    # Warm up the server and the session
+    client.get_job(ids[0])
+
+    fresh = timeCalls(lambda i: freshConnection(client, i), ids)
+    session = timeCalls(client.get_job, ids)
+    start = time.time()
+    jobs = client.get_jobs_batch(set(ids))
+    batch = (time.time() - start) / len(set(ids))
+
+    print "%d get_job calls for %d distinct jobs" % (len(ids), len(set(ids)))
+    print "Connection per call:  %.2fms per job" % (fresh * 1000)
+    print "Keep-alive session:   %.2fms per job (%.1fx)" % (session * 1000, fresh / session)
+    print "get_jobs_batch:       %.2fms per job (%.1fx), %d jobs returned" % (batch * 1000, fresh / batch, len(jobs))
@@ -20,6 +20,7 @@ class XenRTPage(Page):
     def __init__(self, request):
         super(XenRTPage, self).__init__(request)
         self._db = None
+        self._dbPool = None
         self._ad = None
         self._acl = None
         self._user = {}
@@ -131,46 +132,55 @@ class XenRTPage(Page):
                 if self.WRITE and self.WAIT:
                     self.waitForLocalWrite()
             finally:
-                if self._db:
-                    self._db.rollback()
-                    self._db.close()
+                self.releaseDB()
 
     def waitForLocalWrite(self):
         assert self.WRITE
         writeDb = self.getDB()
         writeDb.rollback()
         writeLoc = app.db.getWriteLocation(writeDb)
-        readDb = app.db.dbReadInstance()
-        i = 0
-        interval = self.DB_SYNC_CHECK_START_INTERVAL
-        while i < (self.DB_SYNC_CHECK_MAX_ATTEMPTS):
-            # Get the current xlog replay location from the local DB. This returns none if the local DB is the master
-            if app.db.getWriteLocation(readDb):
-                print "Local database is master, don't need to wait for sync"
-                # This means the local database is the master, so we can stop
-                break
-            readLoc = app.db.getReadLocation(readDb)
-            print "Checking whether writes have synced, attempt %d - write=%s, read=%s" % (i, str(writeLoc), str(readLoc))
-            if readLoc >= writeLoc:
-                break
-            i += 1
-            time.sleep(interval)
-            interval *= 2
-        readDb.rollback()
-        readDb.close()
+        readPool = app.db.readPool()
+        readDb = readPool.get()
+        try:
+            i = 0
+            interval = self.DB_SYNC_CHECK_START_INTERVAL
+            while i < (self.DB_SYNC_CHECK_MAX_ATTEMPTS):
+                # Get the current xlog replay location from the local DB. This returns none if the local DB is the master
+                if app.db.getWriteLocation(readDb):
+                    print "Local database is master, don't need to wait for sync"
+                    # This means the local database is the master, so we can stop
+                    break
+                readLoc = app.db.getReadLocation(readDb)
+                print "Checking whether writes have synced, attempt %d - write=%s, read=%s" % (i, str(writeLoc), str(readLoc))
+                if readLoc >= writeLoc:
+                    break
+                i += 1
+                time.sleep(interval)
+                interval *= 2
+        finally:
+            readPool.put(readDb)
 
     def getDB(self):
         if not self._db:
             if self.WRITE:
-                self._db = app.db.dbWriteInstance()
+                self._dbPool = app.db.writePool()
             else:
-                self._db = app.db.dbReadInstance()
+                self._dbPool = app.db.readPool()
+            self._db = self._dbPool.get()
         return self._db
 
+    def releaseDB(self):
+        """Return the page's connection to the pool, which rolls back
+        anything not committed"""
+        if self._db:
+            db = self._db
+            self._db = None
+            self._dbPool.put(db)
+
     def getWriteDB(self):
         if not self.WRITE:
             self.WRITE = True
-            self._db = None
+            self.releaseDB()
         return self.getDB()
 
     def getAD(self):
@@ -13,7 +13,8 @@ class XenRTAPIPage(XenRTPage):
 
     def __init__(self, request):
         super(XenRTAPIPage, self).__init__(request)
-        self.schedulercache = {"siteresources":{}, "siteprops": {}, "machineprops": {}}
+        self.schedulercache = {"siteresources":{}, "siteprops": {}, "machineprops": {},
+                               "matcher": None, "machineacls": None}
 
     def scm_site_list(self, status=None,checkFull=False):
         """Return details of sites."""
@@ -11,8 +11,9 @@ import time
 
 class TakeoverTime(XenRTAPIPage):
     def render(self):
+        readPool = app.db.readPool()
+        readDB = readPool.get()
         try:
-            readDB = app.db.dbReadInstance()
             readLoc = app.db.getReadLocation(readDB)
             if not readLoc:
                 cur = readDB.cursor()
@@ -22,8 +23,7 @@ class TakeoverTime(XenRTAPIPage):
             else:
                 return HTTPServiceUnavailable()
         finally:
-            readDB.rollback()
-            readDB.close()
+            readPool.put(readDB)
 
 class IsMaster(XenRTAPIPage):
     def render(self):
@@ -38,13 +38,14 @@ class IsUsable(XenRTAPIPage):
         master = self.isDBMaster()
         if master:
             return master
+        writePool = app.db.writePool()
+        readPool = app.db.readPool()
+        writeDB = writePool.get()
+        readDB = readPool.get()
         try:
             check_interval = 0.5
             timeout = 5
 
-            writeDB = app.db.dbWriteInstance()
-            readDB = app.db.dbReadInstance()
-
             writeLoc = app.db.getWriteLocation(writeDB)
             i = 0
             while i <= timeout/check_interval:
@@ -56,10 +57,8 @@ class IsUsable(XenRTAPIPage):
                 i += 1
             return HTTPServiceUnavailable()
         finally:
-            writeDB.rollback()
-            writeDB.close()
-            readDB.rollback()
-            readDB.close()
+            writePool.put(writeDB)
+            readPool.put(readDB)
             
 PageFactory(IsMaster, "/api/dbchecks/ismaster")
 PageFactory(TakeoverTime, "/api/dbchecks/takeovertime")
@@ -5,6 +5,7 @@ from pyramid.httpexceptions import HTTPFound
 import traceback, StringIO, string, time, random, sys, calendar, getopt
 import psycopg2
 import config, app
+import app.matcher
 
 class XenRTSchedule(XenRTAPIPage):
     WRITE = True
@@ -68,6 +69,12 @@ class XenRTSchedule(XenRTAPIPage):
             return
         verbose.write("%d acquired lock %s" % (schedid, time.strftime("%a, %d %b %Y %H:%M:%S +0000\n", time.gmtime())))
         postlocktime = time.mktime(time.gmtime())
+        # Per-phase timings, lock wait is postlocktime-prelocktime
+        timings = {"load": 0.0, "match": 0.0, "commit": 0.0}
+        phasestart = time.time()
+        scheduled = 0
+        self.schedulercache["matcher"] = None
+        self.schedulercache["machineacls"] = None
 
         offline_sites = [x[0] for x in self.scm_site_list(status="offline")]
         sites = self.scm_site_list(checkFull=True)
@@ -90,8 +97,13 @@ class XenRTSchedule(XenRTAPIPage):
                     continue
                 machines[m[0]] = m
 
+            # Machine ACLs, which only change under the scheduler lock
+            self.schedulercache["machineacls"] = self.scm_machine_acls()
+
             # Jobs to be scheduled
             jobs = self.schedulable_jobs()
+            timings["load"] = time.time() - phasestart
+            phasestart = time.time()
 
             sortlist = []
             sortmap = {}
@@ -225,7 +237,10 @@ class XenRTSchedule(XenRTAPIPage):
                     outfh.write("  scheduling %u on %s (%d)\n" % (int(jobid), str(selected), schedid))
                     if alsoPrintToVerbose:
                         verbose.write("  scheduling %u on %s (%d)\n" % (int(jobid), str(selected), schedid))
+                    commitstart = time.time()
                     self.schedule_on(outfh, int(jobid), selected, details['USERID'], preemptable)
+                    timings["commit"] += time.time() - commitstart
+                    scheduled += 1
                     
                     if not site:
                         site = machines[selected[0]][1]
@@ -245,11 +260,20 @@ class XenRTSchedule(XenRTAPIPage):
                                     del machines[m]
                 except Exception, e:
                     print "WARNING: Could not schedule job %d - %s" % (int(jobid), str(e))
+            timings["match"] = time.time() - phasestart - timings["commit"]
         finally:
+            matcher = self.schedulercache["matcher"]
+            self.schedulercache["matcher"] = None
+            self.schedulercache["machineacls"] = None
             self.release_lock()
 
         verbose.write("Scheduler %d completed %s\n" % (schedid,time.strftime("%a, %d %b %Y %H:%M:%S +0000", time.gmtime())))
         finishtime = time.mktime(time.gmtime())
+        verbose.write("Scheduler %d phases: lock wait %ds, load %.3fs (%d jobs), match %.3fs, commit %.3fs (%d jobs)\n" %
+                      (schedid, int(postlocktime-prelocktime), timings["load"], len(jobs), timings["match"], timings["commit"], scheduled))
+        if matcher:
+            verbose.write("Scheduler %d matcher: %d machines indexed, %d queries (%d cached)\n" %
+                          (schedid, len(matcher.names), matcher.stats["queries"], matcher.stats["hits"]))
 
         outfh.write("Scheduler took %ds to acquire lock and %ds to run\n" % (int(postlocktime-prelocktime), int(finishtime-postlocktime)))
         if alsoPrintToVerbose:
@@ -397,12 +421,19 @@ class XenRTSchedule(XenRTAPIPage):
         newjobs = njids
 
         nowspec = time.strftime("HOUR=%H/DAY=%w", time.gmtime())
-        
+
+        # Load every new job in a few set based queries
+        cur = self.getDB().cursor()
+        try:
+            alldetails = app.utils.get_jobs(cur, newjobs)
+        finally:
+            cur.close()
+
         jobs = {}
         newjobs.sort()
         for job in newjobs:
             try:
-                details = self.get_job(job)
+                details = alldetails.get(job)
                 if not details:
                     sys.stderr.write("Could not read details for job %u.\n" %
                                      (job))
@@ -517,25 +548,44 @@ class XenRTSchedule(XenRTAPIPage):
             selx = []
             needed = number
 
-            # Get site properties
-            if self.schedulercache["siteprops"].has_key(s):
-                siteprops = self.schedulercache["siteprops"][s]
-            else:
-                siteprops = None
-                try:
-                    sd = self.site_data(s)
-                    if sd and sd.has_key("FLAGS") and sd["FLAGS"]:
-                        siteprops = sd["FLAGS"]
-                except:
-                    pass
-
-                self.schedulercache["siteprops"][s] = siteprops
+            matcher = self.get_matcher(machines)
+            shortjob = details.has_key("SHORTJOB") and details["SHORTJOB"] == "yes"
 
             ms = clusters[cluster].values()
 
             # Now consider each xindex requirement in turn
             for xindex in range(len(selected), len(selected) + needed):
                 found = False
+
+                # The pools, clusters, resources and flags this machine must have
+                jobpool = ["DEFAULT"]
+                if details.has_key("POOL_%u" % (xindex)):
+                    jobpool = string.split(details["POOL_%u" % (xindex)], ",")
+                elif details.has_key("POOL"):
+                    jobpool = string.split(details["POOL"], ",")
+
+                clusterreq = None
+                if details.has_key("CLUSTER_%u" % xindex):
+                    clusterreq = string.split(details["CLUSTER_%u" % xindex], ",")
+                elif details.has_key("CLUSTER"):
+                    clusterreq = string.split(details["CLUSTER"], ",")
+
+                resreq = None
+                if details.has_key("RESOURCES_REQUIRED_%u" % (xindex)):
+                    resreq = details["RESOURCES_REQUIRED_%u" % (xindex)]
+                elif details.has_key("RESOURCES_REQUIRED"):
+                    resreq = details["RESOURCES_REQUIRED"]
+
+                # We must check flags even if none are specified because of
+                # the possibility of mandatory machine flags.
+                flags = None
+                if details.has_key("FLAGS_%u" % (xindex)):
+                    flags = details["FLAGS_%u" % (xindex)]
+                elif details.has_key("FLAGS"):
+                    flags = details["FLAGS"]
+
+                suitable = matcher.candidates(jobpool, clusterreq, resreq, flags, shortjob)
+
                 # Consider each machine in this cluster
                 # Randomise the list so we spread the load a bit (XRT-737)
                 random.shuffle(ms)
@@ -544,81 +594,9 @@ class XenRTSchedule(XenRTAPIPage):
                     if m[0] in selx:
                         # Machine already provisionally selected
                         continue
-                    #print "    considering machine %s..." % (m[0])
-
-                    # The pool the machine is in
-                    subpool = m[3]
-                    if subpool == "":
-                        subpool = "DEFAULT"
-
-                    # The machine's properties
-                    props = m[6]
-
-                    # Add properties stored in tblMachineData key PROPS
-                    if self.schedulercache["machineprops"].has_key(m[0]):
-                        props = self.schedulercache["machineprops"][m[0]]
-                    else:
-                        d = self.machine_data(m[0])
-                        if d and d.has_key("PROPS"):
-                            props = string.join([props, d["PROPS"]], ",")
-                        self.schedulercache["machineprops"][m[0]] = props
-
-                    # Add site properties
-                    if siteprops:
-                        props = string.join([props, siteprops], ",")
-
-                    # Check the subpool matching
-                    jobpool = ["DEFAULT"]
-                    if details.has_key("POOL_%u" % (xindex)):
-                        jobpool = string.split(details["POOL_%u" % (xindex)], ",")
-                    elif details.has_key("POOL"):
-                        jobpool = string.split(details["POOL"], ",")
-                    if not subpool in jobpool and not "ANY" in jobpool:
-                        # Wrong pool
+                    if not m[0] in suitable:
                         continue
 
-                    # Check the cluster matching
-                    clusterreq = None
-                    thiscluster = m[2] and m[2].strip() or ""
-                    if details.has_key("CLUSTER_%u" % xindex):
-                        clusterreq = string.split(details["CLUSTER_%u" % xindex], ",")
-                    elif details.has_key("CLUSTER"):
-                        clusterreq = string.split(details["CLUSTER"], ",")
-                    if clusterreq and thiscluster not in clusterreq:
-                        # job has requirements on cluster but this machine is not there
-                        continue
-
-                    # Check for resource matching
-                    resreq = None
-                    if details.has_key("RESOURCES_REQUIRED_%u" % (xindex)):
-                        resreq = details["RESOURCES_REQUIRED_%u" % (xindex)]
-                    elif details.has_key("RESOURCES_REQUIRED"):
-                        resreq = details["RESOURCES_REQUIRED"]
-                    if resreq:
-                        if m[5] == "":
-                            # No machine resource string, skip
-                            continue
-                        if not app.utils.check_resources(m[5], resreq):
-                            continue
-
-                    # Check for flags. We must do this even if no flags are specified
-                    # because of the possibility of mandatory machine flags.
-                    if details.has_key("FLAGS_%u" % (xindex)):
-                        if not app.utils.check_attributes(props, details["FLAGS_%u" % (xindex)]):
-                            continue
-                    elif details.has_key("FLAGS"):
-                        if not app.utils.check_attributes(props, details["FLAGS"]):
-                            continue
-                    else:
-                        if not app.utils.check_attributes(props, None):
-                            continue
-
-                    # Check for short jobs
-                    if "shortonly" in string.split(props, ","):
-                        if not details.has_key("SHORTJOB") or \
-                               details["SHORTJOB"] != "yes":
-                            continue
-
                     # All OK
                     verbose.write("      %s suitable\n" % (m[0]))
                     found = True
@@ -643,10 +621,90 @@ class XenRTSchedule(XenRTAPIPage):
         # in any cluster.
         return False
 
+    def scm_site_props(self, site):
+        """Return the FLAGS of <site>, or None"""
+        if not self.schedulercache["siteprops"].has_key(site):
+            siteprops = None
+            try:
+                sd = self.site_data(site)
+                if sd and sd.has_key("FLAGS") and sd["FLAGS"]:
+                    siteprops = sd["FLAGS"]
+            except:
+                pass
+            self.schedulercache["siteprops"][site] = siteprops
+        return self.schedulercache["siteprops"][site]
+
+    def scm_machine_props(self, machines):
+        """Return a dictionary of the properties of each of <machines>, which
+        are the tblMachines flags plus any tblMachineData PROPS"""
+        props = self.schedulercache["machineprops"]
+        missing = [m for m in machines.keys() if not props.has_key(m)]
+        if missing:
+            extra = {}
+            cur = self.getDB().cursor()
+            cur.execute("SELECT machine, value FROM tblMachineData WHERE key = 'PROPS' "
+                        "AND machine IN (%s)" % (string.join(["%s"] * len(missing), ",")),
+                        missing)
+            while True:
+                rc = cur.fetchone()
+                if not rc:
+                    break
+                if rc[1] and string.strip(rc[1]) != "":
+                    extra[string.strip(rc[0])] = string.strip(rc[1])
+            cur.close()
+            for m in missing:
+                if extra.has_key(m):
+                    props[m] = string.join([machines[m][6], extra[m]], ",")
+                else:
+                    props[m] = machines[m][6]
+        return props
+
+    def get_matcher(self, machines):
+        """Return the MachineIndex for this scheduler pass, (re)building it if
+        it doesn't cover all of <machines>"""
+        matcher = self.schedulercache["matcher"]
+        if matcher and matcher.names.issuperset(machines.keys()):
+            return matcher
+        siteprops = {}
+        for m in machines.values():
+            if not siteprops.has_key(m[1]):
+                siteprops[m[1]] = self.scm_site_props(m[1])
+        matcher = app.matcher.MachineIndex(machines, self.scm_machine_props(machines), siteprops)
+        self.schedulercache["matcher"] = matcher
+        return matcher
+
+    def scm_machine_acls(self):
+        """Return a dictionary mapping each machine with an ACL to a tuple
+        of its aclid and the ACL's parent (or None)"""
+        cur = self.getDB().cursor()
+        cur.execute("SELECT m.machine, m.aclid, a.parent FROM tblmachines AS m "
+                    "LEFT OUTER JOIN tblacls AS a ON m.aclid=a.aclid WHERE m.aclid IS NOT NULL")
+        acls = {}
+        while True:
+            rc = cur.fetchone()
+            if not rc:
+                break
+            acls[string.strip(rc[0])] = (int(rc[1]), rc[2] is not None and int(rc[2]) or None)
+        cur.close()
+        return acls
+
     def get_acls_for_machines(self, machines):
         if len(machines) == 0:
             return {}
 
+        # Within a scheduler pass count from the ACLs loaded at the start
+        acls = self.schedulercache["machineacls"]
+        if acls is not None:
+            policies = {}
+            for m in set(machines):
+                if acls.has_key(m):
+                    (aclid, parent) = acls[m]
+                    policies[aclid] = policies.get(aclid, 0) + 1
+                    if parent is not None:
+                        # The ACL may be in use both directly and as a parent
+                        policies[parent] = policies.get(parent, 0) + 1
+            return policies
+
         db = self.getDB()
         policies = {}
         cur = db.cursor()
@@ -2,9 +2,11 @@ from app import XenRTPage
 from server import PageFactory
 from pyramid.response import FileResponse
 from pyramid.httpexceptions import *
+import app.changefeed
 import config
 import urlparse
 import json
+import time
 
 __all__ = ["XenRTAPIError", "XenRTAPIv2Page", "RegisterAPI"]
 
@@ -133,6 +135,46 @@ class XenRTAPIv2Page(XenRTPage):
     def expandVariables(self, params):
         return [self.getUser().userid if x=="${user}" else x for x in params]
 
+    CHANGES_POLL_INTERVAL = 1
+    CHANGES_MAX_WAIT = 60
+    CHANGES_MAX_LIMIT = 1000
+
+    def getChanges(self, table, keycol, returnKey, fetch, keys=[]):
+        """Reply to a change feed request for the rows of table, with the
+        cursor, limit and wait parameters. fetch is called with the keys of
+        the changed rows and returns their objects. Without a cursor the
+        reply is just the cursor to follow the feed from."""
+        try:
+            limit = min(int(self.request.params.get("limit", 100)), self.CHANGES_MAX_LIMIT)
+            wait = min(float(self.request.params.get("wait", 0)), self.CHANGES_MAX_WAIT)
+        except ValueError:
+            raise XenRTAPIError(self, HTTPBadRequest, "Invalid limit or wait")
+        cursor = self.request.params.get("cursor")
+        if not cursor:
+            snapshot = app.changefeed.currentSnapshot(self.getDB().cursor())
+            return {"cursor": app.changefeed.encodeCursor(snapshot), "more": False, returnKey: {}}
+        try:
+            (since, snapshot, after) = app.changefeed.decodeCursor(cursor)
+        except app.changefeed.CursorError, e:
+            raise XenRTAPIError(self, HTTPBadRequest, str(e))
+
+        deadline = time.time() + wait
+        while True:
+            cur = self.getDB().cursor()
+            snap = snapshot or app.changefeed.currentSnapshot(cur)
+            (rows, more) = app.changefeed.changedKeys(cur, table, keycol, since, after, limit, keys)
+            if rows or after or time.time() >= deadline:
+                break
+            # Don't hold a connection, or a snapshot, while waiting
+            self.releaseDB()
+            time.sleep(max(0, min(self.CHANGES_POLL_INTERVAL, deadline - time.time())))
+
+        if more:
+            cursor = app.changefeed.encodeCursor(snap, since, rows[-1])
+        else:
+            cursor = app.changefeed.encodeCursor(snap)
+        return {"cursor": cursor, "more": more, returnKey: fetch([r[1] for r in rows]) if rows else {}}
+
 import app.apiv2.bindings
 import app.apiv2.powershellbindings
 import app.apiv2.jobs
@@ -68,20 +68,14 @@ class Path(object):
                 else:
                     ret += """        if %s != None:\n            payload['%s'] = %s\n""" % (q, p, q)
         if self.method == "get":
-            ret += """        r = requests.get(path, params=paramdict, headers=self.customHeaders)\n"""
-            ret += """        if r.status_code in (502, 503):\n"""
-            ret += """            time.sleep(30)\n"""
-            ret += """            r = requests.get(path, params=paramdict, headers=self.customHeaders)\n"""
+            ret += """        r = self.__request("get", path, params=paramdict, headers=self.customHeaders)\n"""
         else:
             if self.formParams:
                 ret += """        myHeaders = {}\n"""
             else:
                 ret += """        myHeaders = {'content-type': 'application/json'}\n"""
             ret += """        myHeaders.update(self.customHeaders)\n"""
-            ret += """        r = requests.%s(path, params=paramdict, data=payload, files=files, headers=myHeaders)\n""" % self.method
-            ret += """        if r.status_code in (502, 503):\n"""
-            ret += """            time.sleep(30)\n"""
-            ret += """            r = requests.%s(path, params=paramdict, data=payload, files=files, headers=myHeaders)\n""" % self.method
+            ret += """        r = self.__request("%s", path, params=paramdict, data=payload, files=files, headers=myHeaders)\n""" % self.method
         ret += """        self.__raiseForStatus(r)\n"""
         if 'application/json' in self.data['produces']:
             if self.returnKey:
@@ -214,6 +208,7 @@ class PythonBindings(XenRTAPIv2Swagger):
         ret = """#!/usr/bin/python
 
 import requests
+import requests.adapters
 import json
 import httplib
 import os
@@ -221,8 +216,35 @@ import os.path
 import base64
 import sys
 import time
+import random
+import threading
+import cookielib
 import ConfigParser
 
+_session = None
+_sessionLock = threading.Lock()
+
+def _getSession(poolSize):
+    \"\"\"Returns the keep-alive session shared by all clients in this process\"\"\"
+    global _session
+    _sessionLock.acquire()
+    try:
+        if not _session:
+            session = requests.Session()
+            # Connection failures are retried by the adapter before anything
+            # has been sent, so this is safe for all methods
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=poolSize, max_retries=2)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers['Accept-Encoding'] = "gzip, deflate"
+            # Clients with different credentials share the session, so don't
+            # let cookies from one leak into another's requests
+            session.cookies.set_policy(cookielib.DefaultCookiePolicy(allowed_domains=[]))
+            _session = session
+        return _session
+    finally:
+        _sessionLock.release()
+
 class XenRTAPIException(Exception):
     def __init__(self, code, reason, canForce, traceback):
         self.code = code
@@ -239,6 +261,16 @@ class XenRTAPIException(Exception):
         return ret
 
 class XenRT(object):
+    # Maximum connections kept open to each server
+    POOL_SIZE = 16
+    # 502 and 503 responses, and connection failures on reads, are retried
+    # with jittered exponential backoff for up to RETRY_DEADLINE seconds
+    RETRY_DELAY = 1
+    RETRY_MAX_DELAY = 30
+    RETRY_DEADLINE = 120
+    # Responses with an ETag kept to revalidate
+    ETAG_CACHE_SIZE = 64
+
     def __init__(self, apikey=None, user=None, password=None, server=None, masterserver=None):
         \"\"\"
         Constructor
@@ -257,6 +289,8 @@ class XenRT(object):
         self.base = "%s://%%s%s" %% server
         self.masterbase = "%s://%%s%s" %% masterserver
         self.uibase = "%s://%%s%s" %% server
+        self.session = _getSession(self.POOL_SIZE)
+        self.__etagCache = {}
 
         self.customHeaders = {}
         if apikey:
@@ -335,6 +369,83 @@ class XenRT(object):
                                         traceback)
         response.raise_for_status()
 
+    def __rewindFiles(self, files):
+        for f in (files or {}).values():
+            try:
+                f[1].seek(0)
+            except:
+                return False
+        return True
+
+    def __request(self, method, path, **kwargs):
+        if method != "get":
+            return self.__send(method, path, **kwargs)
+        # Revalidate responses the server tagged rather than fetching them again
+        key = (path, tuple(sorted(kwargs['params'].items())))
+        cached = self.__etagCache.get(key)
+        if cached:
+            kwargs['headers'] = dict(kwargs['headers'], **{"If-None-Match": cached.headers['ETag']})
+        r = self.__send(method, path, **kwargs)
+        if r.status_code == 304 and cached:
+            return cached
+        if r.status_code == 200 and r.headers.get("ETag"):
+            if len(self.__etagCache) >= self.ETAG_CACHE_SIZE:
+                self.__etagCache.clear()
+            self.__etagCache[key] = r
+        return r
+
+    def __send(self, method, path, **kwargs):
+        deadline = time.time() + self.RETRY_DEADLINE
+        delay = self.RETRY_DELAY
+        while True:
+            try:
+                r = self.session.request(method, path, **kwargs)
+            except requests.exceptions.ConnectionError:
+                # The request may have reached the server, so only repeat reads
+                if method != "get" or time.time() + delay > deadline:
+                    raise
+            else:
+                if r.status_code not in (502, 503) or time.time() + delay > deadline:
+                    return r
+                if not self.__rewindFiles(kwargs.get("files")):
+                    return r
+            time.sleep(random.uniform(delay / 2.0, delay))
+            delay = min(delay * 2, self.RETRY_MAX_DELAY)
+
+    def get_jobs_batch(self, ids, logitems=False, batchsize=100):
+        \"\"\"
+        Gets many job objects, as get_job does, in as few requests as possible
+
+        Parameters:  
+        `ids`: list of Job IDs to fetch  
+        `logitems`: Return the log items for all testcases in the jobs  
+        `batchsize`: Maximum number of jobs to fetch in each request  
+
+        Returns a dictionary of job ID to job object, jobs that don't exist are omitted
+        \"\"\"
+        ids = [int(x) for x in ids]
+        ret = {}
+        for i in range(0, len(ids), batchsize):
+            jobs = self.get_jobs(jobid=ids[i:i+batchsize], limit=batchsize, params=True, results=True, logitems=logitems)
+            ret.update([(int(k), v) for (k, v) in jobs.items()])
+        return ret
+
+    def get_machines_batch(self, names, batchsize=100):
+        \"\"\"
+        Gets many machine objects, as get_machine does, in as few requests as possible
+
+        Parameters:  
+        `names`: list of machine names to fetch  
+        `batchsize`: Maximum number of machines to fetch in each request  
+
+        Returns a dictionary of machine name to machine object, machines that don't exist are omitted
+        \"\"\"
+        names = list(names)
+        ret = {}
+        for i in range(0, len(names), batchsize):
+            ret.update(self.get_machines(machine=names[i:i+batchsize], include_forbidden=True))
+        return ret
+
     def generate_junit_output_for_job(self, id):
         \"\"\"
         Generate JUnit compatible output for a job. Useful for sending to Jenkins
@@ -4,6 +4,7 @@ from pyramid.httpexceptions import *
 import shutil
 import app.utils
 import os
+import tempfile
 
 class _FilesBase(_JobBase):
     REQUIRE_AUTH_IF_ENABLED = False
@@ -11,9 +12,20 @@ class _FilesBase(_JobBase):
     def uploadFile(self, id, fn, fh):
         id = int(id)
         filename = app.utils.results_filename(fn, id, mkdir=1)
-        fout = file(filename, "w")
-        shutil.copyfileobj(fh, fout)
+        # Write to a temporary file and rename it into place, so anything
+        # reading the file (e.g. converting a log tarball to an indexed
+        # archive) sees either the old or the new file, never a mixture
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(filename), prefix=".upload")
+        fout = os.fdopen(fd, "w")
+        try:
+            shutil.copyfileobj(fh, fout)
+        except:
+            fout.close()
+            os.unlink(tmp)
+            raise
         fout.close()
+        os.chmod(tmp, 0644)
+        os.rename(tmp, filename)
         
     def parseGetURL(self):
         fn = self.request.matchdict["file"]
@@ -82,22 +94,14 @@ class FileFromTar(_FilesBase):
         (job, filename) = self.parseGetURL()
         localfilename = app.utils.results_filename(filename, job)
         innerfilename = "./%s" % "/".join(self.request.matchdict['innerfile'])
-        size = None
-        if os.path.exists("%s.index" % localfilename):
-            f = open("%s.index" % localfilename)
-            for l in f.readlines():
-                ll = l.split()
-                fname = " ".join(ll[5:len(ll)])
-                _size = int(ll[2])
-                if fname == innerfilename:
-                    size = _size
-                    break
-            f.close()
-        return (os.popen('tar -jxf %s -O "%s"' % (localfilename, innerfilename)), innerfilename, size)
+        (fd, size) = app.utils.openTarMember(localfilename, innerfilename)
+        return (fd, innerfilename, size)
     
     def render(self):
         (fd, fn, size) = self.getFD()
-        
+        if not fd:
+            return HTTPNotFound()
+
         self.request.response.body_file = fd
         
         (ctype, encoding) = app.utils.getContentTypeAndEncoding(fn)
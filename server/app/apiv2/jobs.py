@@ -1,6 +1,7 @@
 from app.apiv2 import *
 from machines import _MachineBase
 from pyramid.httpexceptions import *
+import app.changefeed
 import app.constants
 import app.utils
 import calendar
@@ -451,9 +452,82 @@ class GetJob(_JobBase):
     def render(self):
         job = int(self.request.matchdict['id'])
         logitems = self.request.params.get("logitems", "false") == "true"
+        cur = self.getDB().cursor()
+        rc = None
+        if app.changefeed.applied(cur, "tbljobs"):
+            cur.execute("SELECT changeseq FROM tbljobs WHERE jobid=%s", [job])
+            rc = cur.fetchone()
+        if rc:
+            etag = app.changefeed.etag(job, rc[0], int(logitems))
+            if app.changefeed.etagMatches(self.request, etag):
+                return HTTPNotModified(headers=[("ETag", etag)])
+            self.responseHeaders.append(("ETag", etag))
         jobs = self.getJobs(1, ids=[job], getParams=True, getResults=True, getLog=logitems, exceptionIfEmpty=True)
         return jobs[job]
 
+class ListJobChanges(_JobBase):
+    PATH = "/jobs/changes"
+    REQTYPE = "GET"
+    SUMMARY = "Get jobs that have changed since a cursor"
+    DESCRIPTION = "Call without a cursor to get the cursor to start from, then call with the cursor from each reply to get the jobs that have changed since. If more is true, there are more changes to fetch straight away."
+    OPERATION_ID = "get_job_changes"
+    PARAMS = [
+         {'description': 'Cursor from the previous reply',
+          'in': 'query',
+          'name': 'cursor',
+          'required': False,
+          'type': 'string'},
+         {'description': 'Seconds to wait for a change if there are none yet, up to 60. Defaults to 0',
+          'in': 'query',
+          'name': 'wait',
+          'required': False,
+          'type': 'integer'},
+         {'description': 'Limit the number of jobs returned. Defaults to 100, hard limited to 1000',
+          'in': 'query',
+          'name': 'limit',
+          'required': False,
+          'type': 'integer'},
+         {'collectionFormat': 'multi',
+          'description': 'Only return changes to these jobs - can specify multiple',
+          'in': 'query',
+          'items': {'type': 'integer'},
+          'name': 'jobid',
+          'required': False,
+          'type': 'array'},
+         {'default': False,
+          'description': 'Return all job parameters. Defaults to false',
+          'in': 'query',
+          'name': 'params',
+          'required': False,
+          'type': 'boolean'},
+         {'default': False,
+          'description': 'Return the results from all testcases in the jobs. Defaults to false',
+          'in': 'query',
+          'name': 'results',
+          'required': False,
+          'type': 'boolean'},
+         {'default': False,
+          'description': 'Return the log items for all testcases in the jobs. Must also specify results. Defaults to false',
+          'in': 'query',
+          'name': 'logitems',
+          'required': False,
+          'type': 'boolean'}]
+    RESPONSES = { "200": {"description": "Successful response"}}
+    TAGS = ["jobs"]
+
+    def render(self):
+        ids = [int(x) for x in self.getMultiParam("jobid")]
+        params = self.request.params.get("params", "false") == "true"
+        results = self.request.params.get("results", "false") == "true"
+        logitems = self.request.params.get("logitems", "false") == "true"
+        return self.getChanges("tbljobs", "jobid", "jobs",
+                               lambda changed: self.getJobs(len(changed),
+                                                            ids=changed,
+                                                            getParams=params,
+                                                            getResults=results,
+                                                            getLog=logitems),
+                               keys=ids)
+
 class GetTest(_JobBase):
     PATH = "/test/{id}"
     REQTYPE = "GET"
@@ -1082,6 +1156,7 @@ class EmailJob(_JobBase):
 
 RegisterAPI(ListJobs)
 RegisterAPI(GetJob)
+RegisterAPI(ListJobChanges)
 RegisterAPI(GetTest)
 RegisterAPI(RemoveJob)
 RegisterAPI(RemoveJobs)
@@ -42,11 +42,18 @@ class _MachineBase(XenRTAPIv2Page):
                     exceptionIfEmpty=False,
                     search=None,
                     include_forbidden=True,
-                    only_restricted=False):
+                    only_restricted=False,
+                    after=None):
         cur = self.getDB().cursor()
         params = []
         conditions = []
 
+        # Compare and order machine names bytewise, as sorted() does when
+        # the page is cut here rather than in the database
+        if after:
+            conditions.append("m.machine COLLATE \"C\" > %s")
+            params.append(after)
+
         if pools:
             conditions.append(self.generateInCondition("m.pool", pools))
             params.extend(pools)
@@ -101,6 +108,12 @@ class _MachineBase(XenRTAPIv2Page):
         if conditions:
             query += " WHERE %s" % " AND ".join(conditions)
 
+        # Page in the database unless machines are also going to be filtered here
+        sqlLimit = limit and not (flags or resources or search or only_restricted or not include_forbidden)
+        if sqlLimit:
+            query += " ORDER BY m.machine COLLATE \"C\" LIMIT %s OFFSET %s"
+            params.extend([limit, offset])
+
         cur.execute(query, self.expandVariables(params))
 
         ret = {}
@@ -227,7 +240,7 @@ class _MachineBase(XenRTAPIv2Page):
                     del ret[m]
                     continue
 
-        if limit:
+        if limit and not sqlLimit:
             machinesToReturn = sorted(ret.keys())[offset:offset+limit]
 
             for m in ret.keys():
@@ -494,6 +507,11 @@ class ListMachines(_MachineBase):
           'name': 'offset',
           'required': False,
           'type': 'integer'},
+         {'description': 'Only return machines whose names sort after this, for paging with limit enabled. Pass the last machine from the previous page, this is cheaper than offset for large listings',
+          'in': 'query',
+          'name': 'after',
+          'required': False,
+          'type': 'string'},
          {'description': "Get pseudohosts, defaults to false",
           'in' : 'query',
           'name': 'pseudohosts',
@@ -545,6 +563,7 @@ class ListMachines(_MachineBase):
                                 pseudoHosts = self.request.params.get("pseudohosts") == "true",
                                 limit=int(self.request.params.get("limit", 0)),
                                 offset=int(self.request.params.get("offset", 0)),
+                                after=self.request.params.get("after"),
                                 search=self.request.params.get("search"),
                                 include_forbidden=self.request.params.get("include_forbidden", default_forbidden) == "true",
                                 only_restricted=self.request.params.get("only_restricted") == "true")
@@ -567,6 +586,43 @@ class GetMachine(_MachineBase):
         machines = self.getMachines(limit=1, machines=[machine], exceptionIfEmpty=True)
         return machines[machine]
 
+class ListMachineChanges(_MachineBase):
+    PATH = "/machines/changes"
+    REQTYPE = "GET"
+    SUMMARY = "Get machines that have changed since a cursor"
+    DESCRIPTION = "Call without a cursor to get the cursor to start from, then call with the cursor from each reply to get the machines that have changed since. If more is true, there are more changes to fetch straight away. Machines that have been removed are not reported."
+    OPERATION_ID = "get_machine_changes"
+    PARAMS = [
+         {'description': 'Cursor from the previous reply',
+          'in': 'query',
+          'name': 'cursor',
+          'required': False,
+          'type': 'string'},
+         {'description': 'Seconds to wait for a change if there are none yet, up to 60. Defaults to 0',
+          'in': 'query',
+          'name': 'wait',
+          'required': False,
+          'type': 'integer'},
+         {'description': 'Limit the number of machines returned. Defaults to 100, hard limited to 1000',
+          'in': 'query',
+          'name': 'limit',
+          'required': False,
+          'type': 'integer'},
+         {'collectionFormat': 'multi',
+          'description': 'Only return changes to these machines - can specify multiple',
+          'in': 'query',
+          'items': {'type': 'string'},
+          'name': 'machine',
+          'required': False,
+          'type': 'array'}]
+    RESPONSES = { "200": {"description": "Successful response"}}
+    TAGS = ["machines"]
+
+    def render(self):
+        return self.getChanges("tblmachines", "machine", "machines",
+                               lambda changed: self.getMachines(machines=changed),
+                               keys=self.getMultiParam("machine"))
+
 class LeaseMachine(_MachineBase):
     WRITE = True
     PATH = "/machine/{name}/lease"
@@ -1165,6 +1221,7 @@ class NotifyBorrow(_MachineBase):
 
 RegisterAPI(ListMachines)
 RegisterAPI(GetMachine)
+RegisterAPI(ListMachineChanges)
 RegisterAPI(LeaseMachine)
 RegisterAPI(ReturnMachine)
 RegisterAPI(UpdateMachine)
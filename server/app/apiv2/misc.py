@@ -1,6 +1,7 @@
 from app.apiv2 import *
 from pyramid.httpexceptions import *
 import app.user
+import app.db
 import config
 
 class LogServer(XenRTAPIv2Page):
@@ -15,6 +16,17 @@ class LogServer(XenRTAPIv2Page):
     def render(self):
         return {"server": config.log_server }
 
+class DBPoolStats(XenRTAPIv2Page):
+    PATH = "/dbpool"
+    REQTYPE = "GET"
+    SUMMARY = "Get database connection pool metrics for this server process"
+    PARAMS = []
+    RESPONSES = { "200": {"description": "Successful response"}}
+    TAGS = ["backend"]
+
+    def render(self):
+        return app.db.poolStats()
+
 class GetUser(XenRTAPIv2Page):
     PATH = "/loggedinuser"
     REQTYPE = "GET"
@@ -164,6 +176,7 @@ class ADLookup(XenRTAPIv2Page):
         return results
 
 RegisterAPI(LogServer)
+RegisterAPI(DBPoolStats)
 RegisterAPI(GetUser)
 RegisterAPI(ADLookup)
 RegisterAPI(GetUserDetails)
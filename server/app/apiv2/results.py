@@ -277,7 +277,95 @@ class GetEvents(XenRTAPIv2Page):
         
 
 
-class NewLogData(XenRTAPIv2Page):
+class _ResultsBase(XenRTAPIv2Page):
+
+    def addLogData(self, cur, jobid, phase, test, key, value, timenow):
+        """Add a log data item to a test, creating the test if needed.
+        Returns False if the test could not be found."""
+        # Make sure we have a result field for this test
+        result = ""
+        if key == "result":
+            result = value
+        detailid = 0
+        cur.execute("SELECT detailid FROM tblResults " +
+                    "WHERE jobid = %s AND phase = %s AND test = %s;",
+                    [jobid, phase, test])
+        rc = cur.fetchone()
+        if not rc:
+            cur.execute("INSERT INTO tblResults (jobid, phase, test, result) "
+                        "VALUES (%s, %s, %s, %s);",
+                        [jobid, phase, test, result])
+            cur.execute("SELECT detailid FROM tblResults " +
+                        "WHERE jobid = %s AND phase = %s AND test = %s;",
+                        [jobid, phase, test])
+            rc = cur.fetchone()
+            if not rc:
+                return False
+            detailid = int(rc[0])
+        else:
+            detailid = int(rc[0])
+
+        if len(key) > 24:
+            key = key[0:24]
+        if len(value) > 255:
+            value = value[0:255]
+        cur.execute("INSERT INTO tblDetails (detailid, ts, key, value) "
+                    "VALUES (%s, %s, %s, %s);",
+                    [detailid, timenow, key, value])
+
+        # If the key was "result" the update the result in tblResult as well
+        if key == "result":
+            cur.execute("UPDATE tblResults SET result = %s WHERE jobid = %s "
+                        "AND phase = %s AND test = %s;",
+                        [value, jobid, phase, test])
+
+        # If the key was "warning" then modify the result in tblResult
+        if key == "warning":
+            cur.execute("SELECT result FROM tblResults WHERE jobid = %s "
+                        "AND phase = %s AND test = %s;",
+                        [jobid, phase, test])
+            rc = cur.fetchone()
+            if rc and rc[0]:
+                result = string.strip(rc[0])
+            else:
+                result = "unknown"
+            if result[-2:] != "/w":
+                result = result + "/w"
+            cur.execute("UPDATE tblResults SET result = %s WHERE jobid = %s "
+                        "AND phase = %s AND test = %s;",
+                        [result, jobid, phase, test])
+        return True
+
+    def setTestResult(self, cur, jobid, phase, test, result, timenow):
+        """Set the result of a test and record it in the test's history.
+        Returns False if the test could not be found."""
+        cur.execute("SELECT jobid, phase, test, result FROM tblResults "
+                    "WHERE jobid = %s AND phase = %s AND test = %s;",
+                    [jobid, phase, test])
+        rc = cur.fetchone()
+        if not rc:
+            cur.execute("INSERT INTO tblResults (jobid, phase, test, result) "
+                        "VALUES (%s, %s, %s, %s);",
+                        [jobid, phase, test, result])
+        else:
+            cur.execute("UPDATE tblResults SET result = %s WHERE jobid = %s "
+                        "AND phase = %s AND test = %s;",
+                        [result, jobid, phase, test])
+
+        # Also add to the detailed history
+        cur.execute("SELECT detailid FROM tblResults "
+                    "WHERE jobid = %s AND phase = %s AND test = %s;",
+                    [jobid, phase, test])
+        rc = cur.fetchone()
+        if not rc:
+            return False
+        detailid = int(rc[0])
+        cur.execute(
+            "INSERT INTO tblDetails (detailid, ts, key, value) VALUES "
+            "(%s, %s, 'result', %s);", [detailid, timenow, result])
+        return True
+
+class NewLogData(_ResultsBase):
     WRITE = True
     PATH = "/job/{id}/tests/{phase}/{test}/logdata"
     REQTYPE = "POST"
@@ -338,70 +426,16 @@ class NewLogData(XenRTAPIv2Page):
         value = params["value"]
 
         cur = db.cursor()
-
-
-        # Make sure we have a result field for this test
-        result = ""
-        if key == "result":
-            result = value
-        detailid = 0
-        cur.execute("SELECT detailid FROM tblResults " +
-                    "WHERE jobid = %s AND phase = %s AND test = %s;",
-                    [id, phase, test])
-        rc = cur.fetchone()
-        if not rc:
-            cur.execute("INSERT INTO tblResults (jobid, phase, test, result) "
-                        "VALUES (%s, %s, %s, %s);",
-                        [id, phase, test, result])
-            cur.execute("SELECT detailid FROM tblResults " +
-                        "WHERE jobid = %s AND phase = %s AND test = %s;",
-                        [id, phase, test])
-            rc = cur.fetchone()
-            if not rc:
-                cur.close()
-                db.rollback()
-                db.close()
-                raise XenRTAPIError(self, HTTPNotFound, "Could not find test in database")
-            else:
-                detailid = int(rc[0])
-        else:
-            detailid = int(rc[0])
-
-        if len(key) > 24:
-            key = key[0:24]
-        if len(value) > 255:
-            value = value[0:255]
-        cur.execute("INSERT INTO tblDetails (detailid, ts, key, value) "
-                    "VALUES (%s, %s, %s, %s);",
-                    [detailid, timenow, key, value])
-
-        # If the key was "result" the update the result in tblResult as well
-        if key == "result":
-            cur.execute("UPDATE tblResults SET result = %s WHERE jobid = %s "
-                        "AND phase = %s AND test = %s;",
-                        [value, id, phase, test])
-
-        # If the key was "warning" then modify the result in tblResult
-        if key == "warning":
-            cur.execute("SELECT result FROM tblResults WHERE jobid = %s "
-                        "AND phase = %s AND test = %s;",
-                        [id, phase, test])
-            rc = cur.fetchone()
-            if rc and rc[0]:
-                result = string.strip(rc[0])
-            else:
-                result = "unknown"
-            if result[-2:] != "/w":
-                result = result + "/w"
-            cur.execute("UPDATE tblResults SET result = %s WHERE jobid = %s "
-                        "AND phase = %s AND test = %s;",
-                        [result, id, phase, test])
-            
+        if not self.addLogData(cur, id, phase, test, key, value, timenow):
+            cur.close()
+            db.rollback()
+            db.close()
+            raise XenRTAPIError(self, HTTPNotFound, "Could not find test in database")
         db.commit()
         cur.close()
         return {}
 
-class SetResult(XenRTAPIv2Page):
+class SetResult(_ResultsBase):
     WRITE = True
     PATH = "/job/{id}/tests/{phase}/{test}"
     REQTYPE = "POST"
@@ -459,39 +493,87 @@ class SetResult(XenRTAPIv2Page):
         result = params["result"]
 
         cur = db.cursor()
-
-
-        cur.execute("SELECT jobid, phase, test, result FROM tblResults "
-                    "WHERE jobid = %s AND phase = %s AND test = %s;",
-                    [id, phase, test])
-        rc = cur.fetchone()
-        if not rc:
-            cur.execute("INSERT INTO tblResults (jobid, phase, test, result) "
-                        "VALUES (%s, %s, %s, %s);",
-                        [id, phase, test, result])
-        else:
-            cur.execute("UPDATE tblResults SET result = %s WHERE jobid = %s "
-                        "AND phase = %s AND test = %s;",
-                        [result, id, phase, test])
-
-        # Also add to the detailed history
-        cur.execute("SELECT detailid FROM tblResults "
-                    "WHERE jobid = %s AND phase = %s AND test = %s;",
-                    [id, phase, test])
-        rc = cur.fetchone()
-        if not rc:
+        if not self.setTestResult(cur, id, phase, test, result, timenow):
             cur.close()
             raise XenRTAPIError(self, HTTPNotFound, "Could not find test in database")
-        else:
-            detailid = int(rc[0])
-            cur.execute(
-                "INSERT INTO tblDetails (detailid, ts, key, value) VALUES "
-                "(%s, %s, 'result', %s);", [detailid, timenow, result])
-            
         db.commit()
         cur.close()
         return {}
 
+class BulkResults(_ResultsBase):
+    WRITE = True
+    PATH = "/job/{id}/tests"
+    REQTYPE = "POST"
+    SUMMARY = "Set results and add log data for several tests at once"
+    DESCRIPTION = "Updates are applied in order in a single transaction. Each update sets the result of a test (if result is given) or adds log data to it (if key and value are given)."
+    PARAMS = [
+        {'name': 'id',
+         'in': 'path',
+         'required': True,
+         'description': 'Job ID to add results to',
+         'type': 'integer'},
+        {'name': 'body',
+         'in': 'body',
+         'required': True,
+         'description': 'Updates to apply',
+         'schema': { "$ref": "#/definitions/bulkresults" }
+        }]
+    DEFINITIONS = { "bulkresults": {
+             "title": "Result updates",
+             "type": "object",
+             "required": ["updates"],
+             "properties": {
+                "updates": {
+                    "type": "array",
+                    "description": "List of updates, each a dictionary with phase, test and either result, or key and value",
+                    "items": {
+                        "type": "object",
+                        "required": ["phase", "test"],
+                        "properties": {
+                            "phase": {"type": "string"},
+                            "test": {"type": "string"},
+                            "result": {"type": "string"},
+                            "key": {"type": "string"},
+                            "value": {"type": "string"}
+                        }
+                    }
+                }
+             }
+        }
+    }
+    RESPONSES = { "200": {"description": "Successful response"}}
+    TAGS = ["backend"]
+    OPERATION_ID="bulk_results"
+    PARAM_ORDER = ["id", "updates"]
+
+    def render(self):
+        try:
+            params = json.loads(self.request.body)
+            jsonschema.validate(params, self.DEFINITIONS['bulkresults'])
+        except Exception, e:
+            raise XenRTAPIError(self, HTTPBadRequest, str(e).split("\n")[0])
+        for u in params["updates"]:
+            if not u.has_key("result") and not (u.has_key("key") and u.has_key("value")):
+                raise XenRTAPIError(self, HTTPBadRequest, "Update for %s/%s needs a result or a key and value" % (u["phase"], u["test"]))
+        db = self.getDB()
+        timenow = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()))
+        id = self.getIntFromMatchdict("id")
+
+        cur = db.cursor()
+        try:
+            for u in params["updates"]:
+                if u.has_key("result"):
+                    ok = self.setTestResult(cur, id, u["phase"], u["test"], u["result"], timenow)
+                else:
+                    ok = self.addLogData(cur, id, u["phase"], u["test"], u["key"], u["value"], timenow)
+                if not ok:
+                    db.rollback()
+                    raise XenRTAPIError(self, HTTPNotFound, "Could not find test %s/%s in database" % (u["phase"], u["test"]))
+            db.commit()
+        finally:
+            cur.close()
+        return {"updates": len(params["updates"])}
+
 PD_DLIST = 1
 PD_HIDE = 2
 
@@ -616,3 +698,4 @@ RegisterAPI(SetResult)
 RegisterAPI(NewEvent)
 RegisterAPI(GetEvents)
 RegisterAPI(NewLogData)
+RegisterAPI(BulkResults)
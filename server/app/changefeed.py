@@ -0,0 +1,91 @@
+# Change feeds for jobs and machines
+#
+# tbljobs and tblmachines carry a changeseq column, set by the triggers in
+# control/changefeed.sql to the id of the last transaction that changed the
+# row or one of its child rows. Transaction ids only ever increase, so a
+# client's position in the feed can be the database snapshot its previous
+# reply was read with: the rows that changed since then are the ones whose
+# changeseq is not visible in that snapshot. Unlike a plain sequence this
+# doesn't lose changes from transactions that commit out of order.
+import base64, json, re
+
+# txid_snapshot as text, xmin:xmax:xip,...
+SNAPSHOT_RE = re.compile(r"^\d+:\d+:[\d,]*$")
+
+class CursorError(Exception):
+    pass
+
+def encodeCursor(snapshot, since=None, after=None):
+    """An opaque cursor. Once a reply is complete it is just the snapshot the
+    reply was read with, for a partial reply it also has the snapshot the
+    reply is relative to and the (changeseq, key) of the last row returned."""
+    c = {"snapshot": snapshot}
+    if after:
+        c["since"] = since
+        c["after"] = list(after)
+    return base64.urlsafe_b64encode(json.dumps(c, separators=(",", ":")))
+
+def decodeCursor(cursor):
+    """Returns (since, snapshot, after), snapshot being None if the next reply
+    should be read with a new snapshot"""
+    try:
+        c = json.loads(base64.urlsafe_b64decode(str(cursor)))
+        if "after" in c:
+            ret = (c["since"], c["snapshot"], tuple(c["after"]))
+        else:
+            ret = (c["snapshot"], None, None)
+    except (TypeError, ValueError, KeyError, AttributeError):
+        raise CursorError("Invalid cursor")
+    for s in ret[:2]:
+        if s is not None and not (isinstance(s, basestring) and SNAPSHOT_RE.match(s)):
+            raise CursorError("Invalid cursor")
+    return ret
+
+# Tables control/changefeed.sql is known to have been applied to
+_applied = set()
+
+def applied(cur, table):
+    """Whether table has a changeseq column. Once it has, this is remembered,
+    so the schema is only checked again while the script hasn't been run."""
+    if table not in _applied:
+        cur.execute("SELECT 1 FROM information_schema.columns "
+                    "WHERE table_name=%s AND column_name='changeseq'", [table])
+        if cur.fetchone():
+            _applied.add(table)
+    return table in _applied
+
+def currentSnapshot(cur):
+    cur.execute("SELECT txid_current_snapshot()::text")
+    return cur.fetchone()[0]
+
+def changedKeys(cur, table, keycol, since, after=None, limit=100, keys=[]):
+    """Returns the (changeseq, key) of up to limit rows of table changed since
+    the snapshot since, in the order they changed, and whether there are
+    more. keys restricts the rows to those with the given keys."""
+    conditions = ["changeseq >= txid_snapshot_xmin(%s::txid_snapshot)",
+                  "NOT txid_visible_in_snapshot(changeseq, %s::txid_snapshot)"]
+    params = [since, since]
+    if after:
+        conditions.append("(changeseq, %s) > (%%s, %%s)" % keycol)
+        params.extend(after)
+    if keys:
+        conditions.append("%s IN (%s)" % (keycol, ", ".join(["%s"] * len(keys))))
+        params.extend(keys)
+    params.append(limit + 1)
+    cur.execute("SELECT changeseq, %s FROM %s WHERE %s ORDER BY changeseq, %s LIMIT %%s" %
+                (keycol, table, " AND ".join(conditions), keycol), params)
+    rows = cur.fetchall()
+    return ([(r[0], r[1].strip() if isinstance(r[1], basestring) else r[1]) for r in rows[:limit]],
+            len(rows) > limit)
+
+def etag(*parts):
+    """A weak entity tag, as the body may or may not be compressed"""
+    return "W/\"%s\"" % "-".join([str(p) for p in parts])
+
+def etagMatches(request, tag):
+    """Whether the request's If-None-Match matches tag, by weak comparison"""
+    header = request.headers.get("If-None-Match")
+    if not header:
+        return False
+    tags = [re.sub(r"^W/", "", t.strip()) for t in header.split(",")]
+    return "*" in tags or re.sub(r"^W/", "", tag) in tags
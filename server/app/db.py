@@ -1,6 +1,7 @@
-import psycopg2
+import psycopg2, psycopg2.extensions
 import config
 import requests
+import os, threading, time
 import app.utils
 
 class DatabaseOutOfDateException(Exception):
@@ -15,9 +16,192 @@ def dbWriteInstance():
     args = connStrToArgs(config.dbConnectStringWrite)
     return psycopg2.connect(**args)
 
+class ConnectionPool(object):
+    """A process wide pool of connections to one database.
+
+    Connections are rolled back when they are returned, and are closed
+    rather than pooled if that fails, if they are older than maxAge
+    seconds, or if there are already maxIdle idle connections. A
+    connection that has been idle for more than checkInterval seconds
+    is checked with a trivial query before it is handed out again."""
+
+    def __init__(self, connStr, maxIdle, maxAge, checkInterval):
+        self.connStr = connStr
+        self.maxIdle = maxIdle
+        self.maxAge = maxAge
+        self.checkInterval = checkInterval
+        self.lock = threading.Lock()
+        self.pid = os.getpid()
+        # Idle connections as (connection, created, last used), most
+        # recently used last
+        self.idle = []
+        # Creation time of connections that are checked out
+        self.created = {}
+        self.stats = {"connects": 0, "reuses": 0, "checks": 0,
+                      "check_failures": 0, "recycled": 0, "discarded": 0,
+                      "connect_time": 0.0}
+
+    def _connect(self):
+        start = time.time()
+        conn = psycopg2.connect(**connStrToArgs(self.connStr))
+        self.lock.acquire()
+        try:
+            self.stats["connects"] += 1
+            self.stats["connect_time"] += time.time() - start
+        finally:
+            self.lock.release()
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.close()
+        except:
+            pass
+
+    def _healthy(self, conn):
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1")
+            cur.fetchone()
+            cur.close()
+            conn.rollback()
+            return True
+        except:
+            return False
+
+    def get(self):
+        """Return a connection, reusing an idle one if possible."""
+        while True:
+            self.lock.acquire()
+            try:
+                if not self.idle:
+                    break
+                (conn, created, lastUsed) = self.idle.pop()
+                now = time.time()
+                if conn.closed or now - created > self.maxAge:
+                    self.stats["recycled"] += 1
+                    stale = conn
+                    conn = None
+                else:
+                    check = now - lastUsed > self.checkInterval
+                    if check:
+                        self.stats["checks"] += 1
+            finally:
+                self.lock.release()
+            if not conn:
+                self._close(stale)
+                continue
+            if check and not self._healthy(conn):
+                self._close(conn)
+                self.lock.acquire()
+                try:
+                    self.stats["check_failures"] += 1
+                finally:
+                    self.lock.release()
+                continue
+            self.lock.acquire()
+            try:
+                self.stats["reuses"] += 1
+                self.created[id(conn)] = created
+            finally:
+                self.lock.release()
+            return conn
+        conn = self._connect()
+        self.lock.acquire()
+        try:
+            self.created[id(conn)] = time.time()
+        finally:
+            self.lock.release()
+        return conn
+
+    def put(self, conn):
+        """Return a connection to the pool, rolling back any transaction."""
+        self.lock.acquire()
+        try:
+            created = self.created.pop(id(conn), None)
+        finally:
+            self.lock.release()
+        keep = created is not None and not conn.closed
+        if keep:
+            try:
+                conn.rollback()
+                keep = conn.get_transaction_status() == psycopg2.extensions.TRANSACTION_STATUS_IDLE
+            except:
+                keep = False
+        now = time.time()
+        self.lock.acquire()
+        try:
+            if keep and now - created > self.maxAge:
+                self.stats["recycled"] += 1
+                keep = False
+            elif keep and len(self.idle) >= self.maxIdle:
+                self.stats["discarded"] += 1
+                keep = False
+            if keep:
+                self.idle.append((conn, created, now))
+        finally:
+            self.lock.release()
+        if not keep:
+            self._close(conn)
+
+    def clear(self):
+        """Close all idle connections."""
+        self.lock.acquire()
+        try:
+            idle = self.idle
+            self.idle = []
+        finally:
+            self.lock.release()
+        for (conn, created, lastUsed) in idle:
+            self._close(conn)
+
+    def getStats(self):
+        self.lock.acquire()
+        try:
+            ret = dict(self.stats)
+            ret["idle"] = len(self.idle)
+            ret["in_use"] = len(self.created)
+            ret["max_idle"] = self.maxIdle
+            ret["max_age"] = self.maxAge
+            return ret
+        finally:
+            self.lock.release()
+
+_pools = {}
+_poolsLock = threading.Lock()
+
+def _pool(name, connStr):
+    _poolsLock.acquire()
+    try:
+        # Connections can't be shared with a forked child, so a child
+        # abandons (without closing) any pool its parent created
+        if not _pools.has_key(name) or _pools[name].pid != os.getpid():
+            _pools[name] = ConnectionPool(connStr,
+                                          int(config.max_db_connections),
+                                          int(config.db_pool_max_age),
+                                          int(config.db_pool_check_interval))
+        return _pools[name]
+    finally:
+        _poolsLock.release()
+
+def readPool():
+    return _pool("read", config.dbConnectString)
+
+def writePool():
+    return _pool("write", config.dbConnectStringWrite)
+
+def poolStats():
+    _poolsLock.acquire()
+    try:
+        pools = dict(_pools)
+    finally:
+        _poolsLock.release()
+    return dict([(n, p.getStats()) for (n, p) in pools.items()])
+
 def isDBMaster(returnDetail=False):
+    pool = readPool()
+    readDB = pool.get()
     try:
-        readDB = dbReadInstance()
         if getWriteLocation(readDB):
             if not config.partner_ha_node:
                 if returnDetail:
@@ -45,8 +229,7 @@ def isDBMaster(returnDetail=False):
                 return None
             return False
     finally:
-        readDB.rollback()
-        readDB.close()
+        pool.put(readDB)
 
 def getReadLocation(db):
     cur = db.cursor()
@@ -0,0 +1,276 @@
+# Indexed log archives
+#
+# Job and test logs are uploaded as tar.bz2 archives. Serving one file from
+# one of those means decompressing the archive from the start, so alongside
+# each archive we keep an indexed copy in which every member is compressed
+# on its own and an index at the end records where each member starts.
+#
+# Layout: MAGIC, the zlib compressed data of each member, the zlib
+# compressed JSON index, then a trailer of the index offset and length
+# (big endian 64 bit) followed by MAGIC again.
+#
+# The indexed copy is given the modification time of the tarball it was
+# made from, so a copy of an archive that has since been uploaded again is
+# never used.
+
+import os, errno, posixpath, struct, tarfile, threading, time, zlib, json, sys
+
+MAGIC = "XRTLOGA1"
+TRAILER = struct.Struct(">QQ")
+CHUNK = 1024 * 1024
+# A conversion that has left its temporary file untouched for this long is
+# assumed to have died
+STALE_CONVERSION = 3600
+
+_converting = set()
+_convertingLock = threading.Lock()
+
+def archivePath(tarfn):
+    """Return the path of the indexed copy of tarfn"""
+    return "%s.ixa" % tarfn
+
+def normaliseName(name):
+    name = posixpath.normpath(name).lstrip("/")
+    if name == ".":
+        return ""
+    return name
+
+class _MemberFile(object):
+    """A read only file object returning the decompressed data of one
+    archive member"""
+
+    def __init__(self, path, offset, csize):
+        self.fh = open(path, "rb")
+        self.fh.seek(offset)
+        self.remaining = csize
+        self.decomp = zlib.decompressobj()
+        self.buf = ""
+        self.eof = False
+
+    def _fill(self, size):
+        while not self.eof and (size < 0 or len(self.buf) < size):
+            if self.remaining > 0:
+                data = self.fh.read(min(CHUNK, self.remaining))
+                if not data:
+                    raise IOError("Truncated log archive")
+                self.remaining -= len(data)
+                self.buf += self.decomp.decompress(data)
+            else:
+                self.buf += self.decomp.flush()
+                self.eof = True
+
+    def read(self, size=-1):
+        self._fill(size)
+        if size < 0:
+            size = len(self.buf)
+        ret = self.buf[:size]
+        self.buf = self.buf[size:]
+        return ret
+
+    def readline(self, size=-1):
+        while True:
+            i = self.buf.find("\n")
+            if i >= 0 or self.eof:
+                break
+            self._fill(len(self.buf) + CHUNK)
+        if i < 0:
+            i = len(self.buf)
+        else:
+            i += 1
+        if size >= 0:
+            i = min(i, size)
+        ret = self.buf[:i]
+        self.buf = self.buf[i:]
+        return ret
+
+    def readlines(self):
+        return list(iter(self.readline, ""))
+
+    def __iter__(self):
+        return iter(self.readline, "")
+
+    def close(self):
+        self.fh.close()
+
+class LogArchive(object):
+    """An indexed log archive opened for reading"""
+
+    def __init__(self, path):
+        self.path = path
+        f = open(path, "rb")
+        try:
+            if f.read(len(MAGIC)) != MAGIC:
+                raise IOError("%s is not a log archive" % path)
+            f.seek(-(TRAILER.size + len(MAGIC)), os.SEEK_END)
+            trailer = f.read(TRAILER.size + len(MAGIC))
+            if trailer[TRAILER.size:] != MAGIC:
+                raise IOError("%s is incomplete" % path)
+            (offset, length) = TRAILER.unpack(trailer[:TRAILER.size])
+            f.seek(offset)
+            entries = json.loads(zlib.decompress(f.read(length)))
+        finally:
+            f.close()
+        self.members = {}
+        self.order = []
+        for e in entries:
+            self.members[e["name"]] = e
+            self.order.append(e["name"])
+
+    def _resolve(self, name):
+        name = normaliseName(name)
+        for i in range(10):
+            e = self.members.get(name)
+            if not e or not e.has_key("link"):
+                return e
+            name = e["link"]
+        return None
+
+    def listing(self):
+        """Return a list of (name, size) of the files in the archive, in
+        archive order"""
+        ret = []
+        for n in self.order:
+            e = self._resolve(n)
+            if e:
+                ret.append((n, e["size"]))
+        return ret
+
+    def size(self, name):
+        e = self._resolve(name)
+        return e and e["size"]
+
+    def open(self, name):
+        """Return a file object for the member, or None if it is not in
+        the archive"""
+        e = self._resolve(name)
+        if not e:
+            return None
+        return _MemberFile(self.path, e["offset"], e["csize"])
+
+def convert(tarfn, dest=None):
+    """Write an indexed copy of the tar.bz2 archive tarfn to dest (by
+    default archivePath(tarfn)). The copy is written to a temporary file
+    and renamed into place, so readers never see a partial archive."""
+    if not dest:
+        dest = archivePath(tarfn)
+    tmp = "%s.tmp" % dest
+    try:
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    except OSError, e:
+        if e.errno != errno.EEXIST or \
+                time.time() - os.stat(tmp).st_mtime < STALE_CONVERSION:
+            raise
+        # Left behind by a conversion that died
+        os.unlink(tmp)
+        fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0644)
+    out = os.fdopen(fd, "wb")
+    src = None
+    try:
+        src = open(tarfn, "rb")
+        st = os.fstat(src.fileno())
+        out.write(MAGIC)
+        offset = len(MAGIC)
+        entries = []
+        tar = tarfile.open(fileobj=src, mode="r|*")
+        try:
+            for m in tar:
+                name = normaliseName(m.name)
+                if not name:
+                    continue
+                if m.issym():
+                    entries.append({"name": name, "link": normaliseName(
+                        posixpath.normpath(posixpath.join(posixpath.dirname(name), m.linkname)))})
+                elif m.islnk():
+                    entries.append({"name": name, "link": normaliseName(m.linkname)})
+                elif m.isfile():
+                    comp = zlib.compressobj()
+                    csize = 0
+                    size = 0
+                    f = tar.extractfile(m)
+                    while True:
+                        data = f.read(CHUNK)
+                        if not data:
+                            break
+                        size += len(data)
+                        data = comp.compress(data)
+                        csize += len(data)
+                        out.write(data)
+                    data = comp.flush()
+                    csize += len(data)
+                    out.write(data)
+                    entries.append({"name": name, "size": size, "offset": offset,
+                                    "csize": csize, "mtime": m.mtime})
+                    offset += csize
+        finally:
+            tar.close()
+        index = zlib.compress(json.dumps(entries))
+        out.write(index)
+        out.write(TRAILER.pack(offset, len(index)))
+        out.write(MAGIC)
+        out.close()
+        os.utime(tmp, (st.st_atime, st.st_mtime))
+        os.rename(tmp, dest)
+    except:
+        out.close()
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    finally:
+        if src:
+            src.close()
+
+def openArchive(tarfn):
+    """Return the LogArchive for tarfn, or None if there isn't one made from
+    the current tarfn."""
+    path = archivePath(tarfn)
+    try:
+        # utime only sets the time to the microsecond
+        if abs(os.stat(path).st_mtime - os.stat(tarfn).st_mtime) > 0.001:
+            return None
+        return LogArchive(path)
+    except (IOError, OSError, ValueError):
+        return None
+
+def _convertThread(tarfn):
+    try:
+        try:
+            convert(tarfn)
+        except Exception, e:
+            sys.stderr.write("Could not convert %s to a log archive: %s\n" % (tarfn, str(e)))
+    finally:
+        _convertingLock.acquire()
+        try:
+            _converting.discard(tarfn)
+        finally:
+            _convertingLock.release()
+
+def convertInBackground(tarfn):
+    """Start converting tarfn in a background thread, unless this process
+    is already converting it or another process appears to be."""
+    try:
+        st = os.stat("%s.tmp" % archivePath(tarfn))
+        if time.time() - st.st_mtime < STALE_CONVERSION:
+            return
+    except OSError:
+        pass
+    if not os.path.exists(tarfn):
+        return
+    _convertingLock.acquire()
+    try:
+        if tarfn in _converting:
+            return
+        _converting.add(tarfn)
+    finally:
+        _convertingLock.release()
+    t = threading.Thread(target=_convertThread, args=(tarfn,))
+    t.setDaemon(True)
+    t.start()
+
+def getArchive(tarfn):
+    """Return the LogArchive for tarfn if there is an up to date one, else
+    start converting it in the background and return None, in which case
+    the caller should fall back to reading tarfn directly."""
+    a = openArchive(tarfn)
+    if not a:
+        convertInBackground(tarfn)
+    return a
@@ -0,0 +1,135 @@
+# Indexed machine matching for the scheduler
+import string
+import app.utils
+
+class MachineIndex(object):
+    """The pool, cluster, resources and flags of a set of machines, parsed
+    once per scheduler pass and indexed so that a job's requirements can
+    be answered by set intersection instead of re-parsing every machine
+    for every job.
+
+    <machines> is a dictionary of scm_machine_list rows, <props> maps
+    machine to its properties (tblMachines flags plus tblMachineData PROPS)
+    and <siteprops> maps site to its FLAGS, or None.
+
+    The answers are the same as app.utils.check_resources and
+    app.utils.check_attributes would give for each machine."""
+
+    def __init__(self, machines, props, siteprops):
+        self.names = set()
+        self.byPool = {}
+        self.byCluster = {}
+        self.byFlag = {}
+        self.byRawFlag = {}
+        self.byResource = {}
+        # Machines with a valid, non-empty resource string
+        self.withResources = set()
+        # Machine to {resource: [name, op, value]}
+        self.resources = {}
+        # Machine to the flags a job must ask for to use it
+        self.mandatory = {}
+        self.cache = {}
+        self.stats = {"queries": 0, "hits": 0}
+        for m in machines.values():
+            p = props.get(m[0], m[6])
+            if siteprops.get(m[1]):
+                p = string.join([p, siteprops[m[1]]], ",")
+            self._add(m, p)
+
+    def _add(self, m, props):
+        name = m[0]
+        self.names.add(name)
+
+        subpool = m[3]
+        if subpool == "":
+            subpool = "DEFAULT"
+        self.byPool.setdefault(subpool, set()).add(name)
+
+        thiscluster = m[2] and m[2].strip() or ""
+        self.byCluster.setdefault(thiscluster, set()).add(name)
+
+        availlistraw = string.split(props, ",")
+        for f in availlistraw:
+            self.byRawFlag.setdefault(f, set()).add(name)
+            self.byFlag.setdefault(f.strip("+"), set()).add(name)
+            if f and f[0] == "+":
+                self.mandatory.setdefault(name, []).append(f[1:])
+
+        if m[5]:
+            available = string.strip(m[5], "'\"")
+            if not app.utils.check_input(available):
+                entries = {}
+                for entry in app.utils.parse_input(available):
+                    # check_resources uses the first entry for a resource
+                    if not entries.has_key(entry[0]):
+                        entries[entry[0]] = entry
+                        self.byResource.setdefault(entry[0], set()).add(name)
+                self.resources[name] = entries
+                self.withResources.add(name)
+
+    def _union(self, index, keys):
+        s = set()
+        for k in keys:
+            s |= index.get(k, set())
+        return s
+
+    def _matchResources(self, required):
+        required = string.strip(required, "'\"")
+        if app.utils.check_input(required):
+            return set()
+        cand = set(self.withResources)
+        for constraint in app.utils.parse_input(required):
+            if not app.utils.check_constraint(constraint, None):
+                # Machines without the resource can't satisfy this
+                cand &= self.byResource.get(constraint[0], set())
+            cand = set([m for m in cand if app.utils.check_constraint(
+                            constraint, self.resources[m].get(constraint[0]))])
+        return cand
+
+    def _matchFlags(self, required):
+        if required:
+            reqlist = string.split(required, ",")
+        else:
+            reqlist = []
+        cand = set(self.names)
+        for req in reqlist:
+            if not req or req[0] == "~":
+                continue
+            elif req[0] == "!":
+                cand -= self.byFlag.get(req[1:], set())
+            else:
+                cand &= self.byFlag.get(req, set())
+                cand -= self.byFlag.get("-%s" % (req), set())
+        # Machines with mandatory flags the job doesn't mention
+        for m in self.mandatory.keys():
+            if m in cand:
+                for f in self.mandatory[m]:
+                    if f not in reqlist and ("~%s" % f) not in reqlist:
+                        cand.discard(m)
+                        break
+        return cand
+
+    def candidates(self, jobpool, clusterreq, resreq, flags, shortjob):
+        """Return the set of machines that satisfy one machine's worth of a
+        job's requirements: the list of pools (or "ANY"), the list of
+        clusters (or None), the RESOURCES_REQUIRED and FLAGS strings (or
+        None) and whether the job is a SHORTJOB."""
+        key = (tuple(jobpool), clusterreq and tuple(clusterreq), resreq,
+               flags, shortjob)
+        self.stats["queries"] += 1
+        if self.cache.has_key(key):
+            self.stats["hits"] += 1
+            return self.cache[key]
+        if "ANY" in jobpool:
+            cand = set(self.names)
+        else:
+            cand = self._union(self.byPool, jobpool)
+        if clusterreq:
+            cand &= self._union(self.byCluster, clusterreq)
+        if resreq:
+            cand &= self._matchResources(resreq)
+        cand &= self._matchFlags(flags)
+        if not shortjob:
+            cand -= self.byRawFlag.get("shortonly", set())
+        self.cache[key] = cand
+        return cand
@@ -1,7 +1,7 @@
 from server import PageFactory
 from app import XenRTPage
 
-import string, os, re, tempfile, mimetypes
+import string, re, tempfile, mimetypes, StringIO
 
 import app.utils
 from pyramid.httpexceptions import HTTPFound
@@ -28,24 +28,7 @@ class XenRTBrowseBase(XenRTPage):
         
 class XenRTBrowseFiles(XenRTBrowseBase):
     def doRender(self):
-        if os.path.exists("%s.index" % self.tarfile):
-            indexFH = open("%s.index" % self.tarfile)
-            createIndex = False
-        else:
-            indexFH = os.popen("tar -jvtf %s" % (self.tarfile))
-            createIndex = True
-
-        self.index = indexFH.readlines()
-        indexFH.close()
-
-        if createIndex and len(self.index) > 0:
-            try:
-                f = open("%s.index" % self.tarfile, "w")
-                for l in self.index:
-                    f.write(l)
-                f.close()
-            except:
-                pass
+        self.index = app.utils.getTarListing(self.tarfile)
 
         return self.doListing()
 
@@ -68,11 +51,7 @@ class XenRTBrowseFiles(XenRTBrowseBase):
 class XenRTBrowse(XenRTBrowseFiles):
     def doListing(self):
         out = ""
-        for line in self.index:
-            line = string.strip(line)
-            all = line.split()
-            line = " ".join(all[5:len(all)])
-            rawsize = int(all[2])
+        for (line, rawsize) in self.index:
             if rawsize > 1024:
                 size = rawsize / 1024
                 if size > 1024:
@@ -109,12 +88,7 @@ class XenRTBrowse(XenRTBrowseFiles):
 class XenRTBrowseJSON(XenRTBrowseFiles):
     def doListing(self):
         out = {"files": {}}
-        for line in self.index:
-            all = line.split()
-            size = int(all[2])
-            fname = " ".join(all[5:len(all)])
-            if fname.endswith("/"):
-                continue
+        for (fname, size) in self.index:
             if fname[0:2] == "./":
                 fname = fname[2:]
             out["files"][fname] = {}
@@ -135,18 +109,11 @@ class XenRTBrowseFile(XenRTBrowseBase):
 
     def getFD(self):
         self.filename = "./%s" % "/".join(self.request.matchdict['file'])
-        self.size = None
-        if os.path.exists("%s.index" % self.tarfile):
-            f = open("%s.index" % self.tarfile)
-            for l in f.readlines():
-                ll = l.split()
-                fname = " ".join(ll[5:len(ll)])
-                size = int(ll[2])
-                if fname == self.filename:
-                    self.size = size
-                    break
-            f.close()
-        return os.popen('tar -jxf %s -O "%s"' % (self.tarfile, self.filename))
+        (fd, self.size) = app.utils.openTarMember(self.tarfile, self.filename)
+        if not fd:
+            # Not in the archive, behave as tar would and return nothing
+            fd = StringIO.StringIO()
+        return fd
 
     def write(self, text):
         self.outfd.write(text)
@@ -1,7 +1,7 @@
 import string, re, os, json, mimetypes
 import smtplib
 import time
-import config, app.db, app.ad
+import config, app.db, app.ad, app.logarchive
 
 colours = {"pass":       ("green", None, "#90c040"),
            "fail":       ("orange", None, None),
@@ -59,25 +59,7 @@ def colour_tag(colour):
     return reply
 
 def parse_job(rc,cur):
-    d = {}
-    if rc[0]:
-        d['JOBID'] = str(rc[0])
-    if rc[1] and string.strip(rc[1]) != "":
-        d['VERSION'] = string.strip(rc[1])
-    if rc[2] and string.strip(rc[2]) != "":
-        d['REVISION'] = string.strip(rc[2])
-    if rc[3] and string.strip(rc[3]) != "":
-        d['OPTIONS'] = string.strip(rc[3])
-    if rc[4] and string.strip(rc[4]) != "":
-        d['JOBSTATUS'] = string.strip(rc[4])
-    if rc[5] and string.strip(rc[5]) != "":
-        d['USERID'] = string.strip(rc[5])
-    if rc[6] and string.strip(rc[6]) != "":
-        d['UPLOADED'] = string.strip(rc[6])
-    if rc[7] and string.strip(rc[7]) != "":
-        d['REMOVED'] = string.strip(rc[7])
-    if rc[8]:
-        d['PREEMPTABLE'] = "yes"
+    d = parse_job_row(rc)
 
     cur.execute("SELECT param, value FROM tblJobDetails WHERE " +
                 "jobid = %s;", [rc[0]])
@@ -86,9 +68,7 @@ def parse_job(rc,cur):
         rd = cur.fetchone()
         if not rd:
             break
-        if rd[0] and rd[1] and string.strip(rd[1]) != "" and \
-               string.strip(rd[1]) != "":
-            d[string.strip(rd[0])] = string.strip(rd[1])
+        add_job_detail(d, rd[0], rd[1])
     
     if d['JOBSTATUS'] == "running":
         cur.execute("SELECT COUNT(result) FROM tblresults WHERE jobid=%s AND result='paused';", [d['JOBID']])
@@ -102,6 +82,75 @@ def parse_job(rc,cur):
 
     return d
 
+def parse_job_row(rc):
+    """Build a job details dictionary from the core tbljobs fields
+    (jobid, version, revision, options, jobStatus, userId, uploaded,
+    removed, preemptable)"""
+    d = {}
+    if rc[0]:
+        d['JOBID'] = str(rc[0])
+    if rc[1] and string.strip(rc[1]) != "":
+        d['VERSION'] = string.strip(rc[1])
+    if rc[2] and string.strip(rc[2]) != "":
+        d['REVISION'] = string.strip(rc[2])
+    if rc[3] and string.strip(rc[3]) != "":
+        d['OPTIONS'] = string.strip(rc[3])
+    if rc[4] and string.strip(rc[4]) != "":
+        d['JOBSTATUS'] = string.strip(rc[4])
+    if rc[5] and string.strip(rc[5]) != "":
+        d['USERID'] = string.strip(rc[5])
+    if rc[6] and string.strip(rc[6]) != "":
+        d['UPLOADED'] = string.strip(rc[6])
+    if rc[7] and string.strip(rc[7]) != "":
+        d['REMOVED'] = string.strip(rc[7])
+    if rc[8]:
+        d['PREEMPTABLE'] = "yes"
+    return d
+
+def add_job_detail(d, param, value):
+    """Add a tblJobDetails param to a job details dictionary"""
+    if param and value and string.strip(value) != "":
+        d[string.strip(param)] = string.strip(value)
+
+def get_jobs(cur, jobids, batch=1000):
+    """Return a dictionary of job details dictionaries, as parse_job
+    would build them, keyed by jobid for the jobs in jobids. The jobs are
+    loaded with a fixed number of queries per batch of jobids rather than
+    with several queries per job."""
+    jobs = {}
+    jobids = list(jobids)
+    for i in range(0, len(jobids), batch):
+        ids = jobids[i:i+batch]
+        inlist = ", ".join(["%s"] * len(ids))
+        cur.execute("SELECT jobid, version, revision, options, jobStatus, "
+                    "userId, uploaded, removed, preemptable FROM tbljobs "
+                    "WHERE jobid IN (%s);" % (inlist), ids)
+        for rc in cur.fetchall():
+            jobs[rc[0]] = parse_job_row(rc)
+
+        cur.execute("SELECT jobid, param, value FROM tblJobDetails WHERE "
+                    "jobid IN (%s);" % (inlist), ids)
+        for rd in cur.fetchall():
+            if jobs.has_key(rd[0]):
+                add_job_detail(jobs[rd[0]], rd[1], rd[2])
+
+        running = [j for j in ids if jobs.has_key(j) and
+                   jobs[j].get('JOBSTATUS') == "running"]
+        paused = {}
+        if running:
+            cur.execute("SELECT jobid, COUNT(result) FROM tblresults WHERE "
+                        "jobid IN (%s) AND result='paused' GROUP BY jobid;" %
+                        (", ".join(["%s"] * len(running))), running)
+            for rd in cur.fetchall():
+                paused[rd[0]] = rd[1]
+        for j in ids:
+            if jobs.has_key(j):
+                if paused.get(j, 0) > 0:
+                    jobs[j]['PAUSED'] = "yes"
+                else:
+                    jobs[j]['PAUSED'] = "no"
+    return jobs
+
 def results_filename(prefix, id, mkdir=0):
     if prefix == "":
         sprefix = "job"
@@ -497,7 +546,13 @@ def isBinary(fname):
     else:
         return False
 
-def getTarIndex(tarfile, urlname):
+def getTarListing(tarfile):
+    """Return a list of (name, size) of the files in a log tarball, read
+    from its indexed archive if it has one."""
+    archive = app.logarchive.getArchive(tarfile)
+    if archive:
+        return [("./%s" % n, size) for (n, size) in archive.listing()]
+
     if os.path.exists("%s.index" % tarfile):
         indexFH = open("%s.index" % tarfile)
         createIndex = False
@@ -517,19 +572,44 @@ def getTarIndex(tarfile, urlname):
         except:
             pass
 
-    listing = {}
-
+    listing = []
     for l in index:
         ll = l.split()
         fn = " ".join(ll[5:len(ll)])
-        size = int(ll[2])
+        if not fn or fn[-1] == "/":
+            continue
+        listing.append((fn, int(ll[2])))
+    return listing
+
+def openTarMember(tarfile, name):
+    """Return a file object for member <name> of a log tarball and its size
+    (or None if unknown). The file object is None if the tarball has an
+    indexed archive which doesn't contain the member."""
+    archive = app.logarchive.getArchive(tarfile)
+    if archive:
+        return (archive.open(name), archive.size(name))
+
+    size = None
+    if os.path.exists("%s.index" % tarfile):
+        f = open("%s.index" % tarfile)
+        for l in f.readlines():
+            ll = l.split()
+            fname = " ".join(ll[5:len(ll)])
+            if fname == name:
+                size = int(ll[2])
+                break
+        f.close()
+    return (os.popen('tar -jxf %s -O "%s"' % (tarfile, name)), size)
+
+def getTarIndex(tarfile, urlname):
+    listing = {}
+
+    for (fn, size) in getTarListing(tarfile):
         if fn[0:2] == "./":
             fn = fn[2:]
 
         if not fn:
             continue
-        if fn[-1] == "/":
-            continue
         
         listing[fn] = {
             "name": fn,
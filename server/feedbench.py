@@ -0,0 +1,128 @@
+#!/usr/bin/python
+#
+# Load test of steady state job polling against a running server and its
+# (local) PostgreSQL database: a number of clients each watch the same jobs
+# for a while, by fetching each job every interval (as FileManager and the
+# CLI do), by revalidating each job with its ETag, or by following the job
+# change feed with long polls. A writer updates one of the jobs now and then
+# so there is something to notice.
+#
+# Usage: feedbench.py [options] server jobid [jobid...]
+#
+# The bindings are fetched from --bindings if given, otherwise the installed
+# xenrtapi module is used (see apibench.py). With --dsn the database's
+# statement and row counts are read from pg_stat_database before and after.
+
+import optparse, threading, time
+from apibench import loadBindings
+
+class Counter(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.bytes = 0
+        self.seen = 0
+        self.updates = 0
+
+    def add(self, response, seen=0):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.bytes += len(response.content)
+            self.seen += seen
+        finally:
+            self.lock.release()
+
+def pollClient(client, jobids, interval, until, counter):
+    # A fresh GET of every job, every interval
+    while time.time() < until:
+        for j in jobids:
+            r = client.session.get("%s/job/%d" % (client.base, j), headers=client.customHeaders)
+            r.raise_for_status()
+            counter.add(r, 1)
+        time.sleep(interval)
+
+def etagClient(client, jobids, interval, until, counter):
+    tags = {}
+    while time.time() < until:
+        for j in jobids:
+            headers = dict(client.customHeaders)
+            if j in tags:
+                headers['If-None-Match'] = tags[j]
+            r = client.session.get("%s/job/%d" % (client.base, j), headers=headers)
+            r.raise_for_status()
+            tags[j] = r.headers.get("ETag")
+            counter.add(r, r.status_code == 200)
+        time.sleep(interval)
+
+def feedClient(client, jobids, interval, until, counter):
+    path = "%s/jobs/changes" % client.base
+    params = {"jobid": ",".join([str(j) for j in jobids]), "params": "true", "results": "true"}
+    r = client.session.get(path, params=params, headers=client.customHeaders)
+    r.raise_for_status()
+    cursor = r.json()['cursor']
+    while time.time() < until:
+        params['cursor'] = cursor
+        params['wait'] = str(max(1, min(60, int(until - time.time()))))
+        r = client.session.get(path, params=params, headers=client.customHeaders)
+        r.raise_for_status()
+        reply = r.json()
+        counter.add(r, len(reply['jobs']))
+        cursor = reply['cursor']
+
+def writer(client, jobid, period, until, counter):
+    n = 0
+    while time.time() + period < until:
+        time.sleep(period)
+        n += 1
+        client.update_job(jobid, params={"FEEDBENCH": str(n)})
+        counter.updates = n
+
+def dbStats(dsn):
+    import psycopg2
+    conn = psycopg2.connect(dsn)
+    try:
+        cur = conn.cursor()
+        cur.execute("SELECT xact_commit + xact_rollback, tup_returned, tup_fetched FROM pg_stat_database WHERE datname = current_database()")
+        return cur.fetchone()
+    finally:
+        conn.close()
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser(usage="%prog [options] server jobid [jobid...]")
+    parser.add_option("--bindings", dest="bindings", help="URL to fetch the bindings from")
+    parser.add_option("--apikey", dest="apikey")
+    parser.add_option("--dsn", dest="dsn", help="libpq connection string for the server's database")
+    parser.add_option("--clients", dest="clients", type="int", default=20)
+    parser.add_option("--duration", dest="duration", type="int", default=60)
+    parser.add_option("--interval", dest="interval", type="float", default=5,
+                      help="seconds between polls of each job")
+    parser.add_option("--update", dest="update", type="float", default=20,
+                      help="seconds between updates to the first job")
+    parser.add_option("--modes", dest="modes", default="poll,etag,feed")
+    (options, args) = parser.parse_args()
+    if len(args) < 2:
+        parser.error("server and at least one job are required")
+
+    xenrtapi = loadBindings(options.bindings)
+    jobids = [int(j) for j in args[1:]]
+    modes = {"poll": pollClient, "etag": etagClient, "feed": feedClient}
+    for mode in options.modes.split(","):
+        client = xenrtapi.XenRT(apikey=options.apikey, server=args[0])
+        counter = Counter()
+        until = time.time() + options.duration
+        threads = [threading.Thread(target=modes[mode], args=(client, jobids, options.interval, until, counter))
+                   for i in range(options.clients)]
+        threads.append(threading.Thread(target=writer, args=(client, jobids[0], options.update, until, counter)))
+        if options.dsn:
+            before = dbStats(options.dsn)
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        print "%-4s: %d requests, %.1fKiB, %d job fetches for %d updates" % (
+            mode, counter.requests, counter.bytes / 1024.0, counter.seen, counter.updates)
+        if options.dsn:
+            after = dbStats(options.dsn)
+            print "      database: %d transactions, %d rows scanned, %d rows fetched" % tuple(
+                [a - b for (a, b) in zip(after, before)])
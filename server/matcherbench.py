@@ -0,0 +1,91 @@
+#!/usr/bin/python
+#
+# Synthetic benchmark of scheduler machine matching: compares checking each
+# idle machine against each job (as scm_select_machines used to) with the
+# per-pass MachineIndex.
+#
+# Usage: matcherbench.py [machines] [jobs]
+
+import sys, random, string, time
+import app.utils
+import app.matcher
+
+FLAGS = ["vmx", "svm", "sriov", "nfs", "iscsi", "fc", "+restricted",
+         "shortonly", "-nfs", "gpu", "ipv6", "bigmem"]
+POOLS = ["DEFAULT", "DEFAULT", "DEFAULT", "VMX", "PERF"]
+
+def makeMachines(n, rand):
+    machines = {}
+    props = {}
+    for i in range(n):
+        name = "machine%05d" % i
+        flags = string.join(rand.sample(FLAGS, rand.randint(1, 4)), ",")
+        resources = "memory=%dG/cores=%d/disk=%dG" % (rand.choice([8, 16, 32, 64, 128]),
+                                                      rand.choice([2, 4, 8, 16, 32]),
+                                                      rand.choice([100, 500, 1000]))
+        machines[name] = [name, "site%d" % (i % 4), "cluster%d" % (i % 40),
+                          rand.choice(POOLS), "idle", resources, flags,
+                          "", "", "", "", "", "", "3"]
+        props[name] = flags
+    return (machines, props)
+
+def makeJobs(n, rand):
+    jobs = []
+    for i in range(n):
+        flags = string.join(rand.sample(["vmx", "svm", "nfs", "iscsi", "!gpu", "~restricted"],
+                                        rand.randint(0, 2)), ",") or None
+        resreq = rand.choice([None, "memory>=16G", "memory>=32G/cores>=8", "disk>500G"])
+        pool = rand.choice([["DEFAULT"], ["DEFAULT"], ["VMX"], ["ANY"]])
+        jobs.append((pool, None, resreq, flags, rand.choice([True, False])))
+    return jobs
+
+def oldMatch(machines, props, siteprops, job):
+    (jobpool, clusterreq, resreq, flags, shortjob) = job
+    found = set()
+    for m in machines.values():
+        p = props[m[0]]
+        if siteprops.get(m[1]):
+            p = string.join([p, siteprops[m[1]]], ",")
+        subpool = m[3] or "DEFAULT"
+        if not subpool in jobpool and not "ANY" in jobpool:
+            continue
+        if clusterreq and m[2] not in clusterreq:
+            continue
+        if resreq and (m[5] == "" or not app.utils.check_resources(m[5], resreq)):
+            continue
+        if not app.utils.check_attributes(p, flags):
+            continue
+        if "shortonly" in string.split(p, ",") and not shortjob:
+            continue
+        found.add(m[0])
+    return found
+
+def main(nmachines, njobs):
+    rand = random.Random(1)
+    (machines, props) = makeMachines(nmachines, rand)
+    siteprops = {"site0": "ipv6", "site1": None, "site2": None, "site3": "bigmem"}
+    jobs = makeJobs(njobs, rand)
+
+    start = time.time()
+    old = [oldMatch(machines, props, siteprops, j) for j in jobs]
+    oldtime = time.time() - start
+
+    start = time.time()
+    index = app.matcher.MachineIndex(machines, props, siteprops)
+    buildtime = time.time() - start
+    new = [index.candidates(*j) for j in jobs]
+    newtime = time.time() - start
+
+    if old != new:
+        print "ERROR: matcher results differ from per-machine checks"
+        sys.exit(1)
+    print "%d machines, %d jobs" % (nmachines, njobs)
+    print "Per-machine checks: %.3fs" % (oldtime)
+    print "Indexed matcher:    %.3fs (index build %.3fs, %d of %d queries cached)" % \
+          (newtime, buildtime, index.stats["hits"], index.stats["queries"])
+    print "Speed-up:           %.1fx" % (oldtime / max(newtime, 0.000001))
+
+if __name__ == "__main__":
+    nmachines = len(sys.argv) > 1 and int(sys.argv[1]) or 2000
+    njobs = len(sys.argv) > 2 and int(sys.argv[2]) or 500
+    main(nmachines, njobs)
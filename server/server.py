@@ -55,6 +55,9 @@ class Server(object):
             return None
 
 class PageFactory(object):
+    # JSON responses at least this big are compressed for clients that accept gzip
+    GZIP_MIN_SIZE = 1024
+
     def __init__(self, page, location, renderer="string", contentType=None, compatAction=None, reqType=None):
         self.server = ServerInstance()
         self.server.addPage(location, self, renderer, reqType)
@@ -92,6 +95,14 @@ class PageFactory(object):
             ret += "\n"
         if self.json and ret and not isinstance(ret, basestring) and not isinstance(ret, HTTPException):
             ret = json.dumps(ret, indent=2, sort_keys=True, encoding="latin-1")
+        if self.json and ret and isinstance(ret, basestring) and len(ret) >= self.GZIP_MIN_SIZE and \
+                "gzip" in request.headers.get("Accept-Encoding", ""):
+            if isinstance(ret, unicode):
+                ret = ret.encode(request.response.charset or "utf-8")
+            request.response.body = ret
+            request.response.encode_content("gzip")
+            request.response.vary = ("Accept-Encoding",)
+            ret = request.response
         page = None
         gc.collect()
         return ret
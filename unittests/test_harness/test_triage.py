@@ -0,0 +1,79 @@
+import os, re, random, shutil, tempfile
+from mock import patch
+from testing import XenRTUnitTestCase
+import xenrt
+import xenrt.triage
+
+def pcregrep(text, pattern):
+    """Reference behaviour of pcregrep -M over the whole file: print the
+    lines spanned by each match, carrying on from the line after it"""
+    out = ""
+    regex = re.compile(pattern)
+    pos = 0
+    while pos < len(text):
+        m = regex.search(text, pos)
+        if not m:
+            break
+        first = text.rfind("\n", 0, m.start()) + 1
+        end = text.find("\n", max(m.end() - 1, m.start()))
+        if end < 0:
+            out += text[first:] + "\n"
+            break
+        out += text[first:end + 1]
+        pos = end + 1
+    return out
+
+class _SmallBlockTriage(xenrt.triage.LogTriage):
+    # Small blocks so that matches cross buffer boundaries
+    BLOCK = 512
+
+class TestLogTriage(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.logdir = tempfile.mkdtemp()
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start().return_value.getLogdir.return_value = self.logdir
+        rand = random.Random(7)
+        filler = ["[  %d.000000] usb 1-1: new device" % i for i in range(50)] + \
+                 ["some other line", "", "[INFO] Step complete"]
+        blocks = [["[  1.0] ------------[ cut here ]------------",
+                   "[  1.1] WARNING: at foo.c:12",
+                   "[  1.2] Call Trace:",
+                   "[  1.3]  [<ffffffff>] bar+0x10",
+                   "[  1.4] ---[ end trace 1234 ]---"],
+                  ["[  2.0] kernel BUG at mm/slab.c:100!",
+                   "[  2.1] invalid opcode: 0000"],
+                  ["INFO: task xapi:123 blocked for more than 120 seconds."]]
+        self.texts = {}
+        for fn in ("host-serial-log-h1", "host-serial-log-h2"):
+            lines = []
+            for i in range(400):
+                if rand.random() < 0.03:
+                    lines.extend(rand.choice(blocks))
+                else:
+                    lines.append(rand.choice(filler))
+            self.texts[fn] = "\n".join(lines) + "\n"
+            f = open(os.path.join(self.logdir, fn), "w")
+            f.write(self.texts[fn])
+            f.close()
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+        shutil.rmtree(self.logdir)
+
+    def test_same_lines_as_pcregrep(self):
+        """Each pattern matches the same lines as a whole file search"""
+        triage = _SmallBlockTriage()
+        patterns = [fp for fp in xenrt.triage.FAILURE_PATTERNS if fp['file'] == "host-serial-log-*"]
+        for (fn, text) in self.texts.items():
+            found = triage.searchFile(os.path.join(self.logdir, fn), patterns)
+            for (fp, f) in zip(patterns, found):
+                self.assertEqual(pcregrep(text, fp['pattern']), f, "%s differs in %s" % (fp['desc'], fn))
+
+    def test_each_file_read_once(self):
+        """run reads each log file once, whatever the number of patterns"""
+        triage = xenrt.triage.LogTriage()
+        desc = triage.run()
+        self.assertEqual(2, triage.stats["files"])
+        self.assertEqual(sum([len(t) for t in self.texts.values()]), triage.stats["bytes"])
+        self.assertTrue("Found 'cut here' in 'host-serial-log-h1':- \n{noformat}\n" in desc)
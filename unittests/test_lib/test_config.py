@@ -0,0 +1,127 @@
+import glob, os
+from mock import patch, Mock
+from testing import XenRTUnitTestCase
+import xenrt
+
+TOP = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "..")
+
+def loadConfig():
+    config = xenrt.Config()
+    for cf in glob.glob(os.path.join(TOP, "data", "config", "*.json")):
+        config.readFromJSONFile(cf)
+    config.doPostLoadProcessing()
+    for cf in ["site.xml.development", "machine.xml.development"]:
+        config.readFromFile(os.path.join(TOP, "examples", cf))
+    config.setVariable("FIXTURE_BASE", "/base")
+    config.setVariable("FIXTURE_PATH", "${FIXTURE_BASE}/path")
+    config.setVariable(["FIXTURE", "NESTED"], "${FIXTURE_PATH}/nested")
+    config.setVariable("FIXTURE_ENABLED", "${FIXTURE_FLAG}")
+    config.setVariable("FIXTURE_FLAG", "yes")
+    return config
+
+def stringPaths(d, prefix=[]):
+    for k, v in d.items():
+        if type(k) != type(""):
+            continue
+        if type(v) == type(""):
+            yield prefix + [k]
+        elif type(v) == type({}):
+            for p in stringPaths(v, prefix + [k]):
+                yield p
+
+class TestCompiledConfig(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.myThreadPatcher = patch("xenrt.myThread")
+        self.myThread = self.myThreadPatcher.start()
+        self.myThread.return_value = None
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+        self.plain = loadConfig()
+        self.frozen = loadConfig()
+        self.frozen.freeze()
+
+    def tearDown(self):
+        self.myThreadPatcher.stop()
+        self.tecPatcher.stop()
+        if hasattr(self, "threadVariablesPatcher"):
+            self.threadVariablesPatcher.stop()
+
+    def __outcome(self, config, var, boolean):
+        try:
+            return config.lookup(var, None, boolean=boolean)
+        except Exception, e:
+            return e.__class__
+
+    def test_identicalResults(self):
+        """Every variable in the config fixtures looks up the same, twice, with the snapshot"""
+        paths = list(stringPaths(self.plain.config))
+        self.assertTrue(len(paths) > 100)
+        for p in paths:
+            for var in [p, ":".join(p)]:
+                for boolean in [False, True]:
+                    expected = self.__outcome(self.plain, var, boolean)
+                    self.assertEqual(expected, self.__outcome(self.frozen, var, boolean))
+                    self.assertEqual(expected, self.__outcome(self.frozen, var, boolean))
+        for var in ["FIXTURE", ["FIXTURE"], "GUEST_TESTS", "NOT_DEFINED", ["NOT", "DEFINED"]]:
+            self.assertEqual(self.plain.lookup(var, None), self.frozen.lookup(var, None))
+
+    def test_invalidation(self):
+        """Setting a variable changes everything that references it"""
+        self.assertEqual("/base/path/nested", self.frozen.lookup("FIXTURE:NESTED"))
+        self.assertTrue(self.frozen.lookup("FIXTURE_ENABLED", boolean=True))
+        self.frozen.setVariable("FIXTURE_BASE", "/other")
+        self.frozen.setVariable("FIXTURE_FLAG", "no")
+        self.assertEqual("/other/path/nested", self.frozen.lookup(["FIXTURE", "NESTED"]))
+        self.assertEqual("/other/path", self.frozen.lookup("FIXTURE_PATH"))
+        self.assertFalse(self.frozen.lookup("FIXTURE_ENABLED", boolean=True))
+        self.frozen.setVariable("FIXTURE", "flat")
+        self.assertEqual("flat", self.frozen.lookup("FIXTURE"))
+
+    def test_threadLocal(self):
+        """Thread local variables still override the snapshot"""
+        self.assertEqual("/base/path", self.frozen.lookup("FIXTURE_PATH"))
+        thread = Mock()
+        thread._config = {"FIXTURE_BASE": "/thread", "FIXTURE_PATH": "/thread/path"}
+        thread.lookup.side_effect = thread._config.get
+        self.myThread.return_value = thread
+        self.threadVariablesPatcher = patch("xenrt.config._threadVariables", 2)
+        self.threadVariablesPatcher.start()
+        self.assertEqual("/thread/path", self.frozen.lookup("FIXTURE_PATH"))
+        self.assertEqual("/thread/path/nested", self.frozen.lookup("FIXTURE:NESTED"))
+        self.myThread.return_value = None
+        self.assertEqual("/base/path/nested", self.frozen.lookup("FIXTURE:NESTED"))
+
+class TestNetworkDiscovery(XenRTUnitTestCase):
+
+    IP = {"/sbin/ip addr show dev eth0": "inet 10.1.2.3/22 brd 10.1.3.255 scope global eth0",
+          "/sbin/ip route show": "default via 10.1.0.1 dev eth0"}
+
+    def setUp(self):
+        self.popenPatcher = patch("os.popen")
+        self.popen = self.popenPatcher.start()
+        self.popen.side_effect = lambda cmd: Mock(read=Mock(return_value=self.IP.get(cmd, "")))
+
+    def tearDown(self):
+        self.popenPatcher.stop()
+
+    def test_deferred(self):
+        """/sbin/ip is only run once a discovered variable is needed"""
+        config = xenrt.Config()
+        config.setVariable("NTP_SERVERS", "ntp")
+        self.assertEqual("ntp", config.lookup("NTP_SERVERS"))
+        self.assertFalse(self.popen.called)
+        config.setVariable("XENRT_BASE", "/base")
+        self.assertEqual("10.1.2.3:/base/images/iso", config.lookup("EXPORT_ISO_NFS"))
+        self.assertEqual({"SUBNET": "10.1.0.0", "SUBNETMASK": "255.255.252.0", "GATEWAY": "10.1.0.1",
+                          "POOLSTART": "TODO", "POOLEND": "TODO"},
+                         config.lookup(["NETWORK_CONFIG", "DEFAULT"]))
+        self.assertEqual(2, self.popen.call_count)
+
+    def test_configWins(self):
+        """Configured values aren't replaced by discovered ones"""
+        config = xenrt.Config()
+        config.setVariable(["NETWORK_CONFIG", "DEFAULT", "GATEWAY"], "10.1.0.254")
+        self.assertEqual("10.1.0.254", config.lookup("NETWORK_CONFIG:DEFAULT:GATEWAY"))
+        self.assertEqual("10.1.0.0", config.lookup("NETWORK_CONFIG:DEFAULT:SUBNET"))
+        self.assertEqual("10.1.2.3", config.lookup("XENRT_SERVER_ADDRESS"))
@@ -0,0 +1,101 @@
+import socket, threading, xmlrpclib
+from SimpleXMLRPCServer import SimpleXMLRPCServer, SimpleXMLRPCRequestHandler
+import xenrt
+import xenrt.daemonexec
+from testing import XenRTUnitTestCase
+from mock import patch, Mock
+
+
+class _QuietHandler(SimpleXMLRPCRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+
+class TestWaitForResult(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+        self.sleepPatcher = patch("xenrt.sleep")
+        self.sleep = self.sleepPatcher.start()
+        self.now = [1000]
+        self.timePatcher = patch("xenrt.util.timenow")
+        timenow = self.timePatcher.start()
+        timenow.side_effect = lambda: self.now[0]
+        self.server = Mock()
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+        self.sleepPatcher.stop()
+        self.timePatcher.stop()
+
+    def testVersion(self):
+        """The daemon version is parsed from its version string"""
+        self.server.version.return_value = "Execution daemon v0.9.5.\n"
+        v = xenrt.daemonexec.daemonVersion(self.server)
+        self.assertEqual((0, 9, 5), v)
+        self.assertTrue(xenrt.daemonexec.supportsWait(v))
+        self.assertFalse(xenrt.daemonexec.supportsWait((0, 9, 4)))
+
+    def testLongPoll(self):
+        """A long poll gets the result as soon as the command is done, in one call"""
+        self.server.wait.side_effect = ["RUNNING", "DONE"]
+        self.server.result.return_value = {"status": "DONE", "returncode": 3, "log": "output"}
+        res = xenrt.daemonexec.waitForResult(self.server, "0001", 1000, 300, True)
+        self.assertEqual((3, "output"), res)
+        self.server.wait.assert_called_with("0001", 30)
+        self.server.result.assert_called_once_with("0001", True, True)
+        self.assertFalse(self.sleep.called)
+        self.assertFalse(self.server.poll.called)
+
+    def testLongPollTimeout(self):
+        """A long poll doesn't block beyond the timeout"""
+        def wait(ref, t):
+            self.now[0] += t
+            return "RUNNING"
+        self.server.wait.side_effect = wait
+        res = xenrt.daemonexec.waitForResult(self.server, "0001", 1000, 45, True)
+        self.assertEqual(None, res)
+        self.assertEqual([("0001", 30), ("0001", 15)],
+                         [c[0] for c in self.server.wait.call_args_list])
+
+    def testLegacy(self):
+        """An old daemon is polled with backoff and then asked for the result"""
+        self.server.poll.side_effect = ["RUNNING", socket.error(), "RUNNING", "DONE"]
+        self.server.log.return_value = "output"
+        self.server.returncode.return_value = 0
+        res = xenrt.daemonexec.waitForResult(self.server, "0001", 1000, 300, False)
+        self.assertEqual((0, "output"), res)
+        self.assertEqual([1, 2, 4, 8], [c[0][0] for c in self.sleep.call_args_list])
+        self.server.cleanup.assert_called_once_with("0001")
+
+
+class TestMultiCall(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.daemon = SimpleXMLRPCServer(("127.0.0.1", 0), requestHandler=_QuietHandler)
+        self.daemon.register_function(lambda f: f.startswith("c:"), "fileExists")
+        self.daemon.register_multicall_functions()
+        self.requests = []
+        handle = self.daemon._marshaled_dispatch
+        def counted(*args, **kwargs):
+            self.requests.append(args[0])
+            return handle(*args, **kwargs)
+        self.daemon._marshaled_dispatch = counted
+        self.thread = threading.Thread(target=self.daemon.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.proxy = xmlrpclib.ServerProxy("http://127.0.0.1:%d" % self.daemon.server_address[1])
+
+    def tearDown(self):
+        self.daemon.shutdown()
+        self.daemon.server_close()
+
+    def testBatched(self):
+        """Calls are made in one request with the same results"""
+        calls = [("fileExists", ("c:\\a",)), ("fileExists", ("d:\\b",)), ("fileExists", ("c:\\c",))]
+        self.assertEqual([True, False, True], xenrt.daemonexec.multiCall(self.proxy, calls, True))
+        self.assertEqual(1, len(self.requests))
+        self.assertEqual([True, False, True], xenrt.daemonexec.multiCall(self.proxy, calls, False))
+        self.assertEqual(4, len(self.requests))
@@ -0,0 +1,115 @@
+import hashlib, os, shutil, StringIO, tempfile, xmlrpclib, zlib
+import xenrt
+import xenrt.daemonfile
+from testing import XenRTUnitTestCase
+from mock import patch
+
+
+class _FakeDaemon(object):
+    """Keeps files in memory, with the execdaemon's chunked transfer calls"""
+
+    def __init__(self, supported=True):
+        self.files = {}
+        self.supported = supported
+        self.calls = 0
+        self.corrupt = False
+
+    def __check(self, name):
+        self.calls += 1
+        if not self.supported:
+            raise xmlrpclib.Fault(1, "<type 'exceptions.Exception'>:method \"%s\" is not supported" % name)
+
+    def appendFile(self, filename, offset, data, compressed=False):
+        self.__check("appendFile")
+        data = data.data
+        if compressed:
+            data = zlib.decompress(data)
+        offset = long(offset)
+        if offset == 0:
+            self.files[filename] = ""
+        self.assertEqual(offset, len(self.files[filename]))
+        self.files[filename] += data
+        return str(len(self.files[filename]))
+
+    def readFileAt(self, filename, offset, length, compress=False):
+        self.__check("readFileAt")
+        data = self.files[filename][long(offset):long(offset) + length]
+        if compress:
+            z = zlib.compress(data, 1)
+            if len(z) < len(data):
+                return [True, xmlrpclib.Binary(z)]
+        return [False, xmlrpclib.Binary(data)]
+
+    def fileChecksum(self, filename, length=None):
+        data = self.files[filename]
+        if length is not None:
+            data = data[:long(length)]
+        if self.corrupt:
+            data += "x"
+        return hashlib.sha1(data).hexdigest()
+
+    def assertEqual(self, a, b):
+        if a != b:
+            raise Exception("%s != %s" % (a, b))
+
+
+class TestDaemonFile(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.config = {"XMLRPC_CHUNK_SIZE": "1000", "XMLRPC_COMPRESS": True}
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        tec.return_value.lookup.side_effect = \
+            lambda var, default=None, boolean=False: self.config.get(var, default)
+        self.dir = tempfile.mkdtemp()
+        self.local = os.path.join(self.dir, "file")
+        self.data = "".join([chr(i % 251) for i in range(4500)]) + "a" * 3000
+        f = open(self.local, "wb")
+        f.write(self.data)
+        f.close()
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+        shutil.rmtree(self.dir)
+
+    def testRoundTrip(self):
+        """A file is sent and read back in chunks"""
+        daemon = _FakeDaemon()
+        self.assertTrue(xenrt.daemonfile.sendFile(daemon, self.local, "c:\\file"))
+        self.assertEqual(self.data, daemon.files["c:\\file"])
+        self.assertEqual(8, daemon.calls)
+        fh = StringIO.StringIO()
+        self.assertTrue(xenrt.daemonfile.readFile(daemon, "c:\\file", fh))
+        self.assertEqual(self.data, fh.getvalue())
+
+    def testUncompressed(self):
+        """Files are transferred intact with compression turned off"""
+        self.config["XMLRPC_COMPRESS"] = False
+        daemon = _FakeDaemon()
+        self.assertTrue(xenrt.daemonfile.sendFile(daemon, self.local, "c:\\file"))
+        fh = StringIO.StringIO()
+        self.assertTrue(xenrt.daemonfile.readFile(daemon, "c:\\file", fh))
+        self.assertEqual(self.data, fh.getvalue())
+
+    def testEmptyFile(self):
+        """An empty file is created on the daemon"""
+        open(self.local, "wb").close()
+        daemon = _FakeDaemon()
+        self.assertTrue(xenrt.daemonfile.sendFile(daemon, self.local, "c:\\file"))
+        self.assertEqual("", daemon.files["c:\\file"])
+
+    def testChecksumMismatch(self):
+        """A file that doesn't match its checksum raises an error"""
+        daemon = _FakeDaemon()
+        daemon.corrupt = True
+        self.assertRaises(xenrt.XRTError, xenrt.daemonfile.sendFile, daemon, self.local, "c:\\file")
+        fh = StringIO.StringIO()
+        self.assertRaises(xenrt.XRTError, xenrt.daemonfile.readFile, daemon, "c:\\file", fh)
+
+    def testUnsupported(self):
+        """An old daemon is reported so the caller can fall back"""
+        daemon = _FakeDaemon(supported=False)
+        self.assertFalse(xenrt.daemonfile.sendFile(daemon, self.local, "c:\\file"))
+        fh = StringIO.StringIO()
+        self.assertFalse(xenrt.daemonfile.readFile(daemon, "c:\\file", fh))
+        self.assertEqual("", fh.getvalue())
@@ -0,0 +1,68 @@
+import os, shutil, tempfile
+from xenrt.dbconnect import DBConnect
+from testing import XenRTUnitTestCase
+from mock import patch, Mock
+
+
+class TestDBConnectReporting(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.bufferdir = tempfile.mkdtemp()
+        self.config = {"DB_BUFFER_DIR": self.bufferdir,
+                       "DB_REPORT_INTERVAL": "5"}
+        self.gecPatcher = patch("xenrt.GEC")
+        gec = self.gecPatcher.start()
+        gec.return_value.config.lookup.side_effect = \
+            lambda var, default=None, boolean=False: self.config.get(var, default)
+        gec.return_value.anontec.tempFile.side_effect = \
+            lambda: tempfile.mkstemp(dir=self.bufferdir)[1]
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+        self.commandPatcher = patch("xenrt.util.command")
+        self.command = self.commandPatcher.start()
+        self.db = DBConnect(12)
+        self.db._api = Mock()
+
+    def tearDown(self):
+        self.db.close()
+        self.gecPatcher.stop()
+        self.tecPatcher.stop()
+        self.commandPatcher.stop()
+        shutil.rmtree(self.bufferdir)
+
+    def testBatched(self):
+        """Results, log data and job updates are sent in one batch"""
+        self.db.jobSetResult("Phase", "TC1", "pass")
+        self.db.jobLogData("Phase", "TC1", "comment", "hello")
+        self.db.jobUpdate("FIELD", "a")
+        self.db.jobUpdate("FIELD", "b")
+        self.assertTrue(self.db.flush(10))
+        self.db._api.update_job.assert_called_once_with(12, params={"FIELD": "b"})
+        self.db._api.bulk_results.assert_called_once_with(12, [
+            {"phase": "Phase", "test": "TC1", "result": "pass"},
+            {"phase": "Phase", "test": "TC1", "key": "comment", "value": "hello"}])
+        self.assertFalse(self.command.called)
+
+    def testOrderKept(self):
+        """Commands that can't be batched are run in order with the batches"""
+        calls = []
+        self.db._api.bulk_results.side_effect = lambda *args: calls.append("bulk")
+        self.command.side_effect = lambda c: calls.append(c.split()[1])
+        self.db.jobSetResult("Phase", "TC1", "pass")
+        self.db.jobUpload(__file__)
+        self.db.jobSetResult("Phase", "TC2", "fail")
+        self.db.jobComplete()
+        self.assertEqual(["bulk", "upload", "bulk", "complete"], calls)
+
+    def testBufferedWhenUnreachable(self):
+        """Batches that can't be sent are buffered for replay"""
+        self.db._api.bulk_results.side_effect = Exception("Connection refused")
+        self.db.jobUpdate("FIELD", "a")
+        self.db.jobSetResult("Phase", "TC1", "pass")
+        self.assertTrue(self.db.flush(10))
+        lines = open(os.path.join(self.bufferdir, "bufferedcommands")).read().splitlines()
+        # The job update went through, so only the result is buffered
+        self.assertEqual(["COMMAND\tsetresult\t12\tPhase\tTC1\tpass"], lines)
+
+        self.db.replay()
+        self.command.assert_called_once_with("xenrtnew setresult 12 Phase TC1 pass")
@@ -0,0 +1,129 @@
+import threading, time
+import xenrt
+from xenrt.executor import Executor
+from testing import XenRTUnitTestCase
+from mock import patch
+
+
+class TestExecutor(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: default
+        self.lock = threading.Lock()
+        self.running = {}
+        self.peak = {}
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+
+    def __op(self, target, delay=0.05):
+        self.lock.acquire()
+        self.running[target] = self.running.get(target, 0) + 1
+        self.peak[target] = max(self.peak.get(target, 0), self.running[target])
+        total = sum(self.running.values())
+        self.peak["total"] = max(self.peak.get("total", 0), total)
+        self.lock.release()
+        time.sleep(delay)
+        self.lock.acquire()
+        self.running[target] -= 1
+        self.lock.release()
+        return target
+
+    def testConcurrencyLimits(self):
+        """No more than maxWorkers calls, or maxPerTarget calls per target, run at once"""
+        ex = Executor(maxWorkers=4, maxPerTarget=2)
+        futures = ex.map(self.__op, ["h1"] * 6 + ["h2"] * 6, target=lambda t: t)
+        ex.shutdown()
+        self.assertEqual(["h1"] * 6 + ["h2"] * 6, [f.result() for f in futures])
+        self.assertEqual(2, self.peak["h1"])
+        self.assertEqual(2, self.peak["h2"])
+        self.assertTrue(self.peak["total"] <= 4)
+        self.assertTrue(len(ex.workers) == 0)
+
+    def testCancelAndTimeout(self):
+        """Queued calls can be cancelled and result() times out"""
+        ex = Executor(maxWorkers=1)
+        first = ex.submit(self.__op, "h1", 0.3)
+        second = ex.submit(self.__op, "h1")
+        self.assertTrue(second.cancel())
+        self.assertRaises(xenrt.XRTError, first.result, 0.01)
+        self.assertEqual("h1", first.result(5))
+        self.assertFalse(first.cancel())
+        ex.shutdown()
+        self.assertTrue(second.cancelled())
+        self.assertRaises(xenrt.XRTError, second.result)
+
+    def testExceptionsPropagate(self):
+        """An exception raised by a call is raised by result()"""
+        def fail():
+            raise ValueError("bad")
+        ex = Executor(maxWorkers=2)
+        f = ex.submit(fail)
+        ex.shutdown()
+        self.assertRaises(ValueError, f.result)
+        self.assertTrue(isinstance(f.exception(), ValueError))
+
+    def testThreadLocalVariables(self):
+        """Calls see the thread local variables of the submitting thread"""
+        seen = []
+        def submitter():
+            xenrt.myThread().setVariable("VAR", "value")
+            ex = Executor(maxWorkers=2)
+            f = ex.submit(lambda: xenrt.myThread().lookup("VAR"))
+            seen.append(f.result(5))
+            ex.shutdown()
+        t = xenrt.PTask(submitter)
+        t.start()
+        t.join()
+        self.assertEqual(["value"], seen)
+
+
+class TestPfarm(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: default
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+
+    def testOrderedResults(self):
+        """pmap returns results in argument order with a bounded pool"""
+        def slow(x):
+            time.sleep(0.01 * (10 - x))
+            return x * 2
+        self.assertEqual([x * 2 for x in range(10)], xenrt.pmap(slow, range(10), workers=3))
+
+    def testUnboundedByDefault(self):
+        """pfarm runs every task at once unless workers is given"""
+        running = []
+        release = threading.Event()
+        def wait():
+            running.append(1)
+            release.wait(5)
+        tasks = xenrt.pfarm([wait] * 40, wait=False)
+        deadline = time.time() + 5
+        while len(running) < 40 and time.time() < deadline:
+            time.sleep(0.01)
+        started = len(running)
+        release.set()
+        for t in tasks:
+            t.join()
+        self.assertEqual(40, started)
+
+    def testNoWait(self):
+        """pfarm(wait=False) returns tasks that can be joined"""
+        tasks = xenrt.pfarm([lambda: time.sleep(0.05)], wait=False)
+        tasks[0].join()
+        self.assertFalse(tasks[0].isAlive())
+
+    def testTimeout(self):
+        """Tasks not finished within the timeout get an XRTError"""
+        def slow():
+            time.sleep(0.5)
+        result = xenrt.pfarm([slow, slow], workers=1, timeout=0.1, exception=False)
+        self.assertTrue(isinstance(result[0], xenrt.XRTError))
+        self.assertTrue(isinstance(result[1], xenrt.XRTError))
@@ -0,0 +1,119 @@
+import os, shutil, tempfile, threading, time
+from xenrt.filecache import CacheStore
+from testing import XenRTUnitTestCase
+from mock import patch
+
+
+class TestCacheStore(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+        self.dir = tempfile.mkdtemp()
+        self.store = CacheStore(os.path.join(self.dir, "cache"), budget="3000")
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+        shutil.rmtree(self.dir)
+
+    def __add(self, key, data, validators=None, age=0):
+        path = self.store.partialPath(key, "file")
+        f = open(path, "w")
+        f.write(data)
+        f.close()
+        blob = self.store.add(key, path, validators)
+        if age:
+            os.utime(blob, (time.time() - age, time.time() - age))
+        return blob
+
+    def testDeduplicated(self):
+        """The same content under two keys is stored once"""
+        a = self.__add("http://a/file.iso", "x" * 1000)
+        b = self.__add("http://b/copy.iso", "x" * 1000)
+        self.assertEqual(a, b)
+        self.assertEqual(a, self.store.lookup("http://b/copy.iso"))
+        summary = self.store.getSummary()
+        self.assertEqual(1, summary["files"])
+        self.assertEqual(1, summary["deduplicated"])
+        self.assertEqual(1, summary["hits"])
+        # Removing one key leaves the blob for the other
+        self.store.remove("http://a/file.iso")
+        self.assertEqual(None, self.store.lookup("http://a/file.iso"))
+        self.assertTrue(os.path.exists(b))
+
+    def testLRUEviction(self):
+        """Least recently used blobs are evicted first, but never ones in use"""
+        old = self.__add("old", "a" * 1000, age=300)
+        inuse = self.__add("inuse", "b" * 1000, age=200)
+        used = self.__add("used", "c" * 1000, age=100)
+        os.link(inuse, os.path.join(self.dir, "view"))
+        self.store.lookup("used")
+        self.__add("new", "d" * 1000)
+        self.assertFalse(os.path.exists(old))
+        self.assertTrue(os.path.exists(inuse))
+        self.assertTrue(os.path.exists(used))
+        self.assertEqual(None, self.store.lookup("old"))
+        self.assertEqual(1, self.store.getSummary()["evicted"])
+
+    def testPinned(self):
+        """Pinned blobs are kept until the pins are released"""
+        pinned = self.__add("pinned", "a" * 1000, age=300)
+        self.assertTrue(self.store.pin(pinned))
+        self.__add("b", "b" * 1000, age=200)
+        self.__add("c", "c" * 1000, age=100)
+        self.__add("new", "d" * 1000)
+        self.assertTrue(os.path.exists(pinned))
+        self.store.releasePins()
+        self.__add("newer", "e" * 1000)
+        self.assertFalse(os.path.exists(pinned))
+        self.assertFalse(self.store.pin(pinned))
+
+    def testStale(self):
+        """A source whose ETag has changed is detected as stale"""
+        self.__add("key", "data", {"etag": "\"1\"", "lastModified": "Mon"})
+        entry = self.store.getEntry("key")
+        self.assertFalse(self.store.isStale(entry, {"etag": "\"1\"", "lastModified": "Tue"}))
+        self.assertTrue(self.store.isStale(entry, {"etag": "\"2\""}))
+        self.assertTrue(self.store.isStale(entry, {"size": 5}))
+
+    def testStatsBatched(self):
+        """Counts are written to the stats file in batches, not per lookup"""
+        self.__add("key", "data")
+        self.store.lookup("key")
+        self.store.lookup("missing")
+        self.assertFalse(os.path.exists(os.path.join(self.dir, "cache", "stats")))
+        summary = self.store.getSummary()
+        self.assertEqual(1, summary["hits"])
+        self.assertEqual(1, summary["misses"])
+        self.assertTrue(os.path.exists(os.path.join(self.dir, "cache", "stats")))
+
+    def testFetchWaiterWakes(self):
+        """A process waiting for a fetch wakes as soon as the fetcher has finished"""
+        lock = self.store.lockFetch("key", 60)
+        woken = []
+        def wait():
+            self.store.waitForFetch("key", 60)
+            woken.append(time.time())
+        t = threading.Thread(target=wait)
+        t.start()
+        time.sleep(0.5)
+        self.assertEqual([], woken)
+        released = time.time()
+        lock.close()
+        t.join(30)
+        self.assertTrue(woken)
+        # Well before the fallback poll
+        self.assertTrue(woken[0] - released < CacheStore.FETCH_POLL / 2)
+
+    def testDeadFetcher(self):
+        """A fetch abandoned by a process that died is taken over"""
+        pid = os.fork()
+        if pid == 0:
+            self.store.lockFetch("key", 60)
+            os._exit(0)
+        os.waitpid(pid, 0)
+        started = time.time()
+        self.store.lockFetch("key", 60).close()
+        self.assertTrue(time.time() - started < 1)
+        # Nobody is fetching, so nothing to wait for
+        self.store.waitForFetch("other", 60)
@@ -0,0 +1,74 @@
+import BaseHTTPServer, json, os, re, shutil, tempfile, threading
+from xenrt.filemanager import FileManager
+from testing import XenRTUnitTestCase
+from mock import patch
+
+
+class _RangeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        data = self.server.data
+        m = re.match("bytes=(\d+)-(\d+)", self.headers.get("Range", ""))
+        if m:
+            (start, end) = (int(m.group(1)), int(m.group(2)) + 1)
+            self.send_response(206)
+        else:
+            (start, end) = (0, len(data))
+            self.send_response(200)
+        self.send_header("Content-Length", str(end - start))
+        self.end_headers()
+        self.wfile.write(data[start:end])
+        self.server.served += end - start
+
+    def log_message(self, *args):
+        pass
+
+
+class TestSegmentedFetch(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: default
+        self.dir = tempfile.mkdtemp()
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), _RangeHandler)
+        self.server.data = "".join([chr(i % 251) for i in range(300000)])
+        self.server.served = 0
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.setDaemon(True)
+        self.thread.start()
+        self.url = "http://127.0.0.1:%d/file.iso" % self.server.server_port
+        self.dest = os.path.join(self.dir, "file.iso")
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.tecPatcher.stop()
+        shutil.rmtree(self.dir)
+
+    @patch("xenrt.TempDirectory")
+    def testSegments(self, tempdir):
+        """A file fetched in segments matches the original"""
+        fm = FileManager()
+        fm.getSingleFileInSegments(self.url, self.dest, len(self.server.data), 3, 60)
+        self.assertEqual(self.server.data, open(self.dest).read())
+        self.assertEqual(len(self.server.data), self.server.served)
+        self.assertFalse(os.path.exists("%s.part" % self.dest))
+        self.assertFalse(os.path.exists("%s.segments" % self.dest))
+
+    @patch("xenrt.TempDirectory")
+    def testResume(self, tempdir):
+        """An interrupted fetch only fetches what it didn't already have"""
+        size = len(self.server.data)
+        f = open("%s.part" % self.dest, "wb")
+        f.write(self.server.data[:150000])
+        f.truncate(size)
+        f.close()
+        json.dump({"url": self.url, "size": size,
+                   "segments": [[0, 100000, 100000], [100000, 200000, 50000], [200000, size, 0]]},
+                  open("%s.segments" % self.dest, "w"))
+
+        fm = FileManager()
+        fm.getSingleFileInSegments(self.url, self.dest, size, 3, 60)
+        self.assertEqual(self.server.data, open(self.dest).read())
+        self.assertEqual(size - 150000, self.server.served)
@@ -0,0 +1,80 @@
+import os, shutil, sys, tempfile, threading
+from testing import XenRTUnitTestCase
+import xenrt
+import xenrt.lazyimport
+
+class TestLazyModules(XenRTUnitTestCase):
+
+    def test_exportedNames(self):
+        """The names listed for each lazily imported module are the ones it exports"""
+        for (module, names) in xenrt._lazyModules.items():
+            __import__("xenrt.%s" % (module))
+            m = sys.modules["xenrt.%s" % (module)]
+            self.assertEqual(sorted(names), sorted(getattr(m, "__all__", [])))
+            for n in names:
+                self.assertTrue(getattr(xenrt, n) is getattr(m, n))
+
+    def test_toolstackLibraries(self):
+        """Product libraries resolve from xenrt.lib"""
+        self.assertTrue(xenrt.lib.xenserver is sys.modules["xenrt.lib.xenserver"])
+        self.assertTrue(xenrt.productLib("xenserver") is xenrt.lib.xenserver)
+
+class TestLazyPackage(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.dir, "lazypkg"))
+        with open(os.path.join(self.dir, "lazypkg", "__init__.py"), "w") as f:
+            f.write("_count = 0\n"
+                    "def incr():\n"
+                    "    global _count\n"
+                    "    _count += 1\n"
+                    "def name():\n"
+                    "    return NAME\n"
+                    "NAME = 'package'\n")
+        with open(os.path.join(self.dir, "lazypkg", "sub.py"), "w") as f:
+            f.write("import time\n"
+                    "time.sleep(0.1)\n"
+                    "__all__ = ['Thing']\n"
+                    "class Thing(object): pass\n")
+        sys.path.insert(0, self.dir)
+        __import__("lazypkg")
+        self.pkg = xenrt.lazyimport.lazyPackage("lazypkg", {"sub": ["Thing"]})
+
+    def tearDown(self):
+        sys.path.remove(self.dir)
+        for m in ["lazypkg", "lazypkg.sub"]:
+            sys.modules.pop(m, None)
+        shutil.rmtree(self.dir)
+
+    def test_loadOnFirstUse(self):
+        """Submodules are imported when one of their names is first used"""
+        import lazypkg
+        self.assertTrue(lazypkg is self.pkg)
+        self.assertFalse(sys.modules.has_key("lazypkg.sub"))
+        self.assertTrue(lazypkg.Thing is sys.modules["lazypkg.sub"].Thing)
+        self.assertTrue(lazypkg.sub is sys.modules["lazypkg.sub"])
+        self.assertRaises(AttributeError, getattr, lazypkg, "Other")
+
+    def test_assignments(self):
+        """Assignments reach the package's own functions, and its private names are read from it"""
+        self.pkg.NAME = "patched"
+        self.assertEqual("patched", self.pkg.name())
+        self.pkg.incr()
+        self.pkg.incr()
+        self.assertEqual(2, self.pkg._count)
+
+    def test_concurrentLoad(self):
+        """Threads using a submodule while it is being loaded all get its names"""
+        results = []
+        def use():
+            try:
+                results.append(self.pkg.Thing)
+            except Exception, e:
+                results.append(e)
+        threads = [threading.Thread(target=use) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual([sys.modules["lazypkg.sub"].Thing] * 10, results)
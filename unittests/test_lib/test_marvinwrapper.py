@@ -0,0 +1,143 @@
+import threading, time
+import xenrt
+from xenrt.lib.cloud.marvinwrapper import AsyncJobTracker, MarvinApi
+from testing import XenRTUnitTestCase
+from mock import Mock, patch
+
+
+class _Job(object):
+    def __init__(self, jobid, jobstatus, jobresult=None):
+        self.jobid = jobid
+        self.jobstatus = jobstatus
+        self.jobresult = jobresult
+
+
+class _FakeManagementServer(object):
+    """Async jobs that complete a set time after they were started"""
+
+    def __init__(self):
+        self.jobs = {}
+        self.unlisted = set()
+        self.calls = {"listAsyncJobs": 0, "queryAsyncJobResult": 0}
+        self.lock = threading.Lock()
+
+    def start(self, jobid, duration, status=1, listed=True):
+        self.jobs[jobid] = (time.time() + duration, status)
+        if not listed:
+            self.unlisted.add(jobid)
+
+    def __job(self, jobid):
+        (done, status) = self.jobs[jobid]
+        if time.time() < done:
+            return _Job(jobid, 0)
+        return _Job(jobid, status, "result-%s" % jobid)
+
+    def listAsyncJobs(self, page, pagesize, **kwargs):
+        with self.lock:
+            self.calls["listAsyncJobs"] += 1
+        listed = [self.__job(j) for j in sorted(self.jobs.keys()) if j not in self.unlisted]
+        return listed[(page - 1) * pagesize:page * pagesize]
+
+    def queryAsyncJobResult(self, jobid):
+        with self.lock:
+            self.calls["queryAsyncJobResult"] += 1
+        return self.__job(jobid)
+
+
+class _FastTracker(AsyncJobTracker):
+    MIN_INTERVAL = 0.02
+    MAX_INTERVAL = 0.1
+
+
+class _PagedTracker(_FastTracker):
+    PAGESIZE = 4
+
+
+class TestAsyncJobTracker(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: default
+        self.ms = _FakeManagementServer()
+        self.tracker = _FastTracker(self.ms)
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+
+    def testManyJobs(self):
+        """Many jobs are polled for together"""
+        for i in range(30):
+            self.ms.start("job%d" % i, 0.05 + (i % 5) * 0.05)
+        futures = [self.tracker.track("job%d" % i) for i in range(30)]
+        self.assertEqual(["result-job%d" % i for i in range(30)], [f.result(10) for f in futures])
+        # Far fewer calls than polling each job in turn
+        self.assertTrue(self.ms.calls["listAsyncJobs"] < 30)
+        self.assertEqual(0, self.ms.calls["queryAsyncJobResult"])
+
+    def testFailedAndUnlisted(self):
+        """Failed jobs raise, and jobs missing from the list are queried"""
+        self.ms.start("bad", 0, status=2)
+        self.ms.start("hidden", 0.05, listed=False)
+        bad = self.tracker.track("bad")
+        hidden = self.tracker.track("hidden")
+        self.assertRaises(xenrt.XRTFailure, bad.result, 10)
+        self.assertEqual("result-hidden", hidden.result(10))
+        self.assertTrue(self.ms.calls["queryAsyncJobResult"] > 0)
+
+    def testPaged(self):
+        """Pages are read until all the jobs have been seen"""
+        tracker = _PagedTracker(self.ms)
+        for i in range(10):
+            self.ms.start("job%02d" % i, 0)
+        self.assertEqual("result-job01", tracker.track("job01").result(10))
+        self.assertEqual(1, self.ms.calls["listAsyncJobs"])
+        self.assertEqual("result-job09", tracker.track("job09").result(10))
+        self.assertEqual(4, self.ms.calls["listAsyncJobs"])
+        self.assertEqual(0, self.ms.calls["queryAsyncJobResult"])
+
+    def testTimeout(self):
+        """A job that doesn't complete in time raises an error"""
+        self.ms.start("slow", 3600)
+        f = self.tracker.track("slow", timeout=-1)
+        self.assertRaises(xenrt.XRTError, f.result, 10)
+
+
+class _PagedMarvinApi(MarvinApi):
+    PAGESIZE = 3
+
+    def __init__(self, cloudApi):
+        self.cloudApi = cloudApi
+
+
+class TestWaitForTemplates(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+        self.templates = []
+        for i in range(7):
+            t = Mock()
+            t.name = "template%d" % i
+            t.zoneid = "zone1"
+            t.isready = True
+            self.templates.append(t)
+        self.cloudApi = Mock()
+        self.cloudApi.listTemplates.side_effect = lambda page, pagesize, **kwargs: \
+            self.templates[(page - 1) * pagesize:page * pagesize]
+        self.marvin = _PagedMarvinApi(self.cloudApi)
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+
+    def testAllPagesRead(self):
+        """Templates on later pages of the listing are found"""
+        self.marvin.waitForTemplatesReady([("template1", "zone1"), ("template6", "zone1")])
+        self.assertEqual([1, 2, 3], [c[1]["page"] for c in self.cloudApi.listTemplates.call_args_list])
+
+    def testSingleTemplateFiltered(self):
+        """Waiting for one template asks for it by name and zone"""
+        self.marvin.waitForTemplateReady("template1", "zone1")
+        kwargs = self.cloudApi.listTemplates.call_args_list[0][1]
+        self.assertEqual("template1", kwargs["name"])
+        self.assertEqual("zone1", kwargs["zoneid"])
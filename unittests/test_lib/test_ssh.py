@@ -0,0 +1,413 @@
+import os, Queue, shutil, subprocess, tempfile, threading, time
+import paramiko
+import xenrt
+from xenrt.ssh import TransportPool, SSHAsyncCommand
+from testing import XenRTUnitTestCase
+from mock import Mock, patch
+
+
+class TestTransportPool(XenRTUnitTestCase):
+
+    KEY = ("10.0.0.1", 22, "root", "xenroot")
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        self.config = {"SSH_POOL_IDLE_TIMEOUT": "120",
+                       "SSH_POOL_MAX_CHANNELS": "2"}
+        tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: self.config.get(var, default)
+        self.connects = []
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+
+    def __connect(self):
+        trans = Mock()
+        trans.is_active.return_value = True
+        self.connects.append(trans)
+        return trans
+
+    def testTransportIsReused(self):
+        """A released transport is handed out again without a new handshake"""
+        pool = TransportPool()
+        (pt, reused) = pool.acquire(self.KEY, self.__connect)
+        self.assertFalse(reused)
+        pool.release(pt)
+        (pt2, reused) = pool.acquire(self.KEY, self.__connect)
+        self.assertTrue(reused)
+        self.assertEqual(pt, pt2)
+        self.assertEqual(1, len(self.connects))
+        stats = pool.getStats()["root@10.0.0.1:22"]
+        self.assertEqual(1, stats["hits"])
+        self.assertEqual(1, stats["handshakes"])
+
+    def testMaxChannels(self):
+        """A transport at its channel limit causes a new transport to be created"""
+        pool = TransportPool()
+        (pt1, _) = pool.acquire(self.KEY, self.__connect)
+        (pt2, _) = pool.acquire(self.KEY, self.__connect)
+        (pt3, _) = pool.acquire(self.KEY, self.__connect)
+        self.assertEqual(pt1, pt2)
+        self.assertNotEqual(pt1, pt3)
+        self.assertEqual(2, len(self.connects))
+
+    def testDeadTransportReplaced(self):
+        """A transport that has died is closed and replaced"""
+        pool = TransportPool()
+        (pt, _) = pool.acquire(self.KEY, self.__connect)
+        pool.release(pt)
+        pt.trans.is_active.return_value = False
+        (pt2, reused) = pool.acquire(self.KEY, self.__connect)
+        self.assertFalse(reused)
+        self.assertNotEqual(pt, pt2)
+        self.assertTrue(pt.trans.close.called)
+        self.assertEqual(1, pool.getStats()["root@10.0.0.1:22"]["reconnects"])
+
+    def testDiscardWaitsForOtherUsers(self):
+        """Discarding a shared transport only closes it once all users have released it"""
+        pool = TransportPool()
+        (pt, _) = pool.acquire(self.KEY, self.__connect)
+        pool.acquire(self.KEY, self.__connect)
+        pool.release(pt, discard=True)
+        self.assertFalse(pt.trans.close.called)
+        pool.release(pt)
+        self.assertTrue(pt.trans.close.called)
+        (pt2, reused) = pool.acquire(self.KEY, self.__connect)
+        self.assertFalse(reused)
+
+    def testIdleTransportEvicted(self):
+        """Transports idle for longer than the timeout are evicted"""
+        pool = TransportPool()
+        (pt, _) = pool.acquire(self.KEY, self.__connect)
+        pool.release(pt)
+        pt.lastUsed -= 200
+        pool.acquire(("10.0.0.2", 22, "root", "xenroot"), self.__connect)
+        self.assertTrue(pt.trans.close.called)
+        self.assertEqual(1, pool.getStats()["root@10.0.0.1:22"]["evictions"])
+
+    def testOpenTimeoutKeepsLiveTransport(self):
+        """A channel open that times out on a live transport leaves it open,
+        and the channel is closed if it opens later"""
+        pool = TransportPool()
+        (pt, _) = pool.acquire(self.KEY, self.__connect)
+        release = threading.Event()
+        chan = Mock()
+        def openSession():
+            release.wait(5)
+            return chan
+        pt.trans.open_session.side_effect = openSession
+        self.assertRaises(xenrt.XRTError, pool.openChannel, pt, 0.1)
+        self.assertFalse(pt.trans.close.called)
+        release.set()
+        deadline = time.time() + 5
+        while not chan.close.called and time.time() < deadline:
+            time.sleep(0.01)
+        self.assertTrue(chan.close.called)
+
+    def testOpenTimeoutClosesDeadTransport(self):
+        """A channel open that times out on a transport which doesn't answer
+        a keepalive closes the transport"""
+        pool = TransportPool()
+        (pt, _) = pool.acquire(self.KEY, self.__connect)
+        release = threading.Event()
+        pt.trans.open_session.side_effect = lambda: release.wait(5)
+        pt.trans.global_request.side_effect = lambda kind: release.wait(5)
+        try:
+            self.assertRaises(xenrt.XRTError, pool.openChannel, pt, 0.1)
+            self.assertTrue(pt.trans.close.called)
+        finally:
+            release.set()
+
+
+class _FakeChannel(object):
+    def __init__(self):
+        self.data = Queue.Queue()
+        self.status = None
+        self.status_event = threading.Event()
+
+    def settimeout(self, timeout):
+        pass
+
+    def set_combine_stderr(self, combine):
+        pass
+
+    def exec_command(self, command):
+        self.command = command
+
+    def recv(self, n):
+        return self.data.get(timeout=10)
+
+    def recv_exit_status(self):
+        return self.status
+
+    def finish(self, status, delay=0.2):
+        # As OpenSSH does, send the end of the output before the status
+        self.data.put("")
+        def sendStatus():
+            time.sleep(delay)
+            self.status = status
+            self.status_event.set()
+        threading.Thread(target=sendStatus).start()
+
+    def lose(self):
+        # paramiko's status once the channel closes without one
+        self.status = -1
+        self.status_event.set()
+        self.data.put("")
+
+
+class TestSSHAsyncCommand(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tec = self.tecPatcher.start()
+        self.tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: default
+        self.channel = _FakeChannel()
+        trans = Mock()
+        trans.open_session.return_value = self.channel
+        def connect(session, *args):
+            session.trans = trans
+        self.connectPatcher = patch("xenrt.ssh.SSHSession.connectGuarded", connect)
+        self.connectPatcher.start()
+        (fd, self.logfile) = tempfile.mkstemp()
+        os.close(fd)
+
+    def tearDown(self):
+        self.connectPatcher.stop()
+        self.tecPatcher.stop()
+        os.unlink(self.logfile)
+
+    def testOutputStreamed(self):
+        """Output is logged as it arrives, and the exit status is taken from the channel"""
+        cmd = SSHAsyncCommand("10.0.0.1", "echo one\necho two\n", logfile=self.logfile)
+        self.assertEqual("bash -c 'echo one\necho two\n' < /dev/null", self.channel.command)
+        self.channel.data.put("one\ntw")
+        self.assertEqual(None, cmd.wait(0.5))
+        self.assertFalse(cmd.poll())
+        self.assertEqual("one\ntw", open(self.logfile).read())
+        self.tec.return_value.log.assert_called_once_with("one\n")
+
+        self.channel.data.put("o\n")
+        self.channel.finish(3)
+        self.assertEqual(3, cmd.wait(10))
+        self.assertTrue(cmd.poll())
+        self.assertEqual("one\ntwo\n", cmd.getOutput())
+        self.assertEqual("one\ntwo\n", open(self.logfile).read())
+
+    def testChannelLost(self):
+        """A channel that closes without an exit status is reported as -1"""
+        cmd = SSHAsyncCommand("10.0.0.1", "reboot\n")
+        self.channel.lose()
+        self.assertEqual(-1, cmd.wait(10))
+
+    def testStatusAfterOutput(self):
+        """A status that arrives after the end of the output is waited for, within the timeout"""
+        cmd = SSHAsyncCommand("10.0.0.1", "true\n")
+        self.channel.finish(0, delay=1)
+        self.assertEqual(None, cmd.wait(0.2))
+        self.assertEqual(0, cmd.wait(10))
+
+
+class _LocalSFTPFile(object):
+    def __init__(self, f):
+        self.f = f
+
+    def readv(self, chunks):
+        for (offset, length) in chunks:
+            self.f.seek(offset)
+            yield self.f.read(length)
+
+    def read(self, n):
+        return self.f.read(n)
+
+    def write(self, data):
+        self.f.write(data)
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def chmod(self, mode):
+        os.chmod(self.f.name, mode)
+
+    def utime(self, times):
+        # The server has written everything sent before this
+        self.f.flush()
+        os.utime(self.f.name, times)
+
+    def close(self):
+        self.f.close()
+
+
+class _LocalSFTPClient(object):
+    """The parts of paramiko.SFTPClient used for tree copies, on the local
+    filesystem"""
+    def __init__(self, calls):
+        self.calls = calls
+
+    def __call(self, name):
+        self.calls.append((name, self))
+
+    def stat(self, path):
+        self.__call("stat")
+        return paramiko.SFTPAttributes.from_stat(os.stat(path))
+
+    def listdir_attr(self, path):
+        self.__call("listdir_attr")
+        return [paramiko.SFTPAttributes.from_stat(os.lstat(os.path.join(path, f)), f)
+                for f in os.listdir(path)]
+
+    def listdir(self, path="."):
+        return os.listdir(path)
+
+    def open(self, path, mode):
+        self.__call("open")
+        return _LocalSFTPFile(file(path, mode))
+
+    def mkdir(self, path, mode):
+        self.__call("mkdir")
+        try:
+            os.mkdir(path, mode)
+        except OSError, e:
+            raise IOError(str(e))
+
+    def chmod(self, path, mode):
+        os.chmod(path, mode)
+
+    def close(self):
+        pass
+
+
+class TestSFTPTreeCopy(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: default
+        self.calls = []
+        def connect(session, *args):
+            session.trans = Mock()
+        self.connectPatcher = patch("xenrt.ssh.SSHSession.connectGuarded", connect)
+        self.connectPatcher.start()
+        self.clientPatcher = patch("xenrt.ssh.SFTPSession._openClient",
+                                   lambda session: _LocalSFTPClient(self.calls))
+        self.clientPatcher.start()
+        self.dir = tempfile.mkdtemp()
+        src = os.path.join(self.dir, "src")
+        for d in ["a", "a/b", "c"]:
+            os.makedirs(os.path.join(src, d))
+        self.files = {"top.log": "x" * 10, "a/one.log": "y" * 100000,
+                      "a/b/two.log": "", "c/old.log": "z", "c/big.log": "w" * 5000}
+        for (f, data) in self.files.items():
+            fh = open(os.path.join(src, f), "w")
+            fh.write(data)
+            fh.close()
+        os.utime(os.path.join(src, "c/old.log"), (1000, 1000))
+        os.symlink("a/one.log", os.path.join(src, "link.log"))
+
+    def tearDown(self):
+        self.clientPatcher.stop()
+        self.connectPatcher.stop()
+        self.tecPatcher.stop()
+        shutil.rmtree(self.dir)
+
+    def __tree(self, root):
+        tree = {}
+        for (dirname, dirnames, filenames) in os.walk(root):
+            for f in filenames:
+                tree[os.path.relpath(os.path.join(dirname, f), root)] = open(os.path.join(dirname, f)).read()
+        return tree
+
+    def testCopyTreeFrom(self):
+        """Each directory is listed once, and files are fetched in parallel without being stat'd"""
+        sftp = xenrt.ssh.SFTPSession("10.0.0.1")
+        sftp.copyTreeFrom(os.path.join(self.dir, "src"), os.path.join(self.dir, "dest"),
+                          threshold=2000, sizethresh=1000 * 1000)
+        expected = dict(self.files)
+        del expected["c/old.log"]
+        expected["link.log"] = self.files["a/one.log"]
+        self.assertEqual(expected, self.__tree(os.path.join(self.dir, "dest")))
+        self.assertEqual(4, len([c for c in self.calls if c[0] == "listdir_attr"]))
+        # The root of the tree and the symlink
+        self.assertEqual(2, len([c for c in self.calls if c[0] == "stat"]))
+        self.assertTrue(len(set([c[1] for c in self.calls if c[0] == "open"])) > 1)
+
+    def testSizeThreshold(self):
+        """Files over the size threshold are skipped"""
+        sftp = xenrt.ssh.SFTPSession("10.0.0.1")
+        sftp.copyTreeFrom(os.path.join(self.dir, "src"), os.path.join(self.dir, "dest"),
+                          sizethresh=1000)
+        self.assertEqual(["a/b/two.log", "c/old.log", "top.log"],
+                         sorted(self.__tree(os.path.join(self.dir, "dest")).keys()))
+
+    def testCopyTreeTo(self):
+        """A tree copied to the target matches the original"""
+        sftp = xenrt.ssh.SFTPSession("10.0.0.1")
+        sftp.copyTreeTo(os.path.join(self.dir, "src"), os.path.join(self.dir, "dest"))
+        expected = dict(self.files)
+        expected["link.log"] = self.files["a/one.log"]
+        self.assertEqual(expected, self.__tree(os.path.join(self.dir, "dest")))
+        self.assertEqual(1000, os.stat(os.path.join(self.dir, "dest/c/old.log")).st_mtime)
+
+
+class _LocalCommand(object):
+    """Runs an SSH command on the local machine, with stderr combined with
+    stdout as SSHCommand does"""
+    def __init__(self, ip, command, **kwargs):
+        self.command = command
+
+    def read(self, retval="code", fh=None):
+        p = subprocess.Popen(["bash", "-c", self.command], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT)
+        while True:
+            data = p.stdout.read(4096)
+            if not data:
+                break
+            fh.write(data)
+        return p.wait()
+
+
+class TestTarLogsFrom(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+        self.commandPatcher = patch("xenrt.ssh.SSHCommand", _LocalCommand)
+        self.commandPatcher.start()
+        self.dir = tempfile.mkdtemp()
+        self.src = os.path.join(self.dir, "var/log")
+        os.makedirs(os.path.join(self.src, "xen/old"))
+        for (f, size) in [("messages", 100), ("xen/qemu.log", 10), ("xen/old/big.log", 5000),
+                          ("xen/old/old.log", 1), ("unwanted.log", 1)]:
+            fh = open(os.path.join(self.src, f), "w")
+            fh.write("x" * size)
+            fh.close()
+        os.utime(os.path.join(self.src, "xen/old/old.log"), (1000, 1000))
+        self.dest = os.path.join(self.dir, "dest")
+
+    def tearDown(self):
+        self.commandPatcher.stop()
+        self.tecPatcher.stop()
+        shutil.rmtree(self.dir)
+
+    def __files(self):
+        files = []
+        for (dirname, dirnames, filenames) in os.walk(self.dest):
+            files.extend([os.path.relpath(os.path.join(dirname, f), self.dest) for f in filenames])
+        return sorted(files)
+
+    def testLayout(self):
+        """Files and trees are extracted at dest/basename like copyLogsFrom"""
+        received = xenrt.ssh.tarLogsFrom("10.0.0.1",
+                                         [os.path.join(self.src, "messages"),
+                                          os.path.join(self.src, "xen/"),
+                                          os.path.join(self.src, "missing")],
+                                         self.dest)
+        self.assertEqual(["messages", "xen/old/big.log", "xen/old/old.log", "xen/qemu.log"], self.__files())
+        self.assertEqual(1000, os.stat(os.path.join(self.dest, "xen/old/old.log")).st_mtime)
+        self.assertTrue(received > 0)
+
+    def testFilters(self):
+        """Old and big files are left out"""
+        xenrt.ssh.tarLogsFrom("10.0.0.1", [os.path.join(self.src, "xen")], self.dest,
+                              threshold=time.time() - 3600, sizethresh=1000)
+        self.assertEqual(["xen/qemu.log"], self.__files())
@@ -1,6 +1,8 @@
 from testing import XenRTUnitTestCase
-from mock import Mock
+from mock import Mock, patch
+import json
 import xenrt
+from xenrt.lib.cloud.marvinwrapper import CloudApi
 
 
 class VMListDataDouble(object):
@@ -55,3 +57,70 @@ class testCloudStackResidentOn(XenRTUnitTestCase):
         cut = CloudStackDouble([])
         with self.assertRaises(IndexError):
             cut.instanceResidentOn(self.__instance)
+
+
+class JsonLoader(object):
+    """Turns parsed JSON into objects, as marvin's jsonHelper.jsonLoader does"""
+    def __init__(self, obj):
+        for (k, v) in obj.items():
+            if isinstance(v, dict):
+                v = JsonLoader(v)
+            elif isinstance(v, list) and v and isinstance(v[0], dict):
+                v = [JsonLoader(x) for x in v]
+            setattr(self, k, v)
+
+
+# The queryAsyncJobResult response for a completed deployVirtualMachine
+DEPLOY_JOB = """{"queryasyncjobresultresponse": {
+    "accountid": "0c0ac8d6-8b7f-11e4-9a1c-0e1f5b3e3c66",
+    "userid": "0c0b1c5e-8b7f-11e4-9a1c-0e1f5b3e3c66",
+    "cmd": "org.apache.cloudstack.api.command.admin.vm.DeployVMCmdByAdmin",
+    "jobstatus": 1, "jobprocstatus": 0, "jobresultcode": 0,
+    "jobresulttype": "object",
+    "jobresult": {"virtualmachine": {
+        "id": "4f3e1c2a-77b1-4d0e-9b52-1a6c2b7d9e01", "name": "xenrt-vm",
+        "displayname": "xenrt-vm", "account": "admin", "domain": "ROOT",
+        "state": "Stopped", "templatename": "CentOS 6.5", "hypervisor": "XenServer",
+        "nic": [{"id": "b1f0d1c3-2a4e-4f5b-8c6d-7e8f9a0b1c2d", "isdefault": true,
+                 "ipaddress": "10.1.1.23"}],
+        "tags": []}},
+    "jobinstancetype": "VirtualMachine",
+    "jobinstanceid": "4f3e1c2a-77b1-4d0e-9b52-1a6c2b7d9e01",
+    "created": "2015-01-12T10:31:40+0000",
+    "jobid": "9d2c2a0e-5f3b-4a7c-8e1d-0f6a5b4c3d21"}}"""
+
+
+class DeployCloudApiDouble(CloudApi):
+    """Starts the deploy job and reports it completed"""
+    def __init__(self):
+        super(DeployCloudApiDouble, self).__init__(None)
+        self.job = JsonLoader(json.loads(DEPLOY_JOB)["queryasyncjobresultresponse"])
+
+    def deployVirtualMachineAsync(self, **kwargs):
+        return self.job.jobid
+
+    def listAsyncJobs(self, **kwargs):
+        return [self.job]
+
+
+class DeployCloudStackDouble(xenrt.lib.cloud.toolstack.CloudStack):
+    def __init__(self):
+        self.marvin = Mock()
+        self.marvin.cloudApi = DeployCloudApiDouble()
+
+
+class testCloudStackDeployVirtualMachine(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+
+    def testIdIsReadFromTheJobResult(self):
+        """Given a completed deployVirtualMachine job
+        when the VM is deployed then expect the id of the VM in its jobresult"""
+        cut = DeployCloudStackDouble()
+        self.assertEqual("4f3e1c2a-77b1-4d0e-9b52-1a6c2b7d9e01",
+                         cut.deployVirtualMachine(name="xenrt-vm", startvm=False))
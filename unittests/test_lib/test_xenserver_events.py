@@ -0,0 +1,88 @@
+import threading
+import xenrt
+import xenrt.lib.xenserver
+from xenrt.lib.xenserver.events import VMEventWatcher, getVMEventWatcher, closeVMEventWatchers
+from testing import XenRTUnitTestCase
+from mock import Mock, patch
+
+
+class TestVMEventWatcher(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        tec = self.tecPatcher.start()
+        tec.return_value.lookup.side_effect = lambda var, default=None, boolean=False: \
+            {"VM_EVENT_WATCHER": True}.get(var, default)
+        self.record = {"uuid": "uuid-1", "power_state": "Halted", "domid": "-1",
+                       "allowed_operations": ["start"], "resident_on": "OpaqueRef:NULL"}
+        self.changed = threading.Event()
+        self.finished = threading.Event()
+        self.session = Mock()
+        setattr(self.session.xenapi.event, "from", Mock(side_effect=self.__eventFrom))
+        host = Mock()
+        host.getAPISession.return_value = self.session
+        self.watcher = VMEventWatcher(host)
+
+    def tearDown(self):
+        self.watcher.stop()
+        self.finished.set()
+        self.tecPatcher.stop()
+
+    def __eventFrom(self, classes, token, timeout):
+        if token == "":
+            return {"events": [{"operation": "add", "ref": "OpaqueRef:1",
+                                "snapshot": dict(self.record)}],
+                    "token": "1"}
+        if token == "1":
+            self.changed.wait()
+            record = dict(self.record, power_state="Running", domid="5")
+            return {"events": [{"operation": "mod", "ref": "OpaqueRef:1",
+                                "snapshot": record}],
+                    "token": "2"}
+        self.finished.wait()
+        return {"events": [], "token": token}
+
+    def testWaitForWakesOnEvent(self):
+        """waitFor returns once an event satisfies the predicate"""
+        self.session.xenapi.event.inject.side_effect = lambda cls, ref: self.changed.set()
+        self.watcher.start()
+        r = self.watcher.waitFor("uuid-1", lambda r: r["power_state"] == "Running", 10)
+        self.assertEqual(5, r["domid"])
+        self.assertEqual(2, self.watcher.getStats()["batches"])
+
+    def testWaitForTimesOut(self):
+        """waitFor returns None if the predicate never becomes true"""
+        self.watcher.start()
+        self.assertEqual(None, self.watcher.waitFor("uuid-1", lambda r: r["domid"] == 7, 0.5))
+
+    def testFailureWakesWaiters(self):
+        """A failed event loop raises in waitFor rather than leaving waiters blocked"""
+        setattr(self.session.xenapi.event, "from", Mock(side_effect=Exception("connection refused")))
+        self.watcher.start()
+        self.assertRaises(xenrt.XRTError, self.watcher.waitFor, "uuid-1", lambda r: True, 10)
+
+    def testQuerySessionReplacedAfterError(self):
+        """A query that fails on a broken session logs in again next time"""
+        broken = Mock()
+        broken.xenapi.VM.get_record.side_effect = IOError("connection reset")
+        self.watcher.host.getAPISession.side_effect = [broken, self.session]
+        self.session.xenapi.VM.get_record.return_value = self.record
+        self.assertRaises(IOError, self.watcher.current, "uuid-1")
+        self.assertTrue(broken.xenapi.session.logout.called)
+        self.assertEqual(-1, self.watcher.current("uuid-1")["domid"])
+
+    @patch("xenrt.lib.xenserver.events.VMEventWatcher.start")
+    def testOneWatcherPerPool(self, start):
+        """Hosts in the same pool share a single watcher"""
+        master = Mock(spec=xenrt.lib.xenserver.Host)
+        master.getIP.return_value = "10.0.0.1"
+        master.pool = None
+        slave = Mock(spec=xenrt.lib.xenserver.Host)
+        slave.pool = Mock()
+        slave.pool.master = master
+        try:
+            w = getVMEventWatcher(master)
+            self.assertEqual(w, getVMEventWatcher(slave))
+            self.assertEqual(1, start.call_count)
+        finally:
+            closeVMEventWatchers()
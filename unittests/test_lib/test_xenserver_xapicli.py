@@ -0,0 +1,118 @@
+import httplib, xmlrpclib
+from xenrt.lib.xenserver.xapicli import XenAPICLIEngine, RecordSnapshot
+from testing import XenRTUnitTestCase
+from mock import Mock, patch
+
+
+class TestXenAPICLIEngine(XenRTUnitTestCase):
+
+    VMS = {"OpaqueRef:1": {"uuid": "uuid-1",
+                           "name_label": "vm one",
+                           "power_state": "Running",
+                           "is_a_template": False,
+                           "is_a_snapshot": False,
+                           "resident_on": "OpaqueRef:h1",
+                           "other_config": {"a": "b"}},
+           "OpaqueRef:2": {"uuid": "uuid-2",
+                           "name_label": "vm two",
+                           "power_state": "Halted",
+                           "is_a_template": False,
+                           "is_a_snapshot": False,
+                           "resident_on": "OpaqueRef:NULL",
+                           "other_config": {}},
+           "OpaqueRef:3": {"uuid": "uuid-3",
+                           "name_label": "template",
+                           "power_state": "Halted",
+                           "is_a_template": True,
+                           "is_a_snapshot": False,
+                           "resident_on": "OpaqueRef:NULL",
+                           "other_config": {}}}
+
+    def setUp(self):
+        self.tecPatcher = patch("xenrt.TEC")
+        self.tecPatcher.start()
+        self.session = Mock()
+        self.session.xenapi.VM.get_all_records.return_value = self.VMS
+        self.session.xenapi.VM.get_all.return_value = ["OpaqueRef:3", "OpaqueRef:2", "OpaqueRef:1"]
+        self.session.xenapi.VM.get_by_uuid.side_effect = lambda u: [r for r in self.VMS.keys() if self.VMS[r]["uuid"] == u][0]
+        self.session.xenapi.VM.get_by_name_label.side_effect = lambda n: [r for r in self.VMS.keys() if self.VMS[r]["name_label"] == n]
+        self.session.xenapi.VM.get_record.side_effect = lambda r: self.VMS[r]
+        self.session.xenapi.VM.get_other_config.side_effect = lambda r: self.VMS[r]["other_config"]
+        self.session.xenapi.VM.get_resident_on.side_effect = lambda r: self.VMS[r]["resident_on"]
+        self.session.xenapi.host.get_uuid.return_value = "host-uuid"
+        host = Mock()
+        host.getAPISession.return_value = self.session
+        self.engine = XenAPICLIEngine(host)
+
+    def tearDown(self):
+        self.tecPatcher.stop()
+
+    def testMinimalList(self):
+        """vm-list --minimal excludes templates and matches filters"""
+        self.assertEqual(self.engine.execute("vm-list", minimal=True), "uuid-2,uuid-1")
+        self.assertEqual(self.engine.execute("vm-list", 'name-label="vm two" --minimal'), "uuid-2")
+        self.assertEqual(self.engine.execute("vm-list", "power-state=running params=resident-on", minimal=True),
+                         "host-uuid")
+        self.assertEqual(self.engine.execute("template-list", minimal=True), "uuid-3")
+        self.assertEqual(self.engine.execute("vm-list", "uuid=uuid-3", minimal=True), "")
+
+    def testParamGet(self):
+        """param-get renders values the way xe does"""
+        self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-1 param-name=other-config param-key=a"), "b")
+        self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-2 param-name=resident-on"),
+                         "<not in database>")
+
+    def testUntranslatable(self):
+        """Commands we cannot reproduce exactly are left to xe"""
+        self.assertEqual(self.engine.execute("vm-start", "uuid=uuid-1"), None)
+        self.assertEqual(self.engine.execute("vm-list", "params=name-label,uuid", minimal=True), None)
+        self.assertEqual(self.engine.execute("vm-list", "params=all"), None)
+        self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-1 param-name=networks"), None)
+        self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-1 param-name=other-config"), None)
+        self.assertEqual(self.engine.execute("vm-list", "params=other-config", minimal=True), None)
+        self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-1 param-name=other-config param-key=missing"), None)
+
+    def testConnectionErrors(self):
+        """HTTP level errors from the host are left to xe"""
+        for e in [xmlrpclib.ProtocolError("host", 502, "Bad Gateway", {}), httplib.BadStatusLine("")]:
+            self.session.xenapi.VM.get_by_uuid.side_effect = e
+            self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-1 param-name=name-label"), None)
+
+
+class TestRecordSnapshot(TestXenAPICLIEngine):
+
+    def setUp(self):
+        TestXenAPICLIEngine.setUp(self)
+        self.session.xenapi.host.get_all_records.return_value = {"OpaqueRef:h1": {"uuid": "host-uuid"}}
+        self.session.xenapi.host.get_all.return_value = ["OpaqueRef:h1"]
+        for cls in ("VBD", "VDI", "VIF", "SR", "network"):
+            getattr(self.session.xenapi, cls).get_all_records.return_value = {}
+            getattr(self.session.xenapi, cls).get_all.return_value = []
+        self.engine = RecordSnapshot(self.engine.host)
+        self.engine.refresh()
+        self.session.reset_mock()
+
+    def testNoCallsAfterRefresh(self):
+        """Reads are answered from the snapshot without any XenAPI calls"""
+        self.testMinimalList()
+        self.testParamGet()
+        self.assertEqual([], self.session.method_calls)
+
+    def testParameterList(self):
+        """parameterList renders each requested parameter"""
+        self.assertEqual(self.engine.parameterList("vm-list", ["name-label", "power-state"]),
+                         [{"name-label": "vm two", "power-state": "halted"},
+                          {"name-label": "vm one", "power-state": "running"}])
+        self.assertEqual(self.engine.parameterList("vm-list", ["resident-on"], "power-state=running"),
+                         [{"resident-on": "host-uuid"}])
+
+    def testConnectionErrors(self):
+        """Errors from the host don't reach reads answered from the snapshot"""
+        self.session.xenapi.VM.get_by_uuid.side_effect = xmlrpclib.ProtocolError("host", 502, "Bad Gateway", {})
+        self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-1 param-name=name-label"), "vm one")
+
+    def testUnknownObject(self):
+        """Objects created since the snapshot was taken are left to xe"""
+        self.assertEqual(self.engine.execute("vm-param-get", "uuid=uuid-new param-name=name-label"), None)
+        self.assertEqual(self.engine.execute("vm-list", "uuid=uuid-new", minimal=True), None)
+        self.assertEqual(self.engine.execute("pif-list", minimal=True), None)
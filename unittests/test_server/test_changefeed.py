@@ -0,0 +1,125 @@
+# Change feed unit tests
+from mock import Mock, patch
+from testing import XenRTUnitTestCase
+import app.changefeed
+from app.apiv2 import XenRTAPIv2Page
+
+class CursorTests(XenRTUnitTestCase):
+
+    def test_round_trip(self):
+        """Cursors decode to what they were made from"""
+        c = app.changefeed.encodeCursor("10:20:12,15")
+        self.assertEqual(("10:20:12,15", None, None), app.changefeed.decodeCursor(c))
+        c = app.changefeed.encodeCursor("30:31:", "10:20:12,15", (25, "m1"))
+        self.assertEqual(("10:20:12,15", "30:31:", (25, "m1")), app.changefeed.decodeCursor(c))
+
+    def test_invalid(self):
+        """Anything else is rejected before it gets to the database"""
+        for c in ["", "junk", "eyJzbmFwc2hvdCI6IjE7ZHJvcCJ9", app.changefeed.encodeCursor(5)]:
+            self.assertRaises(app.changefeed.CursorError, app.changefeed.decodeCursor, c)
+
+    def test_etag(self):
+        """If-None-Match is compared weakly"""
+        tag = app.changefeed.etag(5, 1234, 0)
+        for (header, match) in [(None, False), ('"5-1234-0"', True), ('"x", W/"5-1234-0"', True),
+                                ('"5-1234-1"', False), ("*", True)]:
+            request = Mock()
+            request.headers = header and {"If-None-Match": header} or {}
+            self.assertEqual(match, app.changefeed.etagMatches(request, tag))
+
+class ChangedKeysTests(XenRTUnitTestCase):
+
+    def test_query(self):
+        """Rows are paged by changeseq and key, with one extra row to tell whether there are more"""
+        cur = Mock()
+        cur.fetchall.return_value = [(21, "m1   "), (22, "m2   "), (22, "m3   ")]
+        (rows, more) = app.changefeed.changedKeys(cur, "tblmachines", "machine", "10:20:", (20, "m0"), 2, ["m1", "m2", "m3"])
+        self.assertEqual([(21, "m1"), (22, "m2")], rows)
+        self.assertTrue(more)
+        (query, params) = cur.execute.call_args[0]
+        self.assertTrue("(changeseq, machine) > (%s, %s)" in query)
+        self.assertTrue(query.endswith("ORDER BY changeseq, machine LIMIT %s"))
+        self.assertEqual(["10:20:", "10:20:", 20, "m0", "m1", "m2", "m3", 3], params)
+
+class AppliedTests(XenRTUnitTestCase):
+
+    def test_applied(self):
+        """The schema is checked until the column is there, then not again"""
+        cur = Mock()
+        cur.fetchone.return_value = None
+        with patch("app.changefeed._applied", set()):
+            self.assertFalse(app.changefeed.applied(cur, "tbljobs"))
+            cur.fetchone.return_value = (1,)
+            self.assertTrue(app.changefeed.applied(cur, "tbljobs"))
+            self.assertTrue(app.changefeed.applied(cur, "tbljobs"))
+        self.assertEqual(2, cur.execute.call_count)
+        self.assertEqual(["tbljobs"], cur.execute.call_args[0][1])
+
+class GetChangesTests(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.request = Mock()
+        self.request.params = {}
+        self.page = XenRTAPIv2Page(self.request)
+        self.page.getDB = Mock()
+        self.page.releaseDB = Mock()
+        self.snapshots = ["100:105:", "106:106:", "107:110:108"]
+        self.changes = []
+        self.snapshotPatcher = patch("app.changefeed.currentSnapshot")
+        self.snapshotPatcher.start().side_effect = lambda cur: self.snapshots.pop(0)
+        self.changedPatcher = patch("app.changefeed.changedKeys")
+        self.changed = self.changedPatcher.start()
+        self.changed.side_effect = lambda *args: self.changes.pop(0)
+        self.sleepPatcher = patch("time.sleep")
+        self.sleep = self.sleepPatcher.start()
+        self.fetch = Mock(side_effect=lambda keys: dict([(k, {"id": k}) for k in keys]))
+
+    def tearDown(self):
+        self.snapshotPatcher.stop()
+        self.changedPatcher.stop()
+        self.sleepPatcher.stop()
+
+    def get(self):
+        return self.page.getChanges("tbljobs", "jobid", "jobs", self.fetch)
+
+    def test_start(self):
+        """Without a cursor only the cursor to start from is returned"""
+        ret = self.get()
+        self.assertEqual({}, ret['jobs'])
+        self.assertEqual(("100:105:", None, None), app.changefeed.decodeCursor(ret['cursor']))
+        self.assertFalse(self.changed.called)
+
+    def test_paging(self):
+        """A partial reply's cursor continues from the last row, then the
+        feed carries on from the snapshot the first page was read with"""
+        self.request.params = {"cursor": app.changefeed.encodeCursor("90:95:"), "limit": "2"}
+        self.changes = [([(96, 1), (97, 2)], True), ([(98, 3)], False)]
+        ret = self.get()
+        self.assertEqual({1: {"id": 1}, 2: {"id": 2}}, ret['jobs'])
+        self.assertTrue(ret['more'])
+        self.assertEqual(("90:95:", "100:105:", (97, 2)), app.changefeed.decodeCursor(ret['cursor']))
+        self.request.params = {"cursor": ret['cursor'], "limit": "2"}
+        ret = self.get()
+        self.assertEqual([3], ret['jobs'].keys())
+        self.assertFalse(ret['more'])
+        self.assertEqual(("100:105:", None, None), app.changefeed.decodeCursor(ret['cursor']))
+        self.assertEqual(("tbljobs", "jobid", "90:95:", (97, 2), 2, []), self.changed.call_args[0][1:])
+
+    def test_long_poll(self):
+        """With wait the feed is polled, without holding a connection, until something changes"""
+        self.request.params = {"cursor": app.changefeed.encodeCursor("90:95:"), "wait": "30"}
+        self.changes = [([], False), ([], False), ([(107, 4)], False)]
+        ret = self.get()
+        self.assertEqual([4], ret['jobs'].keys())
+        self.assertEqual(2, self.page.releaseDB.call_count)
+        self.assertEqual(2, self.sleep.call_count)
+        self.assertEqual(("107:110:108", None, None), app.changefeed.decodeCursor(ret['cursor']))
+
+    def test_nothing_changed(self):
+        """Without wait an empty reply is returned straight away"""
+        self.request.params = {"cursor": app.changefeed.encodeCursor("90:95:")}
+        self.changes = [([], False)]
+        ret = self.get()
+        self.assertEqual({}, ret['jobs'])
+        self.assertFalse(self.fetch.called)
+        self.assertFalse(self.sleep.called)
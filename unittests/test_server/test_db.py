@@ -0,0 +1,73 @@
+# Database connection pool unit tests
+from mock import Mock, patch
+from testing import XenRTUnitTestCase
+import psycopg2.extensions
+import app.db
+
+class ConnectionPoolTests(XenRTUnitTestCase):
+
+    def setUp(self):
+        self.connectPatcher = patch("psycopg2.connect")
+        self.connect = self.connectPatcher.start()
+        self.connect.side_effect = self.newConnection
+        self.time = 1000.0
+        self.timePatcher = patch("time.time")
+        self.timePatcher.start().side_effect = lambda: self.time
+        self.pool = app.db.ConnectionPool("localhost:xenrt:user:pass", 2, 600, 30)
+
+    def tearDown(self):
+        self.connectPatcher.stop()
+        self.timePatcher.stop()
+
+    def newConnection(self, **kwargs):
+        conn = Mock()
+        conn.closed = 0
+        conn.get_transaction_status.return_value = psycopg2.extensions.TRANSACTION_STATUS_IDLE
+        return conn
+
+    def test_reuse_rolls_back(self):
+        """Returned connections are rolled back and handed out again"""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        conn.rollback.assert_called_once_with()
+        self.assertTrue(self.pool.get() is conn)
+        self.assertEqual(1, self.connect.call_count)
+        self.assertEqual(1, self.pool.getStats()["reuses"])
+
+    def test_failed_rollback_discards(self):
+        """A connection that can't be rolled back is closed, not pooled"""
+        conn = self.pool.get()
+        conn.rollback.side_effect = psycopg2.OperationalError
+        self.pool.put(conn)
+        conn.close.assert_called_once_with()
+        self.assertFalse(self.pool.get() is conn)
+
+    def test_max_age(self):
+        """Connections older than the maximum age are recycled"""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.time += 601
+        self.assertFalse(self.pool.get() is conn)
+        conn.close.assert_called_once_with()
+        self.assertEqual(1, self.pool.getStats()["recycled"])
+
+    def test_health_check(self):
+        """Connections idle for longer than the check interval are checked"""
+        conn = self.pool.get()
+        self.pool.put(conn)
+        self.time += 31
+        conn.cursor.return_value.execute.side_effect = psycopg2.OperationalError
+        self.assertFalse(self.pool.get() is conn)
+        stats = self.pool.getStats()
+        self.assertEqual(1, stats["checks"])
+        self.assertEqual(1, stats["check_failures"])
+
+    def test_max_idle(self):
+        """No more than the maximum number of idle connections are kept"""
+        conns = [self.pool.get() for i in range(3)]
+        for c in conns:
+            self.pool.put(c)
+        stats = self.pool.getStats()
+        self.assertEqual(2, stats["idle"])
+        self.assertEqual(1, stats["discarded"])
+        conns[2].close.assert_called_once_with()
@@ -0,0 +1,74 @@
+# Indexed log archive unit tests
+import os, shutil, tarfile, tempfile, time, StringIO
+from testing import XenRTUnitTestCase
+import app.logarchive
+
+class LogArchiveTests(XenRTUnitTestCase):
+
+    FILES = {"./xenrt.log": "line one\nline two\n" * 1000,
+             "./host/messages": "",
+             "./host/SMlog": "".join(["%d\n" % i for i in range(100000)])}
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.tarfn = os.path.join(self.dir, "job00000001")
+        tar = tarfile.open(self.tarfn, "w:bz2")
+        for (name, data) in sorted(self.FILES.items()):
+            info = tarfile.TarInfo(name)
+            info.size = len(data)
+            tar.addfile(info, StringIO.StringIO(data))
+        info = tarfile.TarInfo("./host/latest.log")
+        info.type = tarfile.SYMTYPE
+        info.linkname = "SMlog"
+        tar.addfile(info)
+        tar.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_members_round_trip(self):
+        """Every member reads back the same as from the tarball"""
+        app.logarchive.convert(self.tarfn)
+        archive = app.logarchive.openArchive(self.tarfn)
+        self.assertEqual(sorted([("host/SMlog", len(self.FILES["./host/SMlog"])),
+                                 ("host/latest.log", len(self.FILES["./host/SMlog"])),
+                                 ("host/messages", 0),
+                                 ("xenrt.log", len(self.FILES["./xenrt.log"]))]),
+                         sorted(archive.listing()))
+        for (name, data) in self.FILES.items():
+            self.assertEqual(data, archive.open(name).read())
+        self.assertEqual(self.FILES["./host/SMlog"], archive.open("./host/latest.log").read())
+        self.assertEqual(None, archive.open("./missing"))
+
+    def test_readline(self):
+        """Members can be read a line at a time"""
+        app.logarchive.convert(self.tarfn)
+        f = app.logarchive.openArchive(self.tarfn).open("./xenrt.log")
+        self.assertEqual("line one\n", f.readline())
+        self.assertEqual("line", f.read(4))
+        self.assertEqual(1999, len(f.readlines()))
+        self.assertEqual("", f.readline())
+
+    def test_stale_archive_ignored(self):
+        """An archive older than its tarball is not used"""
+        app.logarchive.convert(self.tarfn)
+        past = time.time() - 60
+        os.utime(app.logarchive.archivePath(self.tarfn), (past, past))
+        self.assertEqual(None, app.logarchive.openArchive(self.tarfn))
+
+    def test_reuploaded_tarball(self):
+        """An archive made from an earlier upload of the tarball is not used"""
+        app.logarchive.convert(self.tarfn)
+        future = time.time() + 60
+        os.utime(self.tarfn, (future, future))
+        self.assertEqual(None, app.logarchive.openArchive(self.tarfn))
+        app.logarchive.convert(self.tarfn)
+        self.assertNotEqual(None, app.logarchive.openArchive(self.tarfn))
+
+    def test_incomplete_archive_ignored(self):
+        """A truncated archive is not used"""
+        app.logarchive.convert(self.tarfn)
+        path = app.logarchive.archivePath(self.tarfn)
+        data = open(path).read()
+        open(path, "w").write(data[:-4])
+        self.assertEqual(None, app.logarchive.openArchive(self.tarfn))
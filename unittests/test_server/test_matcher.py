@@ -0,0 +1,71 @@
+# Scheduler machine matcher unit tests
+import random, string
+from testing import XenRTUnitTestCase
+import app.utils
+import app.matcher
+
+FLAGS = ["a", "b", "c", "+m", "-b", "shortonly", ""]
+REQFLAGS = ["a", "b", "c", "m", "~m", "!a", "!", ""]
+RESOURCES = ["", "memory=4G", "memory=8G/cores=4", "cores=8/memory=16G",
+             "disk=100G", "bad resource", "'memory=2G'"]
+REQRESOURCES = ["memory>=4G", "memory<8G", "cores>4/memory>=8G", "disk>0",
+                "cores<4", "'memory=8G'", "invalid"]
+
+def oldMatch(m, props, jobpool, clusterreq, resreq, flags, shortjob):
+    """The per-machine checks scm_select_machines used to make"""
+    subpool = m[3] or "DEFAULT"
+    if not subpool in jobpool and not "ANY" in jobpool:
+        return False
+    if clusterreq and m[2] not in clusterreq:
+        return False
+    if resreq:
+        if m[5] == "" or not app.utils.check_resources(m[5], resreq):
+            return False
+    if not app.utils.check_attributes(props, flags):
+        return False
+    if "shortonly" in string.split(props, ",") and not shortjob:
+        return False
+    return True
+
+class MachineIndexTests(XenRTUnitTestCase):
+
+    def setUp(self):
+        rand = random.Random(42)
+        self.machines = {}
+        self.props = {}
+        for i in range(300):
+            name = "m%03d" % i
+            flags = string.join(rand.sample(FLAGS, rand.randint(0, 3)), ",")
+            self.machines[name] = [name, "site%d" % (i % 2), "c%d" % (i % 3),
+                                   rand.choice(["", "DEFAULT", "VMX"]), "idle",
+                                   rand.choice(RESOURCES), flags, "", "", "", "",
+                                   "", "", "3"]
+            self.props[name] = flags
+        self.siteprops = {"site0": "a", "site1": None}
+        self.index = app.matcher.MachineIndex(self.machines, self.props, self.siteprops)
+        self.rand = rand
+
+    def test_candidates_match_per_machine_checks(self):
+        """candidates gives the same answer as checking each machine in turn"""
+        for i in range(200):
+            jobpool = self.rand.choice([["DEFAULT"], ["VMX"], ["ANY"], ["DEFAULT", "VMX"]])
+            clusterreq = self.rand.choice([None, ["c0"], ["c1", "c2"]])
+            resreq = self.rand.choice([None] + REQRESOURCES)
+            flags = self.rand.choice([None, string.join(self.rand.sample(REQFLAGS, 2), ",")])
+            shortjob = self.rand.choice([True, False])
+            expected = set()
+            for m in self.machines.values():
+                props = self.props[m[0]]
+                if self.siteprops[m[1]]:
+                    props = props + "," + self.siteprops[m[1]]
+                if oldMatch(m, props, jobpool, clusterreq, resreq, flags, shortjob):
+                    expected.add(m[0])
+            self.assertEqual(expected, self.index.candidates(jobpool, clusterreq, resreq, flags, shortjob),
+                             "Mismatch for %s" % str((jobpool, clusterreq, resreq, flags, shortjob)))
+
+    def test_candidates_cached(self):
+        """Repeated requirements are answered from the cache"""
+        a = self.index.candidates(["DEFAULT"], None, "memory>=4G", "a", False)
+        b = self.index.candidates(["DEFAULT"], None, "memory>=4G", "a", False)
+        self.assertTrue(a is b)
+        self.assertEqual({"queries": 2, "hits": 1}, self.index.stats)
@@ -0,0 +1,30 @@
+# Server utility unit tests
+from mock import Mock
+from testing import XenRTUnitTestCase
+import app.utils
+
+class GetJobsTests(XenRTUnitTestCase):
+
+    JOBS = [(1, "trunk", "r1", None, "new", "user1", "", "", False),
+            (2, "trunk", "r2", "opt", "running", "user2", "", "", True)]
+    DETAILS = [(1, "JOBPRIO", "2"), (1, "MACHINES_REQUIRED", " 3 "),
+               (1, "EMPTY", " "), (2, "SITE", "site1")]
+
+    def setUp(self):
+        self.cur = Mock()
+        self.cur.fetchall.side_effect = [self.JOBS, self.DETAILS, [(2, 1)]]
+
+    def test_get_jobs_matches_parse_job(self):
+        """get_jobs builds the same dictionaries as parse_job"""
+        jobs = app.utils.get_jobs(self.cur, [1, 2])
+        self.assertEqual({"JOBID": "1", "VERSION": "trunk", "REVISION": "r1",
+                          "JOBSTATUS": "new", "USERID": "user1", "JOBPRIO": "2",
+                          "MACHINES_REQUIRED": "3", "PAUSED": "no"}, jobs[1])
+        self.assertEqual({"JOBID": "2", "VERSION": "trunk", "REVISION": "r2",
+                          "OPTIONS": "opt", "JOBSTATUS": "running", "USERID": "user2",
+                          "PREEMPTABLE": "yes", "SITE": "site1", "PAUSED": "yes"}, jobs[2])
+
+    def test_get_jobs_query_count(self):
+        """get_jobs runs a fixed number of queries regardless of the number of jobs"""
+        app.utils.get_jobs(self.cur, [1, 2])
+        self.assertEqual(3, self.cur.execute.call_count)
@@ -0,0 +1,74 @@
+#!/usr/bin/python
+#
+# Replay bursts of DHCP traffic against the XenRT allocator, as when a rack
+# of hosts PXE boots at once, and report how long each packet took.
+#
+# Run against a scratch database (set "dbdsn" in the global section of the
+# config) with each interface's range configured, e.g. on "lo":
+#
+#   loadtest.py --config loadtest.cfg --hosts 200 --bursts 5
+#
+# Each interface is handled by its own thread, as xenrtdhcpd does. Every
+# host sends a DISCOVER and then a REQUEST, which renews the lease it was
+# offered.
+
+import optparse, threading, time, logging
+
+import xenrtallocator
+from libpydhcpserver.dhcp_types.mac import MAC
+from libpydhcpserver.dhcp_types.packet import DHCPPacket
+
+DISCOVER = 1
+REQUEST = 3
+
+def makePacket(mac, msgtype):
+    packet = DHCPPacket()
+    packet.setOption(53, [msgtype])
+    packet.setHardwareAddress(list(MAC(mac)))
+    return packet
+
+def replay(allocator, intf, macs, timings, failures):
+    for msgtype in (DISCOVER, REQUEST):
+        for mac in macs:
+            started = time.time()
+            ret = allocator.getResponse(intf, MAC(mac), makePacket(mac, msgtype))
+            timings.append(time.time() - started)
+            if not ret:
+                failures.append(mac)
+
+def percentile(values, p):
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("--config", dest="config", help="allocator configuration file")
+    parser.add_option("--hosts", dest="hosts", type="int", default=100,
+                      help="hosts booting on each interface in a burst")
+    parser.add_option("--bursts", dest="bursts", type="int", default=3)
+    parser.add_option("--verbose", dest="verbose", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+    if not options.config:
+        parser.error("--config is required")
+    logging.basicConfig(level=options.verbose and logging.INFO or logging.WARNING)
+
+    allocator = xenrtallocator.XenRTDHCPAllocator(options.config, xmlrpc=False)
+    interfaces = allocator.config['interfaces'].keys()
+    for burst in range(options.bursts):
+        # Xen OUI, so none are treated as CloudStack MACs
+        macs = dict([(i, ["00:16:3e:%02x:%02x:%02x" % (burst % 256, n // 256, n % 256)
+                          for n in range(options.hosts)]) for i in interfaces])
+        timings = []
+        failures = []
+        threads = [threading.Thread(target=replay, args=(allocator, i, macs[i], timings, failures))
+                   for i in interfaces]
+        started = time.time()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        elapsed = time.time() - started
+        timings.sort()
+        print "Burst %d: %d packets in %.2fs (%.0f/s), mean %.1fms, p95 %.1fms, max %.1fms, %d without a lease" % (
+            burst, len(timings), elapsed, len(timings) / elapsed,
+            1000 * sum(timings) / len(timings), 1000 * percentile(timings, 95),
+            1000 * timings[-1], len(failures))